@@ -0,0 +1,255 @@
+#!/usr/bin/python
+"""
+Simulates a rate limited account spread over several proxies, to compare
+the per-request memcache rate limiting with the local buckets that
+sync_interval turns on.
+
+Each proxy is a RateLimitMiddleware sharing one counting fake memcache.
+Requests arrive as a Poisson stream on a simulated clock and are handed to
+the proxies at random; every request a proxy would let through is counted
+at the time it would leave its sleep.  The first 10 and last 5 simulated
+seconds are left out of the figures.
+
+This is what it printed for the defaults:
+
+limit 100/s, offered 300/s, 60s
+proxies      sync    mean/s  worst 1s  worst 100ms   memcache/req
+      1   per-req     100.0       101        110/s        1.635
+      1       0.1     100.0       101        110/s        0.033
+      1       0.5     100.0       101        110/s        0.007
+      1       1.0     100.0       101        110/s        0.003
+      4   per-req     100.0       101        110/s        1.635
+      4       0.1      99.6       101        130/s        0.119
+      4       0.5     100.2       102        120/s        0.026
+      4       1.0     100.6       105        120/s        0.013
+     16   per-req     100.0       101        110/s        1.635
+     16       0.1      97.5       102        160/s        0.351
+     16       0.5      99.8       103        160/s        0.098
+     16       1.0     100.4       105        160/s        0.051
+
+skewed / light load, limit 100/s, 8 proxies
+  load   skew      sync   mean/s    avg sleep
+   3.0   0.70   per-req    100.0      4.986s
+   3.0   0.70       0.1     98.9      4.962s
+   3.0   0.70       1.0    100.9      4.960s
+   0.5   0.12   per-req     49.8      0.000s
+   0.5   0.12       0.1     50.0      0.003s
+   0.5   0.12       1.0     49.8      0.002s
+   0.5   0.70   per-req     49.8      0.000s
+   0.5   0.70       0.1     49.8      0.006s
+   0.5   0.70       1.0     49.8      0.005s
+   0.9   0.70   per-req     91.9      0.001s
+   0.9   0.70       0.1     91.6      0.053s
+   0.9   0.70       1.0     92.0      0.082s
+"""
+
+import __builtin__
+import os
+import random
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+__builtin__._ = lambda s: s
+
+from swift.common.middleware import ratelimit
+
+
+KEY = 'ratelimit/a'
+
+
+class Clock(object):
+    """
+    Simulated time, stood in for time.time in the ratelimit module.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingMemcache(object):
+    """
+    Just enough of MemcacheRing for the middleware, counting its calls.
+    """
+
+    def __init__(self):
+        self.store = {}
+        self.ops = 0
+
+    def get(self, key):
+        self.ops += 1
+        return self.store.get(key)
+
+    def set(self, key, value, serialize=False, timeout=0):
+        self.ops += 1
+        self.store[key] = value
+        return True
+
+    def incr(self, key, delta=1, timeout=0):
+        self.ops += 1
+        self.store[key] = int(self.store.get(key, 0)) + int(delta)
+        if self.store[key] < 0:
+            self.store[key] = 0
+        return self.store[key]
+
+    def decr(self, key, delta=1, timeout=0):
+        return self.incr(key, delta=-delta, timeout=timeout)
+
+
+class NullLogger(object):
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class inline_spawn_n(object):
+    """
+    Runs what the middleware would spawn straight away, as there is no hub
+    turning in simulated time.
+    """
+
+    def spawn_n(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+def make_proxies(nproxies, sync_interval, memcache):
+    proxies = []
+    for _junk in xrange(nproxies):
+        proxy = ratelimit.RateLimitMiddleware(
+            None, {'sync_interval': sync_interval,
+                   'max_sleep_time_seconds': 5},
+            logger=NullLogger())
+        proxy.memcache_client = memcache
+        proxies.append(proxy)
+    return proxies
+
+
+def run(clock, nproxies, sync_interval, rate, load, duration, seed,
+        weights=None):
+    """
+    Offers rate * load requests a second for duration seconds.
+
+    :returns: (admission times, sleeps after the warm up, requests offered,
+               memcache calls)
+    """
+    random.seed(seed)
+    memcache = CountingMemcache()
+    proxies = make_proxies(nproxies, sync_interval, memcache)
+    admitted = []
+    sleeps = []
+    offered = 0
+    clock.now = 0.0
+    while clock.now < duration:
+        clock.now += random.expovariate(rate * load)
+        offered += 1
+        if weights:
+            proxy = proxies[pick(weights)]
+        else:
+            proxy = random.choice(proxies)
+        try:
+            sleep = proxy._get_sleep_time(KEY, rate)
+        except ratelimit.MaxSleepTimeHitError:
+            continue
+        admitted.append(clock.now + sleep)
+        if clock.now > 10:
+            sleeps.append(sleep)
+    return admitted, sleeps, offered, memcache.ops
+
+
+def pick(weights):
+    r = random.random()
+    i = 0
+    while r > weights[i] and i < len(weights) - 1:
+        r -= weights[i]
+        i += 1
+    return i
+
+
+def accuracy(clock, nproxies, sync_interval, rate, load, duration):
+    """
+    :returns: (mean rate let through, busiest second, busiest 100ms as a
+               rate, memcache calls per request)
+    """
+    admitted, _junk, offered, ops = run(clock, nproxies, sync_interval,
+                                        rate, load, duration, 1)
+    admitted = sorted(a for a in admitted if 10 <= a < duration - 5)
+    span = duration - 15
+    seconds = [0] * int(span)
+    for a in admitted:
+        seconds[int(a - 10)] += 1
+    burst = 0
+    start = 0
+    for i in xrange(len(admitted)):
+        while admitted[i] - admitted[start] >= 0.1:
+            start += 1
+        burst = max(burst, i - start + 1)
+    return (len(admitted) / float(span), max(seconds), burst * 10,
+            float(ops) / offered)
+
+
+def skewed(clock, nproxies, sync_interval, rate, load, skew, duration):
+    """
+    Like accuracy, but with skew of the requests going to the first proxy.
+
+    :returns: (mean rate let through, average sleep)
+    """
+    weights = [skew] + [(1 - skew) / (nproxies - 1)] * (nproxies - 1)
+    admitted, sleeps, _junk, _junk = run(clock, nproxies, sync_interval,
+                                         rate, load, duration, 2, weights)
+    admitted = [a for a in admitted if 10 <= a < duration - 5]
+    return (len(admitted) / (duration - 15.0),
+            sum(sleeps) / max(len(sleeps), 1))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--rate', type='float', default=100.0,
+                      help='rate limit in requests per second')
+    parser.add_option('-l', '--load', type='float', default=3.0,
+                      help='requests offered, as a multiple of the rate')
+    parser.add_option('-d', '--duration', type='int', default=60,
+                      help='simulated seconds per run')
+    parser.add_option('-p', '--proxies', default='1,4,16',
+                      help='comma separated numbers of proxies to try')
+    parser.add_option('-s', '--sync-intervals', default='0,0.1,0.5,1.0',
+                      help='comma separated sync_intervals to try, 0 being '
+                      'the per-request memcache limiting')
+    options, args = parser.parse_args()
+    proxy_counts = [int(p) for p in options.proxies.split(',')]
+    intervals = [float(s) for s in options.sync_intervals.split(',')]
+
+    clock = Clock()
+    ratelimit.time.time = clock
+    ratelimit.eventlet = inline_spawn_n()
+
+    print 'limit %g/s, offered %g/s, %ds' % (
+        options.rate, options.rate * options.load, options.duration)
+    print '%7s %9s %9s %9s %12s %14s' % (
+        'proxies', 'sync', 'mean/s', 'worst 1s', 'worst 100ms',
+        'memcache/req')
+    for nproxies in proxy_counts:
+        for interval in intervals:
+            mean, second, burst, ops = accuracy(
+                clock, nproxies, interval, options.rate, options.load,
+                options.duration)
+            print '%7d %9s %9.1f %9d %10d/s %12.3f' % (
+                nproxies, interval or 'per-req', mean, second, burst, ops)
+
+    print
+    print 'skewed / light load, limit %g/s, 8 proxies' % options.rate
+    print '%6s %6s %9s %8s %12s' % ('load', 'skew', 'sync', 'mean/s',
+                                    'avg sleep')
+    for load, skew in ((3.0, 0.7), (0.5, 1.0 / 8), (0.5, 0.7), (0.9, 0.7)):
+        for interval in (0, 0.1, 1.0):
+            mean, sleep = skewed(clock, 8, interval, options.rate, load,
+                                 skew, options.duration)
+            print '%6s %6.2f %9s %8.1f %10.3fs' % (
+                load, skew, interval or 'per-req', mean, sleep)
+
+
+if __name__ == '__main__':
+    main()
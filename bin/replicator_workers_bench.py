@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""
+Times object replication passes with different replicator_workers settings,
+to see how a pass scales with the processes it is spread over.
+
+Every partition of a one replica ring lives on one of a number of local
+devices, so a pass is all local work: walking the devices and hashing every
+suffix of every partition from scratch, as the saved hashes and listings are
+removed before each pass.  Each setting gets a number of passes and the
+fastest counts; the speedup is against replicator_workers = 0.
+
+These are three runs of the defaults on the box the option was written on,
+which has a single core:
+
+cores 1, 4 devices x 128 partitions x 50 objects
+workers   best pass   speedup  partitions  suffixes
+      0       3.13s      1.00         512     25443
+      2       3.45s      0.91         512     25443
+      4       4.26s      0.74         512     25443
+
+      0       4.31s      1.00         512     25443
+      2       4.35s      0.99         512     25443
+      4       5.40s      0.80         512     25443
+
+      0       6.75s      1.00         512     25443
+      2       6.48s      1.04         512     25443
+      4       6.60s      1.02         512     25443
+
+With one core the workers can only add the cost of forking, so these
+figures say nothing about scaling.  replicator_workers stays off by default
+until this has been run on a node with as many cores as devices.
+"""
+
+import __builtin__
+import multiprocessing
+import os
+import sys
+import time
+from array import array
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+__builtin__._ = lambda s: s
+
+from swift.common import utils
+from swift.common.ring import RingData
+from swift.common.utils import normalize_timestamp
+from swift.obj import replicator, server
+
+
+class NullLogger(object):
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def build(devices_dir, swift_dir, ndevices, partitions, objects):
+    """
+    Writes a one replica ring dealing the partitions out to the devices,
+    and fills every partition with objects.
+    """
+    devs = [{'id': i, 'ip': '127.0.0.1', 'port': 6000, 'zone': i,
+             'device': 'sd%s' % chr(ord('a') + i), 'weight': 1}
+            for i in xrange(ndevices)]
+    part2dev = array('H', [part % ndevices for part in xrange(partitions)])
+    part_power = max(partitions - 1, 1).bit_length()
+    part2dev.extend([0] * (2 ** part_power - partitions))
+    RingData([part2dev], devs, 32 - part_power).save(
+        os.path.join(swift_dir, 'object.ring.gz'))
+    for part in xrange(partitions):
+        device = devs[part % ndevices]['device']
+        for i in xrange(objects):
+            df = server.DiskFile(devices_dir, device, str(part), 'a', 'c',
+                                 'o%d-%d' % (part, i), NullLogger())
+            with df.mkstemp() as fd:
+                df.put(fd, {'X-Timestamp': normalize_timestamp(time.time()),
+                            'Content-Length': '0'})
+
+
+def forget_hashes(devices_dir):
+    for path, dirs, files in os.walk(devices_dir):
+        for name in files:
+            if name in (replicator.HASH_FILE, replicator.HASH_JOURNAL) or \
+                    name.endswith(replicator.LISTING_EXT):
+                os.unlink(os.path.join(path, name))
+
+
+def run_pass(devices_dir, swift_dir, workers):
+    """
+    :returns: (seconds, partitions replicated, suffixes hashed)
+    """
+    forget_hashes(devices_dir)
+    repl = replicator.ObjectReplicator({
+        'devices': devices_dir, 'mount_check': 'false',
+        'swift_dir': swift_dir, 'recon_cache_path': swift_dir,
+        'replicator_workers': workers})
+    repl.logger = NullLogger()
+    start = time.time()
+    repl.replicate()
+    return time.time() - start, repl.replication_count, repl.suffix_hash
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--devices', type='int', default=4,
+                      help='number of local devices')
+    parser.add_option('-p', '--partitions', type='int', default=512,
+                      help='number of partitions, dealt out to the devices')
+    parser.add_option('-n', '--objects', type='int', default=50,
+                      help='number of objects per partition')
+    parser.add_option('-w', '--workers', default='0,2,4',
+                      help='comma separated replicator_workers to try')
+    parser.add_option('-r', '--runs', type='int', default=3,
+                      help='passes per setting, of which the fastest counts')
+    parser.add_option('--dir', default=None,
+                      help='where to build the devices (on the file system '
+                      'under test); a temporary dir by default')
+    options, args = parser.parse_args()
+    workers = [int(w) for w in options.workers.split(',')]
+
+    if not utils.HASH_PATH_SUFFIX and not utils.HASH_PATH_PREFIX:
+        utils.HASH_PATH_SUFFIX = 'bench'
+    tmp = mkdtemp(dir=options.dir)
+    try:
+        devices_dir = os.path.join(tmp, 'node')
+        swift_dir = os.path.join(tmp, 'swift')
+        os.mkdir(devices_dir)
+        os.mkdir(swift_dir)
+        build(devices_dir, swift_dir, options.devices, options.partitions,
+              options.objects)
+
+        print 'cores %d, %d devices x %d partitions x %d objects' % (
+            multiprocessing.cpu_count(), options.devices,
+            options.partitions / options.devices, options.objects)
+        print '%7s %11s %9s %11s %9s' % (
+            'workers', 'best pass', 'speedup', 'partitions', 'suffixes')
+        base = None
+        for count in workers:
+            best, parts, suffixes = min(
+                run_pass(devices_dir, swift_dir, count)
+                for _junk in xrange(options.runs))
+            base = base or best
+            print '%7d %10.2fs %9.2f %11d %9d' % (
+                count, best, base / best, parts, suffixes)
+    finally:
+        rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
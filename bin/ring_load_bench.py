@@ -0,0 +1,151 @@
+#!/usr/bin/python
+"""
+Times RingData.load() of the same ring saved in format version 1 (gzipped)
+and 2 (uncompressed, mapped), and measures the memory a number of workers
+that have each loaded the ring take up for it.
+
+The ring has random partition assignments over a number of devices.  Each
+worker is a child process that loads the ring and reads every entry of its
+tables, as lookups of every partition would.  Its PSS is read from
+/proc/<pid>/smaps_rollup before and after.  PSS splits the pages that a
+number of processes share between them, so the growth summed over the
+workers is what they take up together.
+
+This is what it printed on a single core ext4 box with a warm page cache,
+for the defaults and with -w 8:
+
+part_power 20, 3 replicas, 4 workers
+format  file MB  load s (best)  PSS/worker MB  PSS total MB
+1           4.0         0.0320           11.3          45.4
+2           6.0         0.0006            2.2           8.8
+
+part_power 20, 3 replicas, 8 workers
+format  file MB  load s (best)  PSS/worker MB  PSS total MB
+1           4.0         0.0320           12.6         100.7
+2           6.0         0.0006            1.5          11.6
+
+Each worker of a version 1 ring holds its own copy of the 6MB of tables and
+more for loading them.  The workers of a version 2 ring share one copy in
+the page cache, so what they take up together hardly grows with their
+number.
+"""
+
+import __builtin__
+import os
+import random
+import sys
+import time
+from array import array
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+__builtin__._ = lambda s: s
+
+from swift.common.ring import RingData
+
+
+def build(part_power, replicas, ndevices):
+    devs = [{'id': i, 'region': 1, 'zone': i % 5,
+             'ip': '10.0.%d.%d' % (i % 5, i / 5), 'port': 6000,
+             'device': 'sd%d' % i, 'weight': 100.0, 'meta': ''}
+            for i in xrange(ndevices)]
+    tables = [array('H', [random.randrange(ndevices)
+                          for part in xrange(2 ** part_power)])
+              for replica in xrange(replicas)]
+    return RingData(tables, devs, 32 - part_power)
+
+
+def pss(pid):
+    """
+    :returns: PSS of a process in KB
+    """
+    with open('/proc/%d/smaps_rollup' % pid) as fp:
+        for line in fp:
+            if line.startswith('Pss:'):
+                return int(line.split()[1])
+
+
+def worker(path, ready, go):
+    """
+    Waits to be measured, then loads the ring, reads all of its tables and
+    waits to be measured again.
+    """
+    os.write(ready, 'x')
+    os.read(go, 1)
+    ring_data = RingData.load(path)
+    for part2dev_id in ring_data._replica2part2dev_id:
+        sum(part2dev_id)
+    os.write(ready, 'x')
+    os.read(go, 1)
+    os._exit(0)
+
+
+def measure(path, workers):
+    """
+    :returns: PSS growth summed over the workers in KB, from before to
+              after they loaded the ring
+    """
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    pids = []
+    for i in xrange(workers):
+        pid = os.fork()
+        if not pid:
+            worker(path, ready_w, go_r)
+        pids.append(pid)
+    samples = []
+    for step in xrange(2):
+        for pid in pids:
+            os.read(ready_r, 1)
+        samples.append(sum(pss(pid) for pid in pids))
+        os.write(go_w, 'x' * workers)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    for fd in (ready_r, ready_w, go_r, go_w):
+        os.close(fd)
+    return samples[1] - samples[0]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--part-power', type='int', default=20)
+    parser.add_option('-r', '--replicas', type='int', default=3)
+    parser.add_option('-d', '--devices', type='int', default=300)
+    parser.add_option('-w', '--workers', type='int', default=4,
+                      help='number of workers loading the ring')
+    parser.add_option('-n', '--loads', type='int', default=10,
+                      help='number of loads to time, of which the fastest '
+                      'counts')
+    options, args = parser.parse_args()
+
+    tmp = mkdtemp()
+    try:
+        ring_data = build(options.part_power, options.replicas,
+                          options.devices)
+        print 'part_power %d, %d replicas, %d workers' % (
+            options.part_power, options.replicas, options.workers)
+        print '%-6s %8s %14s %14s %13s' % (
+            'format', 'file MB', 'load s (best)', 'PSS/worker MB',
+            'PSS total MB')
+        for format_version in (1, 2):
+            path = os.path.join(tmp, 'object-%d.ring.gz' % format_version)
+            ring_data.save(path, format_version=format_version)
+            best = None
+            for i in xrange(options.loads):
+                start = time.time()
+                RingData.load(path)
+                elapsed = time.time() - start
+                best = min(best or elapsed, elapsed)
+            growth = measure(path, options.workers) / 1024.0
+            print '%-6d %8.1f %14.4f %14.1f %13.1f' % (
+                format_version, os.path.getsize(path) / 1048576.0, best,
+                growth / options.workers, growth)
+    finally:
+        rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
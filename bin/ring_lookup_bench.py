@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""
+Times Ring.get_nodes() and Ring.get_part_nodes() on a ring of a given part
+power.
+
+The ring has a number of devices in five zones, with every replica of each
+partition on a different device, assigned at random rather than by a
+RingBuilder so that large part powers are quick to build.  A number of
+object names are looked up over and over, as a proxy does for its hot
+objects; --names 0 looks up every partition in turn instead.
+
+This is what it printed on a single core box for part powers 18 and 20,
+run in a tree from before node lists were cached and then with the cache:
+
+                         get_nodes/s  get_part_nodes/s
+before, part_power 18         437616           730475
+before, part_power 20         429901           716705
+cached, part_power 18         796950          2804099
+cached, part_power 20         824675          2874612
+
+With --names 0 on part power 20 no partition comes round again before the
+cache has been cleared, and the cache costs rather than saves: get_nodes
+came to 423898/s before and 330637/s cached, get_part_nodes to 742598/s
+and 515081/s.
+"""
+
+import __builtin__
+import os
+import random
+import sys
+import time
+from array import array
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+__builtin__._ = lambda s: s
+
+from swift.common import utils
+from swift.common.ring import Ring, RingData
+
+
+def build(path, part_power, replicas, ndevices):
+    devs = [{'id': i, 'region': 1, 'zone': i % 5,
+             'ip': '10.0.%d.%d' % (i % 5, i / 5), 'port': 6000,
+             'device': 'sd%d' % i, 'weight': 100.0, 'meta': ''}
+            for i in xrange(ndevices)]
+    tables = [array('H') for replica in xrange(replicas)]
+    for part in xrange(2 ** part_power):
+        for table, dev_id in zip(tables,
+                                 random.sample(xrange(ndevices), replicas)):
+            table.append(dev_id)
+    RingData(tables, devs, 32 - part_power).save(path)
+
+
+def rate(call, args, seconds):
+    """
+    :returns: calls per second, going round args for about seconds
+    """
+    calls = 0
+    start = time.time()
+    while True:
+        for arg in args:
+            call(*arg)
+        calls += len(args)
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--part-power', type='int', default=18)
+    parser.add_option('-r', '--replicas', type='int', default=3)
+    parser.add_option('-d', '--devices', type='int', default=300)
+    parser.add_option('-n', '--names', type='int', default=10000,
+                      help='number of object names looked up over and over; '
+                      '0 for every partition in turn')
+    parser.add_option('-t', '--time', type='float', default=5,
+                      help='seconds to time each call for')
+    options, args = parser.parse_args()
+
+    if not utils.HASH_PATH_SUFFIX and not utils.HASH_PATH_PREFIX:
+        utils.HASH_PATH_SUFFIX = 'bench'
+    tmp = mkdtemp()
+    try:
+        path = os.path.join(tmp, 'object.ring.gz')
+        build(path, options.part_power, options.replicas, options.devices)
+        ring = Ring(path)
+        if options.names:
+            names = [('a', 'c', 'o%d' % i) for i in xrange(options.names)]
+            parts = [(ring.get_nodes(*name)[0],) for name in names]
+        else:
+            names = [('a', 'c', 'o%d' % i) for i in xrange(100000)]
+            parts = [(part,) for part in xrange(ring.partition_count)]
+        print '%-24s %12s %16s' % ('', 'get_nodes/s', 'get_part_nodes/s')
+        print '%-24s %12d %16d' % (
+            'part_power %d' % options.part_power,
+            rate(ring.get_nodes, names, options.time),
+            rate(ring.get_part_nodes, parts, options.time))
+    finally:
+        rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
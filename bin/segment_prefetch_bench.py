@@ -0,0 +1,146 @@
+#!/usr/bin/python
+"""
+Times reading a large object through SegmentedIterable for different
+segment_prefetch windows, against a fake backend with a given time to first
+byte and bandwidth per connection.
+
+The backend is simulated with eventlet sleeps, so the connections it serves
+at the same time do not slow each other down, as on a cluster whose object
+servers and network are far from busy.  Segment rate limiting is off unless
+--rate-limit-after is given.
+
+This is what it printed on a single core box, for the defaults:
+
+50 segments of 1048576 bytes, 20 ms to first byte, 40.0 MB/s per connection
+segment_prefetch      MB/s   seconds
+               0      21.3      2.46
+               1      42.6      1.23
+               2      62.5      0.84
+               4     105.7      0.50
+               8     173.4      0.30
+
+Each step of the window lets one more GET run while a segment is sent, so
+the rate grows with it until the proxy's CPU, the client or the cluster is
+what limits it, none of which the fake backend takes into account.
+"""
+
+import __builtin__
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+__builtin__._ = lambda s: s
+
+from eventlet import sleep
+
+from swift.common.swob import Response
+from swift.proxy.controllers.obj import SegmentedIterable
+
+
+class FakeRing(object):
+
+    def get_nodes(self, account, container, obj):
+        return 0, [{'ip': '127.0.0.1', 'port': 6000, 'device': 'sda'}]
+
+    def get_more_nodes(self, partition):
+        return []
+
+
+class FakeController(object):
+    """
+    Stands in for both the object controller and the proxy app, and serves
+    every segment GET from a backend that waits latency seconds and then
+    sends the body at a fixed rate.
+    """
+
+    def __init__(self, options):
+        self.app = self
+        self.logger = self
+        self.account_name = 'a'
+        self.container_name = 'c'
+        self.object_name = 'o'
+        self.object_ring = FakeRing()
+        self.object_chunk_size = 65536
+        self.client_timeout = 60
+        self.node_timeout = 10
+        self.rate_limit_after_segment = options.rate_limit_after
+        self.rate_limit_segments_per_sec = 1
+        self.segment_prefetch_bytes = options.prefetch_bytes
+        self.segment_size = options.size
+        self.latency = options.latency / 1000.0
+        self.rate = options.rate * 1000000.0
+
+    def __getattr__(self, name):
+        # the logger's methods
+        return lambda *args, **kwargs: None
+
+    def _body(self):
+        sleep(self.latency)
+        sent = 0
+        while sent < self.segment_size:
+            chunk = 'x' * min(self.object_chunk_size,
+                              self.segment_size - sent)
+            sleep(len(chunk) / self.rate)
+            sent += len(chunk)
+            yield chunk
+
+    def GETorHEAD_base(self, req, server_type, partition, nodes, path,
+                       attempts):
+        return Response(app_iter=self._body())
+
+    def iter_nodes(self, partition, nodes, ring):
+        return iter(nodes)
+
+    def sort_nodes(self, nodes):
+        return nodes
+
+
+def read(controller, segments):
+    """
+    :returns: seconds to read the whole object
+    """
+    listing = [{'name': 'o/%08d' % i, 'bytes': controller.segment_size}
+               for i in xrange(segments)]
+    start = time.time()
+    size = 0
+    for chunk in SegmentedIterable(controller, 'c_segments', listing):
+        size += len(chunk)
+    assert size == segments * controller.segment_size, size
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--segments', type='int', default=50)
+    parser.add_option('-s', '--size', type='int', default=1048576,
+                      help='segment size in bytes')
+    parser.add_option('-l', '--latency', type='float', default=20,
+                      help='ms from a segment GET to its first byte')
+    parser.add_option('-r', '--rate', type='float', default=40,
+                      help='MB/s the backend sends a segment at')
+    parser.add_option('-w', '--windows', default='0,1,2,4,8',
+                      help='comma separated segment_prefetch values to try')
+    parser.add_option('--prefetch-bytes', type='int', default=8388608,
+                      help='segment_prefetch_bytes')
+    parser.add_option('--rate-limit-after', type='int', default=1000000,
+                      help='rate_limit_after_segment (1 a second after it)')
+    options, args = parser.parse_args()
+
+    controller = FakeController(options)
+    print '%d segments of %d bytes, %d ms to first byte, %.1f MB/s per ' \
+        'connection' % (options.segments, options.size, options.latency,
+                        options.rate)
+    print '%16s %9s %9s' % ('segment_prefetch', 'MB/s', 'seconds')
+    for window in [int(w) for w in options.windows.split(',')]:
+        controller.segment_prefetch = window
+        elapsed = read(controller, options.segments)
+        print '%16d %9.1f %9.2f' % (
+            window, options.segments * options.size / elapsed / 1000000,
+            elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,18 +18,21 @@ from __future__ import with_statement
 import os
 import time
 import traceback
+from itertools import chain
 from xml.sax import saxutils
 
 from eventlet import Timeout
 
 import swift.common.db
-from swift.common.db import AccountBroker
+from swift.common.db import AccountBroker, listing_pages, \
+    LISTING_PAGE_SIZE
 from swift.common.utils import get_logger, get_param, hash_path, public, \
     normalize_timestamp, storage_directory, config_true_value, \
     validate_device_partition, json, timing_stats
 from swift.common.constraints import ACCOUNT_LISTING_LIMIT, \
     check_mount, check_float, check_utf8, FORMAT2CONTENT_TYPE
-from swift.common.db_replicator import ReplicatorRpc
+from swift.common.db_replicator import ReplicatorRpc, \
+    ROW_STREAM_CONTENT_TYPE
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, \
     HTTPCreated, HTTPForbidden, HTTPInternalServerError, \
     HTTPMethodNotAllowed, HTTPNoContent, HTTPNotFound, \
@@ -228,39 +231,73 @@ class AccountController(object):
             ['text/plain', 'application/json', 'application/xml', 'text/xml'])
         if not out_content_type:
             return HTTPNotAcceptable(request=req)
-        account_list = broker.list_containers_iter(limit, marker, end_marker,
-                                                   prefix, delimiter)
+        pages = listing_pages(broker.list_containers_iter, limit, marker,
+                              end_marker, prefix, delimiter)
+        first_page = next(pages, [])
+        if out_content_type == 'text/plain' and not first_page:
+            return HTTPNoContent(request=req, headers=resp_headers)
+        pages = chain([first_page], pages)
         if out_content_type == 'application/json':
+            body = self._json_listing(pages)
+        elif out_content_type.endswith('/xml'):
+            body = self._xml_listing(account, pages)
+        else:
+            body = ('\n'.join(r[0] for r in page) + '\n' for page in pages)
+        if len(first_page) < LISTING_PAGE_SIZE or limit <= LISTING_PAGE_SIZE:
+            # the whole listing is in; send it with a Content-Length
+            ret = Response(body=''.join(body), request=req,
+                           headers=resp_headers)
+        else:
+            ret = Response(app_iter=body, request=req, headers=resp_headers)
+        ret.content_type = out_content_type
+        ret.charset = 'utf-8'
+        return ret
+
+    def _json_listing(self, pages):
+        """
+        Encodes a listing as JSON, one page of entries at a time.
+
+        :param pages: iterator of lists of rows from list_containers_iter
+        :returns: generator of pieces of the JSON document
+        """
+        yield '['
+        separator = ''
+        for page in pages:
             data = []
-            for (name, object_count, bytes_used, is_subdir) in account_list:
+            for (name, object_count, bytes_used, is_subdir) in page:
                 if is_subdir:
-                    data.append({'subdir': name})
+                    data.append(json.dumps({'subdir': name}))
                 else:
-                    data.append({'name': name, 'count': object_count,
-                                'bytes': bytes_used})
-            account_list = json.dumps(data)
-        elif out_content_type.endswith('/xml'):
-            output_list = ['<?xml version="1.0" encoding="UTF-8"?>',
-                           '<account name="%s">' % account]
-            for (name, object_count, bytes_used, is_subdir) in account_list:
+                    data.append(json.dumps({'name': name,
+                                            'count': object_count,
+                                            'bytes': bytes_used}))
+            yield separator + ', '.join(data)
+            separator = ', '
+        yield ']'
+
+    def _xml_listing(self, account, pages):
+        """
+        Encodes a listing as XML, one page of entries at a time.
+
+        :param account: account name
+        :param pages: iterator of lists of rows from list_containers_iter
+        :returns: generator of pieces of the XML document
+        """
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+            '<account name="%s">' % account
+        for page in pages:
+            output_list = []
+            for (name, object_count, bytes_used, is_subdir) in page:
                 name = saxutils.escape(name)
                 if is_subdir:
-                    output_list.append('<subdir name="%s" />' % name)
+                    output_list.append('\n<subdir name="%s" />' % name)
                 else:
-                    item = '<container><name>%s</name><count>%s</count>' \
+                    item = '\n<container><name>%s</name><count>%s</count>' \
                            '<bytes>%s</bytes></container>' % \
                            (name, object_count, bytes_used)
                     output_list.append(item)
-            output_list.append('</account>')
-            account_list = '\n'.join(output_list)
-        else:
-            if not account_list:
-                return HTTPNoContent(request=req, headers=resp_headers)
-            account_list = '\n'.join(r[0] for r in account_list) + '\n'
-        ret = Response(body=account_list, request=req, headers=resp_headers)
-        ret.content_type = out_content_type
-        ret.charset = 'utf-8'
-        return ret
+            yield ''.join(output_list)
+        yield '\n</account>'
 
     @public
     @timing_stats()
@@ -278,11 +315,17 @@ class AccountController(object):
                                   request=req)
         if self.mount_check and not check_mount(self.root, drive):
             return HTTPInsufficientStorage(drive=drive, request=req)
+        stream = None
         try:
-            args = json.load(req.environ['wsgi.input'])
+            if req.headers.get('Content-Type') == ROW_STREAM_CONTENT_TYPE:
+                # the args are on the first line, followed by the rows
+                stream = req.environ['wsgi.input']
+                args = json.loads(stream.readline())
+            else:
+                args = json.load(req.environ['wsgi.input'])
         except ValueError, err:
             return HTTPBadRequest(body=str(err), content_type='text/plain')
-        ret = self.replicator_rpc.dispatch(post_args, args)
+        ret = self.replicator_rpc.dispatch(post_args, args, stream)
         ret.request = req
         return ret
 
@@ -1,3 +1,4 @@
+# --encoding: utf-8--
 # Copyright (c) 2010-2012 OpenStack, LLC.
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -28,10 +29,12 @@ BufferedHTTPResponse.
 
 from urllib import quote
 import logging
+import select
+import socket
 import time
 
-from eventlet.green.httplib import CONTINUE, HTTPConnection, HTTPMessage, \
-    HTTPResponse, HTTPSConnection, _UNKNOWN
+from eventlet.green.httplib import BadStatusLine, CONTINUE, HTTPConnection, \
+    HTTPMessage, HTTPResponse, HTTPSConnection, _UNKNOWN
 
 
 class BufferedHTTPResponse(HTTPResponse):
@@ -56,6 +59,8 @@ class BufferedHTTPResponse(HTTPResponse):
         self.chunk_left = _UNKNOWN      # bytes left to read in current chunk
         self.length = _UNKNOWN          # number of bytes left in response
         self.will_close = _UNKNOWN      # conn will close at end of response
+        self._pooled_conn = None
+        self._reading = False
 
     def expect_response(self):
         if self.fp:
@@ -73,14 +78,120 @@ class BufferedHTTPResponse(HTTPResponse):
             self.msg = HTTPMessage(self.fp, 0)
             self.msg.fp = None
 
+    def read(self, amt=None):
+        self._reading = True
+        try:
+            data = HTTPResponse.read(self, amt)
+        finally:
+            self._reading = False
+        # httplib closes the response itself once the whole body has been
+        # read; only then is the connection ready for another request.
+        if self._pooled_conn is not None and self.fp is None and \
+                not self.length:
+            self._release_conn()
+        return data
+
     def close(self):
+        if not self._reading:
+            # closed by the caller before the body was consumed
+            self._pooled_conn = None
         HTTPResponse.close(self)
         self.sock = None
 
+    def _release_conn(self):
+        """
+        Hands the socket of a fully read response back to its pool.  The
+        connection object is detached from the socket first, so a later
+        conn.close() by whoever still holds it cannot touch a socket that
+        may already be serving another request.
+        """
+        conn, self._pooled_conn = self._pooled_conn, None
+        sock, conn.sock = conn.sock, None
+        if sock is not None:
+            conn.pool.put(conn.pool_key, sock)
+
+
+class ConnectionPool(object):
+    """
+    Idle persistent backend connections, keyed by (ip, port).
+
+    Sockets are checked back in by their response once its body has been
+    read in full and the server agreed to keep the connection open; a
+    response that is abandoned part way through never comes back.  Idle
+    sockets older than idle_timeout, or that the other end has already
+    closed, are thrown away on checkout.  Meant to be created once per
+    worker process.
+
+    :param max_idle: maximum idle sockets kept per (ip, port)
+    :param idle_timeout: seconds an idle socket may sit in the pool
+    """
+
+    def __init__(self, max_idle=16, idle_timeout=30.0):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+
+    def _prune(self, idle, now):
+        while idle and idle[0][1] + self.idle_timeout <= now:
+            idle.pop(0)[0].close()
+
+    def get(self, key):
+        """
+        :param key: (ip, port) tuple
+        :returns: an idle connected socket, or None
+        """
+        idle = self.idle.get(key)
+        if not idle:
+            return None
+        self._prune(idle, time.time())
+        while idle:
+            sock = idle.pop()[0]
+            try:
+                # An idle keep-alive socket has nothing to say; if it is
+                # readable the server closed it (or it is out of sync).
+                if not select.select([sock], [], [], 0)[0]:
+                    return sock
+            except (select.error, socket.error, ValueError):
+                pass
+            sock.close()
+        return None
+
+    def put(self, key, sock):
+        """
+        :param key: (ip, port) tuple
+        :param sock: connected socket with no outstanding response
+        """
+        idle = self.idle.setdefault(key, [])
+        self._prune(idle, time.time())
+        if len(idle) >= self.max_idle:
+            sock.close()
+        else:
+            idle.append((sock, time.time()))
+
+    def drop(self, key):
+        """
+        Closes every idle socket to a host, e.g. after it has errored.
+
+        :param key: (ip, port) tuple
+        """
+        for sock, _junk in self.idle.pop(key, ()):
+            sock.close()
+
 
 class BufferedHTTPConnection(HTTPConnection):
-    """HTTPConnection class that uses BufferedHTTPResponse"""
+    """
+    HTTPConnection class that uses BufferedHTTPResponse
+
+    A request sent over a socket from a pool (reused) may find that the
+    server closed it meanwhile.  If that shows while sending the headers or
+    reading the response to them, before any body was sent, the request is
+    sent again once over a new connection.
+    """
     response_class = BufferedHTTPResponse
+    pool = None
+    reused = False
+    _request_head = None
+    _body_sent = False
 
     def connect(self):
         self._connected_time = time.time()
@@ -92,14 +203,58 @@ class BufferedHTTPConnection(HTTPConnection):
         return HTTPConnection.putrequest(self, method, url, skip_host,
                                          skip_accept_encoding)
 
+    def endheaders(self, message_body=None):
+        self._request_head = '\r\n'.join(self._buffer + ['', ''])
+        try:
+            HTTPConnection.endheaders(self, message_body)
+        except socket.error:
+            if message_body is not None or not self._resend():
+                raise
+        self._body_sent = message_body is not None
+
+    def send(self, data):
+        self._body_sent = True
+        return HTTPConnection.send(self, data)
+
+    def _resend(self):
+        """
+        Sends the request headers again over a new connection, if they went
+        out over a reused socket.  Callers must not call this once any of
+        the body has been sent.
+
+        :returns: whether they were sent again
+        """
+        if not self.reused:
+            return False
+        self.reused = False
+        self.sock.close()
+        self.sock = None
+        self.connect()
+        self.sock.sendall(self._request_head)
+        return True
+
     def getexpect(self):
-        response = BufferedHTTPResponse(self.sock, strict=self.strict,
-                                        method=self._method)
-        response.expect_response()
+        try:
+            response = BufferedHTTPResponse(self.sock, strict=self.strict,
+                                            method=self._method)
+            response.expect_response()
+        except (socket.error, BadStatusLine):
+            if self._body_sent or not self._resend():
+                raise
+            response = BufferedHTTPResponse(self.sock, strict=self.strict,
+                                            method=self._method)
+            response.expect_response()
         return response
 
     def getresponse(self):
-        response = HTTPConnection.getresponse(self)
+        try:
+            response = HTTPConnection.getresponse(self)
+        except (socket.error, BadStatusLine):
+            if self._body_sent or not self._resend():
+                raise
+            response = HTTPConnection.getresponse(self)
+        if self.pool is not None and not response.will_close:
+            response._pooled_conn = self
         logging.debug(_("HTTP PERF: %(time).5f seconds to %(method)s "
                         "%(host)s:%(port)s %(path)s)"),
                       {'time': time.time() - self._connected_time,
@@ -109,7 +264,7 @@ class BufferedHTTPConnection(HTTPConnection):
 
 
 def http_connect(ipaddr, port, device, partition, method, path,
-                 headers=None, query_string=None, ssl=False):
+                 headers=None, query_string=None, ssl=False, pool=None):
     """
     Helper function to create an HTTPConnection object. If ssl is set True,
     HTTPSConnection will be used. However, if ssl=False, BufferedHTTPConnection
@@ -128,6 +283,8 @@ def http_connect(ipaddr, port, device, partition, method, path,
     :param headers: dictionary of headers
     :param query_string: request query string
     :param ssl: set True if SSL should be used (default: False)
+    :param pool: ConnectionPool to reuse idle connections from and return
+                 this one to once its response has been read (default: None)
     :returns: HTTPConnection object
     """
     if isinstance(path, unicode):
@@ -137,11 +294,11 @@ def http_connect(ipaddr, port, device, partition, method, path,
             logging.exception(_('Error encoding to UTF-8: %s'), e.message)
     path = quote('/' + device + '/' + str(partition) + path)
     return http_connect_raw(
-        ipaddr, port, method, path, headers, query_string, ssl)
+        ipaddr, port, method, path, headers, query_string, ssl, pool)
 
 
 def http_connect_raw(ipaddr, port, method, path, headers=None,
-                     query_string=None, ssl=False):
+                     query_string=None, ssl=False, pool=None):
     """
     Helper function to create an HTTPConnection object. If ssl is set True,
     HTTPSConnection will be used. However, if ssl=False, BufferedHTTPConnection
@@ -154,6 +311,10 @@ def http_connect_raw(ipaddr, port, method, path, headers=None,
     :param headers: dictionary of headers
     :param query_string: request query string
     :param ssl: set True if SSL should be used (default: False)
+    :param pool: ConnectionPool to reuse idle connections from and return
+                 this one to once its response has been read; any
+                 Connection header is dropped since the pool decides the
+                 connection's lifetime (default: None)
     :returns: HTTPConnection object
     """
     if not port:
@@ -162,6 +323,16 @@ def http_connect_raw(ipaddr, port, method, path, headers=None,
         conn = HTTPSConnection('%s:%s' % (ipaddr, port))
     else:
         conn = BufferedHTTPConnection('%s:%s' % (ipaddr, port))
+        if pool is not None:
+            conn.pool = pool
+            conn.pool_key = (ipaddr, port)
+            conn.sock = pool.get(conn.pool_key)
+            if conn.sock is not None:
+                conn.reused = True
+                conn._connected_time = time.time()
+            if headers:
+                headers = dict((k, v) for k, v in headers.iteritems()
+                               if k.lower() != 'connection')
     if query_string:
         path += '?' + query_string
     conn.path = path
@@ -25,6 +25,7 @@ import sys
 import time
 import cPickle as pickle
 import errno
+import struct
 from tempfile import mkstemp
 
 from eventlet import sleep, Timeout
@@ -43,12 +44,114 @@ BROKER_TIMEOUT = 25
 PICKLE_PROTOCOL = 2
 #: Max number of pending entries
 PENDING_CAP = 131072
+#: Leading byte of a binary pending entry: the entry's pickle, prefixed with
+#: its length.  Older versions wrote base64 encoded pickles after a colon.
+PENDING_MAGIC = '\x00'
+PENDING_HEADER = '!cI'
+PENDING_HEADER_SIZE = struct.calcsize(PENDING_HEADER)
+#: Number of bytes of a .pending file read at a time when committing it
+PENDING_READ_SIZE = 65536
+#: Number of rows fetched at a time for a streamed listing
+LISTING_PAGE_SIZE = 1000
+#: Max number of rows a delimiter listing reads past in a rolled up
+#: "directory" before seeking past it with a new query; about as many rows as
+#: a query costs to read (see bin/container_listing_bench.py)
+ROLLUP_SCAN = 10
 
 
 def utf8encode(*args):
     return [(s.encode('utf8') if isinstance(s, unicode) else s) for s in args]
 
 
+def pending_entry(row):
+    """
+    Encodes a row for appending to a .pending file.
+
+    :param row: tuple of the row's values
+    :returns: the entry as a string
+    """
+    data = pickle.dumps(row, protocol=PICKLE_PROTOCOL)
+    return struct.pack(PENDING_HEADER, PENDING_MAGIC, len(data)) + data
+
+
+def iter_pending(fp, read_size=PENDING_READ_SIZE):
+    """
+    Reads the entries of a .pending file a chunk at a time, decoding each as
+    soon as it is complete.  Binary entries and base64 entries written by
+    older versions may be mixed.
+
+    :param fp: the .pending file, open for reading
+    :param read_size: number of bytes to read at a time
+    :returns: generator of (row, raw entry); the row is None if the entry
+              cannot be decoded
+    """
+    data = ''
+    eof = False
+    while not eof:
+        chunk = fp.read(read_size)
+        eof = not chunk
+        data += chunk
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if data[pos] == PENDING_MAGIC:
+                start = pos + PENDING_HEADER_SIZE
+                if start <= end:
+                    length = struct.unpack(PENDING_HEADER,
+                                           data[pos:start])[1]
+                elif eof:
+                    length = end
+                else:
+                    break
+                if start + length > end and not eof:
+                    break
+                pos = start + length
+                entry = data[start:pos]
+                try:
+                    yield pickle.loads(entry), entry
+                except Exception:
+                    yield None, entry
+                continue
+            colon = data.find(':', pos + 1)
+            if colon < 0:
+                colon = end
+            magic = data.find(PENDING_MAGIC, pos + 1, colon)
+            if magic >= 0:
+                colon = magic
+            if colon == end and not eof:
+                break
+            entry = data[pos + 1:colon]
+            pos += 1 + len(entry)
+            if entry:
+                try:
+                    yield pickle.loads(entry.decode('base64')), entry
+                except Exception:
+                    yield None, entry
+        data = data[pos:]
+
+
+def listing_pages(list_iter, limit, marker, *args):
+    """
+    Pages through a listing, so that it can be streamed without keeping a
+    statement open on the database, and its locks held, in between pages.
+
+    :param list_iter: a broker's list_objects_iter or list_containers_iter
+    :param limit: maximum number of entries to get
+    :param marker: marker query
+    :param args: remaining arguments to list_iter
+    :returns: generator of lists of entries as returned by list_iter
+    """
+    while limit > 0:
+        page_size = min(limit, LISTING_PAGE_SIZE)
+        page = list_iter(page_size, marker, *args)
+        if page:
+            yield page
+        if len(page) < page_size:
+            break
+        limit -= len(page)
+        marker = page[-1][0]
+
+
 class DatabaseConnectionError(sqlite3.DatabaseError):
     """More friendly error messages for DB Errors."""
 
@@ -154,13 +257,14 @@ class DatabaseBroker(object):
 
     def __init__(self, db_file, timeout=BROKER_TIMEOUT, logger=None,
                  account=None, container=None, pending_timeout=10,
-                 stale_reads_ok=False):
+                 stale_reads_ok=False, skip_commits=False):
         """ Encapsulates working with a database. """
         self.conn = None
         self.db_file = db_file
         self.pending_file = self.db_file + '.pending'
         self.pending_timeout = pending_timeout
         self.stale_reads_ok = stale_reads_ok
+        self.skip_commits = skip_commits
         self.db_dir = os.path.dirname(db_file)
         self.timeout = timeout
         self.logger = logger or logging.getLogger()
@@ -398,11 +502,7 @@ class DatabaseBroker(object):
         :param count: number to get
         :returns: list of objects between start and end
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         with self.get() as conn:
             curs = conn.execute('''
                 SELECT * FROM %s WHERE ROWID > ? ORDER BY ROWID ASC LIMIT ?
@@ -451,11 +551,7 @@ class DatabaseBroker(object):
         :returns: dict containing keys: hash, id, created_at, put_timestamp,
             delete_timestamp, count, max_row, and metadata
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         query_part1 = '''
             SELECT hash, id, created_at, put_timestamp, delete_timestamp,
                 %s_count AS count,
@@ -480,6 +576,20 @@ class DatabaseBroker(object):
     def _commit_puts(self):
         pass    # stub to be overridden if need be
 
+    def _commit_puts_stale_ok(self):
+        """
+        Commits pending entries before a read.  Nothing is committed when
+        skip_commits is set, e.g. because another thread merges them, and a
+        LockTimeout is ignored when stale reads are ok.
+        """
+        if self.skip_commits:
+            return
+        try:
+            self._commit_puts()
+        except LockTimeout:
+            if not self.stale_reads_ok:
+                raise
+
     def merge_syncs(self, sync_points, incoming=True):
         """
         Merge a list of sync points with the incoming sync table.
@@ -778,11 +888,7 @@ class ContainerBroker(DatabaseBroker):
 
         :returns: True if the database has no active objects, False otherwise
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         with self.get() as conn:
             row = conn.execute(
                 'SELECT object_count from container_stat').fetchone()
@@ -801,21 +907,20 @@ class ContainerBroker(DatabaseBroker):
                     self.merge_items(item_list)
                 return
             with open(self.pending_file, 'r+b') as fp:
-                for entry in fp.read().split(':'):
-                    if entry:
-                        try:
-                            (name, timestamp, size, content_type, etag,
-                                deleted) = pickle.loads(entry.decode('base64'))
-                            item_list.append({'name': name,
-                                              'created_at': timestamp,
-                                              'size': size,
-                                              'content_type': content_type,
-                                              'etag': etag,
-                                              'deleted': deleted})
-                        except Exception:
-                            self.logger.exception(
-                                _('Invalid pending entry %(file)s: %(entry)s'),
-                                {'file': self.pending_file, 'entry': entry})
+                for row, entry in iter_pending(fp):
+                    try:
+                        (name, timestamp, size, content_type, etag,
+                            deleted) = row
+                        item_list.append({'name': name,
+                                          'created_at': timestamp,
+                                          'size': size,
+                                          'content_type': content_type,
+                                          'etag': etag,
+                                          'deleted': deleted})
+                    except Exception:
+                        self.logger.exception(
+                            _('Invalid pending entry %(file)s: %(entry)s'),
+                            {'file': self.pending_file, 'entry': entry})
                 if item_list:
                     self.merge_items(item_list)
                 try:
@@ -898,12 +1003,8 @@ class ContainerBroker(DatabaseBroker):
             with lock_parent_directory(
                     self.pending_file, self.pending_timeout):
                 with open(self.pending_file, 'a+b') as fp:
-                    # Colons aren't used in base64 encoding; so they are our
-                    # delimiter
-                    fp.write(':')
-                    fp.write(pickle.dumps(
-                        (name, timestamp, size, content_type, etag, deleted),
-                        protocol=PICKLE_PROTOCOL).encode('base64'))
+                    fp.write(pending_entry(
+                        (name, timestamp, size, content_type, etag, deleted)))
                     fp.flush()
 
     def is_deleted(self, timestamp=None):
@@ -914,11 +1015,7 @@ class ContainerBroker(DatabaseBroker):
         """
         if self.db_file != ':memory:' and not os.path.exists(self.db_file):
             return True
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         with self.get() as conn:
             row = conn.execute('''
                 SELECT put_timestamp, delete_timestamp, object_count
@@ -944,11 +1041,7 @@ class ContainerBroker(DatabaseBroker):
                   If include_metadata is set, metadata is included as a key
                   pointing to a dict of tuples of the metadata
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         with self.get() as conn:
             data = None
             trailing1 = 'metadata'
@@ -1066,11 +1159,7 @@ class ContainerBroker(DatabaseBroker):
         """
         (marker, end_marker, prefix, delimiter, path) = utf8encode(
             marker, end_marker, prefix, delimiter, path)
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         if path is not None:
             prefix = path
             if path:
@@ -1080,6 +1169,10 @@ class ContainerBroker(DatabaseBroker):
             prefix = ''
         orig_marker = marker
         with self.get() as conn:
+            if self.get_db_version(conn) < 1:
+                deleted_clause = ' +deleted = 0'
+            else:
+                deleted_clause = ' deleted = 0'
             results = []
             while len(results) < limit:
                 query = '''SELECT name, created_at, size, content_type, etag
@@ -1094,12 +1187,11 @@ class ContainerBroker(DatabaseBroker):
                 elif prefix:
                     query += ' name >= ? AND'
                     query_args.append(prefix)
-                if self.get_db_version(conn) < 1:
-                    query += ' +deleted = 0'
-                else:
-                    query += ' deleted = 0'
-                query += ' ORDER BY name LIMIT ?'
-                query_args.append(limit - len(results))
+                query += deleted_clause + ' ORDER BY name LIMIT ?'
+                query_limit = limit - len(results)
+                if delimiter:
+                    query_limit += ROLLUP_SCAN
+                query_args.append(query_limit)
                 curs = conn.execute(query, query_args)
                 curs.row_factory = None
 
@@ -1108,9 +1200,21 @@ class ContainerBroker(DatabaseBroker):
                 if not delimiter:
                     return [r for r in curs if r[0].startswith(prefix)]
                 rowcount = 0
+                # Rows under a "directory" that was just rolled up are read
+                # past while there are few of them; only after ROLLUP_SCAN
+                # rows is the cursor dropped to seek past the directory.
+                rollup = None
                 for row in curs:
                     rowcount += 1
-                    marker = name = row[0]
+                    name = row[0]
+                    if rollup:
+                        if name.startswith(rollup):
+                            skipped += 1
+                            if skipped < ROLLUP_SCAN:
+                                continue
+                            break
+                        rollup = None
+                    marker = name
                     if len(results) >= limit or not name.startswith(prefix):
                         curs.close()
                         return results
@@ -1120,18 +1224,23 @@ class ContainerBroker(DatabaseBroker):
                             continue
                         if end >= 0 and len(name) > end + len(delimiter):
                             marker = name[:end] + chr(ord(delimiter) + 1)
-                            curs.close()
-                            break
+                            rollup = name[:end + 1]
+                            skipped = 0
+                            continue
                     elif end > 0:
                         marker = name[:end] + chr(ord(delimiter) + 1)
                         dir_name = name[:end + 1]
                         if dir_name != orig_marker:
                             results.append([dir_name, '0', 0, None, ''])
-                        curs.close()
-                        break
+                        rollup = dir_name
+                        skipped = 0
+                        continue
                     results.append(row)
-                if not rowcount:
-                    break
+                else:
+                    if rowcount < query_limit:
+                        # ran out of rows
+                        break
+                curs.close()
             return results
 
     def merge_items(self, item_list, source=None):
@@ -1142,28 +1251,37 @@ class ContainerBroker(DatabaseBroker):
                           'size', 'content_type', 'etag', 'deleted'}
         :param source: if defined, update incoming_sync with the source
         """
+        # Only the newest record for a name can survive the merge (the first
+        # one on a tie), so the others are dropped up front and the rest go
+        # through executemany().
+        newest = {}
+        max_rowid = -1
+        for rec in item_list:
+            if rec['name'] not in newest or \
+                    newest[rec['name']]['created_at'] < rec['created_at']:
+                newest[rec['name']] = rec
+            if source:
+                max_rowid = max(max_rowid, rec['ROWID'])
         with self.get() as conn:
-            max_rowid = -1
-            for rec in item_list:
-                query = '''
-                    DELETE FROM object
-                    WHERE name = ? AND (created_at < ?)
+            if self.get_db_version(conn) >= 1:
+                deleted_clause = ' AND deleted IN (0, 1)'
+            else:
+                deleted_clause = ''
+            conn.executemany(
+                'DELETE FROM object WHERE name = ? AND (created_at < ?)' +
+                deleted_clause,
+                ((rec['name'], rec['created_at'])
+                 for rec in newest.itervalues()))
+            conn.executemany(
                 '''
-                if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                conn.execute(query, (rec['name'], rec['created_at']))
-                query = 'SELECT 1 FROM object WHERE name = ?'
-                if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                if not conn.execute(query, (rec['name'],)).fetchall():
-                    conn.execute('''
-                        INSERT INTO object (name, created_at, size,
-                            content_type, etag, deleted)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', ([rec['name'], rec['created_at'], rec['size'],
-                          rec['content_type'], rec['etag'], rec['deleted']]))
-                if source:
-                    max_rowid = max(max_rowid, rec['ROWID'])
+                INSERT INTO object (name, created_at, size,
+                    content_type, etag, deleted)
+                SELECT ?, ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM object WHERE name = ?%s)
+                ''' % deleted_clause,
+                ((rec['name'], rec['created_at'], rec['size'],
+                  rec['content_type'], rec['etag'], rec['deleted'],
+                  rec['name']) for rec in newest.itervalues()))
             if source:
                 try:
                     conn.execute('''
@@ -1328,23 +1446,21 @@ class AccountBroker(DatabaseBroker):
                     self.merge_items(item_list)
                 return
             with open(self.pending_file, 'r+b') as fp:
-                for entry in fp.read().split(':'):
-                    if entry:
-                        try:
-                            (name, put_timestamp, delete_timestamp,
-                             object_count, bytes_used, deleted) = \
-                                pickle.loads(entry.decode('base64'))
-                            item_list.append(
-                                {'name': name,
-                                 'put_timestamp': put_timestamp,
-                                 'delete_timestamp': delete_timestamp,
-                                 'object_count': object_count,
-                                 'bytes_used': bytes_used,
-                                 'deleted': deleted})
-                        except Exception:
-                            self.logger.exception(
-                                _('Invalid pending entry %(file)s: %(entry)s'),
-                                {'file': self.pending_file, 'entry': entry})
+                for row, entry in iter_pending(fp):
+                    try:
+                        (name, put_timestamp, delete_timestamp,
+                         object_count, bytes_used, deleted) = row
+                        item_list.append(
+                            {'name': name,
+                             'put_timestamp': put_timestamp,
+                             'delete_timestamp': delete_timestamp,
+                             'object_count': object_count,
+                             'bytes_used': bytes_used,
+                             'deleted': deleted})
+                    except Exception:
+                        self.logger.exception(
+                            _('Invalid pending entry %(file)s: %(entry)s'),
+                            {'file': self.pending_file, 'entry': entry})
                 if item_list:
                     self.merge_items(item_list)
                 try:
@@ -1359,11 +1475,7 @@ class AccountBroker(DatabaseBroker):
 
         :returns: True if the database has no active containers.
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         with self.get() as conn:
             row = conn.execute(
                 'SELECT container_count from account_stat').fetchone()
@@ -1441,13 +1553,9 @@ class AccountBroker(DatabaseBroker):
             with lock_parent_directory(self.pending_file,
                                        self.pending_timeout):
                 with open(self.pending_file, 'a+b') as fp:
-                    # Colons aren't used in base64 encoding; so they are our
-                    # delimiter
-                    fp.write(':')
-                    fp.write(pickle.dumps(
+                    fp.write(pending_entry(
                         (name, put_timestamp, delete_timestamp, object_count,
-                         bytes_used, deleted),
-                        protocol=PICKLE_PROTOCOL).encode('base64'))
+                         bytes_used, deleted)))
                     fp.flush()
 
     def can_delete_db(self, cutoff):
@@ -1482,11 +1590,7 @@ class AccountBroker(DatabaseBroker):
         """
         if self.db_file != ':memory:' and not os.path.exists(self.db_file):
             return True
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         with self.get() as conn:
             row = conn.execute('''
                 SELECT put_timestamp, delete_timestamp, container_count, status
@@ -1511,11 +1615,7 @@ class AccountBroker(DatabaseBroker):
                   delete_timestamp, container_count, object_count,
                   bytes_used, hash, id
         """
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         with self.get() as conn:
             return dict(conn.execute('''
                 SELECT account, created_at,  put_timestamp, delete_timestamp,
@@ -1540,11 +1640,7 @@ class AccountBroker(DatabaseBroker):
         """
         (marker, end_marker, prefix, delimiter) = utf8encode(
             marker, end_marker, prefix, delimiter)
-        try:
-            self._commit_puts()
-        except LockTimeout:
-            if not self.stale_reads_ok:
-                raise
+        self._commit_puts_stale_ok()
         if delimiter and not prefix:
             prefix = ''
         orig_marker = marker
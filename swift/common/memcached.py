@@ -27,17 +27,28 @@ import time
 from bisect import bisect
 from hashlib import md5
 
+from eventlet import GreenPile, Timeout
+from eventlet.pools import Pool
+
 from swift.common.utils import json
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 DEFAULT_MEMCACHED_PORT = 11211
 
 CONN_TIMEOUT = 0.3
+POOL_TIMEOUT = 1.0  # WAG
 IO_TIMEOUT = 2.0
 PICKLE_FLAG = 1
 JSON_FLAG = 2
+MSGPACK_FLAG = 4
 NODE_WEIGHT = 50
 PICKLE_PROTOCOL = 2
 TRY_COUNT = 3
+DEFAULT_MAX_CONNECTIONS = 2
 
 # if ERROR_LIMIT_COUNT errors occur in ERROR_LIMIT_TIME seconds, the server
 # will be considered failed for ERROR_LIMIT_DURATION seconds.
@@ -66,14 +77,69 @@ class MemcacheConnectionError(Exception):
     pass
 
 
+class MemcachePoolTimeout(Timeout):
+    pass
+
+
+class MemcacheConnPool(Pool):
+    """
+    Bounded pool of connections to one memcached server. Callers wait for a
+    free connection once max_size are in use.
+
+    A connection that failed is put back as (None, None) so that its slot
+    is kept; a new connection is made for it the next time it is handed out.
+    """
+
+    def __init__(self, server, size, connect_timeout, io_timeout):
+        Pool.__init__(self, max_size=size)
+        self.server = server
+        self._connect_timeout = connect_timeout
+        self._io_timeout = io_timeout
+
+    def create(self):
+        if ':' in self.server:
+            host, port = self.server.split(':')
+        else:
+            host = self.server
+            port = DEFAULT_MEMCACHED_PORT
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self._connect_timeout)
+        sock.connect((host, int(port)))
+        sock.settimeout(self._io_timeout)
+        return (sock.makefile(), sock)
+
+    def get(self):
+        fp, sock = Pool.get(self)
+        if fp is None:
+            # the connection in this slot failed earlier, make a new one
+            try:
+                fp, sock = self.create()
+            except (Exception, Timeout):
+                self.put((None, None))
+                raise
+        return fp, sock
+
+
 class MemcacheRing(object):
     """
     Simple, consistent-hashed memcache client.
+
+    Each server has a bounded pool of max_conns connections. Multi-key
+    calls without a server_key spread the keys over the ring like single
+    key calls do, sending one batched command to each server involved, all
+    servers in parallel.
+
+    Values are serialized with JSON by default. With allow_msgpack (and the
+    msgpack module installed) they are serialized with msgpack instead,
+    which is quicker than pickle, safe to load, and keeps byte strings and
+    unicode apart. JSON and msgpack values can always be read back.
     """
 
     def __init__(self, servers, connect_timeout=CONN_TIMEOUT,
-                 io_timeout=IO_TIMEOUT, tries=TRY_COUNT,
-                 allow_pickle=False, allow_unpickle=False):
+                 io_timeout=IO_TIMEOUT, pool_timeout=POOL_TIMEOUT,
+                 tries=TRY_COUNT, allow_pickle=False, allow_unpickle=False,
+                 allow_msgpack=False, max_conns=DEFAULT_MAX_CONNECTIONS):
         self._ring = {}
         self._errors = dict(((serv, []) for serv in servers))
         self._error_limited = dict(((serv, 0) for serv in servers))
@@ -82,14 +148,36 @@ class MemcacheRing(object):
                 self._ring[md5hash('%s-%s' % (server, i))] = server
         self._tries = tries if tries <= len(servers) else len(servers)
         self._sorted = sorted(self._ring.keys())
-        self._client_cache = dict(((server, []) for server in servers))
+        self._client_cache = dict((
+            (server, MemcacheConnPool(server, max_conns, connect_timeout,
+                                      io_timeout))
+            for server in servers))
         self._connect_timeout = connect_timeout
         self._io_timeout = io_timeout
+        self._pool_timeout = pool_timeout
         self._allow_pickle = allow_pickle
         self._allow_unpickle = allow_unpickle or allow_pickle
-
-    def _exception_occurred(self, server, e, action='talking'):
-        if isinstance(e, socket.timeout):
+        if allow_msgpack and msgpack is None:
+            logging.warning(_('msgpack serialization requested but the '
+                              'msgpack module is not installed; using JSON'))
+        self._allow_msgpack = allow_msgpack and msgpack is not None
+
+    def _exception_occurred(self, server, e, action='talking',
+                            sock=None, fp=None, got_connection=True):
+        for conn in (fp, sock):
+            try:
+                if conn:
+                    conn.close()
+            except Exception:
+                pass
+        if got_connection:
+            # keep the pool slot; it reconnects when next handed out
+            self._return_conn(server, None, None)
+        if isinstance(e, Timeout) and not isinstance(e, MemcachePoolTimeout):
+            # the caller's own deadline went off; that's not the server's
+            # fault, and the caller is the one to handle it
+            raise e
+        if isinstance(e, (socket.timeout, Timeout)):
             logging.error(_("Timeout %(action)s to memcached: %(server)s"),
                           {'action': action, 'server': server})
         else:
@@ -104,43 +192,110 @@ class MemcacheRing(object):
                 self._error_limited[server] = now + ERROR_LIMIT_DURATION
                 logging.error(_('Error limiting server %s'), server)
 
-    def _get_conns(self, key):
+    def _get_servers(self, key):
         """
-        Retrieves a server conn from the pool, or connects a new one.
-        Chooses the server based on a consistent hash of "key".
+        Returns the servers, in order, that "key" is tried against.
         """
         pos = bisect(self._sorted, key)
         served = []
         while len(served) < self._tries:
             pos = (pos + 1) % len(self._sorted)
             server = self._ring[self._sorted[pos]]
-            if server in served:
-                continue
-            served.append(server)
+            if server not in served:
+                served.append(server)
+        return tuple(served)
+
+    def _get_conns(self, key):
+        """
+        Retrieves a server conn from the pool, or connects a new one.
+        Chooses the server based on a consistent hash of "key".
+        """
+        for server in self._get_servers(key):
             if self._error_limited[server] > time.time():
                 continue
             try:
-                fp, sock = self._client_cache[server].pop()
+                with MemcachePoolTimeout(self._pool_timeout):
+                    fp, sock = self._client_cache[server].get()
+            except MemcachePoolTimeout, e:
+                self._exception_occurred(
+                    server, e, action='getting a connection',
+                    got_connection=False)
+            except (Exception, Timeout), e:
+                self._exception_occurred(server, e, 'connecting',
+                                         got_connection=False)
+            else:
                 yield server, fp, sock
-            except IndexError:
-                try:
-                    if ':' in server:
-                        host, port = server.split(':')
-                    else:
-                        host = server
-                        port = DEFAULT_MEMCACHED_PORT
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                    sock.settimeout(self._connect_timeout)
-                    sock.connect((host, int(port)))
-                    sock.settimeout(self._io_timeout)
-                    yield server, sock.makefile(), sock
-                except Exception, e:
-                    self._exception_occurred(server, e, 'connecting')
 
     def _return_conn(self, server, fp, sock):
         """ Returns a server connection to the pool """
-        self._client_cache[server].append((fp, sock))
+        self._client_cache[server].put((fp, sock))
+
+    def _group_keys(self, keys):
+        """
+        Groups hashed keys by the servers they would be tried against.
+
+        :returns: dict of server tuple to list of keys
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._get_servers(key), []).append(key)
+        return groups
+
+    def _in_parallel(self, func, args_list):
+        """
+        Calls func(*args) for each args in args_list, concurrently when
+        there is more than one.
+
+        :returns: list of the results, in the order of args_list
+        """
+        if len(args_list) <= 1:
+            return [func(*args) for args in args_list]
+        pile = GreenPile(len(args_list))
+        for args in args_list:
+            pile.spawn(func, *args)
+        return list(pile)
+
+    def _serialize(self, value, serialize=True):
+        """
+        :returns: a tuple of the serialized value and its memcache flags
+        """
+        if not serialize:
+            return value, 0
+        if self._allow_pickle:
+            return pickle.dumps(value, PICKLE_PROTOCOL), PICKLE_FLAG
+        if self._allow_msgpack:
+            return msgpack.packb(value, use_bin_type=True), MSGPACK_FLAG
+        return json.dumps(value), JSON_FLAG
+
+    def _deserialize(self, value, flags):
+        if flags & PICKLE_FLAG:
+            if self._allow_unpickle:
+                return pickle.loads(value)
+            return None
+        if flags & JSON_FLAG:
+            return json.loads(value)
+        if flags & MSGPACK_FLAG:
+            if msgpack is None:
+                return None
+            return msgpack.unpackb(value, encoding='utf-8')
+        return value
+
+    def _read_values(self, fp):
+        """
+        Reads the VALUE lines of a get response up to its END.
+
+        :returns: dict of key to deserialized value
+        """
+        responses = {}
+        line = fp.readline().strip().split()
+        while line[0].upper() != 'END':
+            if line[0].upper() == 'VALUE':
+                size = int(line[3])
+                responses[line[1]] = self._deserialize(
+                    fp.read(size), int(line[2]))
+                fp.readline()
+            line = fp.readline().strip().split()
+        return responses
 
     def set(self, key, value, serialize=True, timeout=0, time=0,
             min_compress_len=0):
@@ -168,21 +323,15 @@ class MemcacheRing(object):
         if timeout:
             logging.warn("parameter timeout has been deprecated, use time")
         timeout = sanitize_timeout(time or timeout)
-        flags = 0
-        if serialize and self._allow_pickle:
-            value = pickle.dumps(value, PICKLE_PROTOCOL)
-            flags |= PICKLE_FLAG
-        elif serialize:
-            value = json.dumps(value)
-            flags |= JSON_FLAG
+        value, flags = self._serialize(value, serialize)
         for (server, fp, sock) in self._get_conns(key):
             try:
                 sock.sendall('set %s %d %d %s noreply\r\n%s\r\n' %
                              (key, flags, timeout, len(value), value))
                 self._return_conn(server, fp, sock)
                 return
-            except Exception, e:
-                self._exception_occurred(server, e)
+            except (Exception, Timeout), e:
+                self._exception_occurred(server, e, sock=sock, fp=fp)
 
     def get(self, key):
         """
@@ -194,28 +343,14 @@ class MemcacheRing(object):
         :returns: value of the key in memcache
         """
         key = md5hash(key)
-        value = None
         for (server, fp, sock) in self._get_conns(key):
             try:
                 sock.sendall('get %s\r\n' % key)
-                line = fp.readline().strip().split()
-                while line[0].upper() != 'END':
-                    if line[0].upper() == 'VALUE' and line[1] == key:
-                        size = int(line[3])
-                        value = fp.read(size)
-                        if int(line[2]) & PICKLE_FLAG:
-                            if self._allow_unpickle:
-                                value = pickle.loads(value)
-                            else:
-                                value = None
-                        elif int(line[2]) & JSON_FLAG:
-                            value = json.loads(value)
-                        fp.readline()
-                    line = fp.readline().strip().split()
+                value = self._read_values(fp).get(key)
                 self._return_conn(server, fp, sock)
                 return value
-            except Exception, e:
-                self._exception_occurred(server, e)
+            except (Exception, Timeout), e:
+                self._exception_occurred(server, e, sock=sock, fp=fp)
 
     def incr(self, key, delta=1, time=0, timeout=0):
         """
@@ -266,8 +401,8 @@ class MemcacheRing(object):
                     ret = int(line[0].strip())
                 self._return_conn(server, fp, sock)
                 return ret
-            except Exception, e:
-                self._exception_occurred(server, e)
+            except (Exception, Timeout), e:
+                self._exception_occurred(server, e, sock=sock, fp=fp)
         raise MemcacheConnectionError("No Memcached connections succeeded.")
 
     def decr(self, key, delta=1, time=0, timeout=0):
@@ -303,17 +438,18 @@ class MemcacheRing(object):
                 sock.sendall('delete %s noreply\r\n' % key)
                 self._return_conn(server, fp, sock)
                 return
-            except Exception, e:
-                self._exception_occurred(server, e)
+            except (Exception, Timeout), e:
+                self._exception_occurred(server, e, sock=sock, fp=fp)
 
-    def set_multi(self, mapping, server_key, serialize=True, timeout=0,
+    def set_multi(self, mapping, server_key=None, serialize=True, timeout=0,
                   time=0, min_compress_len=0):
         """
         Sets multiple key/value pairs in memcache.
 
         :param mapping: dictonary of keys and values to be set in memcache
         :param servery_key: key to use in determining which server in the ring
-                            is used
+                            is used; if None each key goes to its own server
+                            and the servers are written to in parallel
         :param serialize: if True, value is serialized with JSON before sending
                           to memcache, or with pickle if configured to use
                           pickle instead of JSON (to avoid cache poisoning)
@@ -332,65 +468,61 @@ class MemcacheRing(object):
         if timeout:
             logging.warn("parameter timeout has been deprecated, use time")
 
-        server_key = md5hash(server_key)
         timeout = sanitize_timeout(time or timeout)
-        msg = ''
+        commands = {}
         for key, value in mapping.iteritems():
             key = md5hash(key)
-            flags = 0
-            if serialize and self._allow_pickle:
-                value = pickle.dumps(value, PICKLE_PROTOCOL)
-                flags |= PICKLE_FLAG
-            elif serialize:
-                value = json.dumps(value)
-                flags |= JSON_FLAG
-            msg += ('set %s %d %d %s noreply\r\n%s\r\n' %
-                    (key, flags, timeout, len(value), value))
+            value, flags = self._serialize(value, serialize)
+            commands[key] = ('set %s %d %d %s noreply\r\n%s\r\n' %
+                             (key, flags, timeout, len(value), value))
+        if server_key is not None:
+            groups = {md5hash(server_key): commands.keys()}
+        else:
+            groups = dict((keys[0], keys) for keys in
+                          self._group_keys(commands.keys()).itervalues())
+        self._in_parallel(
+            self._send_multi,
+            [(group_key, ''.join(commands[key] for key in keys))
+             for group_key, keys in groups.iteritems()])
+
+    def _send_multi(self, server_key, msg):
         for (server, fp, sock) in self._get_conns(server_key):
             try:
                 sock.sendall(msg)
                 self._return_conn(server, fp, sock)
                 return
-            except Exception, e:
-                self._exception_occurred(server, e)
+            except (Exception, Timeout), e:
+                self._exception_occurred(server, e, sock=sock, fp=fp)
 
-    def get_multi(self, keys, server_key):
+    def get_multi(self, keys, server_key=None):
         """
         Gets multiple values from memcache for the given keys.
 
         :param keys: keys for values to be retrieved from memcache
         :param servery_key: key to use in determining which server in the ring
-                            is used
+                            is used; if None each key is looked for on its
+                            own server and the servers are asked in parallel
         :returns: list of values
         """
-        server_key = md5hash(server_key)
         keys = [md5hash(key) for key in keys]
+        if server_key is not None:
+            groups = {md5hash(server_key): keys}
+        else:
+            groups = dict((group[0], group) for group in
+                          self._group_keys(keys).itervalues())
+        responses = {}
+        for group_responses in self._in_parallel(self._get_multi,
+                                                 groups.items()):
+            responses.update(group_responses)
+        return [responses.get(key) for key in keys]
+
+    def _get_multi(self, server_key, keys):
         for (server, fp, sock) in self._get_conns(server_key):
             try:
                 sock.sendall('get %s\r\n' % ' '.join(keys))
-                line = fp.readline().strip().split()
-                responses = {}
-                while line[0].upper() != 'END':
-                    if line[0].upper() == 'VALUE':
-                        size = int(line[3])
-                        value = fp.read(size)
-                        if int(line[2]) & PICKLE_FLAG:
-                            if self._allow_unpickle:
-                                value = pickle.loads(value)
-                            else:
-                                value = None
-                        elif int(line[2]) & JSON_FLAG:
-                            value = json.loads(value)
-                        responses[line[1]] = value
-                        fp.readline()
-                    line = fp.readline().strip().split()
-                values = []
-                for key in keys:
-                    if key in responses:
-                        values.append(responses[key])
-                    else:
-                        values.append(None)
+                responses = self._read_values(fp)
                 self._return_conn(server, fp, sock)
-                return values
-            except Exception, e:
-                self._exception_occurred(server, e)
+                return responses
+            except (Exception, Timeout), e:
+                self._exception_occurred(server, e, sock=sock, fp=fp)
+        return {}
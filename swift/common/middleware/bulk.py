@@ -14,21 +14,28 @@
 # limitations under the License.
 
 import tarfile
+from collections import deque
+from cStringIO import StringIO
 from urllib import quote, unquote
 from xml.sax import saxutils
+from eventlet import GreenPool, Timeout, spawn
+from eventlet.greenthread import GreenThread
 from swift.common.swob import Request, HTTPBadGateway, \
     HTTPCreated, HTTPBadRequest, HTTPNotFound, HTTPUnauthorized, HTTPOk, \
     HTTPPreconditionFailed, HTTPRequestEntityTooLarge, HTTPNotAcceptable, \
-    HTTPLengthRequired, wsgify
-from swift.common.utils import json, TRUE_VALUES
+    HTTPLengthRequired, HTTPException, HTTPServerError, wsgify
+from swift.common.utils import get_logger, json, TRUE_VALUES
 from swift.common.constraints import check_utf8, MAX_FILE_SIZE
 from swift.common.http import HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, \
-    HTTP_NOT_FOUND
+    HTTP_NOT_FOUND, HTTP_PRECONDITION_FAILED, HTTP_REQUEST_ENTITY_TOO_LARGE
 from swift.common.constraints import MAX_OBJECT_NAME_LENGTH, \
     MAX_CONTAINER_NAME_LENGTH
 
 
 MAX_PATH_LENGTH = MAX_OBJECT_NAME_LENGTH + MAX_CONTAINER_NAME_LENGTH + 2
+# Files in an archive up to this size are read into memory so they can be
+# uploaded concurrently; bigger ones are streamed straight from the archive.
+MAX_BUFFERED_FILE_SIZE = 1024 * 1024
 
 
 class CreateContainerError(Exception):
@@ -77,6 +84,61 @@ def get_response_body(data_format, data_dict, error_list):
     raise HTTPNotAcceptable('Invalid output type')
 
 
+class BulkExecutor(object):
+    """
+    Runs the sub-requests of a bulk operation at most concurrency at a time.
+    Results are handed back in the order the work was submitted so the
+    response lists failures the same way regardless of the concurrency.
+
+    :param concurrency: maximum number of sub-requests in flight; with 1
+                        the work is simply done inline
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = max(1, concurrency)
+        self.pool = GreenPool(self.concurrency)
+        self.pending = deque()
+
+    def spawn(self, func, *args):
+        """
+        Queues func(*args), blocking while concurrency calls are running.
+        """
+        if self.concurrency == 1:
+            self.add_result(func(*args))
+        else:
+            self.pending.append(self.pool.spawn(func, *args))
+
+    def add_result(self, result):
+        """Queues an already known result behind the work in flight."""
+        self.pending.append((result,))
+
+    def results(self, wait=False):
+        """
+        Yields the results of queued work in submission order.
+
+        :param wait: if False stop at the first call still running, otherwise
+                     wait for everything queued
+        """
+        while self.pending:
+            entry = self.pending[0]
+            if isinstance(entry, GreenThread):
+                if not (wait or entry.dead):
+                    return
+                result = entry.wait()
+            else:
+                result = entry[0]
+            self.pending.popleft()
+            yield result
+
+    def drain(self):
+        """
+        Waits for the work still in flight, discarding the results. Used
+        when a bulk operation stops early; nothing new is started.
+        """
+        for _junk in self.results(wait=True):
+            pass
+
+
 class Bulk(object):
     """
     Middleware that will do many operations on a single request.
@@ -151,16 +213,32 @@ class Bulk(object):
     proxy-logging is used the leftmost logger will not have a
     swift.source set and the content length will reflect the size of the
     payload sent to the proxy (the list of objects/containers to be deleted).
+
+    Concurrency and Long Requests:
+
+    Both operations keep up to max_concurrent_ops sub-requests (by default
+    1, one at a time) in flight at once. Files in an archive no bigger than
+    1MB are read into memory so their uploads can overlap; each container is
+    only created (or found to fail) once per request.
+
+    When yield_frequency is set and an operation has not finished within that
+    many seconds, a 200 response is started and a space is sent every
+    yield_frequency seconds until it has. The body then ends in the usual
+    result, which also gives the real outcome as "Response Status" (and, for
+    errors without a result, "Response Body").
     """
 
     def __init__(self, app, conf):
         self.app = app
+        self.logger = get_logger(conf, log_route='bulk')
         self.max_containers = int(
             conf.get('max_containers_per_extraction', 10000))
         self.max_failed_extractions = int(
             conf.get('max_failed_extractions', 1000))
         self.max_deletes_per_request = int(
             conf.get('max_deletes_per_request', 1000))
+        self.max_concurrent_ops = int(conf.get('max_concurrent_ops', 1))
+        self.yield_frequency = float(conf.get('yield_frequency', 0))
 
     def create_container(self, req, container_path):
         """
@@ -238,15 +316,8 @@ class Bulk(object):
         failed_files = []
         success_count = not_found_count = 0
         failed_file_response_type = HTTPBadRequest
-        for obj_to_delete in objs_to_delete:
-            obj_to_delete = obj_to_delete.strip().lstrip('/')
-            if not obj_to_delete:
-                continue
-            delete_path = '/'.join(['', vrs, account, obj_to_delete])
-            if not check_utf8(delete_path):
-                failed_files.append([quote(delete_path),
-                                     HTTPPreconditionFailed().status])
-                continue
+
+        def delete_one(delete_path):
             new_env = req.environ.copy()
             new_env['PATH_INFO'] = delete_path
             del(new_env['wsgi.input'])
@@ -255,28 +326,50 @@ class Bulk(object):
                 '%s %s' % (req.environ.get('HTTP_USER_AGENT'), user_agent)
             new_env['swift.source'] = swift_source
             delete_obj_req = Request.blank(delete_path, new_env)
-            resp = delete_obj_req.get_response(self.app)
-            if resp.status_int // 100 == 2:
-                success_count += 1
-            elif resp.status_int == HTTP_NOT_FOUND:
-                not_found_count += 1
-            elif resp.status_int == HTTP_UNAUTHORIZED:
-                return HTTPUnauthorized(request=req)
-            else:
-                if resp.status_int // 100 == 5:
-                    failed_file_response_type = HTTPBadGateway
-                failed_files.append([quote(delete_path), resp.status])
-
-        resp_body = get_response_body(
-            out_content_type,
-            {'Number Deleted': success_count,
-             'Number Not Found': not_found_count},
-            failed_files)
+            return delete_path, delete_obj_req.get_response(self.app)
+
+        executor = BulkExecutor(self.max_concurrent_ops)
+
+        def delete_results():
+            for obj_to_delete in objs_to_delete:
+                obj_to_delete = obj_to_delete.strip().lstrip('/')
+                if not obj_to_delete:
+                    continue
+                delete_path = '/'.join(['', vrs, account, obj_to_delete])
+                if not check_utf8(delete_path):
+                    executor.add_result(
+                        (delete_path, HTTPPreconditionFailed()))
+                else:
+                    executor.spawn(delete_one, delete_path)
+                for result in executor.results():
+                    yield result
+            for result in executor.results(wait=True):
+                yield result
+
+        try:
+            for delete_path, resp in delete_results():
+                if resp.status_int // 100 == 2:
+                    success_count += 1
+                elif resp.status_int == HTTP_NOT_FOUND:
+                    not_found_count += 1
+                elif resp.status_int == HTTP_UNAUTHORIZED:
+                    return HTTPUnauthorized(request=req)
+                else:
+                    if resp.status_int // 100 == 5:
+                        failed_file_response_type = HTTPBadGateway
+                    failed_files.append([quote(delete_path), resp.status])
+        finally:
+            executor.drain()
+
+        data_dict = {'Number Deleted': success_count,
+                     'Number Not Found': not_found_count}
         if (success_count or not_found_count) and not failed_files:
-            return HTTPOk(resp_body, content_type=out_content_type)
+            return self.bulk_response(
+                req, HTTPOk, out_content_type, data_dict, failed_files)
         if failed_files:
-            return failed_file_response_type(
-                resp_body, content_type=out_content_type)
+            return self.bulk_response(
+                req, failed_file_response_type, out_content_type, data_dict,
+                failed_files)
         return HTTPBadRequest('Invalid bulk delete.')
 
     def handle_extract(self, req, compress_type):
@@ -289,7 +382,6 @@ class Bulk(object):
         """
         success_count = 0
         failed_files = []
-        existing_containers = set()
         out_content_type = req.accept.best_match(ACCEPTABLE_FORMATS)
         if not out_content_type:
             return HTTPNotAcceptable(request=req)
@@ -302,89 +394,187 @@ class Bulk(object):
             return HTTPNotFound(request=req)
         extract_base = extract_base or ''
         extract_base = extract_base.rstrip('/')
-        try:
+
+        def create_obj(destination, obj_file, size):
+            new_env = req.environ.copy()
+            new_env['wsgi.input'] = obj_file
+            new_env['PATH_INFO'] = destination
+            new_env['CONTENT_LENGTH'] = size
+            new_env['swift.source'] = 'EA'
+            new_env['HTTP_USER_AGENT'] = \
+                '%s BulkExpand' % req.environ.get('HTTP_USER_AGENT')
+            create_obj_req = Request.blank(destination, new_env)
+            resp = create_obj_req.get_response(self.app)
+            return destination, resp.status_int, resp.status
+
+        executor = BulkExecutor(self.max_concurrent_ops)
+
+        def extract_results():
+            # container -> None once created, otherwise the (status_int,
+            # status) to fail its files with; server errors aren't
+            # remembered so the next file gets another go
+            containers = {}
+            created_containers = 0
             tar = tarfile.open(mode='r|' + compress_type,
                                fileobj=req.body_file)
             while True:
+                for result in executor.results():
+                    yield result
                 tar_info = tar.next()
                 if tar_info is None or \
                         len(failed_files) >= self.max_failed_extractions:
                     break
-                if tar_info.isfile():
-                    obj_path = tar_info.name
-                    if obj_path.startswith('./'):
-                        obj_path = obj_path[2:]
-                    obj_path = obj_path.lstrip('/')
-                    if extract_base:
-                        obj_path = extract_base + '/' + obj_path
-                    if '/' not in obj_path:
-                        continue  # ignore base level file
-
-                    destination = '/'.join(
-                        ['', vrs, account, obj_path])
-                    container = obj_path.split('/', 1)[0]
-                    if not check_utf8(destination):
-                        failed_files.append(
-                            [quote(destination[:MAX_PATH_LENGTH]),
-                             HTTPPreconditionFailed().status])
+                if not tar_info.isfile():
+                    continue
+                obj_path = tar_info.name
+                if obj_path.startswith('./'):
+                    obj_path = obj_path[2:]
+                obj_path = obj_path.lstrip('/')
+                if extract_base:
+                    obj_path = extract_base + '/' + obj_path
+                if '/' not in obj_path:
+                    continue  # ignore base level file
+
+                destination = '/'.join(['', vrs, account, obj_path])
+                container = obj_path.split('/', 1)[0]
+                if not check_utf8(destination):
+                    executor.add_result(
+                        (destination, HTTP_PRECONDITION_FAILED,
+                         HTTPPreconditionFailed().status))
+                    continue
+                if tar_info.size > MAX_FILE_SIZE:
+                    executor.add_result(
+                        (destination, HTTP_REQUEST_ENTITY_TOO_LARGE,
+                         HTTPRequestEntityTooLarge().status))
+                    continue
+                if container not in containers:
+                    try:
+                        self.create_container(
+                            req, '/'.join(['', vrs, account, container]))
+                        containers[container] = None
+                        created_containers += 1
+                    except CreateContainerError, err:
+                        if err.status_int // 100 != 5:
+                            containers[container] = (err.status_int,
+                                                     err.status)
+                        executor.add_result(
+                            (destination, err.status_int, err.status))
                         continue
-                    if tar_info.size > MAX_FILE_SIZE:
-                        failed_files.append([
-                            quote(destination[:MAX_PATH_LENGTH]),
-                            HTTPRequestEntityTooLarge().status])
+                    except ValueError:
+                        containers[container] = (HTTP_BAD_REQUEST,
+                                                 HTTP_BAD_REQUEST)
+                        executor.add_result(
+                            (destination, HTTP_BAD_REQUEST, HTTP_BAD_REQUEST))
                         continue
-                    if container not in existing_containers:
-                        try:
-                            self.create_container(
-                                req, '/'.join(['', vrs, account, container]))
-                            existing_containers.add(container)
-                        except CreateContainerError, err:
-                            if err.status_int == HTTP_UNAUTHORIZED:
-                                return HTTPUnauthorized(request=req)
-                            failed_files.append([
-                                quote(destination[:MAX_PATH_LENGTH]),
-                                err.status])
-                            continue
-                        except ValueError:
-                            failed_files.append([
-                                quote(destination[:MAX_PATH_LENGTH]),
-                                HTTP_BAD_REQUEST])
-                            continue
-                        if len(existing_containers) > self.max_containers:
-                            return HTTPBadRequest(
-                                'More than %d base level containers in tar.' %
-                                self.max_containers)
-
-                    tar_file = tar.extractfile(tar_info)
-                    new_env = req.environ.copy()
-                    new_env['wsgi.input'] = tar_file
-                    new_env['PATH_INFO'] = destination
-                    new_env['CONTENT_LENGTH'] = tar_info.size
-                    new_env['swift.source'] = 'EA'
-                    new_env['HTTP_USER_AGENT'] = \
-                        '%s BulkExpand' % req.environ.get('HTTP_USER_AGENT')
-                    create_obj_req = Request.blank(destination, new_env)
-                    resp = create_obj_req.get_response(self.app)
-                    if resp.status_int // 100 == 2:
-                        success_count += 1
-                    else:
-                        if resp.status_int == HTTP_UNAUTHORIZED:
-                            return HTTPUnauthorized(request=req)
-                        failed_files.append([
-                            quote(destination[:MAX_PATH_LENGTH]), resp.status])
-
-            resp_body = get_response_body(
-                out_content_type,
-                {'Number Files Created': success_count},
-                failed_files)
+                    if created_containers > self.max_containers:
+                        raise HTTPBadRequest(
+                            'More than %d base level containers in tar.' %
+                            self.max_containers)
+                elif containers[container] is not None:
+                    executor.add_result(
+                        (destination,) + containers[container])
+                    continue
+
+                tar_file = tar.extractfile(tar_info)
+                if tar_info.size <= MAX_BUFFERED_FILE_SIZE:
+                    # read it now so the upload can run while the archive
+                    # moves on to the next member
+                    executor.spawn(create_obj, destination,
+                                   StringIO(tar_file.read()), tar_info.size)
+                else:
+                    executor.add_result(
+                        create_obj(destination, tar_file, tar_info.size))
+            for result in executor.results(wait=True):
+                yield result
+
+        try:
+            for destination, status_int, status in extract_results():
+                if status_int // 100 == 2:
+                    success_count += 1
+                elif status_int == HTTP_UNAUTHORIZED:
+                    return HTTPUnauthorized(request=req)
+                else:
+                    failed_files.append([
+                        quote(destination[:MAX_PATH_LENGTH]), status])
+
+            data_dict = {'Number Files Created': success_count}
             if success_count and not failed_files:
-                return HTTPCreated(resp_body, content_type=out_content_type)
+                return self.bulk_response(
+                    req, HTTPCreated, out_content_type, data_dict,
+                    failed_files)
             if failed_files:
-                return HTTPBadGateway(resp_body, content_type=out_content_type)
+                return self.bulk_response(
+                    req, HTTPBadGateway, out_content_type, data_dict,
+                    failed_files)
             return HTTPBadRequest('Invalid Tar File: No Valid Files')
 
+        except HTTPException, err_resp:
+            return err_resp
         except tarfile.TarError, tar_error:
             return HTTPBadRequest('Invalid Tar File: %s' % tar_error)
+        finally:
+            executor.drain()
+
+    def bulk_response(self, req, resp_type, out_content_type, data_dict,
+                      failed_files):
+        """
+        Builds the response to a bulk operation, remembering the data
+        behind it in case the status has to be reported in the body.
+        :params resp_type: the swob response class to return
+        :params out_content_type: resulting format
+        :params data_dict: generated data about results.
+        :params failed_files: list of quoted filenames that failed
+        :returns: a swob Response
+        """
+        req.environ['swift.bulk.result'] = (data_dict, failed_files)
+        return resp_type(
+            get_response_body(out_content_type, data_dict, failed_files),
+            content_type=out_content_type)
+
+    def keep_alive(self, req, handler, *args):
+        """
+        Runs handler(*args). If it is not done within yield_frequency
+        seconds a 200 is started, and a space is sent every yield_frequency
+        seconds until it is, so that the client and anything in between
+        don't time the connection out. The real outcome then follows in the
+        body, with its status given as "Response Status".
+        :params req: a swob Request
+        :params handler: handle_delete or handle_extract
+        :returns: a swob Response
+        """
+        if self.yield_frequency <= 0:
+            return handler(*args)
+        out_content_type = req.accept.best_match(ACCEPTABLE_FORMATS)
+        if not out_content_type:
+            return HTTPNotAcceptable(request=req)
+        worker = spawn(handler, *args)
+        with Timeout(self.yield_frequency, False):
+            return worker.wait()
+        return HTTPOk(
+            app_iter=self._keep_alive_iter(req, worker, out_content_type),
+            content_type=out_content_type)
+
+    def _keep_alive_iter(self, req, worker, out_content_type):
+        resp = None
+        try:
+            while resp is None:
+                yield ' '
+                with Timeout(self.yield_frequency, False):
+                    try:
+                        resp = worker.wait()
+                    except HTTPException, err_resp:
+                        resp = err_resp
+                    except Exception:
+                        # too late to let it become a 500 of its own
+                        self.logger.exception(_('Error in bulk request'))
+                        resp = HTTPServerError(request=req)
+        except GeneratorExit:
+            worker.kill()
+            raise
+        data_dict, failed_files = req.environ.pop(
+            'swift.bulk.result', ({'Response Body': resp.body}, []))
+        data_dict['Response Status'] = resp.status
+        yield get_response_body(out_content_type, data_dict, failed_files)
 
     @wsgify
     def __call__(self, req):
@@ -394,11 +584,12 @@ class Bulk(object):
                 'tar': '', 'tar.gz': 'gz',
                 'tar.bz2': 'bz2'}.get(extract_type.lower().strip('.'))
             if archive_type is not None:
-                return self.handle_extract(req, archive_type)
+                return self.keep_alive(
+                    req, self.handle_extract, req, archive_type)
             else:
                 return HTTPBadRequest("Unsupported archive format")
         if 'bulk-delete' in req.params and req.method == 'DELETE':
-            return self.handle_delete(req)
+            return self.keep_alive(req, self.handle_delete, req)
 
         return self.app
 
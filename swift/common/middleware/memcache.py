@@ -16,7 +16,8 @@
 import os
 from ConfigParser import ConfigParser, NoSectionError, NoOptionError
 
-from swift.common.memcached import MemcacheRing
+from swift.common.memcached import MemcacheRing, \
+    DEFAULT_MAX_CONNECTIONS
 
 
 class MemcacheMiddleware(object):
@@ -28,8 +29,10 @@ class MemcacheMiddleware(object):
         self.app = app
         self.memcache_servers = conf.get('memcache_servers')
         serialization_format = conf.get('memcache_serialization_support')
+        max_conns = conf.get('memcache_max_connections')
 
-        if not self.memcache_servers or serialization_format is None:
+        if not self.memcache_servers or serialization_format is None or \
+                max_conns is None:
             path = os.path.join(conf.get('swift_dir', '/etc/swift'),
                                 'memcache.conf')
             memcache_conf = ConfigParser()
@@ -47,6 +50,13 @@ class MemcacheMiddleware(object):
                                               'memcache_serialization_support')
                     except (NoSectionError, NoOptionError):
                         pass
+                if max_conns is None:
+                    try:
+                        max_conns = \
+                            memcache_conf.get('memcache',
+                                              'memcache_max_connections')
+                    except (NoSectionError, NoOptionError):
+                        pass
 
         if not self.memcache_servers:
             self.memcache_servers = '127.0.0.1:11211'
@@ -54,11 +64,17 @@ class MemcacheMiddleware(object):
             serialization_format = 2
         else:
             serialization_format = int(serialization_format)
+        if max_conns is None:
+            max_conns = DEFAULT_MAX_CONNECTIONS
+        else:
+            max_conns = max(1, int(max_conns))
 
         self.memcache = MemcacheRing(
             [s.strip() for s in self.memcache_servers.split(',') if s.strip()],
             allow_pickle=(serialization_format == 0),
-            allow_unpickle=(serialization_format <= 1))
+            allow_unpickle=(serialization_format <= 1),
+            allow_msgpack=(serialization_format == 3),
+            max_conns=max_conns)
 
     def __call__(self, env, start_response):
         env['swift.cache'] = self.memcache
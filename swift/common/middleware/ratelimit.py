@@ -20,16 +20,56 @@ from swift.common.memcached import MemcacheConnectionError
 from swift.common.swob import Request, Response
 
 
+# how much of the request counts a bucket's share is based on is carried
+# over from one sync to the next
+SHARE_DECAY = 0.8
+
+
 class MaxSleepTimeHitError(Exception):
     pass
 
 
+class LocalRateBucket(object):
+    """
+    One worker's share of a ratelimit key, used when sync_interval is set.
+
+    The worker limits the key itself, at max_rate times share, where share
+    is this worker's part of all the requests for the key across the
+    proxies recently. requests counts this worker's requests since it last
+    added them to the key's counter in memcache; own and total are decaying
+    sums of this worker's and everybody's requests, as of the last sync.
+    """
+
+    def __init__(self, now_m):
+        self.running_time_m = now_m
+        self.last_used_m = now_m
+        self.requests = 0
+        self.counter = None
+        self.own = self.total = 0.0
+
+    @property
+    def share(self):
+        # a worker that hasn't seen the key lately still gets a little of it
+        return min(max(self.own, 1) / max(self.total, 1), 1)
+
+
 class RateLimitMiddleware(object):
     """
     Rate limiting middleware
 
     Rate limits requests on both an Account and Container level.  Limits are
     configurable.
+
+    By default every limited request does an incr on its key in memcache.
+    With sync_interval set, each worker instead limits a key by itself, at
+    its share of the key's rate: the part of all the key's requests, across
+    the proxies, that came to this worker lately. Workers add up the
+    requests they see for a key in memcache once every sync_interval
+    seconds, off the request path, and take their new shares from the
+    totals; the first request for a key a worker hasn't seen lately waits
+    for that. The sum of the shares stays close to the configured rate, but
+    a change in how requests are spread across the proxies takes a few
+    sync_intervals to be reflected.
     """
 
     BLACK_LIST_SLEEP = 1
@@ -47,6 +87,10 @@ class RateLimitMiddleware(object):
             float(conf.get('log_sleep_time_seconds', 0))
         self.clock_accuracy = int(conf.get('clock_accuracy', 1000))
         self.rate_buffer_seconds = int(conf.get('rate_buffer_seconds', 5))
+        self.sync_interval = float(conf.get('sync_interval', 0))
+        self.buckets = {}
+        self.last_sync_m = 0
+        self.syncing = False
         self.ratelimit_whitelist = \
             [acc.strip() for acc in
                 conf.get('account_whitelist', '').split(',') if acc.strip()]
@@ -138,6 +182,8 @@ class RateLimitMiddleware(object):
         :param max_rate: maximum rate allowed in requests per second
         :raises: MaxSleepTimeHitError if max sleep time is exceeded.
         '''
+        if self.sync_interval > 0:
+            return self._get_local_sleep_time(key, max_rate)
         try:
             now_m = int(round(time.time() * self.clock_accuracy))
             time_per_request_m = int(round(self.clock_accuracy / max_rate))
@@ -165,6 +211,78 @@ class RateLimitMiddleware(object):
         except MemcacheConnectionError:
             return 0
 
+    def _get_local_sleep_time(self, key, max_rate):
+        '''
+        Same as _get_sleep_time, but against the worker's LocalRateBucket for
+        key instead of memcache.
+        '''
+        now_m = int(round(time.time() * self.clock_accuracy))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = LocalRateBucket(now_m)
+            self._sync_bucket(key, bucket)
+        bucket.last_used_m = now_m
+        bucket.requests += 1
+        if not self.syncing and now_m - self.last_sync_m >= \
+                self.sync_interval * self.clock_accuracy:
+            self.syncing = True
+            eventlet.spawn_n(self._sync_buckets)
+        time_per_request_m = int(round(
+            self.clock_accuracy / (max_rate * bucket.share)))
+        if (now_m - bucket.running_time_m >
+                self.rate_buffer_seconds * self.clock_accuracy):
+            bucket.running_time_m = now_m
+        need_to_sleep_m = max(bucket.running_time_m - now_m, 0)
+
+        max_sleep_m = self.max_sleep_time_seconds * self.clock_accuracy
+        if max_sleep_m - need_to_sleep_m <= self.clock_accuracy * 0.01:
+            raise MaxSleepTimeHitError(
+                "Max Sleep Time Exceeded: %.2f" %
+                (float(need_to_sleep_m) / self.clock_accuracy))
+
+        bucket.running_time_m += time_per_request_m
+        return float(need_to_sleep_m) / self.clock_accuracy
+
+    def _sync_bucket(self, key, bucket):
+        """
+        Adds the requests a bucket has seen to its key's counter in memcache
+        and works out the bucket's new share from what everybody else saw.
+        """
+        requests = bucket.requests
+        bucket.requests = 0
+        try:
+            counter = self.memcache_client.incr('%s/requests' % key,
+                                                delta=requests)
+        except MemcacheConnectionError:
+            bucket.requests += requests
+            return
+        if bucket.counter is not None:
+            # a counter that went backwards expired or was evicted
+            others = max(counter - bucket.counter - requests, 0)
+            bucket.own = bucket.own * SHARE_DECAY + requests
+            bucket.total = bucket.total * SHARE_DECAY + requests + others
+        bucket.counter = counter
+
+    def _sync_buckets(self):
+        """
+        Syncs every bucket used since the last sync, and forgets those that
+        weren't once they have nothing left to add.
+        """
+        try:
+            last_sync_m = self.last_sync_m
+            self.last_sync_m = int(round(time.time() * self.clock_accuracy))
+            for key, bucket in self.buckets.items():
+                used = bucket.last_used_m >= last_sync_m
+                if used or bucket.requests:
+                    self._sync_bucket(key, bucket)
+                if not used and not bucket.requests and \
+                        self.buckets.get(key) is bucket:
+                    del self.buckets[key]
+        except Exception:
+            self.logger.exception(_('Error syncing ratelimits'))
+        finally:
+            self.syncing = False
+
     def handle_ratelimit(self, req, account_name, container_name, obj_name):
         '''
         Performs rate limiting and account white/black listing.  Sleeps
@@ -128,7 +128,8 @@ class ReconMiddleware(object):
                                           self.container_recon_cache)
         elif recon_type == 'object':
             return self._from_recon_cache(['object_replication_time',
-                                           'object_replication_last'],
+                                           'object_replication_last',
+                                           'object_replication_progress'],
                                           self.object_recon_cache)
         else:
             return None
@@ -152,6 +153,27 @@ class ReconMiddleware(object):
         else:
             return None
 
+    def get_merge_info(self):
+        """
+        get container server background merge info, the stats of each
+        device's latest batch added up over the worker processes
+        """
+        entries = self._from_recon_cache(
+            ['container_merge'],
+            self.container_recon_cache)['container_merge'] or {}
+        devices = {}
+        for entry in entries.itervalues():
+            if not isinstance(entry, dict) or 'device' not in entry:
+                continue
+            stats = devices.setdefault(
+                entry['device'], {'queue_depth': 0, 'merged': 0,
+                                  'merge_time': 0, 'max_staleness': 0})
+            for key in ('queue_depth', 'merged'):
+                stats[key] += entry.get(key, 0)
+            for key in ('merge_time', 'max_staleness'):
+                stats[key] = max(stats[key], entry.get(key, 0))
+        return {'container_merge': devices}
+
     def get_expirer_info(self, recon_type):
         """get expirer info"""
         if recon_type == 'object':
@@ -291,6 +313,8 @@ class ReconMiddleware(object):
             content = self.get_updater_info(rtype)
         elif rcheck == "auditor" and rtype in all_rtypes:
             content = self.get_auditor_info(rtype)
+        elif rcheck == "merge":
+            content = self.get_merge_info()
         elif rcheck == "expirer" and rtype == 'object':
             content = self.get_expirer_info(rtype)
         elif rcheck == "mounted":
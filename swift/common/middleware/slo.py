@@ -101,7 +101,9 @@ left to the user use caution in handling the segments.
 Deleting a Large Object
 -----------------------
 
-A DELETE request will just delete the manifest object itself.
+A DELETE request will just delete the manifest object itself. That includes
+objects stored by auto-segmenting (see below); their segments are only
+deleted along with them by a DELETE with ?multipart-manifest=delete.
 
 A DELETE with a query parameter::
 
@@ -118,6 +120,35 @@ Modifying a Large Object
 PUTs / POSTs will work as expected, PUTs will just overwrite the manifest
 object for example.
 
+---------------------------
+Auto-segmenting Large PUTs
+---------------------------
+
+If auto_segment_size is set, an ordinary object PUT with a Content-Length
+larger than that is turned into a static large object by the proxy, without
+any change to the client. The request body is cut into segments of
+auto_segment_size bytes (more if that would exceed max_manifest_segments)
+which are stored in the container <container>_segments as::
+
+    <object>/<timestamp>/<total size>/<segment size>/<segment index>
+
+The segment container is created if it does not exist yet, which the client
+needs permission to do; if it can't be, the PUT fails with the 4xx status of
+the container request.
+
+Up to auto_segment_concurrency segments are written to the object servers at
+once, each from a small buffer filled as the client's body is read, so a
+single upload becomes several parallel backend streams. Once every segment
+is stored a manifest for them is written under the requested name. If
+anything fails, the segments already written are deleted again.
+
+An Etag sent by the client is checked against the MD5 of the whole body, as
+for an ordinary PUT. The Etag of the response, though, is the one any later
+GET or HEAD of the object returns: that of a static large object, the MD5
+of its segments' Etags. Like any other static large object, the object's
+segments are left behind when it is overwritten or deleted with a plain
+DELETE; delete it with ?multipart-manifest=delete to remove them too.
+
 ------------------
 Container Listings
 ------------------
@@ -136,13 +167,28 @@ metadata which can be used for stats purposes.
 from urllib import quote
 from cStringIO import StringIO
 from datetime import datetime
+from hashlib import md5
+from time import time
 import mimetypes
+from eventlet import GreenPile, GreenPool
+from eventlet.queue import Queue, Empty
+from swift.common.constraints import MAX_FILE_SIZE
+from swift.common.exceptions import ChunkReadTimeout
 from swift.common.swob import Request, HTTPBadRequest, HTTPServerError, \
-    HTTPMethodNotAllowed, HTTPRequestEntityTooLarge, HTTPLengthRequired, wsgify
-from swift.common.utils import json, get_logger, config_true_value
+    HTTPMethodNotAllowed, HTTPRequestEntityTooLarge, HTTPLengthRequired, \
+    HTTPClientDisconnect, HTTPRequestTimeout, HTTPUnprocessableEntity, \
+    status_map, wsgify
+from swift.common.utils import json, get_logger, config_true_value, \
+    normalize_timestamp
 from swift.common.middleware.bulk import get_response_body, \
     ACCEPTABLE_FORMATS, Bulk
 
+#: Size of the reads from the client when auto-segmenting a PUT
+AUTO_SEGMENT_CHUNK_SIZE = 65536
+
+#: Chunks buffered for each auto-segment PUT in flight
+AUTO_SEGMENT_BUFFER_CHUNKS = 16
+
 
 def parse_input(raw_data):
     """
@@ -167,6 +213,47 @@ def parse_input(raw_data):
     return parsed_data
 
 
+class SegmentPipe(object):
+    """
+    File-like wsgi.input for one auto-segment PUT, fed with the client's
+    request body as it is read.
+
+    :param max_chunks: chunks written but not yet read before write() waits
+    """
+
+    def __init__(self, max_chunks):
+        self.chunks = Queue(max_chunks)
+        self.buf = ''
+        self.eof = False
+        self.finished = False
+
+    def write(self, chunk):
+        if not self.finished:
+            self.chunks.put(chunk)
+
+    def close(self):
+        """Ends the segment; the PUT reads whatever it is short as EOF."""
+        self.write('')
+
+    def read(self, size=-1):
+        if not self.buf and not self.eof:
+            self.buf = self.chunks.get()
+            self.eof = not self.buf
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def finish(self):
+        """Called once the PUT is done with; discards anything unread."""
+        self.finished = True
+        try:
+            while True:
+                self.chunks.get_nowait()
+        except Empty:
+            pass
+
+
 class StaticLargeObject(object):
     """
     StaticLargeObject Middleware
@@ -192,6 +279,13 @@ class StaticLargeObject(object):
                                     1024 * 1024))
         self.bulk_deleter = Bulk(
             app, {'max_deletes_per_request': self.max_manifest_segments})
+        self.auto_segment_size = int(self.conf.get('auto_segment_size', 0))
+        if self.auto_segment_size:
+            self.auto_segment_size = max(self.auto_segment_size,
+                                         self.min_segment_size)
+        self.auto_segment_concurrency = int(
+            self.conf.get('auto_segment_concurrency', 4))
+        self.client_timeout = int(self.conf.get('client_timeout', 60))
 
     def handle_multipart_put(self, req):
         """
@@ -280,6 +374,18 @@ class StaticLargeObject(object):
             resp_body = get_response_body(
                 out_content_type, {}, problem_segments)
             raise HTTPBadRequest(resp_body, content_type=out_content_type)
+        self._make_manifest_put(req, data_for_storage, total_size)
+        return self.app
+
+    def _make_manifest_put(self, req, data_for_storage, total_size):
+        """
+        Turns req into the PUT of the manifest object that is actually
+        stored for a SLO.
+
+        :params req: a swob.Request with an obj in path
+        :params data_for_storage: list of segment dicts for the manifest
+        :params total_size: sum of the segment sizes
+        """
         env = req.environ
 
         if not env.get('CONTENT_TYPE'):
@@ -291,7 +397,157 @@ class StaticLargeObject(object):
         json_data = json.dumps(data_for_storage)
         env['CONTENT_LENGTH'] = str(len(json_data))
         env['wsgi.input'] = StringIO(json_data)
-        return self.app
+
+    def _sub_request(self, req, path, method, user_agent):
+        """
+        Makes a subrequest for req with no body.
+
+        :returns: the subrequest's swob.Response
+        """
+        new_env = req.environ.copy()
+        new_env['PATH_INFO'] = path
+        new_env['REQUEST_METHOD'] = method
+        new_env['swift.source'] = 'SLO'
+        new_env.pop('wsgi.input', None)
+        new_env.pop('HTTP_ETAG', None)
+        new_env['QUERY_STRING'] = ''
+        new_env['CONTENT_LENGTH'] = 0
+        new_env['HTTP_USER_AGENT'] = \
+            '%s %s' % (req.environ.get('HTTP_USER_AGENT'), user_agent)
+        return Request.blank(path, new_env).get_response(self.app)
+
+    def _put_segment(self, req, path, size, pipe, failed):
+        """
+        PUTs one auto-segment, reading its body from pipe.
+
+        :param failed: list the response is appended to if the PUT fails,
+                       so the caller can stop reading the client's body
+        :returns: a tuple of (path, size, swob.Response)
+        """
+        new_env = req.environ.copy()
+        for key in new_env.keys():
+            if key.startswith('HTTP_X_OBJECT_META_'):
+                del new_env[key]
+        new_env['PATH_INFO'] = path
+        new_env['swift.source'] = 'SLO'
+        new_env.pop('HTTP_ETAG', None)
+        new_env['QUERY_STRING'] = ''
+        new_env['CONTENT_LENGTH'] = str(size)
+        new_env['CONTENT_TYPE'] = 'application/octet-stream'
+        new_env['wsgi.input'] = pipe
+        new_env['HTTP_USER_AGENT'] = \
+            '%s AutoSegmentPUT' % req.environ.get('HTTP_USER_AGENT')
+        try:
+            resp = Request.blank(path, new_env).get_response(self.app)
+            if resp.status_int // 100 != 2:
+                failed.append(resp)
+            return path, size, resp
+        finally:
+            pipe.finish()
+
+    def _delete_segments(self, req, paths):
+        for path in paths:
+            self._sub_request(req, path, 'DELETE', 'AutoSegmentDELETE')
+
+    def handle_auto_segment_put(self, req):
+        """
+        Will handle a PUT too large for one object by storing its body as
+        segments, several at a time, and then a SLO manifest for them.
+
+        :params req: a swob.Request with an obj in path
+        :returns: swob.Response on failure, otherwise self.app
+        """
+        vrs, account, container, obj = req.split_path(4, 4, True)
+        segment_size = max(
+            self.auto_segment_size,
+            -(-req.content_length // self.max_manifest_segments))
+        if segment_size > MAX_FILE_SIZE:
+            raise HTTPRequestEntityTooLarge(request=req)
+        seg_container = container + '_segments'
+        seg_container_path = '/'.join(['', vrs, account, seg_container])
+        resp = self._sub_request(req, seg_container_path, 'HEAD',
+                                 'AutoSegmentPUT')
+        if resp.status_int == 404:
+            resp = self._sub_request(req, seg_container_path, 'PUT',
+                                     'AutoSegmentPUT')
+        if resp.status_int // 100 == 4:
+            return status_map[resp.status_int](
+                request=req,
+                body='Objects over %d bytes are stored as segments in the '
+                     'container %s, which could not be created.' %
+                     (self.auto_segment_size, seg_container))
+        if resp.status_int // 100 != 2:
+            return resp
+
+        prefix = '%s/%s/%s/%s/' % (obj, normalize_timestamp(time()),
+                                   req.content_length, segment_size)
+        pile = GreenPile(GreenPool(self.auto_segment_concurrency))
+        body_md5 = md5()
+        error_resp = None
+        failed = []
+        left = req.content_length
+        index = 0
+        while left > 0 and not error_resp and not failed:
+            seg_left = min(segment_size, left)
+            pipe = SegmentPipe(AUTO_SEGMENT_BUFFER_CHUNKS)
+            pile.spawn(self._put_segment, req,
+                       '%s/%s%08d' % (seg_container_path, prefix, index),
+                       seg_left, pipe, failed)
+            while seg_left > 0:
+                if failed:
+                    # no point reading a body that won't be stored
+                    break
+                try:
+                    with ChunkReadTimeout(self.client_timeout):
+                        chunk = req.environ['wsgi.input'].read(
+                            min(AUTO_SEGMENT_CHUNK_SIZE, seg_left))
+                except ChunkReadTimeout:
+                    error_resp = HTTPRequestTimeout(request=req)
+                    break
+                if not chunk:
+                    error_resp = HTTPClientDisconnect(request=req)
+                    break
+                body_md5.update(chunk)
+                pipe.write(chunk)
+                seg_left -= len(chunk)
+                left -= len(chunk)
+            pipe.close()
+            index += 1
+
+        data_for_storage = []
+        stored = []
+        for path, size, resp in pile:
+            if resp.status_int // 100 != 2:
+                if not error_resp:
+                    error_resp = resp
+                continue
+            stored.append(path)
+            last_modified = resp.last_modified or datetime.now()
+            data_for_storage.append(
+                {'name': '/' + path.split('/', 3)[3],
+                 'bytes': size,
+                 'hash': resp.etag,
+                 'content_type': 'application/octet-stream',
+                 'last_modified':
+                 last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')})
+        etag = req.headers.get('etag')
+        if not error_resp and etag and \
+                etag.strip('"').lower() != body_md5.hexdigest():
+            error_resp = HTTPUnprocessableEntity(request=req)
+        if error_resp:
+            self._delete_segments(req, stored)
+            return error_resp
+
+        req.environ.pop('HTTP_ETAG', None)
+        self._make_manifest_put(req, data_for_storage, req.content_length)
+        resp = req.get_response(self.app)
+        if resp.status_int // 100 != 2:
+            self._delete_segments(req, stored)
+            return resp
+        # what a GET or HEAD of the large object will say
+        resp.etag = md5(''.join(
+            seg['hash'] for seg in data_for_storage)).hexdigest()
+        return resp
 
     def handle_multipart_delete(self, req):
         """
@@ -352,6 +608,11 @@ class StaticLargeObject(object):
                     body='X-Static-Large-Object is a reserved header. '
                     'To create a static large object add query param '
                     'multipart-manifest=put.')
+            if req.method == 'PUT' and self.auto_segment_size and \
+                    req.content_length > self.auto_segment_size and \
+                    'X-Copy-From' not in req.headers and \
+                    'X-Object-Manifest' not in req.headers:
+                return self.handle_auto_segment_put(req)
 
         return self.app
 
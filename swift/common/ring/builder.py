@@ -15,7 +15,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import ipdb
-DEBUG = True
+DEBUG = False
 
 import bisect
 import itertools
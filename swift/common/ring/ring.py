@@ -17,6 +17,9 @@
 
 import array
 import cPickle as pickle
+import ctypes
+import mmap
+import sys
 from collections import defaultdict
 from gzip import GzipFile
 from os.path import getmtime
@@ -32,7 +35,17 @@ from swift.common.ring.utils import tiers_for_dev
 
 import ipdb
 
-DEBUG = True
+DEBUG = False
+
+#: Max number of partitions whose node tuples a Ring keeps at a time
+PART_NODES_CACHE_SIZE = 65536
+
+#: Ring file format versions RingData.save() knows how to write
+RING_FORMAT_VERSIONS = (1, 2)
+
+#: Byte alignment of the partition tables in a format version 2 ring file
+RING_V2_ALIGN = 8
+
 
 class RingData(object):
     """Partitioned consistent hashing ring data (used for serialization)."""
@@ -57,6 +70,41 @@ class RingData(object):
                 array.array('H', gz_file.read(2 * partition_count)))
         return ring_dict
 
+    @classmethod
+    def deserialize_v2(cls, fp):
+        """
+        Read the body of an uncompressed format version 2 ring file.
+
+        The partition tables are not copied into memory; they are ctypes
+        arrays over a copy-on-write mmap of the file, so the pages are
+        shared by every process on the host that loads the same ring.
+        Rings written on a host with the other byte order are copied and
+        byteswapped instead.
+
+        :param fp: open ring file, positioned just after the version
+        """
+        json_len, = struct.unpack('!I', fp.read(4))
+        ring_dict = json.loads(fp.read(json_len))
+        offset = fp.tell()
+        offset += -offset % RING_V2_ALIGN
+        ring_dict['replica2part2dev_id'] = []
+        if ring_dict['byteorder'] == sys.byteorder:
+            mm = None
+            if ring_dict['part_counts']:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+            for part_count in ring_dict['part_counts']:
+                # from_buffer keeps a reference to the mmap for us
+                ring_dict['replica2part2dev_id'].append(
+                    (ctypes.c_uint16 * part_count).from_buffer(mm, offset))
+                offset += 2 * part_count
+        else:
+            fp.seek(offset)
+            for part_count in ring_dict['part_counts']:
+                part2dev_id = array.array('H', fp.read(2 * part_count))
+                part2dev_id.byteswap()
+                ring_dict['replica2part2dev_id'].append(part2dev_id)
+        return ring_dict
+
     @classmethod
     def load(cls, filename):
         """
@@ -66,6 +114,17 @@ class RingData(object):
         :returns: A RingData instance containing the loaded data.
         """
         if DEBUG: ipdb.set_trace()
+        with open(filename, 'rb') as fp:
+            # Format version 2 rings are not compressed
+            if fp.read(4) == 'R1NG':
+                version, = struct.unpack('!H', fp.read(2))
+                if version != 2:
+                    raise Exception('Unknown ring format version %d' %
+                                    version)
+                ring_data = cls.deserialize_v2(fp)
+                return RingData(ring_data['replica2part2dev_id'],
+                                ring_data['devs'], ring_data['part_shift'])
+
         gz_file = GzipFile(filename, 'rb')
         # Python 2.6 GzipFile doesn't support BufferedIO
         if hasattr(gz_file, '_checkReadable'):
@@ -88,6 +147,24 @@ class RingData(object):
                                  ring_data['devs'], ring_data['part_shift'])
         return ring_data
 
+    @classmethod
+    def file_format_version(cls, filename):
+        """
+        Tells which format a ring file was saved in, so that it can be saved
+        again in the same one.
+
+        :param filename: Path to a ring file.
+        :returns: 2 for an uncompressed version 2 ring, 1 for anything else
+                  or if there is no such file.
+        """
+        try:
+            with open(filename, 'rb') as fp:
+                if fp.read(4) == 'R1NG':
+                    return 2
+        except IOError:
+            pass
+        return 1
+
     def serialize_v1(self, file_obj):
         # Write out new-style serialization magic and version:
         file_obj.write(struct.pack('!4sH', 'R1NG', 1))
@@ -100,26 +177,62 @@ class RingData(object):
         file_obj.write(struct.pack('!I', json_len))
         file_obj.write(json_text)
         for part2dev_id in ring['replica2part2dev_id']:
-            file_obj.write(part2dev_id.tostring())
+            file_obj.write(array.array('H', part2dev_id).tostring())
+
+    def serialize_v2(self, file_obj):
+        # Same header as version 1, plus what a reader needs to map the
+        # partition tables straight out of the file
+        file_obj.write(struct.pack('!4sH', 'R1NG', 2))
+        ring = self.to_dict()
+        json_encoder = json.JSONEncoder(sort_keys=True)
+        json_text = json_encoder.encode(
+            {'devs': ring['devs'], 'part_shift': ring['part_shift'],
+             'replica_count': len(ring['replica2part2dev_id']),
+             'part_counts': [len(part2dev_id) for part2dev_id in
+                             ring['replica2part2dev_id']],
+             'byteorder': sys.byteorder})
+        json_len = len(json_text)
+        file_obj.write(struct.pack('!I', json_len))
+        file_obj.write(json_text)
+        file_obj.write('\0' * (-(10 + json_len) % RING_V2_ALIGN))
+        for part2dev_id in ring['replica2part2dev_id']:
+            file_obj.write(array.array('H', part2dev_id).tostring())
 
-    def save(self, filename):
+    def save(self, filename, format_version=1):
         """
         Serialize this RingData instance to disk.
 
+        The file is written under a temporary name and renamed into place,
+        so processes that have an older version 2 ring mapped never see it
+        change underneath them.
+
         :param filename: File into which this instance should be serialized.
+        :param format_version: 1 for the gzipped format every Swift since
+                               1.6.0 reads, 2 for the uncompressed format
+                               that can be loaded with mmap
         """
-        # Override the timestamp so that the same ring data creates
-        # the same bytes on disk. This makes a checksum comparison a
-        # good way to see if two rings are identical.
-        #
-        # This only works on Python 2.7; on 2.6, we always get the
-        # current time in the gzip output.
-        try:
-            gz_file = GzipFile(filename, 'wb', mtime=1300507380.0)
-        except TypeError:
-            gz_file = GzipFile(filename, 'wb')
-        self.serialize_v1(gz_file)
-        gz_file.close()
+        if format_version not in RING_FORMAT_VERSIONS:
+            raise ValueError('Unknown ring format version %r' %
+                             (format_version,))
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as fp:
+            if format_version == 2:
+                self.serialize_v2(fp)
+            else:
+                # Override the timestamp so that the same ring data creates
+                # the same bytes on disk. This makes a checksum comparison a
+                # good way to see if two rings are identical.
+                #
+                # This only works on Python 2.7; on 2.6, we always get the
+                # current time in the gzip output.
+                try:
+                    gz_file = GzipFile(filename, 'wb', fileobj=fp,
+                                       mtime=1300507380.0)
+                except TypeError:
+                    gz_file = GzipFile(filename, 'wb', fileobj=fp)
+                self.serialize_v1(gz_file)
+                gz_file.close()
+        os.rename(tmp_filename, filename)
 
     def to_dict(self):
         return {'devs': self.devs,
@@ -158,6 +271,7 @@ class Ring(object):
             self._replica2part2dev_id = ring_data._replica2part2dev_id
             self._part_shift = ring_data._part_shift
             self._rebuild_tier_data()
+            self._part_nodes = {}
 
     def _rebuild_tier_data(self):
         #if DEBUG: ipdb.set_trace()
@@ -204,14 +318,23 @@ class Ring(object):
 
     def _get_part_nodes(self, part):
         if DEBUG: ipdb.set_trace()
+        # The nodes of a partition are kept as a tuple until the ring is
+        # reloaded; callers get a list of their own, which they may shuffle.
+        try:
+            return list(self._part_nodes[part])
+        except KeyError:
+            pass
         part_nodes = []
         seen_ids = set()
         for r2p2d in self._replica2part2dev_id:
             if part < len(r2p2d):
                 dev_id = r2p2d[part]
                 if dev_id not in seen_ids:
-                    part_nodes.append(self.devs[dev_id])
+                    part_nodes.append(self._devs[dev_id])
                 seen_ids.add(dev_id)
+        if len(self._part_nodes) >= PART_NODES_CACHE_SIZE:
+            self._part_nodes.clear()
+        self._part_nodes[part] = tuple(part_nodes)
         return part_nodes
 
     def get_part_nodes(self, part):
@@ -228,8 +351,6 @@ class Ring(object):
 
         See :func:`get_nodes` for a description of the node dicts.
         """
-        if DEBUG: ipdb.set_trace()
-
         if time() > self._rtime:
             self._reload()
         return self._get_part_nodes(part)
@@ -283,8 +404,7 @@ class Ring(object):
 
         See :func:`get_nodes` for a description of the node dicts.
         """
-        import ipdb
-        ipdb.set_trace()
+        if DEBUG: ipdb.set_trace()
         if time() > self._rtime:
             self._reload()
         # 由partition得到主要节点(就是负责这个partition的节点)
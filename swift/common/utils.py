@@ -19,6 +19,7 @@ import errno
 import fcntl
 import os
 import pwd
+import signal
 import sys
 import time
 import functools
@@ -42,8 +43,9 @@ from urlparse import urlparse as stdlib_urlparse, ParseResult
 import itertools
 
 import eventlet
-from eventlet import GreenPool, sleep, Timeout
-from eventlet.green import socket, threading
+from eventlet import GreenPool, sleep, Timeout, tpool
+from eventlet.green import socket, threading, os as green_os
+from eventlet.greenio import GreenPipe
 import netifaces
 import codecs
 utf8_decoder = codecs.getdecoder('utf-8')
@@ -1480,10 +1482,35 @@ def human_readable(value):
     return '%d%si' % (round(value), suffixes[index])
 
 
+def put_recon_cache_entry(cache_entry, key, item):
+    """
+    Sets a value in a recon cache entry.  A dictionary value is merged into
+    a dictionary already there, so that several processes can each keep
+    their own items of it; an empty dictionary as the value of one of its
+    items removes that item.
+
+    :param cache_entry: the recon cache entry, a dictionary
+    :param key: key to set
+    :param item: value to set it to
+    """
+    if not isinstance(item, dict):
+        cache_entry[key] = item
+        return
+    if not isinstance(cache_entry.get(key), dict):
+        cache_entry[key] = {}
+    for sub_key, sub_item in item.iteritems():
+        if sub_item == {}:
+            cache_entry[key].pop(sub_key, None)
+        else:
+            cache_entry[key][sub_key] = sub_item
+
+
 def dump_recon_cache(cache_dict, cache_file, logger, lock_timeout=2):
     """Update recon cache values
 
-    :param cache_dict: Dictionary of cache key/value pairs to write out
+    :param cache_dict: Dictionary of cache key/value pairs to write out;
+                       dictionary values are merged as described in
+                       put_recon_cache_entry
     :param cache_file: cache file to update
     :param logger: the logger to use to log an encountered error
     :param lock_timeout: timeout (in seconds)
@@ -1499,7 +1526,7 @@ def dump_recon_cache(cache_dict, cache_file, logger, lock_timeout=2):
                 #file doesn't have a valid entry, we'll recreate it
                 pass
             for cache_key, cache_value in cache_dict.items():
-                cache_entry[cache_key] = cache_value
+                put_recon_cache_entry(cache_entry, cache_key, cache_value)
             try:
                 with NamedTemporaryFile(dir=os.path.dirname(cache_file),
                                         delete=False) as tf:
@@ -1633,6 +1660,80 @@ def reiterate(iterable):
             return []
 
 
+def fork_workers(func, shards, logger=None, progress=None):
+    """
+    Calls a function once for each shard of some work, each call in a
+    forked child process of its own, and all at once.  Each child sends
+    what the function returned back to the parent as JSON.
+
+    With progress given, the function is also called with a second argument,
+    a function it can call with interim results as it goes; the parent
+    calls progress with the index of the shard and each of them as they
+    arrive.  The parent reads from the children with green I/O, so its other
+    greenthreads keep running until they are all done.
+
+    :param func: function to call with a shard
+    :param shards: list of shards
+    :param logger: logger for the children to log exceptions to
+    :param progress: function to call with (shard index, interim result)
+    :returns: list of what the function returned for each shard, None for
+              those whose child failed
+    """
+    # tpool's threads don't survive a fork; have it start afresh in every
+    # process rather than wait on threads that are gone
+    tpool.killall()
+    children = []
+    for shard in shards:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(write_fd)
+            children.append((pid, read_fd))
+            continue
+        status = 1
+        try:
+            os.close(read_fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            with closing(GreenPipe(write_fd, 'wb')) as fp:
+
+                def send(kind, value):
+                    fp.write(json.dumps({kind: value}) + '\n')
+                    fp.flush()
+
+                if progress:
+                    result = func(shard, lambda value: send('progress', value))
+                else:
+                    result = func(shard)
+                send('result', result)
+            status = 0
+        except Exception:
+            (logger or logging).exception(
+                _('Error in worker process %s'), os.getpid())
+        finally:
+            os._exit(status)
+
+    results = [None] * len(children)
+
+    def read_child(index, pid, read_fd):
+        with closing(GreenPipe(read_fd, 'rb')) as fp:
+            for line in fp:
+                message = json.loads(line)
+                if 'progress' in message:
+                    progress(index, message['progress'])
+                else:
+                    results[index] = message['result']
+        if green_os.waitpid(pid, 0)[1]:
+            results[index] = None
+
+    # the children are forked before any reader is spawned, so that none of
+    # them inherit a reader greenthread
+    pool = GreenPool(size=len(children) or 1)
+    for index, (pid, read_fd) in enumerate(children):
+        pool.spawn_n(read_child, index, pid, read_fd)
+    pool.waitall()
+    return results
+
+
 class InputProxy(object):
     """
     File-like object that counts bytes read.
@@ -26,6 +26,7 @@ from StringIO import StringIO
 import eventlet
 import eventlet.debug
 from eventlet import greenio, GreenPool, sleep, wsgi, listen
+from eventlet.hubs import trampoline
 from paste.deploy import loadapp, appconfig
 from eventlet.green import socket, ssl
 from urllib import unquote
@@ -57,6 +58,40 @@ def monkey_patch_mimetools():
     mimetools.Message.parsetype = parsetype
 
 
+class SwiftHttpProtocol(wsgi.HttpProtocol):
+    """
+    HttpProtocol that gives up on a kept-alive connection once it has sat
+    idle for keep_alive_timeout seconds (0 waits forever), so persistent
+    connections held open by proxies cannot pin every greenthread of the
+    server's pool.
+    """
+    keep_alive_timeout = 0
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.keep_alive_timeout and not self._wait_for_request():
+                break
+            self.handle_one_request()
+
+    def _wait_for_request(self):
+        """
+        :returns: True once the next request starts arriving, False if the
+                  connection stayed idle for keep_alive_timeout
+        """
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is not None and rbuf.tell():
+            return True
+        try:
+            trampoline(self.connection, read=True,
+                       timeout=self.keep_alive_timeout,
+                       timeout_exc=socket.timeout)
+        except socket.timeout:
+            return False
+        return True
+
+
 def get_socket(conf, default_port=8080):
     """Bind socket to bind ip:port in conf
 
@@ -94,6 +129,9 @@ def get_socket(conf, default_port=8080):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     # in my experience, sockets can hang around forever without keepalive
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # accepted sockets inherit this; without it every chunk of a streamed
+    # response after the first waits for the client's delayed ACK
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     if hasattr(socket, 'TCP_KEEPIDLE'):
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 600)
     if warn_ssl:
@@ -140,6 +178,8 @@ def run_wsgi(conf_file, app_section, *args, **kwargs):
         wsgi.HttpProtocol.log_message = \
             lambda s, f, *a: logger.error('ERROR WSGI: ' + f % a)
         wsgi.WRITE_TIMEOUT = int(conf.get('client_timeout') or 60)
+        SwiftHttpProtocol.keep_alive_timeout = \
+            float(conf.get('keep_alive_timeout', 0))
 
         eventlet.hubs.use_hub(get_hub())
         eventlet.patcher.monkey_patch(all=False, socket=True)
@@ -149,7 +189,8 @@ def run_wsgi(conf_file, app_section, *args, **kwargs):
                       global_conf={'log_name': log_name})
         pool = GreenPool(size=1024)
         try:
-            wsgi.server(sock, app, NullLogger(), custom_pool=pool)
+            wsgi.server(sock, app, NullLogger(), custom_pool=pool,
+                        protocol=SwiftHttpProtocol)
         except socket.error, err:
             if err[0] != errno.EINVAL:
                 raise
@@ -18,21 +18,25 @@ from __future__ import with_statement
 import os
 import time
 import traceback
+from itertools import chain
 from xml.sax import saxutils
 from datetime import datetime
 
-from eventlet import Timeout
+from eventlet import Timeout, sleep, spawn_n
 
 import swift.common.db
-from swift.common.db import ContainerBroker
+from swift.common.db import ContainerBroker, listing_pages, \
+    LISTING_PAGE_SIZE
 from swift.common.utils import get_logger, get_param, hash_path, public, \
     normalize_timestamp, storage_directory, validate_sync_to, \
-    config_true_value, validate_device_partition, json, timing_stats
+    config_true_value, validate_device_partition, json, timing_stats, \
+    dump_recon_cache
 from swift.common.constraints import CONTAINER_LISTING_LIMIT, \
     check_mount, check_float, check_utf8, FORMAT2CONTENT_TYPE
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
-from swift.common.db_replicator import ReplicatorRpc
+from swift.common.db_replicator import ReplicatorRpc, \
+    ROW_STREAM_CONTENT_TYPE
 from swift.common.http import HTTP_NOT_FOUND, is_success
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPConflict, \
     HTTPCreated, HTTPInternalServerError, HTTPNoContent, HTTPNotFound, \
@@ -40,6 +44,100 @@ from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPConflict, \
     HTTPInsufficientStorage, HTTPNotAcceptable
 
 DATADIR = 'containers'
+#: Seconds after which another worker's merge stats are dropped from recon
+MERGE_STATS_TTL = 3600
+
+
+class PendingMerger(object):
+    """
+    Merges the .pending files of container DBs in the background, with one
+    greenthread per device.  A DB is merged at most once per interval, so
+    the updates that arrive in the meantime share a single transaction.
+    The merges run in the greenthread itself, like the ones requests make,
+    as the broker's locking and timeouts are green.
+
+    Stats of each device's latest batch are kept in the recon cache under
+    container_merge, one entry per device and worker process.
+
+    :param interval: seconds to wait before merging a queued DB
+    :param logger: logger to use
+    :param recon_cache: path to the recon cache file to report stats to
+    """
+
+    def __init__(self, interval, logger, recon_cache):
+        self.interval = interval
+        self.logger = logger
+        self.recon_cache = recon_cache
+        self.queues = {}
+
+    def schedule(self, device, db_file):
+        """
+        Queues a DB for merging, unless it is queued already.
+
+        :param device: device the DB is on
+        :param db_file: path to the DB
+        """
+        if device not in self.queues:
+            self.queues[device] = {}
+            spawn_n(self._run, device)
+        self.queues[device].setdefault(db_file, time.time())
+
+    def queued_since(self, device, db_file):
+        """
+        :param device: device the DB is on
+        :param db_file: path to the DB
+        :returns: time at which the DB was queued, or None if it is not
+        """
+        return self.queues.get(device, {}).get(db_file)
+
+    def _merge(self, db_file):
+        ContainerBroker(db_file, logger=self.logger)._commit_puts()
+
+    def _run(self, device):
+        queue = self.queues[device]
+        while queue:
+            sleep(self.interval)
+            batch = sorted(queue.iteritems(), key=lambda item: item[1])
+            queue.clear()
+            begin = time.time()
+            for db_file, queued in batch:
+                try:
+                    self._merge(db_file)
+                except (Exception, Timeout):
+                    self.logger.exception(
+                        _('ERROR merging pending entries of %s'), db_file)
+                sleep()
+            now = time.time()
+            self._report(device, {'device': device,
+                                  'queue_depth': len(queue),
+                                  'merged': len(batch),
+                                  'merge_time': now - begin,
+                                  'max_staleness': now - batch[0][1],
+                                  'updated': now})
+        del self.queues[device]
+
+    def _report(self, device, stats):
+        """
+        Writes the stats of a device's latest batch to the recon cache, and
+        drops any entries other workers haven't updated for MERGE_STATS_TTL
+        seconds, such as those of workers that are gone.
+        """
+        entries = {'%s:%d' % (device, os.getpid()): stats}
+        try:
+            with open(self.recon_cache) as fp:
+                existing = json.load(fp).get('container_merge', {})
+        except (IOError, ValueError, AttributeError):
+            existing = {}
+        if not isinstance(existing, dict):
+            existing = {}
+        for key, entry in existing.iteritems():
+            if key not in entries and (
+                    not isinstance(entry, dict) or
+                    entry.get('updated', 0) < stats['updated'] -
+                    MERGE_STATS_TTL):
+                entries[key] = {}
+        dump_recon_cache({'container_merge': entries}, self.recon_cache,
+                         self.logger)
 
 
 class ContainerController(object):
@@ -68,6 +166,13 @@ class ContainerController(object):
             self.save_headers.append('x-versions-location')
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        self.merger = None
+        if config_true_value(conf.get('background_merge', 'f')):
+            self.merger = PendingMerger(
+                float(conf.get('merge_interval', 1)), self.logger,
+                os.path.join(conf.get('recon_cache_path', '/var/cache/swift'),
+                             'container.recon'))
+        self.merge_staleness = float(conf.get('merge_staleness', 10))
 
     def _get_container_broker(self, drive, part, account, container):
         """
@@ -85,6 +190,27 @@ class ContainerController(object):
         return ContainerBroker(db_path, account=account, container=container,
                                logger=self.logger)
 
+    def _merged_in_background(self, drive, broker):
+        """
+        Tells whether a read may leave the pending entries of a DB to the
+        background merger.  That is the case as long as the DB was queued
+        for merging, or if no other worker did so, last updated, less than
+        merge_staleness seconds ago.
+
+        :param drive: drive that holds the container
+        :param broker: ContainerBroker object
+        :returns: True if the read should not merge pending entries
+        """
+        if not self.merger:
+            return False
+        since = self.merger.queued_since(drive, broker.db_file)
+        if since is None:
+            try:
+                since = os.path.getmtime(broker.pending_file)
+            except OSError:
+                return True
+        return time.time() - since < self.merge_staleness
+
     def account_update(self, req, account, container, broker):
         """
         Update the account server(s) with latest container info.
@@ -190,6 +316,8 @@ class ContainerController(object):
             return HTTPNotFound()
         if obj:     # delete object
             broker.delete_object(obj, req.headers.get('x-timestamp'))
+            if self.merger:
+                self.merger.schedule(drive, broker.db_file)
             return HTTPNoContent(request=req)
         else:
             # delete container
@@ -239,6 +367,8 @@ class ContainerController(object):
             broker.put_object(obj, timestamp, int(req.headers['x-size']),
                               req.headers['x-content-type'],
                               req.headers['x-etag'])
+            if self.merger:
+                self.merger.schedule(drive, broker.db_file)
             return HTTPCreated(request=req)
         else:   # put container
             if not os.path.exists(broker.db_file):
@@ -285,6 +415,7 @@ class ContainerController(object):
         broker = self._get_container_broker(drive, part, account, container)
         broker.pending_timeout = 0.1
         broker.stale_reads_ok = True
+        broker.skip_commits = self._merged_in_background(drive, broker)
         if broker.is_deleted():
             return HTTPNotFound(request=req)
         info = broker.get_info()
@@ -343,6 +474,7 @@ class ContainerController(object):
         broker = self._get_container_broker(drive, part, account, container)
         broker.pending_timeout = 0.1
         broker.stale_reads_ok = True
+        broker.skip_commits = self._merged_in_background(drive, broker)
         if broker.is_deleted():
             return HTTPNotFound(request=req)
         info = broker.get_info()
@@ -385,13 +517,42 @@ class ContainerController(object):
             ['text/plain', 'application/json', 'application/xml', 'text/xml'])
         if not out_content_type:
             return HTTPNotAcceptable(request=req)
-        container_list = broker.list_objects_iter(limit, marker, end_marker,
-                                                  prefix, delimiter, path)
+        pages = listing_pages(broker.list_objects_iter, limit, marker,
+                              end_marker, prefix, delimiter, path)
+        first_page = next(pages, [])
+        if out_content_type == 'text/plain' and not first_page:
+            return HTTPNoContent(request=req, headers=resp_headers)
+        pages = chain([first_page], pages)
         if out_content_type == 'application/json':
+            body = self._json_listing(pages)
+        elif out_content_type.endswith('/xml'):
+            body = self._xml_listing(container, pages)
+        else:
+            body = ('\n'.join(r[0] for r in page) + '\n' for page in pages)
+        if len(first_page) < LISTING_PAGE_SIZE or limit <= LISTING_PAGE_SIZE:
+            # the whole listing is in; send it with a Content-Length
+            ret = Response(body=''.join(body), request=req,
+                           headers=resp_headers)
+        else:
+            ret = Response(app_iter=body, request=req, headers=resp_headers)
+        ret.content_type = out_content_type
+        ret.charset = 'utf-8'
+        return ret
+
+    def _json_listing(self, pages):
+        """
+        Encodes a listing as JSON, one page of entries at a time.
+
+        :param pages: iterator of lists of rows from list_objects_iter
+        :returns: generator of pieces of the JSON document
+        """
+        yield '['
+        separator = ''
+        for page in pages:
             data = []
-            for (name, created_at, size, content_type, etag) in container_list:
+            for (name, created_at, size, content_type, etag) in page:
                 if content_type is None:
-                    data.append({"subdir": name})
+                    data.append(json.dumps({"subdir": name}))
                 else:
                     created_at = datetime.utcfromtimestamp(
                         float(created_at)).isoformat()
@@ -400,13 +561,27 @@ class ContainerController(object):
                         created_at += ".000000"
                     content_type, size = self.derive_content_type_metadata(
                         content_type, size)
-                    data.append({'last_modified': created_at, 'bytes': size,
-                                'content_type': content_type, 'hash': etag,
-                                'name': name})
-            container_list = json.dumps(data)
-        elif out_content_type.endswith('/xml'):
+                    data.append(json.dumps(
+                        {'last_modified': created_at, 'bytes': size,
+                         'content_type': content_type, 'hash': etag,
+                         'name': name}))
+            yield separator + ', '.join(data)
+            separator = ', '
+        yield ']'
+
+    def _xml_listing(self, container, pages):
+        """
+        Encodes a listing as XML, one page of entries at a time.
+
+        :param container: container name
+        :param pages: iterator of lists of rows from list_objects_iter
+        :returns: generator of pieces of the XML document
+        """
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+            '<container name=%s>' % saxutils.quoteattr(container)
+        for page in pages:
             xml_output = []
-            for (name, created_at, size, content_type, etag) in container_list:
+            for (name, created_at, size, content_type, etag) in page:
                 # escape name and format date here
                 name = saxutils.escape(name)
                 created_at = datetime.utcfromtimestamp(
@@ -426,18 +601,8 @@ class ContainerController(object):
                         '<bytes>%d</bytes><content_type>%s</content_type>'
                         '<last_modified>%s</last_modified></object>' %
                         (name, etag, size, content_type, created_at))
-            container_list = ''.join([
-                '<?xml version="1.0" encoding="UTF-8"?>\n',
-                '<container name=%s>' % saxutils.quoteattr(container),
-                ''.join(xml_output), '</container>'])
-        else:
-            if not container_list:
-                return HTTPNoContent(request=req, headers=resp_headers)
-            container_list = '\n'.join(r[0] for r in container_list) + '\n'
-        ret = Response(body=container_list, request=req, headers=resp_headers)
-        ret.content_type = out_content_type
-        ret.charset = 'utf-8'
-        return ret
+            yield ''.join(xml_output)
+        yield '</container>'
 
     @public
     @timing_stats(sample_rate=0.01)
@@ -454,11 +619,17 @@ class ContainerController(object):
                                   request=req)
         if self.mount_check and not check_mount(self.root, drive):
             return HTTPInsufficientStorage(drive=drive, request=req)
+        stream = None
         try:
-            args = json.load(req.environ['wsgi.input'])
+            if req.headers.get('Content-Type') == ROW_STREAM_CONTENT_TYPE:
+                # the args are on the first line, followed by the rows
+                stream = req.environ['wsgi.input']
+                args = json.loads(stream.readline())
+            else:
+                args = json.load(req.environ['wsgi.input'])
         except ValueError, err:
             return HTTPBadRequest(body=str(err), content_type='text/plain')
-        ret = self.replicator_rpc.dispatch(post_args, args)
+        ret = self.replicator_rpc.dispatch(post_args, args, stream)
         ret.request = req
         return ret
 
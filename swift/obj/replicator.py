@@ -23,20 +23,29 @@ import hashlib
 import itertools
 import cPickle as pickle
 import errno
+import socket
+import struct
 import uuid
+from collections import defaultdict
+from tempfile import mkstemp
+from urllib import quote
 
 import eventlet
 from eventlet import GreenPool, tpool, Timeout, sleep, hubs
+from eventlet.event import Event
 from eventlet.green import subprocess
 from eventlet.support.greenlets import GreenletExit
+from xattr import getxattr
 
 from swift.common.ring import Ring
 from swift.common.utils import whataremyips, unlink_older_than, lock_path, \
     compute_eta, get_logger, write_pickle, renamer, dump_recon_cache, \
-    rsync_ip, mkdirs, config_true_value, list_from_csv, get_hub
-from swift.common.bufferedhttp import http_connect
+    rsync_ip, mkdirs, config_true_value, list_from_csv, get_hub, \
+    fork_workers, fdatasync
+from swift.common.bufferedhttp import http_connect, http_connect_raw, \
+    ConnectionPool
 from swift.common.daemon import Daemon
-from swift.common.http import HTTP_OK, HTTP_INSUFFICIENT_STORAGE
+from swift.common.http import HTTP_OK, HTTP_INSUFFICIENT_STORAGE, is_success
 from swift.common.exceptions import PathNotDir
 
 hubs.use_hub(get_hub())
@@ -44,6 +53,22 @@ hubs.use_hub(get_hub())
 PICKLE_PROTOCOL = 2
 ONE_WEEK = 604800
 HASH_FILE = 'hashes.pkl'
+HASH_JOURNAL = 'hashes.invalid'
+LISTING_EXT = '.listing'
+INDEX_EXT = '.index'
+# a hash dir changed less than this many seconds ago is not indexed, as
+# another change within the same mtime tick would go unnoticed
+INDEX_MTIME_GRACE = 1
+# number of suffix indexes each process keeps unpickled
+INDEX_CACHE_SIZE = 4096
+METADATA_KEY = 'user.swift.metadata'
+METADATA_MAGIC = 'SMD'
+METADATA_HEADER = '!3sBI'
+SYNC_CHUNK_SIZE = 65536
+# replication job classes, most urgent first: handoff partitions, partitions
+# with a node that failed to sync lately, partitions changed since they were
+# last hashed, and the rest
+JOB_CLASSES = ('handoff', 'degraded', 'changed', 'normal')
 
 
 def quarantine_renamer(device_path, corrupted_file_path):
@@ -60,7 +85,7 @@ def quarantine_renamer(device_path, corrupted_file_path):
     """
     from_dir = dirname(corrupted_file_path)
     to_dir = join(device_path, 'quarantined', 'objects', basename(from_dir))
-    invalidate_hash(dirname(from_dir))
+    invalidate_hash(dirname(from_dir), basename(from_dir))
     try:
         renamer(from_dir, to_dir)
     except OSError, e:
@@ -71,23 +96,295 @@ def quarantine_renamer(device_path, corrupted_file_path):
     return to_dir
 
 
-def hash_suffix(path, reclaim_age):
+def current_files(files):
+    """
+    Given the file names found in an object's hash dir, returns the ones that
+    make up the current state of the object, newest first: either a lone
+    tombstone, or the newest .data preceded by the newest .meta if that is
+    more recent still.
+
+    :param files: list of file names in the hash dir
+    :returns: list of file names, empty if there is no current object
+    """
+    meta = None
+    for filename in sorted(files, reverse=True):
+        if filename.endswith('.ts'):
+            return [filename]
+        if filename.endswith('.meta') and not meta:
+            meta = filename
+        if filename.endswith('.data'):
+            return [meta, filename] if meta else [filename]
+    return []
+
+
+def missing_files(partition_dir, names):
+    """
+    Works out which of the files another node offers to push are missing
+    from a partition.  Files that would not be part of their object's
+    current state next to what is already here, such as a .data older than
+    the tombstone this node has, are not wanted either.
+
+    :param partition_dir: absolute path of the partition
+    :param names: list of "<suffix>/<hash>/<file name>" paths
+    :returns: list of the paths that should be pushed
+    """
+    offered = {}
+    for name in names:
+        hash_dir, filename = name.rsplit('/', 1)
+        offered.setdefault(hash_dir, []).append(filename)
+    wanted = []
+    for hash_dir, filenames in offered.iteritems():
+        try:
+            existing = os.listdir(join(partition_dir, hash_dir))
+        except OSError, err:
+            if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            existing = []
+        current = current_files(existing + filenames)
+        wanted.extend('%s/%s' % (hash_dir, filename)
+                      for filename in filenames
+                      if filename in current and filename not in existing)
+    return wanted
+
+
+def list_suffix_files(partition_dir, suffixes):
+    """
+    Lists the files of some suffixes of a partition.
+
+    :param partition_dir: absolute path of the partition
+    :param suffixes: list of suffixes
+    :returns: list of "<suffix>/<hash>/<file name>" paths
+    """
+    names = []
+    for suffix in suffixes:
+        suffix_dir = join(partition_dir, suffix)
+        try:
+            hashes = os.listdir(suffix_dir)
+        except OSError:
+            continue
+        for hsh in hashes:
+            try:
+                files = os.listdir(join(suffix_dir, hsh))
+            except OSError:
+                continue
+            names.extend('%s/%s/%s' % (suffix, hsh, filename)
+                         for filename in files)
+    return names
+
+
+def read_raw_metadata(fd):
+    """
+    Reads the metadata xattrs of an object file without decoding them.
+    Metadata in the binary format usually lives in a single xattr; it and
+    pickled metadata may be split over several.
+
+    :param fd: file descriptor or file object of the object file
+    :returns: the metadata string, joined up if it is split over several
+              xattrs
+    """
+    metadata = ''
+    key = 0
+    header_size = struct.calcsize(METADATA_HEADER)
+    try:
+        while True:
+            metadata += getxattr(fd, '%s%s' % (METADATA_KEY, (key or '')))
+            if metadata.startswith(METADATA_MAGIC) and \
+                    len(metadata) >= header_size and \
+                    len(metadata) >= header_size + struct.unpack_from(
+                        METADATA_HEADER, metadata)[2]:
+                break
+            key += 1
+    except IOError:
+        pass
+    return metadata
+
+
+def _read_suffix_pickle(suffix_dir, ext):
+    try:
+        with open(suffix_dir + ext, 'rb') as fp:
+            return pickle.load(fp)
+    except Exception:
+        return None
+
+
+def _write_suffix_pickle(suffix_dir, ext, obj):
+    partition_dir = dirname(suffix_dir)
+    fd, tmppath = mkstemp(dir=partition_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+        pickle.dump(obj, fp, PICKLE_PROTOCOL)
+    os.rename(tmppath, suffix_dir + ext)
+
+
+def _unlink_suffix_file(suffix_dir, ext):
+    try:
+        os.unlink(suffix_dir + ext)
+    except OSError:
+        pass
+
+
+def read_suffix_index(suffix_dir):
+    """
+    Loads the object index of a suffix dir.  The index is a cache of what
+    listing the hash dirs of the suffix would say: it maps each object hash
+    to the mtime of its hash dir and the output of current_files() for it at
+    that mtime, which lets DiskFile skip the listdir of a hash dir that has
+    not changed since.  Only hash_suffix() fills it in.
+
+    :param suffix_dir: absolute path to the suffix dir
+    :returns: dictionary of hash -> (mtime, file names), or None if the
+              suffix has no usable index
+    """
+    return _read_suffix_pickle(suffix_dir, INDEX_EXT)
+
+
+def write_suffix_index(suffix_dir, index):
+    """
+    Replaces the object index of a suffix dir.  The index is only a cache of
+    what a listdir would say, so unlike hashes.pkl it is not fsynced.
+
+    :param suffix_dir: absolute path to the suffix dir
+    :param index: dictionary of hash -> (mtime, file names)
+    """
+    _write_suffix_pickle(suffix_dir, INDEX_EXT, index)
+
+
+def request_suffix_index(suffix_dir):
+    """
+    Asks for a suffix dir to be indexed: leaves an empty index for
+    hash_suffix() to fill in, and invalidates the suffix so the next rehash
+    lists it.
+
+    :param suffix_dir: absolute path to the suffix dir
+    """
+    if os.path.exists(suffix_dir + INDEX_EXT) or not isdir(suffix_dir):
+        return
+    try:
+        write_suffix_index(suffix_dir, {})
+        invalidate_hash(suffix_dir)
+    except (IOError, OSError):
+        # the partition went away under us; there is nothing to index
+        pass
+
+
+def _index_entry(hash_dir, entry=None, now=None):
+    """
+    Checks a suffix index entry against its hash dir, and lists the hash dir
+    again if it changed since.
+
+    :param hash_dir: absolute path to the object hash dir
+    :param entry: the (mtime, file names) the index has for hash_dir
+    :param now: time the index is being built at; if given, a stale entry is
+                replaced by a fresh one
+    :returns: the entry if it is still current, a fresh entry, or None if
+              there is none to be had (and, when now is given, if hash_dir
+              changed too recently for its mtime to tell a later change
+              apart)
+    """
+    try:
+        mtime = os.stat(hash_dir).st_mtime
+        if isinstance(entry, tuple) and entry[0] == mtime:
+            return entry
+        if now is None or now - mtime < INDEX_MTIME_GRACE:
+            return None
+        return mtime, current_files(os.listdir(hash_dir))
+    except OSError, err:
+        if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+
+
+_index_cache = {}
+
+
+def _cached_suffix_index(suffix_dir):
+    """
+    Like read_suffix_index(), but keeps the indexes it loads so each one is
+    only unpickled again once hash_suffix() replaces it.
+    """
+    try:
+        stat = os.stat(suffix_dir + INDEX_EXT)
+    except OSError:
+        return None
+    version = (stat.st_ino, stat.st_mtime)
+    cached = _index_cache.get(suffix_dir)
+    if cached and cached[0] == version:
+        return cached[1]
+    index = read_suffix_index(suffix_dir)
+    if index is not None:
+        if len(_index_cache) >= INDEX_CACHE_SIZE:
+            _index_cache.clear()
+        _index_cache[suffix_dir] = (version, index)
+    return index
+
+
+def get_indexed_files(hash_dir):
+    """
+    Looks up the current files of an object hash dir in its suffix index.
+    The entry is only trusted while the hash dir still has the mtime it was
+    indexed at, so PUTs, DELETEs, rsync pushes and anything else that
+    changes the hash dir go back to a listdir until the next rehash of the
+    suffix.  A suffix without an index asks for one.
+
+    :param hash_dir: absolute path to the object hash dir
+    :returns: list of file names as returned by current_files(), or None if
+              the object is not indexed or its entry is out of date
+    """
+    suffix_dir = dirname(hash_dir)
+    index = _cached_suffix_index(suffix_dir)
+    if index is None:
+        request_suffix_index(suffix_dir)
+        return None
+    entry = index.get(basename(hash_dir))
+    if entry:
+        entry = _index_entry(hash_dir, entry)
+    if entry:
+        return entry[1]
+
+
+def hash_suffix(path, reclaim_age, changed=None, last_hash=None):
     """
     Performs reclamation and returns an md5 of all (remaining) files.
 
+    The remaining files of every hash dir are saved next to the suffix along
+    with the md5, so when only a few objects changed since then, only their
+    hash dirs need to be listed again.
+
     :param reclaim_age: age in seconds at which to remove tombstones
+    :param changed: set of hashes in the suffix that changed since it was
+                    last hashed, or None to list the whole suffix
+    :param last_hash: the md5 the suffix was last hashed to; the saved
+                      listing is only trusted if it matches
     :raises PathNotDir: if given path is not a valid directory
     :raises OSError: for non-ENOTDIR errors
     """
     md5 = hashlib.md5()
-    try:
-        path_contents = sorted(os.listdir(path))
-    except OSError, err:
-        if err.errno in (errno.ENOTDIR, errno.ENOENT):
+    listing = None
+    if changed is not None and last_hash:
+        saved = _read_suffix_pickle(path, LISTING_EXT)
+        if saved and saved[0] == last_hash:
+            listing = saved[1]
+    if listing is None:
+        try:
+            path_contents = os.listdir(path)
+        except OSError, err:
+            if err.errno in (errno.ENOTDIR, errno.ENOENT):
+                raise PathNotDir()
+            raise
+        listing = {}
+    else:
+        if not isdir(path):
+            _unlink_suffix_file(path, LISTING_EXT)
             raise PathNotDir()
-        raise
+        path_contents = set(changed)
+        # lone tombstones may have aged past reclaim_age since the last hash
+        for hsh, files in listing.iteritems():
+            if len(files) == 1 and files[0].endswith('.ts'):
+                ts = files[0].rsplit('.', 1)[0]
+                if (time.time() - float(ts)) > reclaim_age:
+                    path_contents.add(hsh)
     for hsh in path_contents:
         hsh_path = join(path, hsh)
+        listing.pop(hsh, None)
         try:
             files = os.listdir(hsh_path)
         except OSError, err:
@@ -100,6 +397,8 @@ def hash_suffix(path, reclaim_age):
                     _('Quarantined %s to %s because it is not a directory') %
                     (hsh_path, quar_path))
                 continue
+            if err.errno == errno.ENOENT and changed is not None:
+                continue
             raise
         if len(files) == 1:
             if files[0].endswith('.ts'):
@@ -126,36 +425,145 @@ def hash_suffix(path, reclaim_age):
                     files.remove(filename)
         if not files:
             os.rmdir(hsh_path)
-        for filename in files:
+        else:
+            listing[hsh] = files
+    for hsh in sorted(listing):
+        for filename in listing[hsh]:
             md5.update(filename)
     try:
         os.rmdir(path)
     except OSError:
         pass
+    if listing:
+        _write_suffix_pickle(path, LISTING_EXT, (md5.hexdigest(), listing))
+    else:
+        _unlink_suffix_file(path, LISTING_EXT)
+    if os.path.exists(path + INDEX_EXT):
+        rebuild_suffix_index(path, listing.keys())
     return md5.hexdigest()
 
 
-def invalidate_hash(suffix_dir):
+def rebuild_suffix_index(suffix_dir, hashes):
+    """
+    Rewrites the object index of a suffix dir after hash_suffix() has gone
+    through it.  Entries that are still current are kept; the hash dirs of
+    the others are listed again.
+
+    :param suffix_dir: absolute path to the suffix dir
+    :param hashes: the object hashes in the suffix
     """
-    Invalidates the hash for a suffix_dir in the partition's hashes file.
+    if not hashes and not os.path.exists(suffix_dir):
+        _unlink_suffix_file(suffix_dir, INDEX_EXT)
+        return
+    old_index = read_suffix_index(suffix_dir) or {}
+    index = {}
+    now = time.time()
+    for hsh in hashes:
+        entry = _index_entry(join(suffix_dir, hsh), old_index.get(hsh), now)
+        if entry:
+            index[hsh] = entry
+    if index != old_index:
+        write_suffix_index(suffix_dir, index)
+
+
+def invalidate_hash(suffix_dir, hsh=None):
+    """
+    Invalidates the hash for a suffix_dir by appending it to the partition's
+    journal of invalidations, which get_hashes() folds into the hashes file.
 
     :param suffix_dir: absolute path to suffix dir whose hash needs
                        invalidating
+    :param hsh: the object hash within the suffix that changed, if known
     """
 
     suffix = os.path.basename(suffix_dir)
     partition_dir = os.path.dirname(suffix_dir)
-    hashes_file = join(partition_dir, HASH_FILE)
+    entry = suffix if hsh is None else join(suffix, hsh)
     with lock_path(partition_dir):
-        try:
-            with open(hashes_file, 'rb') as fp:
-                hashes = pickle.load(fp)
-            if suffix in hashes and not hashes[suffix]:
+        with open(join(partition_dir, HASH_JOURNAL), 'ab') as fp:
+            fp.write(entry + '\n')
+            fp.flush()
+            # the object itself is on disk by now; an invalidation lost in a
+            # crash would leave the suffix's stale hash to be trusted
+            fdatasync(fp.fileno())
+
+
+def read_hash_journal(partition_dir):
+    """
+    Reads the journal of invalidations of a partition.  A trailing partial
+    entry, left by an interrupted append, is ignored.
+
+    :param partition_dir: absolute path of the partition
+    :returns: tuple of (dictionary of suffix -> set of changed hashes, or
+              None if the hashes are not known, number of bytes read)
+    """
+    try:
+        with open(join(partition_dir, HASH_JOURNAL), 'rb') as fp:
+            journal = fp.read()
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return {}, 0
+    journal = journal[:journal.rfind('\n') + 1]
+    changed = {}
+    for entry in journal.splitlines():
+        suffix, sep, hsh = entry.partition('/')
+        if not hsh:
+            changed[suffix] = None
+        elif changed.get(suffix, ()) is not None:
+            changed.setdefault(suffix, set()).add(hsh)
+    return changed, len(journal)
+
+
+def compact_hash_journal(partition_dir, length):
+    """
+    Drops entries that were folded into the hashes file from the start of
+    the journal of invalidations.  The caller must hold the lock on the
+    partition dir, from before it checked that nobody else has rewritten
+    the hashes file (and so compacted the journal) since the journal was
+    read, until after this returns.
+
+    Entries left over are written to a new journal that replaces the old
+    one, so a crash part way through cannot lose them.
+
+    :param partition_dir: absolute path of the partition
+    :param length: number of bytes to drop, as returned by
+                   read_hash_journal()
+    """
+    if not length:
+        return
+    journal_file = join(partition_dir, HASH_JOURNAL)
+    try:
+        with open(journal_file, 'r+b') as fp:
+            fp.seek(length)
+            rest = fp.read()
+            if not rest:
+                # losing this to a crash only costs a rehash
+                fp.truncate(0)
                 return
-        except Exception:
-            return
-        hashes[suffix] = None
-        write_pickle(hashes, hashes_file, partition_dir, PICKLE_PROTOCOL)
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return
+    fd, tmppath = mkstemp(dir=partition_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(rest)
+        fp.flush()
+        fdatasync(fp.fileno())
+    os.rename(tmppath, journal_file)
+
+
+def _hashes_file_version(hashes_file):
+    """
+    :returns: what tells one write of a hashes file from another, since
+              write_pickle() renames a new file into place every time; None
+              if there is no hashes file
+    """
+    try:
+        stat = os.stat(hashes_file)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime
 
 
 def get_hashes(partition_dir, recalculate=[], do_listdir=False,
@@ -165,6 +573,9 @@ def get_hashes(partition_dir, recalculate=[], do_listdir=False,
     the hash cache for suffix existence at the (unexpectedly high) cost of a
     listdir.  reclaim_age is just passed on to hash_suffix.
 
+    Invalidations journaled since the last call are applied first; suffixes
+    for which the journal names the changed objects are hashed incrementally.
+
     :param partition_dir: absolute path of partition to get hashes for
     :param recalculate: list of suffixes which should be recalculated when got
     :param do_listdir: force existence check for all hashes in the partition
@@ -176,27 +587,34 @@ def get_hashes(partition_dir, recalculate=[], do_listdir=False,
     hashed = 0
     hashes_file = join(partition_dir, HASH_FILE)
     modified = False
-    force_rewrite = False
     hashes = {}
-    mtime = -1
+    # Whoever rewrites the hashes file also compacts the journal, so if the
+    # file is the same when it is time to write it, so is the journal read
+    # after looking at it.
+    version = _hashes_file_version(hashes_file)
     try:
         with open(hashes_file, 'rb') as fp:
             hashes = pickle.load(fp)
-        mtime = os.path.getmtime(hashes_file)
     except Exception:
         do_listdir = True
-        force_rewrite = True
+    changed, journal_length = read_hash_journal(partition_dir)
+    last_hashes = dict(hashes)
     if do_listdir:
         for suff in os.listdir(partition_dir):
             if len(suff) == 3:
                 hashes.setdefault(suff, None)
         modified = True
-    hashes.update((hash_, None) for hash_ in recalculate)
+    changed.update((hash_, None) for hash_ in recalculate)
+    hashes.update((hash_, None) for hash_ in changed)
+    if journal_length:
+        modified = True
     for suffix, hash_ in hashes.items():
         if not hash_:
             suffix_dir = join(partition_dir, suffix)
             try:
-                hashes[suffix] = hash_suffix(suffix_dir, reclaim_age)
+                hashes[suffix] = hash_suffix(
+                    suffix_dir, reclaim_age, changed.get(suffix),
+                    last_hashes.get(suffix))
                 hashed += 1
             except PathNotDir:
                 del hashes[suffix]
@@ -205,10 +623,10 @@ def get_hashes(partition_dir, recalculate=[], do_listdir=False,
             modified = True
     if modified:
         with lock_path(partition_dir):
-            if force_rewrite or not os.path.exists(hashes_file) or \
-                    os.path.getmtime(hashes_file) == mtime:
+            if _hashes_file_version(hashes_file) == version:
                 write_pickle(
                     hashes, hashes_file, partition_dir, PICKLE_PROTOCOL)
+                compact_hash_journal(partition_dir, journal_length)
                 return hashed, hashes
         return get_hashes(partition_dir, recalculate, do_listdir,
                           reclaim_age)
@@ -253,6 +671,10 @@ class ObjectReplicator(Daemon):
         self.swift_dir = conf.get('swift_dir', '/etc/swift')
         self.port = int(conf.get('bind_port', 6000))
         self.concurrency = int(conf.get('concurrency', 1))
+        # with 0 no partition would ever be replicated
+        self.device_concurrency = max(1, int(conf.get('device_concurrency',
+                                                      self.concurrency)))
+        self.workers = int(conf.get('replicator_workers', 0))
         self.stats_interval = int(conf.get('stats_interval', '300'))
         self.object_ring = Ring(self.swift_dir, ring_name='object')
         self.ring_check_interval = int(conf.get('ring_check_interval', 15))
@@ -263,10 +685,22 @@ class ObjectReplicator(Daemon):
         self.rsync_timeout = int(conf.get('rsync_timeout', 900))
         self.rsync_io_timeout = conf.get('rsync_io_timeout', '30')
         self.http_timeout = int(conf.get('http_timeout', 60))
+        self.sync_method = conf.get('sync_method', 'rsync').lower()
+        if self.sync_method not in ('rsync', 'http'):
+            raise ValueError(_('Invalid sync_method: %s') % self.sync_method)
+        self.conn_pool = ConnectionPool()
+        self.replicate_batch_size = \
+            int(conf.get('replicate_batch_size', 1))
+        self.replicate_batch_interval = \
+            float(conf.get('replicate_batch_interval', 1))
         self.lockup_timeout = int(conf.get('lockup_timeout', 1800))
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
         self.rcache = os.path.join(self.recon_cache_path, "object.recon")
+        self.failed_nodes = set()
+        self.last_failed_nodes = set()
+        # set in replicator_workers children, to send progress to the parent
+        self.report_progress = None
 
     def _rsync(self, args):
         """
@@ -351,6 +785,148 @@ class ObjectReplicator(Daemon):
                     'objects', job['partition']))
         return self._rsync(args) == 0
 
+    def http_sync(self, node, job, suffixes):
+        """
+        Synchronize local suffix directories from a partition with a remote
+        node over HTTP, using the object server's SYNC verb and pooled
+        connections instead of an rsync process.  The remote node is first
+        sent the names of the local files and answers with the ones it
+        lacks; those are then streamed to it with their metadata, and it
+        rehashes the suffixes once they are stored.
+
+        :param node: the "dev" entry for the remote node to sync with
+        :param job: information about the partition being synced
+        :param suffixes: a list of suffixes which need to be pushed
+
+        :returns: boolean indicating success or failure
+        """
+        if not os.path.exists(job['path']):
+            return False
+        suffixes = [suffix for suffix in suffixes
+                    if os.path.exists(join(job['path'], suffix))]
+        if not suffixes:
+            return False
+        start_time = time.time()
+        names = tpool_reraise(list_suffix_files, job['path'], suffixes)
+        path = '/' + '-'.join(suffixes)
+        conn = None
+        sent = 0
+        try:
+            with Timeout(self.rsync_timeout):
+                wanted = []
+                if names:
+                    body = '\n'.join(names)
+                    with Timeout(self.http_timeout):
+                        conn = self._sync_connect(
+                            node, job, path,
+                            {'Content-Length': len(body),
+                             'X-Sync-Phase': 'check'})
+                        conn.send(body)
+                        resp = conn.getresponse()
+                        wanted = resp.read().splitlines()
+                    if resp.status != HTTP_OK:
+                        self.logger.error(
+                            _('Invalid response %(resp)s from %(ip)s'),
+                            {'resp': resp.status, 'ip': node['ip']})
+                        return False
+                with Timeout(self.http_timeout):
+                    conn = self._sync_connect(
+                        node, job, path, {'Transfer-Encoding': 'chunked'})
+                pending = []
+                pending_size = 0
+                for chunk in self._sync_records(job['path'], wanted):
+                    if chunk is None:
+                        sent += 1
+                        continue
+                    pending.append(chunk)
+                    pending_size += len(chunk)
+                    if pending_size >= SYNC_CHUNK_SIZE:
+                        chunk = ''.join(pending)
+                        with Timeout(self.http_timeout):
+                            conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+                        pending = []
+                        pending_size = 0
+                chunk = ''.join(pending)
+                if chunk:
+                    chunk = '%x\r\n%s\r\n' % (len(chunk), chunk)
+                with Timeout(self.http_timeout):
+                    conn.send(chunk + '0\r\n\r\n')
+                    resp = conn.getresponse()
+                    resp.read()
+        except (Exception, Timeout):
+            self.logger.exception(_('Error syncing %(path)s with %(ip)s'),
+                                  {'path': job['path'], 'ip': node['ip']})
+            if conn:
+                conn.close()
+            return False
+        if not is_success(resp.status):
+            self.logger.error(_('Invalid response %(resp)s from %(ip)s'),
+                              {'resp': resp.status, 'ip': node['ip']})
+            return False
+        self.logger.debug(
+            _('Successful sync of %(path)s at %(ip)s/%(device)s: %(count)d '
+              'of %(total)d files sent (%(time).03f)'),
+            {'path': job['path'], 'ip': node['ip'], 'device': node['device'],
+             'count': sent, 'total': len(names),
+             'time': time.time() - start_time})
+        return True
+
+    def _sync_connect(self, node, job, path, headers):
+        """
+        Starts a SYNC request to a node on a pooled connection.  Nagle's
+        algorithm is turned off for it: the request body follows the
+        headers in a separate small write, which would otherwise wait for
+        the remote end's delayed ACK.
+
+        :returns: HTTPConnection object
+        """
+        conn = http_connect(node['ip'], node['port'], node['device'],
+                            job['partition'], 'SYNC', path, headers=headers,
+                            pool=self.conn_pool)
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def _sync_records(self, partition_dir, names):
+        """
+        Generates the body of a SYNC request pushing files of a partition:
+        for each file, a "<name> <metadata length> <data length>" line
+        followed by its raw metadata and its data.  None is yielded after
+        each complete record; files that went away meanwhile are skipped.
+
+        :param partition_dir: absolute path of the partition
+        :param names: list of "<suffix>/<hash>/<file name>" paths
+        """
+        for name in names:
+            try:
+                fp = open(join(partition_dir, name), 'rb')
+            except IOError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            with fp:
+                metadata = read_raw_metadata(fp)
+                size = os.fstat(fp.fileno()).st_size
+                yield '%s %d %d\n' % (name, len(metadata), size)
+                yield metadata
+                for chunk in iter(lambda: fp.read(SYNC_CHUNK_SIZE), ''):
+                    yield chunk
+            yield None
+
+    def sync(self, node, job, suffixes):
+        """
+        Synchronize local suffix directories from a partition with a remote
+        node, using the configured sync_method.
+
+        :param node: the "dev" entry for the remote node to sync with
+        :param job: information about the partition being synced
+        :param suffixes: a list of suffixes which need to be pushed
+
+        :returns: boolean indicating success or failure
+        """
+        if self.sync_method == 'http':
+            return self.http_sync(node, job, suffixes)
+        return self.rsync(node, job, suffixes)
+
     def check_ring(self):
         """
         Check to see if the ring has been updated
@@ -382,8 +958,10 @@ class ObjectReplicator(Daemon):
             suffixes = tpool.execute(tpool_get_suffixes, job['path'])
             if suffixes:
                 for node in job['nodes']:
-                    success = self.rsync(node, job, suffixes)
-                    if success:
+                    success = self.sync(node, job, suffixes)
+                    if not success:
+                        self.failed_nodes.add(node['id'])
+                    elif self.sync_method == 'rsync':
                         with Timeout(self.http_timeout):
                             http_connect(
                                 node['ip'], node['port'],
@@ -402,6 +980,154 @@ class ObjectReplicator(Daemon):
             self.partition_times.append(time.time() - begin)
             self.logger.timing_since('partition.delete.timing', begin)
 
+    def fetch_remote_hashes(self, node, partitions):
+        """
+        Gets the hashes of many partitions of a remote device with a single
+        REPLICATE request, yielding them as the remote node streams them
+        back.
+
+        :param node: the "dev" entry for the remote node
+        :param partitions: list of (partition, suffixes to recalculate)
+                           tuples
+
+        :returns: iterator of (partition, hashes) tuples; hashes is None if
+                  the remote node could not hash the partition
+        :raises Exception: if the request fails or the response is cut off
+        """
+        body = '\n'.join(
+            '%s %s' % (partition, '-'.join(suffixes)) if suffixes
+            else partition for partition, suffixes in partitions)
+        with Timeout(self.http_timeout):
+            conn = http_connect_raw(
+                node['ip'], node['port'], 'REPLICATE',
+                quote('/' + node['device']),
+                headers={'Content-Length': len(body)}, pool=self.conn_pool)
+            # the body is a separate small write, as with SYNC requests
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.send(body)
+            resp = conn.getresponse()
+        if resp.status != HTTP_OK:
+            resp.read()
+            raise Exception(_('Invalid response %(resp)s from %(ip)s') %
+                            {'resp': resp.status, 'ip': node['ip']})
+        while True:
+            with Timeout(self.http_timeout):
+                header = resp.read(4)
+                if not header:
+                    break
+                if len(header) < 4:
+                    raise Exception(_('Truncated response from %s') %
+                                    node['ip'])
+                length = struct.unpack('!I', header)[0]
+                data = resp.read(length)
+            if len(data) < length:
+                raise Exception(_('Truncated response from %s') % node['ip'])
+            yield pickle.loads(data)
+
+    def prefetch_hashes(self, jobs):
+        """
+        Starts fetching the remote hashes for a batch of update jobs, with
+        one batched REPLICATE request per remote device.  Each job gets a
+        'remote_hashes' dictionary mapping node ids to events, which fire
+        with the node's hashes for the partition as soon as they arrive, or
+        with None if they could not be fetched.
+
+        :param jobs: list of update jobs
+        """
+        by_node = {}
+        for job in jobs:
+            job['remote_hashes'] = {}
+            for node in job['nodes']:
+                event = job['remote_hashes'][node['id']] = Event()
+                by_node.setdefault(node['id'], (node, {}))[1][
+                    job['partition']] = event
+        for node, events in by_node.itervalues():
+            eventlet.spawn_n(self._prefetch_node_hashes, node, events)
+
+    def _prefetch_node_hashes(self, node, events):
+        """
+        Fetches the hashes of some partitions from a remote node.
+
+        :param node: the "dev" entry for the remote node
+        :param events: dictionary of partition -> event to fire with the
+                       partition's hashes
+        """
+        try:
+            for partition, hashes in self.fetch_remote_hashes(
+                    node, [(partition, []) for partition in events]):
+                event = events.pop(partition, None)
+                if event:
+                    event.send(hashes)
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('Error fetching hashes from %(ip)s/%(device)s'), node)
+        finally:
+            for event in events.itervalues():
+                event.send(None)
+
+    def recalculate_remote(self, node, job, suffixes):
+        """
+        Has a remote node recalculate the hashes of suffixes just rsynced
+        to it.  With a replicate_batch_size above 1, partitions are queued
+        up per node and sent off in batches by a single request, once a
+        batch is full or replicate_batch_interval seconds after its first
+        partition was queued, whichever comes first.
+
+        :param node: the "dev" entry for the remote node
+        :param job: information about the partition that was synced
+        :param suffixes: a list of suffixes which were pushed
+        """
+        if self.replicate_batch_size <= 1:
+            with Timeout(self.http_timeout):
+                conn = http_connect(
+                    node['ip'], node['port'], node['device'],
+                    job['partition'], 'REPLICATE', '/' + '-'.join(suffixes),
+                    headers={'Content-Length': '0'})
+                conn.getresponse().read()
+            return
+        if node['id'] not in self.recalculations:
+            self.recalculations[node['id']] = (
+                node, [], eventlet.spawn_after(
+                    self.replicate_batch_interval,
+                    self._send_recalculations, node['id']))
+        partitions = self.recalculations[node['id']][1]
+        partitions.append((job['partition'], suffixes))
+        if len(partitions) >= self.replicate_batch_size:
+            self._send_recalculations(node['id'])
+
+    def _send_recalculations(self, node_id):
+        """
+        Sends off the recalculations queued up for a node, if there are any.
+
+        :param node_id: id of the remote node
+        """
+        queued = self.recalculations.pop(node_id, None)
+        if queued:
+            node, partitions, timer = queued
+            timer.cancel()
+            self.recalculate_pool.spawn_n(
+                self._recalculate_batch, node, partitions)
+
+    def _recalculate_batch(self, node, partitions):
+        """
+        Has a remote node recalculate the hashes of a batch of partitions.
+
+        :param node: the "dev" entry for the remote node
+        :param partitions: list of (partition, suffixes) tuples
+        """
+        try:
+            for _junk in self.fetch_remote_hashes(node, partitions):
+                pass
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('Error recalculating hashes on %(ip)s/%(device)s'), node)
+
+    def flush_recalculations(self):
+        """Sends off all queued recalculations and waits for them."""
+        for node_id in self.recalculations.keys():
+            self._send_recalculations(node_id)
+        self.recalculate_pool.waitall()
+
     def update(self, job):
         """
         High-level method that replicates a single partition.
@@ -427,24 +1153,32 @@ class ObjectReplicator(Daemon):
                 node = next(nodes)
                 attempts_left -= 1
                 try:
-                    with Timeout(self.http_timeout):
-                        resp = http_connect(
-                            node['ip'], node['port'],
-                            node['device'], job['partition'], 'REPLICATE',
-                            '', headers={'Content-Length': '0'}).getresponse()
-                        if resp.status == HTTP_INSUFFICIENT_STORAGE:
-                            self.logger.error(_('%(ip)s/%(device)s responded'
-                                                ' as unmounted'), node)
-                            attempts_left += 1
-                            continue
-                        if resp.status != HTTP_OK:
-                            self.logger.error(_("Invalid response %(resp)s "
-                                                "from %(ip)s"),
-                                              {'resp': resp.status,
-                                               'ip': node['ip']})
-                            continue
-                        remote_hash = pickle.loads(resp.read())
-                        del resp
+                    remote_hash = None
+                    if node['id'] in job.get('remote_hashes', {}):
+                        remote_hash = job['remote_hashes'][node['id']].wait()
+                    if remote_hash is None:
+                        with Timeout(self.http_timeout):
+                            resp = http_connect(
+                                node['ip'], node['port'],
+                                node['device'], job['partition'], 'REPLICATE',
+                                '', headers={'Content-Length': '0'}).\
+                                getresponse()
+                            if resp.status == HTTP_INSUFFICIENT_STORAGE:
+                                self.logger.error(_('%(ip)s/%(device)s '
+                                                    'responded as unmounted'),
+                                                  node)
+                                self.failed_nodes.add(node['id'])
+                                attempts_left += 1
+                                continue
+                            if resp.status != HTTP_OK:
+                                self.logger.error(_("Invalid response "
+                                                    "%(resp)s from %(ip)s"),
+                                                  {'resp': resp.status,
+                                                   'ip': node['ip']})
+                                self.failed_nodes.add(node['id'])
+                                continue
+                            remote_hash = pickle.loads(resp.read())
+                            del resp
                     suffixes = [suffix for suffix in local_hash if
                                 local_hash[suffix] !=
                                 remote_hash.get(suffix, -1)]
@@ -459,19 +1193,16 @@ class ObjectReplicator(Daemon):
                     suffixes = [suffix for suffix in local_hash if
                                 local_hash[suffix] !=
                                 remote_hash.get(suffix, -1)]
-                    self.rsync(node, job, suffixes)
-                    with Timeout(self.http_timeout):
-                        conn = http_connect(
-                            node['ip'], node['port'],
-                            node['device'], job['partition'], 'REPLICATE',
-                            '/' + '-'.join(suffixes),
-                            headers={'Content-Length': '0'})
-                        conn.getresponse().read()
+                    if not self.sync(node, job, suffixes):
+                        self.failed_nodes.add(node['id'])
+                    if self.sync_method == 'rsync':
+                        self.recalculate_remote(node, job, suffixes)
                     self.suffix_sync += len(suffixes)
                     self.logger.update_stats('suffix.syncs', len(suffixes))
                 except (Exception, Timeout):
                     self.logger.exception(_("Error syncing with node: %s") %
                                           node)
+                    self.failed_nodes.add(node['id'])
             self.suffix_count += len(local_hash)
         except (Exception, Timeout):
             self.logger.exception(_("Error syncing partition"))
@@ -496,6 +1227,12 @@ class ObjectReplicator(Daemon):
                  'remaining': '%d%s' % compute_eta(self.start,
                                                    self.replication_count,
                                                    self.job_count)})
+            self.logger.info(
+                _("Partitions replicated by class: %s"),
+                ', '.join('%s %d/%d' % (job_class,
+                                        self.job_progress[job_class]['done'],
+                                        self.job_progress[job_class]['total'])
+                          for job_class in JOB_CLASSES))
             if self.suffix_count:
                 self.logger.info(
                     _("%(checked)d suffixes checked - "
@@ -524,14 +1261,18 @@ class ObjectReplicator(Daemon):
             except GreenletExit:
                 pass
 
-    def heartbeat(self):
+    def heartbeat(self, dump_progress=False):
         """
         Loop that runs in the background during replication.  It periodically
         logs progress.
+
+        :param dump_progress: whether to also write progress out to recon
         """
         while True:
             eventlet.sleep(self.stats_interval)
             self.stats_line()
+            if dump_progress:
+                self.dump_progress()
 
     def detect_lockups(self):
         """
@@ -546,55 +1287,180 @@ class ObjectReplicator(Daemon):
                 self.kill_coros()
             self.last_replication_count = self.replication_count
 
-    def collect_jobs(self):
+    def local_devices(self):
+        """Returns the ring devices of this node."""
+        ips = whataremyips()
+        return [dev for dev in self.object_ring.devs
+                if dev and dev['ip'] in ips and dev['port'] == self.port]
+
+    def build_jobs(self, local_dev):
         """
-        Returns a sorted list of jobs (dictionaries) that specify the
-        partitions, nodes, etc to be rsynced.
+        Generates jobs (dictionaries) that specify the partitions, nodes,
+        etc of a local device to be rsynced.
+
+        :param local_dev: the ring device
         """
-        jobs = []
-        ips = whataremyips()
-        for local_dev in [dev for dev in self.object_ring.devs
-                          if dev and dev['ip'] in ips and
-                          dev['port'] == self.port]:
-            dev_path = join(self.devices_dir, local_dev['device'])
-            obj_path = join(dev_path, 'objects')
-            tmp_path = join(dev_path, 'tmp')
-            if self.mount_check and not os.path.ismount(dev_path):
-                self.logger.warn(_('%s is not mounted'), local_dev['device'])
-                continue
-            unlink_older_than(tmp_path, time.time() - self.reclaim_age)
-            if not os.path.exists(obj_path):
-                try:
-                    mkdirs(obj_path)
-                except Exception:
-                    self.logger.exception('ERROR creating %s' % obj_path)
-                continue
-            for partition in os.listdir(obj_path):
-                try:
-                    job_path = join(obj_path, partition)
-                    if isfile(job_path):
-                        # Clean up any (probably zero-byte) files where a
-                        # partition should be.
-                        self.logger.warning('Removing partition directory '
-                                            'which was a file: %s', job_path)
-                        os.remove(job_path)
-                        continue
-                    part_nodes = \
-                        self.object_ring.get_part_nodes(int(partition))
-                    nodes = [node for node in part_nodes
-                             if node['id'] != local_dev['id']]
-                    jobs.append(
-                        dict(path=job_path,
-                             device=local_dev['device'],
-                             nodes=nodes,
-                             delete=len(nodes) > len(part_nodes) - 1,
-                             partition=partition))
-                except (ValueError, OSError):
+        dev_path = join(self.devices_dir, local_dev['device'])
+        obj_path = join(dev_path, 'objects')
+        tmp_path = join(dev_path, 'tmp')
+        if self.mount_check and not os.path.ismount(dev_path):
+            self.logger.warn(_('%s is not mounted'), local_dev['device'])
+            return
+        unlink_older_than(tmp_path, time.time() - self.reclaim_age)
+        if not os.path.exists(obj_path):
+            try:
+                mkdirs(obj_path)
+            except Exception:
+                self.logger.exception('ERROR creating %s' % obj_path)
+            return
+        for partition in os.listdir(obj_path):
+            try:
+                job_path = join(obj_path, partition)
+                if isfile(job_path):
+                    # Clean up any (probably zero-byte) files where a
+                    # partition should be.
+                    self.logger.warning('Removing partition directory '
+                                        'which was a file: %s', job_path)
+                    os.remove(job_path)
                     continue
+                part_nodes = \
+                    self.object_ring.get_part_nodes(int(partition))
+                nodes = [node for node in part_nodes
+                         if node['id'] != local_dev['id']]
+                yield dict(path=job_path,
+                           device=local_dev['device'],
+                           nodes=nodes,
+                           delete=len(nodes) > len(part_nodes) - 1,
+                           partition=partition)
+            except (ValueError, OSError):
+                continue
+
+    def job_class(self, job):
+        """
+        Returns which of JOB_CLASSES a job falls in.
+
+        :param job: a dict containing info about the partition to be replicated
+        """
+        if job['delete']:
+            return 'handoff'
+        for node in job['nodes']:
+            if node['id'] in self.failed_nodes or \
+                    node['id'] in self.last_failed_nodes:
+                return 'degraded'
+        try:
+            if os.path.getsize(join(job['path'], HASH_JOURNAL)):
+                return 'changed'
+        except OSError:
+            pass
+        if not os.path.exists(join(job['path'], HASH_FILE)):
+            return 'changed'
+        return 'normal'
+
+    def collect_jobs(self, devices=None):
+        """
+        Returns a list of jobs (dictionaries) that specify the partitions,
+        nodes, etc to be rsynced, most urgent first (see JOB_CLASSES) and
+        shuffled within each class.
+
+        :param devices: ring devices to collect jobs for; defaults to all
+                        the devices of this node
+        """
+        if devices is None:
+            devices = self.local_devices()
+        jobs = []
+        for local_dev in devices:
+            jobs.extend(self.build_jobs(local_dev))
         random.shuffle(jobs)
-        self.job_count = len(jobs)
+        for job in jobs:
+            job['class'] = self.job_class(job)
+        jobs.sort(key=lambda job: JOB_CLASSES.index(job['class']))
         return jobs
 
+    def replicate_devices(self, devices, override_partitions):
+        """
+        Feeds the partitions of local devices to the run pool: in turn from
+        each device, most urgent first, and skipping devices that already
+        have device_concurrency partitions being replicated.  A device is
+        listed when its first turn comes, so replication starts without
+        waiting for the other devices to be listed.
+
+        :param devices: the ring devices to replicate
+        :param override_partitions: if given, only these partitions are
+                                    replicated
+        """
+        queues = [[local_dev, None, []] for local_dev in devices]
+        while queues and not self.ring_changed:
+            self.job_finished = Event()
+            dispatched = False
+            for queue in list(queues):
+                local_dev, jobs, ready = queue
+                if jobs is None:
+                    jobs = queue[1] = [
+                        job for job in self.collect_jobs([local_dev])
+                        if not override_partitions or
+                        job['partition'] in override_partitions]
+                    jobs.reverse()
+                    self.job_count += len(jobs)
+                    for job in jobs:
+                        self.job_progress[job['class']]['total'] += 1
+                if not (jobs or ready):
+                    queues.remove(queue)
+                    continue
+                device = local_dev['device']
+                if self.device_running[device] >= self.device_concurrency:
+                    continue
+                if not ready:
+                    ready.append(jobs.pop())
+                    if not ready[0]['delete'] and \
+                            self.replicate_batch_size > 1:
+                        while jobs and not jobs[-1]['delete'] and \
+                                len(ready) < self.replicate_batch_size:
+                            ready.append(jobs.pop())
+                        self.prefetch_hashes(ready)
+                dev_path = join(self.devices_dir, device)
+                if self.mount_check and not os.path.ismount(dev_path):
+                    self.logger.warn(_('%s is not mounted'), device)
+                    queues.remove(queue)
+                    continue
+                if not self.check_ring():
+                    self.logger.info(_("Ring change detected. Aborting "
+                                       "current replication pass."))
+                    self.ring_changed = True
+                    return
+                self.device_running[device] += 1
+                self.run_pool.spawn(self.run_job, ready.pop(0))
+                dispatched = True
+            if queues and not dispatched:
+                self.job_finished.wait()
+
+    def run_job(self, job):
+        """
+        Replicates a partition and then frees its device's turn.
+
+        :param job: a dict containing info about the partition to be replicated
+        """
+        try:
+            if job['delete']:
+                self.update_deleted(job)
+            else:
+                self.update(job)
+        finally:
+            self.device_running[job['device']] -= 1
+            self.job_progress[job['class']]['done'] += 1
+            if not self.job_finished.ready():
+                self.job_finished.send()
+
+    def dump_progress(self):
+        """
+        Writes the progress of each class of jobs out to recon, or from a
+        worker, sends the worker's stats to the parent to do that.
+        """
+        if self.report_progress:
+            self.report_progress(self.shard_stats())
+            return
+        dump_recon_cache({'object_replication_progress': self.job_progress},
+                         self.rcache, self.logger)
+
     def replicate(self, override_devices=[], override_partitions=[]):
         """Run a replication pass"""
         self.start = time.time()
@@ -604,39 +1470,152 @@ class ObjectReplicator(Daemon):
         self.replication_count = 0
         self.last_replication_count = -1
         self.partition_times = []
-        stats = eventlet.spawn(self.heartbeat)
+        self.job_count = 0
+        self.job_progress = dict((job_class, {'total': 0, 'done': 0})
+                                 for job_class in JOB_CLASSES)
+        self.ring_changed = False
+        self.last_failed_nodes, self.failed_nodes = self.failed_nodes, set()
+        devices = [local_dev for local_dev in self.local_devices()
+                   if not override_devices or
+                   local_dev['device'] in override_devices]
+        dump_progress = not (override_devices or override_partitions)
+        try:
+            if self.workers > 1 and len(devices) > 1:
+                self.replicate_in_workers(devices, override_partitions,
+                                          dump_progress)
+            else:
+                self.replicate_in_process(devices, override_partitions,
+                                          dump_progress)
+        finally:
+            self.stats_line()
+            if dump_progress:
+                self.dump_progress()
+
+    def replicate_in_process(self, devices, override_partitions,
+                             dump_progress=False):
+        """
+        Replicates local devices in this process.
+
+        :param devices: the ring devices to replicate
+        :param override_partitions: if given, only these partitions are
+                                    replicated
+        :param dump_progress: whether to write progress out to recon as it
+                              goes
+        """
+        self.recalculations = {}
+        self.recalculate_pool = GreenPool()
+        self.device_running = defaultdict(int)
+        self.job_finished = Event()
+        stats = eventlet.spawn(self.heartbeat, dump_progress)
         lockup_detector = eventlet.spawn(self.detect_lockups)
         eventlet.sleep()  # Give spawns a cycle
         try:
             self.run_pool = GreenPool(size=self.concurrency)
-            jobs = self.collect_jobs()
-            for job in jobs:
-                if override_devices and job['device'] not in override_devices:
-                    continue
-                if override_partitions and \
-                        job['partition'] not in override_partitions:
-                    continue
-                dev_path = join(self.devices_dir, job['device'])
-                if self.mount_check and not os.path.ismount(dev_path):
-                    self.logger.warn(_('%s is not mounted'), job['device'])
-                    continue
-                if not self.check_ring():
-                    self.logger.info(_("Ring change detected. Aborting "
-                                       "current replication pass."))
-                    return
-                if job['delete']:
-                    self.run_pool.spawn(self.update_deleted, job)
-                else:
-                    self.run_pool.spawn(self.update, job)
+            self.replicate_devices(devices, override_partitions)
+            if self.ring_changed:
+                return
             with Timeout(self.lockup_timeout):
                 self.run_pool.waitall()
+                self.flush_recalculations()
         except (Exception, Timeout):
             self.logger.exception(_("Exception in top-level replication loop"))
             self.kill_coros()
         finally:
             stats.kill()
             lockup_detector.kill()
-            self.stats_line()
+
+    def replicate_in_workers(self, devices, override_partitions,
+                             dump_progress=False):
+        """
+        Replicates local devices in replicator_workers child processes, each
+        with its share of the devices, and adds up their stats.
+
+        :param devices: the ring devices to replicate
+        :param override_partitions: if given, only these partitions are
+                                    replicated
+        :param dump_progress: whether to write progress out to recon as the
+                              workers report it
+        """
+        shards = [(devices[worker::self.workers], override_partitions)
+                  for worker in xrange(min(self.workers, len(devices)))]
+        worker_stats = [None] * len(shards)
+
+        def progress(index, stats):
+            worker_stats[index] = stats
+            self.add_worker_stats(worker_stats)
+            if dump_progress:
+                self.dump_progress()
+
+        results = fork_workers(self.replicate_shard, shards, self.logger,
+                               progress)
+        for index, stats in enumerate(results):
+            if stats is None:
+                # what the worker last reported still counts
+                self.logger.error(_('Replication worker failed'))
+            else:
+                worker_stats[index] = stats
+        self.add_worker_stats(worker_stats)
+
+    def add_worker_stats(self, worker_stats):
+        """
+        Sets this pass's stats to the sum of the workers' latest ones.
+
+        :param worker_stats: list of the stats each worker last reported,
+                             None for those that haven't yet
+        """
+        self.replication_count = self.job_count = 0
+        self.suffix_count = self.suffix_hash = self.suffix_sync = 0
+        self.partition_times = []
+        self.job_progress = dict((job_class, {'total': 0, 'done': 0})
+                                 for job_class in JOB_CLASSES)
+        self.failed_nodes = set()
+        self.ring_changed = False
+        for stats in worker_stats:
+            if stats is None:
+                continue
+            self.replication_count += stats['replication_count']
+            self.job_count += stats['job_count']
+            self.suffix_count += stats['suffix_count']
+            self.suffix_hash += stats['suffix_hash']
+            self.suffix_sync += stats['suffix_sync']
+            self.partition_times.extend(stats['partition_times'])
+            for job_class, progress in stats['job_progress'].iteritems():
+                for key, value in progress.iteritems():
+                    self.job_progress[job_class][key] += value
+            self.failed_nodes.update(stats['failed_nodes'])
+            self.ring_changed = self.ring_changed or stats['ring_changed']
+
+    def replicate_shard(self, shard, report):
+        """
+        Replicates a worker's share of the local devices, in the worker.
+
+        :param shard: tuple of (ring devices, partitions to replicate or an
+                      empty list for all)
+        :param report: function to send the worker's stats to the parent
+                       with as it goes
+        :returns: dictionary of the stats of the worker's pass
+        """
+        devices, override_partitions = shard
+        # connections kept alive by the parent are not this worker's to use
+        self.conn_pool = ConnectionPool()
+        self.report_progress = report
+        self.replicate_in_process(devices, override_partitions, True)
+        self.logger.info(_("Replication of %s complete"),
+                         ', '.join(dev['device'] for dev in devices))
+        self.stats_line()
+        return self.shard_stats()
+
+    def shard_stats(self):
+        """Returns the stats of a worker's pass so far."""
+        return {'replication_count': self.replication_count,
+                'job_count': self.job_count,
+                'suffix_count': self.suffix_count,
+                'suffix_hash': self.suffix_hash,
+                'suffix_sync': self.suffix_sync,
+                'partition_times': self.partition_times,
+                'job_progress': self.job_progress,
+                'failed_nodes': list(self.failed_nodes),
+                'ring_changed': self.ring_changed}
 
     def run_once(self, *args, **kwargs):
         start = time.time()
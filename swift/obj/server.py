@@ -19,6 +19,9 @@ from __future__ import with_statement
 import cPickle as pickle
 import errno
 import os
+import random
+import re
+import struct
 import time
 import traceback
 from datetime import datetime
@@ -27,7 +30,7 @@ from tempfile import mkstemp
 from urllib import unquote
 from contextlib import contextmanager
 
-from xattr import getxattr, setxattr
+from xattr import setxattr
 from eventlet import sleep, Timeout, tpool
 
 from swift.common.utils import mkdirs, normalize_timestamp, public, \
@@ -40,7 +43,9 @@ from swift.common.constraints import check_object_creation, check_mount, \
 from swift.common.exceptions import ConnectionTimeout, DiskFileError, \
     DiskFileNotExist
 from swift.obj.replicator import tpool_reraise, invalidate_hash, \
-    quarantine_renamer, get_hashes
+    quarantine_renamer, get_hashes, current_files, get_indexed_files, \
+    missing_files, read_raw_metadata, METADATA_KEY, METADATA_MAGIC, \
+    METADATA_HEADER
 from swift.common.http import is_success
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPCreated, \
     HTTPInternalServerError, HTTPNoContent, HTTPNotFound, HTTPNotModified, \
@@ -52,39 +57,131 @@ from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPCreated, \
 DATADIR = 'objects'
 ASYNCDIR = 'async_pending'
 PICKLE_PROTOCOL = 2
-METADATA_KEY = 'user.swift.metadata'
+METADATA_VERSION = 1
 MAX_OBJECT_NAME_LENGTH = 1024
 # keep these lower-case
 DISALLOWED_HEADERS = set('content-length content-type deleted etag'.split())
+# "<suffix>/<hash>/<file name>" of a file pushed by the replicator
+SYNC_NAME = re.compile(r'^([0-9a-f]{3})/([0-9a-f]{29}\1)/'
+                       r'(\d+\.\d+\.(?:data|meta|ts))$')
+
+
+def encode_metadata(metadata):
+    """
+    Encodes a metadata dictionary in the compact binary format: a header of
+    METADATA_MAGIC, the format version and the payload length, followed by
+    one (key, type, value) record per item.
+
+    :param metadata: dictionary of metadata to encode
+    :returns: the encoded string
+    :raises TypeError: if a key is not a str or a value is of a type the
+                       format cannot represent
+    """
+    records = []
+    for key, value in metadata.iteritems():
+        if not isinstance(key, str):
+            raise TypeError('Unsupported metadata key %r' % (key,))
+        if isinstance(value, str):
+            tag = 's'
+        elif isinstance(value, unicode):
+            tag, value = 'u', value.encode('utf-8')
+        elif isinstance(value, bool):
+            tag, value = 'b', value and '1' or ''
+        elif isinstance(value, (int, long)):
+            tag, value = 'i', str(value)
+        elif isinstance(value, float):
+            tag, value = 'f', repr(value)
+        else:
+            raise TypeError('Unsupported metadata value %r' % (value,))
+        records.append(struct.pack('!HcI', len(key), tag, len(value)))
+        records.append(key)
+        records.append(value)
+    payload = ''.join(records)
+    return struct.pack(METADATA_HEADER, METADATA_MAGIC, METADATA_VERSION,
+                       len(payload)) + payload
+
+
+def decode_metadata(metastr):
+    """
+    Decodes metadata written by write_metadata, in either the binary format
+    or the older pickle format.
+
+    :param metastr: the metadata string read from the xattrs
+    :returns: dictionary of metadata
+    """
+    if not metastr.startswith(METADATA_MAGIC):
+        return pickle.loads(metastr)
+    header_size = struct.calcsize(METADATA_HEADER)
+    _junk, version, length = struct.unpack_from(METADATA_HEADER, metastr)
+    if version != METADATA_VERSION:
+        raise ValueError('Unknown metadata format version %d' % version)
+    if len(metastr) < header_size + length:
+        raise ValueError('Truncated metadata')
+    record_size = struct.calcsize('!HcI')
+    metadata = {}
+    pos = header_size
+    end = header_size + length
+    while pos < end:
+        key_len, tag, value_len = struct.unpack_from('!HcI', metastr, pos)
+        pos += record_size
+        key = metastr[pos:pos + key_len]
+        pos += key_len
+        value = metastr[pos:pos + value_len]
+        pos += value_len
+        if tag == 'u':
+            value = value.decode('utf-8')
+        elif tag == 'b':
+            value = bool(value)
+        elif tag == 'i':
+            value = int(value)
+        elif tag == 'f':
+            value = float(value)
+        elif tag != 's':
+            raise ValueError('Unknown metadata value type %r' % tag)
+        metadata[key] = value
+    return metadata
 
 
 def read_metadata(fd):
     """
-    Helper function to read the pickled metadata from an object file.
+    Helper function to read the metadata from an object file.
 
     :param fd: file descriptor to load the metadata from
 
     :returns: dictionary of metadata
     """
-    metadata = ''
-    key = 0
-    try:
-        while True:
-            metadata += getxattr(fd, '%s%s' % (METADATA_KEY, (key or '')))
-            key += 1
-    except IOError:
-        pass
-    return pickle.loads(metadata)
+    return decode_metadata(read_raw_metadata(fd))
 
 
-def write_metadata(fd, metadata):
+def write_metadata(fd, metadata, binary=False):
     """
-    Helper function to write pickled metadata for an object file.
+    Helper function to write metadata for an object file.  The metadata is
+    pickled and split over 254-byte xattrs, which every object server can
+    read.  With binary set it is instead written to a single xattr in the
+    binary format, unless it holds values that format cannot represent;
+    binary metadata too large for one xattr on the filesystem is split the
+    same way as pickled metadata.
 
     :param fd: file descriptor to write the metadata
     :param metadata: metadata to write
+    :param binary: if True, write the binary format, which object servers
+                   older than it cannot read
     """
-    metastr = pickle.dumps(metadata, PICKLE_PROTOCOL)
+    metastr = None
+    if binary:
+        try:
+            metastr = encode_metadata(metadata)
+        except TypeError:
+            pass
+    if metastr is not None:
+        try:
+            setxattr(fd, METADATA_KEY, metastr)
+            return
+        except IOError:
+            # e.g. ENOSPC or E2BIG: more than one xattr value can hold
+            pass
+    else:
+        metastr = pickle.dumps(metadata, PICKLE_PROTOCOL)
     key = 0
     while metastr:
         setxattr(fd, '%s%s' % (METADATA_KEY, key or ''), metastr[:254])
@@ -105,11 +202,17 @@ class DiskFile(object):
     :param keep_data_fp: if True, don't close the fp, otherwise close it
     :param disk_chunk_size: size of chunks on file reads
     :param iter_hook: called when __iter__ returns a chunk
+    :param use_index: if True, look the object's files up in the per-suffix
+                      object index instead of listing the hash dir, when the
+                      index has them
+    :param binary_metadata: if True, write metadata in the binary format
+                            instead of the pickle format older object
+                            servers can read
     """
 
     def __init__(self, path, device, partition, account, container, obj,
                  logger, keep_data_fp=False, disk_chunk_size=65536,
-                 iter_hook=None):
+                 iter_hook=None, use_index=False, binary_metadata=False):
         self.disk_chunk_size = disk_chunk_size
         self.iter_hook = iter_hook
         self.name = '/' + '/'.join((account, container, obj))
@@ -130,19 +233,43 @@ class DiskFile(object):
         self.quarantined_dir = None
         self.keep_cache = False
         self.suppress_file_closing = False
+        self.verify_etag = True
+        self.zero_copy = False
+        self.use_index = use_index
+        self.binary_metadata = binary_metadata
+        if use_index:
+            files = get_indexed_files(self.datadir)
+            if files is not None:
+                try:
+                    self._open_files(files, keep_data_fp)
+                    return
+                except IOError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    # The index is stale; fall back to listing the dir.
+                    self.close(verify_file=False)
+                    self.metadata = {}
+                    self.meta_file = self.data_file = None
         if not os.path.exists(self.datadir):
             return
-        files = sorted(os.listdir(self.datadir), reverse=True)
+        self._open_files(current_files(os.listdir(self.datadir)),
+                         keep_data_fp)
+
+    def _open_files(self, files, keep_data_fp):
+        """
+        Loads the object's state from its current files.
+
+        :param files: file names as returned by current_files()
+        :param keep_data_fp: if True, don't close the fp, otherwise close it
+        """
         for file in files:
             if file.endswith('.ts'):
-                self.data_file = self.meta_file = None
                 self.metadata = {'deleted': True}
                 return
-            if file.endswith('.meta') and not self.meta_file:
+            if file.endswith('.meta'):
                 self.meta_file = os.path.join(self.datadir, file)
-            if file.endswith('.data') and not self.data_file:
+            if file.endswith('.data'):
                 self.data_file = os.path.join(self.datadir, file)
-                break
         if not self.data_file:
             return
         self.fp = open(self.data_file, 'rb')
@@ -165,7 +292,8 @@ class DiskFile(object):
             self.read_to_eof = False
             if self.fp.tell() == 0:
                 self.started_at_0 = True
-                self.iter_etag = md5()
+                if self.verify_etag:
+                    self.iter_etag = md5()
             while True:
                 chunk = self.fp.read(self.disk_chunk_size)
                 if chunk:
@@ -220,6 +348,17 @@ class DiskFile(object):
                 self.suppress_file_closing = False
                 self.close()
 
+    def fileno(self):
+        """
+        Returns the file descriptor of the open data file, so a
+        wsgi.file_wrapper can send it without copying it through Python.
+        """
+        return self.fp.fileno()
+
+    def read(self, size=-1):
+        """Reads from the open data file, for wsgi.file_wrapper."""
+        return self.fp.read(size)
+
     def _handle_close_quarantine(self):
         """Check if file needs to be quarantined"""
         try:
@@ -246,6 +385,10 @@ class DiskFile(object):
             try:
                 if verify_file:
                     self._handle_close_quarantine()
+                if self.zero_copy:
+                    # the whole file was handed off, so drop all of it,
+                    # unless it is to be kept in the cache
+                    self.drop_cache(self.fp.fileno(), 0, 0)
             except (Exception, Timeout), e:
                 self.logger.error(_(
                     'ERROR DiskFile %(data_file)s in '
@@ -306,11 +449,12 @@ class DiskFile(object):
         assert self.tmppath is not None
         metadata['name'] = self.name
         timestamp = normalize_timestamp(metadata['X-Timestamp'])
-        write_metadata(fd, metadata)
+        write_metadata(fd, metadata, binary=self.binary_metadata)
         if 'Content-Length' in metadata:
             self.drop_cache(fd, 0, int(metadata['Content-Length']))
         tpool.execute(fsync, fd)
-        invalidate_hash(os.path.dirname(self.datadir))
+        invalidate_hash(os.path.dirname(self.datadir),
+                        os.path.basename(self.datadir))
         renamer(self.tmppath,
                 os.path.join(self.datadir, timestamp + extension))
         self.metadata = metadata
@@ -334,13 +478,18 @@ class DiskFile(object):
         :param timestamp: timestamp to compare with each file
         """
         timestamp = normalize_timestamp(timestamp)
+        unlinked = False
         for fname in os.listdir(self.datadir):
             if fname < timestamp:
                 try:
                     os.unlink(os.path.join(self.datadir, fname))
+                    unlinked = True
                 except OSError, err:    # pragma: no cover
                     if err.errno != errno.ENOENT:
                         raise
+        if unlinked:
+            invalidate_hash(os.path.dirname(self.datadir),
+                            os.path.basename(self.datadir))
 
     def drop_cache(self, fd, offset, length):
         """Method for no-oping buffer cache drop method."""
@@ -412,6 +561,12 @@ class ObjectController(object):
         self.max_upload_time = int(conf.get('max_upload_time', 86400))
         self.slow = int(conf.get('slow', 0))
         self.bytes_per_sync = int(conf.get('mb_per_sync', 512)) * 1024 * 1024
+        self.object_index = \
+            config_true_value(conf.get('object_index', 'false'))
+        self.binary_metadata = \
+            config_true_value(conf.get('binary_metadata', 'false'))
+        self.etag_verify_rate = \
+            float(conf.get('etag_verify_rate', 1.0))
         default_allowed_headers = '''
             content-disposition,
             content-encoding,
@@ -585,7 +740,9 @@ class ObjectController(object):
         if self.mount_check and not check_mount(self.devices, device):
             return HTTPInsufficientStorage(drive=device, request=request)
         file = DiskFile(self.devices, device, partition, account, container,
-                        obj, self.logger, disk_chunk_size=self.disk_chunk_size)
+                        obj, self.logger, disk_chunk_size=self.disk_chunk_size,
+                        use_index=self.object_index,
+                        binary_metadata=self.binary_metadata)
 
         if file.is_deleted() or file.is_expired():
             return HTTPNotFound(request=request)
@@ -637,7 +794,9 @@ class ObjectController(object):
             return HTTPBadRequest(body='X-Delete-At in past', request=request,
                                   content_type='text/plain')
         file = DiskFile(self.devices, device, partition, account, container,
-                        obj, self.logger, disk_chunk_size=self.disk_chunk_size)
+                        obj, self.logger, disk_chunk_size=self.disk_chunk_size,
+                        use_index=self.object_index,
+                        binary_metadata=self.binary_metadata)
         orig_timestamp = file.metadata.get('X-Timestamp')
         upload_expiration = time.time() + self.max_upload_time
         etag = md5()
@@ -733,7 +892,8 @@ class ObjectController(object):
         file = DiskFile(self.devices, device, partition, account, container,
                         obj, self.logger, keep_data_fp=True,
                         disk_chunk_size=self.disk_chunk_size,
-                        iter_hook=sleep)
+                        iter_hook=sleep, use_index=self.object_index,
+                        binary_metadata=self.binary_metadata)
         if file.is_deleted() or file.is_expired():
             if request.headers.get('if-match') == '*':
                 return HTTPPreconditionFailed(request=request)
@@ -776,8 +936,18 @@ class ObjectController(object):
                 if_modified_since:
             file.close()
             return HTTPNotModified(request=request)
+        file.verify_etag = random.random() < self.etag_verify_rate
         response = Response(app_iter=file,
                             request=request, conditional_response=True)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        # Only GETs whose data is not to be checked against the ETag can be
+        # handed off: the data never passes through us then.  The eventlet
+        # WSGI server offers no file wrapper, so this is for the likes of
+        # mod_wsgi, which sends the file with sendfile().
+        if file_wrapper and 'range' not in request.headers and \
+                not file.verify_etag:
+            file.zero_copy = True
+            response.app_iter = file_wrapper(file, self.disk_chunk_size)
         response.headers['Content-Type'] = file.metadata.get(
             'Content-Type', 'application/octet-stream')
         for key, value in file.metadata.iteritems():
@@ -813,7 +983,9 @@ class ObjectController(object):
         if self.mount_check and not check_mount(self.devices, device):
             return HTTPInsufficientStorage(drive=device, request=request)
         file = DiskFile(self.devices, device, partition, account, container,
-                        obj, self.logger, disk_chunk_size=self.disk_chunk_size)
+                        obj, self.logger, disk_chunk_size=self.disk_chunk_size,
+                        use_index=self.object_index,
+                        binary_metadata=self.binary_metadata)
         if file.is_deleted() or file.is_expired():
             return HTTPNotFound(request=request)
         try:
@@ -856,7 +1028,9 @@ class ObjectController(object):
             return HTTPInsufficientStorage(drive=device, request=request)
         response_class = HTTPNoContent
         file = DiskFile(self.devices, device, partition, account, container,
-                        obj, self.logger, disk_chunk_size=self.disk_chunk_size)
+                        obj, self.logger, disk_chunk_size=self.disk_chunk_size,
+                        use_index=self.object_index,
+                        binary_metadata=self.binary_metadata)
         if 'x-if-delete-at' in request.headers and \
                 int(request.headers['x-if-delete-at']) != \
                 int(file.metadata.get('X-Delete-At') or 0):
@@ -891,16 +1065,36 @@ class ObjectController(object):
         """
         Handle REPLICATE requests for the Swift Object Server.  This is used
         by the object replicator to get hashes for directories.
+
+        A REPLICATE of a whole device handles many of its partitions at
+        once: the body holds a "<partition>[ <suffix>-<suffix>...]" line
+        for each, and as each partition is hashed the response streams
+        back a 4-byte length and a pickled (partition, hashes) tuple.
+        hashes is None if the partition could not be hashed.
         """
         try:
             device, partition, suffix = split_path(
-                unquote(request.path), 2, 3, True)
-            validate_device_partition(device, partition)
+                unquote(request.path), 1, 3, True)
+            if partition:
+                validate_device_partition(device, partition)
+                batch = None
+            else:
+                batch = []
+                for line in request.body.splitlines():
+                    partition, _junk, suffixes = line.partition(' ')
+                    validate_device_partition(device, partition)
+                    batch.append(
+                        (partition, suffixes.split('-') if suffixes else []))
+                if not batch:
+                    raise ValueError('No partitions')
         except ValueError, e:
             return HTTPBadRequest(body=str(e), request=request,
                                   content_type='text/plain')
         if self.mount_check and not check_mount(self.devices, device):
             return HTTPInsufficientStorage(drive=device, request=request)
+        if batch:
+            return Response(app_iter=self._replicate_iter(device, batch),
+                            request=request)
         path = os.path.join(self.devices, device, DATADIR, partition)
         if not os.path.exists(path):
             mkdirs(path)
@@ -908,6 +1102,140 @@ class ObjectController(object):
         _junk, hashes = tpool_reraise(get_hashes, path, recalculate=suffixes)
         return Response(body=pickle.dumps(hashes))
 
+    def _replicate_iter(self, device, batch):
+        """
+        Generates the response body of a REPLICATE of a whole device.
+
+        :param device: the device
+        :param batch: list of (partition, suffixes to recalculate) tuples
+        """
+        for partition, suffixes in batch:
+            path = os.path.join(self.devices, device, DATADIR, partition)
+            try:
+                if not os.path.exists(path):
+                    mkdirs(path)
+                _junk, hashes = tpool_reraise(get_hashes, path,
+                                              recalculate=suffixes)
+            except (Exception, Timeout):
+                self.logger.exception(_('Error hashing partition %s'), path)
+                hashes = None
+            data = pickle.dumps((partition, hashes), PICKLE_PROTOCOL)
+            yield struct.pack('!I', len(data)) + data
+
+    @public
+    @timing_stats(sample_rate=0.1)
+    def SYNC(self, request):
+        """
+        Handle SYNC requests for the Swift Object Server.  This is used by
+        the object replicator, when its sync_method is http, to push the
+        files of some suffixes of a partition.  With an X-Sync-Phase of
+        check, the body lists the files on offer and the response the ones
+        this node wants.  Otherwise the body holds the files themselves,
+        each a "<name> <metadata length> <data length>" line followed by
+        its raw metadata and data; once they are stored, the suffixes in
+        the path are rehashed.
+        """
+        try:
+            device, partition, suffix = split_path(
+                unquote(request.path), 2, 3, True)
+            validate_device_partition(device, partition)
+        except ValueError, e:
+            return HTTPBadRequest(body=str(e), request=request,
+                                  content_type='text/plain')
+        if self.mount_check and not check_mount(self.devices, device):
+            return HTTPInsufficientStorage(drive=device, request=request)
+        path = os.path.join(self.devices, device, DATADIR, partition)
+        if request.headers.get('x-sync-phase') == 'check':
+            names = request.body.splitlines()
+            if not all(SYNC_NAME.match(name) for name in names):
+                return HTTPBadRequest(body='Invalid file name',
+                                      request=request,
+                                      content_type='text/plain')
+            wanted = tpool_reraise(missing_files, path, names)
+            return Response(body='\n'.join(wanted), request=request,
+                            content_type='text/plain')
+        reader = request.environ['wsgi.input']
+        while True:
+            line = reader.readline(MAX_OBJECT_NAME_LENGTH)
+            if not line:
+                break
+            try:
+                name, meta_len, data_len = line.split()
+                match = SYNC_NAME.match(name)
+                metadata = decode_metadata(reader.read(int(meta_len)))
+                data_len = int(data_len)
+            except Exception:
+                return HTTPBadRequest(body='Invalid record', request=request,
+                                      content_type='text/plain')
+            if not match:
+                return HTTPBadRequest(body='Invalid file name',
+                                      request=request,
+                                      content_type='text/plain')
+            hash_dir = os.path.join(path, match.group(1), match.group(2))
+            error_response = self._sync_file(
+                request, reader, device, hash_dir, match.group(3), metadata,
+                data_len)
+            if error_response:
+                return error_response
+        if not os.path.exists(path):
+            mkdirs(path)
+        suffixes = suffix.split('-') if suffix else []
+        tpool_reraise(get_hashes, path, recalculate=suffixes)
+        return HTTPNoContent(request=request)
+
+    def _sync_file(self, request, reader, device, hash_dir, filename,
+                   metadata, data_len):
+        """
+        Stores a file pushed in a SYNC request.
+
+        :param request: the SYNC request
+        :param reader: the request's wsgi.input, positioned at the file data
+        :param device: the device the file goes to
+        :param hash_dir: absolute path of the object hash dir to store it in
+        :param filename: name of the file in hash_dir
+        :param metadata: the file's decoded metadata
+        :param data_len: length of the file data
+        :returns: an error response, or None if the file was stored
+        """
+        tmpdir = os.path.join(self.devices, device, 'tmp')
+        if not os.path.exists(tmpdir):
+            mkdirs(tmpdir)
+        fd, tmppath = mkstemp(dir=tmpdir)
+        try:
+            try:
+                fallocate(fd, data_len)
+            except OSError:
+                return HTTPInsufficientStorage(drive=device, request=request)
+            etag = md5()
+            while data_len:
+                chunk = reader.read(min(data_len, self.network_chunk_size))
+                if not chunk:
+                    return HTTPClientDisconnect(request=request)
+                data_len -= len(chunk)
+                etag.update(chunk)
+                while chunk:
+                    written = os.write(fd, chunk)
+                    chunk = chunk[written:]
+            if filename.endswith('.data') and 'ETag' in metadata and \
+                    metadata['ETag'] != etag.hexdigest():
+                return HTTPUnprocessableEntity(
+                    body='ETag mismatch for %s' % metadata.get('name'),
+                    request=request, content_type='text/plain')
+            write_metadata(fd, metadata, binary=self.binary_metadata)
+            drop_buffer_cache(fd, 0, os.fstat(fd).st_size)
+            tpool.execute(fsync, fd)
+            invalidate_hash(os.path.dirname(hash_dir),
+                            os.path.basename(hash_dir))
+            renamer(tmppath, os.path.join(hash_dir, filename))
+            tmppath = None
+        finally:
+            os.close(fd)
+            if tmppath:
+                try:
+                    os.unlink(tmppath)
+                except OSError:
+                    pass
+
     def __call__(self, env, start_response):
         """WSGI Application entry point for the Swift Object Server."""
         start_time = time.time()
@@ -942,7 +1270,7 @@ class ObjectController(object):
                 req.headers.get('x-trans-id', '-'),
                 req.user_agent or '-',
                 trans_time)
-            if req.method == 'REPLICATE':
+            if req.method in ('REPLICATE', 'SYNC'):
                 self.logger.debug(log_line)
             else:
                 self.logger.info(log_line)
@@ -114,9 +114,10 @@ class AccountController(Controller):
                    'x-trans-id': self.trans_id,
                    'Connection': 'close'}
         self.transfer_headers(req.headers, headers)
+        cache_key = get_account_memcache_key(self.account_name)
+        self.app.info_cache.invalidate(cache_key)
         if self.app.memcache:
-            self.app.memcache.delete(
-                get_account_memcache_key(self.account_name))
+            self.app.memcache.delete(cache_key)
         
         # 执行请求
         # 这里只传递了account_partition, 没有传递account nodes
@@ -140,9 +141,10 @@ class AccountController(Controller):
                    'X-Trans-Id': self.trans_id,
                    'Connection': 'close'}
         self.transfer_headers(req.headers, headers)
+        cache_key = get_account_memcache_key(self.account_name)
+        self.app.info_cache.invalidate(cache_key)
         if self.app.memcache:
-            self.app.memcache.delete(
-                get_account_memcache_key(self.account_name))
+            self.app.memcache.delete(cache_key)
         resp = self.make_requests(
             req, self.app.account_ring, account_partition, 'POST',
             req.path_info, [headers] * len(accounts))
@@ -174,9 +176,10 @@ class AccountController(Controller):
         headers = {'X-Timestamp': normalize_timestamp(time.time()),
                    'X-Trans-Id': self.trans_id,
                    'Connection': 'close'}
+        cache_key = get_account_memcache_key(self.account_name)
+        self.app.info_cache.invalidate(cache_key)
         if self.app.memcache:
-            self.app.memcache.delete(
-                get_account_memcache_key(self.account_name))
+            self.app.memcache.delete(cache_key)
         resp = self.make_requests(
             req, self.app.account_ring, account_partition, 'DELETE',
             req.path_info, [headers] * len(accounts))
@@ -27,10 +27,15 @@
 # collected. We've seen objects hang around forever otherwise.
 
 import time
+import copy
 import functools
 import inspect
 
+from collections import deque
+from heapq import nsmallest
+
 from eventlet import spawn_n, GreenPile
+from eventlet.event import Event
 from eventlet.queue import Queue, Empty, Full
 from eventlet.timeout import Timeout
 
@@ -263,6 +268,189 @@ def get_account_info(env, app, swift_source=None):
     return env[env_key]
 
 
+class InfoCache(object):
+    """
+    Account and container info cached in each proxy worker, in front of
+    memcache.
+
+    Entries found (200) are kept for ttl seconds and entries not found (404)
+    for a tenth of that, and the least recently used are dropped once there
+    are more than max_size. Only one lookup per key is made at a time; other
+    callers that miss on the same key wait for its result instead of making
+    their own, and if it fails each raises a copy of its error. An entry
+    that is used in the last quarter of its life is refreshed in the
+    background, so hot keys never expire under load.
+
+    :param max_size: most entries to keep; 0 keeps none
+    :param ttl: seconds a found entry is kept; 0 keeps none
+    :param logger: logger to send hit, miss, coalesced and refresh counts to
+    """
+
+    def __init__(self, max_size, ttl, logger):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.logger = logger
+        # key -> [expires, refresh_after, info, last_used]
+        self.entries = {}
+        # key -> Event for the lookup under way
+        self.pending = {}
+
+    def get(self, key, lookup):
+        """
+        Returns the info for key, calling lookup() to get it if needed.
+
+        :param key: the memcache key of the account or container
+        :param lookup: callable returning the info dict, including 'status'
+        :returns: a copy of the info dict
+        """
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            entry[3] = now
+            self.logger.increment('info_cache.hit')
+            if entry[1] < now and key not in self.pending:
+                self.logger.increment('info_cache.refresh')
+                spawn_n(self._refresh, key, lookup)
+            return dict(entry[2])
+        if key in self.pending:
+            self.logger.increment('info_cache.coalesced')
+            info, err = self.pending[key].wait()
+            if err:
+                raise copy.copy(err)
+            return dict(info)
+        self.logger.increment('info_cache.miss')
+        return dict(self._load(key, lookup))
+
+    def _load(self, key, lookup):
+        event = self.pending[key] = Event()
+        try:
+            info = lookup()
+        except (Exception, Timeout), err:
+            del self.pending[key]
+            event.send((None, err))
+            raise
+        del self.pending[key]
+        self._store(key, info)
+        event.send((info, None))
+        return info
+
+    def _refresh(self, key, lookup):
+        try:
+            self._load(key, lookup)
+        except (Exception, Timeout):
+            # Whoever looks the key up next will see the error
+            pass
+
+    def _store(self, key, info):
+        if not self.max_size or not self.ttl:
+            return
+        status = info.get('status')
+        if status == HTTP_OK:
+            ttl = self.ttl
+        elif status == HTTP_NOT_FOUND:
+            ttl = self.ttl * 0.1
+        else:
+            self.entries.pop(key, None)
+            return
+        now = time.time()
+        self.entries[key] = [now + ttl, now + ttl * 0.75, info, now]
+        if len(self.entries) > self.max_size:
+            for key in [k for k, e in self.entries.iteritems()
+                        if e[0] <= now]:
+                del self.entries[key]
+            excess = len(self.entries) - self.max_size * 9 // 10
+            if excess > 0:
+                for key, _junk in nsmallest(
+                        excess, self.entries.iteritems(),
+                        key=lambda item: item[1][3]):
+                    del self.entries[key]
+
+    def invalidate(self, key):
+        """Forgets key, after a change to the account or container."""
+        self.entries.pop(key, None)
+
+
+class NodeLatency(object):
+    """
+    Per-device model of backend latency, kept in each proxy worker.
+
+    Every request to a device feeds the time it took to connect and get
+    response headers back (or node_timeout if it failed) into an
+    exponentially weighted moving average for that device. Estimates decay
+    with a half life of half_life seconds while a device goes unused, so a
+    device that was once slow is eventually tried, and measured, again.
+    Devices never measured estimate 0 and are tried first.
+
+    Recent GET/HEAD samples are also kept per server type so that a
+    percentile of them can be used as a hedging deadline.
+
+    :param half_life: seconds for an unrefreshed estimate to halve
+    :param alpha: weight given to each new sample
+    :param window: recent samples kept per server type
+    """
+
+    def __init__(self, half_life=300, alpha=0.3, window=1000):
+        self.half_life = half_life
+        self.alpha = alpha
+        self.window = window
+        # (ip, port, device) -> [ewma, last_updated]
+        self.devices = {}
+        # server type -> deque of recent samples
+        self.samples = {}
+
+    def record(self, node, elapsed, server_type=None):
+        """
+        :param node: dictionary of node the request went to
+        :param elapsed: seconds until response headers, or the penalty for
+                        a failed request
+        :param server_type: also keep the sample for percentile() under
+                            this server type
+        """
+        key = (node['ip'], node['port'], node['device'])
+        entry = self.devices.get(key)
+        now = time.time()
+        if entry is None:
+            self.devices[key] = [elapsed, now]
+        else:
+            current = self.estimate(node, now)
+            entry[0] = current + self.alpha * (elapsed - current)
+            entry[1] = now
+        if server_type is not None:
+            samples = self.samples.get(server_type)
+            if samples is None:
+                samples = self.samples[server_type] = deque(
+                    maxlen=self.window)
+            samples.append(elapsed)
+
+    def estimate(self, node, now=None):
+        """
+        :param node: dictionary of node to estimate for
+        :returns: expected seconds until response headers
+        """
+        entry = self.devices.get((node['ip'], node['port'], node['device']))
+        if entry is None:
+            return 0.0
+        if now is None:
+            now = time.time()
+        age = max(now - entry[1], 0)
+        return entry[0] * 0.5 ** (age / self.half_life)
+
+    def percentile(self, server_type, pct, min_samples=20):
+        """
+        :param server_type: server type the samples were recorded under
+        :param pct: percentile wanted, 0-100
+        :param min_samples: fewest samples worth computing a percentile of
+        :returns: the percentile in seconds, or None if there are too few
+                  samples
+        """
+        samples = self.samples.get(server_type)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * pct / 100.0),
+                           len(ordered) - 1)]
+
+
 class Controller(object):
     """Base WSGI controller class for the proxy"""
     server_type = 'Base'
@@ -314,6 +502,7 @@ class Controller(object):
         :param msg: error message
         """
         self.error_increment(node)
+        self.drop_pooled_connections(node)
         self.app.logger.error(_('%(msg)s %(ip)s:%(port)s'),
                               {'msg': msg, 'ip': node['ip'],
                               'port': node['port']})
@@ -326,6 +515,7 @@ class Controller(object):
         :param typ: server type
         :param additional_info: additional information to log
         """
+        self.drop_pooled_connections(node)
         self.app.logger.exception(
             _('ERROR with %(type)s server %(ip)s:%(port)s/%(device)s re: '
               '%(info)s'),
@@ -362,6 +552,17 @@ class Controller(object):
         """
         node['errors'] = self.app.error_suppression_limit + 1
         node['last_error'] = time.time()
+        self.drop_pooled_connections(node)
+
+    def drop_pooled_connections(self, node):
+        """
+        Close any idle pooled connections to a node that has misbehaved,
+        rather than handing them to the next request.
+
+        :param node: dictionary of node whose connections should be dropped
+        """
+        if self.app.conn_pool is not None:
+            self.app.conn_pool.drop((node['ip'], node['port']))
 
     def account_info(self, account, autocreate=False):
         """
@@ -372,6 +573,32 @@ class Controller(object):
                   or (None, None, None) if it does not exist
         """
         partition, nodes = self.app.account_ring.get_nodes(account)
+        lookup = functools.partial(self._lookup_account_info, account,
+                                   partition, nodes, autocreate)
+        if autocreate:
+            # A cached 404 is no good to us here
+            account_info = lookup()
+        else:
+            account_info = self.app.info_cache.get(
+                get_account_memcache_key(account), lookup)
+        if account_info['status'] == HTTP_OK:
+            try:
+                container_count = int(account_info['container_count'])
+            except (ValueError, TypeError):
+                container_count = 0
+            return partition, nodes, container_count
+        return None, None, None
+
+    def _lookup_account_info(self, account, partition, nodes,
+                             autocreate=False):
+        """
+        Looks an account up in memcache or, failing that, on the account
+        servers, creating it if asked to.
+
+        :returns: account info dict; its 'status' is 200 if the account
+                  exists, 404 if it does not and 0 or -1 if that could not
+                  be told
+        """
         account_info = {'status': 0,
                         'container_count': 0,
                         'total_object_count': None,
@@ -382,18 +609,11 @@ class Controller(object):
             cache_key = get_account_memcache_key(account)
             cache_value = self.app.memcache.get(cache_key)
             if not isinstance(cache_value, dict):
-                result_code = cache_value
-                container_count = 0
-            else:
-                result_code = cache_value['status']
-                try:
-                    container_count = int(cache_value['container_count'])
-                except ValueError:
-                    container_count = 0
-            if result_code == HTTP_OK:
-                return partition, nodes, container_count
-            elif result_code == HTTP_NOT_FOUND and not autocreate:
-                return None, None, None
+                cache_value = {'status': cache_value, 'container_count': 0}
+            if cache_value['status'] == HTTP_OK or \
+                    (cache_value['status'] == HTTP_NOT_FOUND and
+                     not autocreate):
+                return cache_value
         result_code = 0
         attempts_left = len(nodes)
         path = '/%s' % account
@@ -410,10 +630,13 @@ class Controller(object):
                 with ConnectionTimeout(self.app.conn_timeout):
                     conn = http_connect(node['ip'], node['port'],
                                         node['device'], partition, 'HEAD',
-                                        path, headers)
+                                        path, headers,
+                                        pool=self.app.conn_pool)
                 self.app.set_node_timing(node, time.time() - start_node_timing)
                 with Timeout(self.app.node_timeout):
                     resp = conn.getresponse()
+                    self.app.record_node_latency(
+                        node, time.time() - start_node_timing)
                     resp.read()
                     if is_success(resp.status):
                         result_code = HTTP_OK
@@ -431,12 +654,14 @@ class Controller(object):
                     else:
                         result_code = -1
             except (Exception, Timeout):
+                self.app.record_node_latency(node, self.app.node_timeout)
                 self.exception_occurred(node, _('Account'),
                                         _('Trying to get account info for %s')
                                         % path)
         if result_code == HTTP_NOT_FOUND and autocreate:
             if len(account) > MAX_ACCOUNT_NAME_LENGTH:
-                return None, None, None
+                account_info.update(status=result_code)
+                return account_info
             headers = {'X-Timestamp': normalize_timestamp(time.time()),
                        'X-Trans-Id': self.trans_id,
                        'Connection': 'close'}
@@ -446,24 +671,18 @@ class Controller(object):
             if not is_success(resp.status_int):
                 self.app.logger.warning('Could not autocreate account %r' %
                                         path)
-                return None, None, None
+                return account_info
             result_code = HTTP_OK
+        account_info.update(status=result_code)
         if self.app.memcache and result_code in (HTTP_OK, HTTP_NOT_FOUND):
             if result_code == HTTP_OK:
                 cache_timeout = self.app.recheck_account_existence
             else:
                 cache_timeout = self.app.recheck_account_existence * 0.1
-            account_info.update(status=result_code)
             self.app.memcache.set(cache_key,
                                   account_info,
                                   time=cache_timeout)
-        if result_code == HTTP_OK:
-            try:
-                container_count = int(account_info['container_count'])
-            except ValueError:
-                container_count = 0
-            return partition, nodes, container_count
-        return None, None, None
+        return account_info
 
     def container_info(self, account, container, account_autocreate=False):
         """
@@ -480,6 +699,36 @@ class Controller(object):
                   Values are set to None if the container does not exist.
         """
         part, nodes = self.app.container_ring.get_nodes(account, container)
+        container_info = {'status': 0, 'read_acl': None,
+                          'write_acl': None, 'sync_key': None,
+                          'count': None, 'bytes': None,
+                          'versions': None, 'partition': None,
+                          'nodes': None}
+        lookup = functools.partial(self._lookup_container_info, account,
+                                   container, part, nodes, account_autocreate)
+        cache_value = self.app.info_cache.get(
+            get_container_memcache_key(account, container), lookup)
+        if account_autocreate and not is_success(cache_value['status']):
+            # The cached or shared lookup may not have created the account
+            cache_value = lookup()
+        if is_success(cache_value['status']):
+            container_info.update(cache_value)
+            container_info['partition'] = part
+            container_info['nodes'] = nodes
+        else:
+            container_info['status'] = cache_value['status']
+        return container_info
+
+    def _lookup_container_info(self, account, container, part, nodes,
+                               account_autocreate=False):
+        """
+        Looks a container up in memcache or, failing that, on the container
+        servers.
+
+        :returns: container info dict; its 'status' is 200 if the container
+                  exists, 404 if it does not and 0 or -1 if that could not
+                  be told
+        """
         path = '/%s/%s' % (account, container)
         container_info = {'status': 0, 'read_acl': None,
                           'write_acl': None, 'sync_key': None,
@@ -492,11 +741,7 @@ class Controller(object):
             if isinstance(cache_value, dict):
                 if 'container_size' in cache_value:
                     cache_value['count'] = cache_value['container_size']
-                if is_success(cache_value['status']):
-                    container_info.update(cache_value)
-                    container_info['partition'] = part
-                    container_info['nodes'] = nodes
-                return container_info
+                return cache_value
         if not self.account_info(account, autocreate=account_autocreate)[1]:
             return container_info
         attempts_left = len(nodes)
@@ -507,10 +752,13 @@ class Controller(object):
                 with ConnectionTimeout(self.app.conn_timeout):
                     conn = http_connect(node['ip'], node['port'],
                                         node['device'], part, 'HEAD',
-                                        path, headers)
+                                        path, headers,
+                                        pool=self.app.conn_pool)
                 self.app.set_node_timing(node, time.time() - start_node_timing)
                 with Timeout(self.app.node_timeout):
                     resp = conn.getresponse()
+                    self.app.record_node_latency(
+                        node, time.time() - start_node_timing)
                     resp.read()
                 if is_success(resp.status):
                     container_info.update(
@@ -523,6 +771,7 @@ class Controller(object):
                     if resp.status == HTTP_INSUFFICIENT_STORAGE:
                         self.error_limit(node)
             except (Exception, Timeout):
+                self.app.record_node_latency(node, self.app.node_timeout)
                 self.exception_occurred(
                     node, _('Container'),
                     _('Trying to get container info for %s') % path)
@@ -538,9 +787,6 @@ class Controller(object):
                 self.app.memcache.set(
                     cache_key, container_info,
                     time=self.app.recheck_container_existence * 0.1)
-        if container_info['status'] == HTTP_OK:
-            container_info['partition'] = part
-            container_info['nodes'] = nodes
         return container_info
 
     def iter_nodes(self, partition, nodes, ring):
@@ -578,17 +824,21 @@ class Controller(object):
                 with ConnectionTimeout(self.app.conn_timeout):
                     conn = http_connect(node['ip'], node['port'],
                                         node['device'], part, method, path,
-                                        headers=headers, query_string=query)
+                                        headers=headers, query_string=query,
+                                        pool=self.app.conn_pool)
                     conn.node = node
                 self.app.set_node_timing(node, time.time() - start_node_timing)
                 with Timeout(self.app.node_timeout):
                     resp = conn.getresponse()
+                    self.app.record_node_latency(
+                        node, time.time() - start_node_timing)
                     if not is_informational(resp.status) and \
                             not is_server_error(resp.status):
                         return resp.status, resp.reason, resp.read()
                     elif resp.status == HTTP_INSUFFICIENT_STORAGE:
                         self.error_limit(node)
             except (Exception, Timeout):
+                self.app.record_node_latency(node, self.app.node_timeout)
                 self.exception_occurred(node, self.server_type,
                                         _('Trying to %(method)s %(path)s') %
                                         {'method': method, 'path': path})
@@ -773,6 +1023,105 @@ class Controller(object):
         """
         return is_success(src.status) or is_redirection(src.status)
 
+    def _get_source(self, req, server_type, partition, node, path):
+        """
+        Sends one backend request for GETorHEAD_base.
+
+        :returns: the response, with its swift_conn set, or None if the node
+                  could not be reached
+        """
+        start_node_timing = time.time()
+        try:
+            with ConnectionTimeout(self.app.conn_timeout):
+                headers = dict(req.headers)
+                headers['Connection'] = 'close'
+                conn = http_connect(
+                    node['ip'], node['port'], node['device'], partition,
+                    req.method, path, headers=headers,
+                    query_string=req.query_string,
+                    pool=self.app.conn_pool)
+            self.app.set_node_timing(node, time.time() - start_node_timing)
+            with Timeout(self.app.node_timeout):
+                possible_source = conn.getresponse()
+                # See NOTE: swift_conn at top of file about this.
+                possible_source.swift_conn = conn
+        except (Exception, Timeout):
+            self.app.record_node_latency(node, self.app.node_timeout)
+            self.exception_occurred(
+                node, server_type, _('Trying to %(method)s %(path)s') %
+                {'method': req.method, 'path': req.path})
+            return None
+        self.app.record_node_latency(
+            node, time.time() - start_node_timing, server_type)
+        return possible_source
+
+    def _iter_sources(self, req, server_type, partition, nodes, path):
+        """
+        Yields (node, response) for GETorHEAD_base, asking one node after
+        another.
+        """
+        for node in nodes:
+            if self.error_limited(node):
+                continue
+            possible_source = self._get_source(req, server_type, partition,
+                                               node, path)
+            if possible_source is not None:
+                yield node, possible_source
+
+    def _iter_hedged_sources(self, req, server_type, partition, nodes, path,
+                             deadline):
+        """
+        Yields (node, response) for GETorHEAD_base in the order responses
+        arrive. Like _iter_sources, except that if the node being asked has
+        not answered within deadline seconds, the next node is asked as
+        well, once per request. Responses that arrive after the caller has
+        stopped iterating are closed.
+        """
+        results = Queue()
+        finished = []
+        logger_thread_locals = self.app.logger.thread_locals
+
+        def ask(node):
+            self.app.logger.thread_locals = logger_thread_locals
+            possible_source = self._get_source(req, server_type, partition,
+                                               node, path)
+            if not finished:
+                results.put((node, possible_source))
+            elif possible_source is not None:
+                self.close_swift_conn(possible_source)
+
+        def ask_next():
+            for node in nodes:
+                if not self.error_limited(node):
+                    spawn_n(ask, node)
+                    return 1
+            return 0
+
+        try:
+            outstanding = ask_next()
+            hedged = False
+            while outstanding:
+                try:
+                    node, possible_source = results.get(
+                        timeout=None if hedged else deadline)
+                except Empty:
+                    hedged = True
+                    if ask_next():
+                        outstanding += 1
+                        self.app.logger.increment('hedged_get')
+                    continue
+                outstanding -= 1
+                if possible_source is not None:
+                    yield node, possible_source
+                if not outstanding:
+                    outstanding = ask_next()
+        finally:
+            finished.append(True)
+            while not results.empty():
+                node, possible_source = results.get_nowait()
+                if possible_source is not None:
+                    self.close_swift_conn(possible_source)
+
     def GETorHEAD_base(self, req, server_type, partition, nodes, path,
                        attempts):
         """
@@ -790,37 +1139,24 @@ class Controller(object):
         reasons = []
         bodies = []
         sources = []
+        source_nodes = {}
         newest = config_true_value(req.headers.get('x-newest', 'f'))
         nodes = iter(nodes)
+        deadline = None
+        if req.method == 'GET' and not newest and \
+                self.app.hedged_get_percentile:
+            deadline = self.app.node_latency.percentile(
+                server_type, self.app.hedged_get_percentile)
+        if deadline is None:
+            possible_sources = self._iter_sources(
+                req, server_type, partition, nodes, path)
+        else:
+            possible_sources = self._iter_hedged_sources(
+                req, server_type, partition, nodes, path, deadline)
         
         # 根据找到的节点数，例如3个， 循环访问
         # 并将结果保存返回
-        while len(statuses) < attempts:
-            try:
-                node = nodes.next()
-            except StopIteration:
-                break
-            if self.error_limited(node):
-                continue
-            start_node_timing = time.time()
-            try:
-                with ConnectionTimeout(self.app.conn_timeout):
-                    headers = dict(req.headers)
-                    headers['Connection'] = 'close'
-                    conn = http_connect(
-                        node['ip'], node['port'], node['device'], partition,
-                        req.method, path, headers=headers,
-                        query_string=req.query_string)
-                self.app.set_node_timing(node, time.time() - start_node_timing)
-                with Timeout(self.app.node_timeout):
-                    possible_source = conn.getresponse()
-                    # See NOTE: swift_conn at top of file about this.
-                    possible_source.swift_conn = conn
-            except (Exception, Timeout):
-                self.exception_occurred(
-                    node, server_type, _('Trying to %(method)s %(path)s') %
-                    {'method': req.method, 'path': req.path})
-                continue
+        for node, possible_source in possible_sources:
             if self.is_good_source(possible_source):
                 # 404 if we know we don't have a synced copy
                 if not float(possible_source.getheader('X-PUT-Timestamp', 1)):
@@ -833,6 +1169,7 @@ class Controller(object):
                     reasons.append(possible_source.reason)
                     bodies.append('')
                     sources.append(possible_source)
+                    source_nodes[id(possible_source)] = node
                     if not newest:  # one good source is enough
                         break
             else:
@@ -847,6 +1184,9 @@ class Controller(object):
                                         {'status': possible_source.status,
                                          'body': bodies[-1][:1024],
                                          'type': server_type})
+            if len(statuses) >= attempts:
+                break
+        possible_sources.close()
         if sources:
             sources.sort(key=source_key)
             source = sources.pop()
@@ -855,7 +1195,8 @@ class Controller(object):
             res = Response(request=req, conditional_response=True)
             if req.method == 'GET' and \
                     source.status in (HTTP_OK, HTTP_PARTIAL_CONTENT):
-                res.app_iter = self._make_app_iter(node, source)
+                res.app_iter = self._make_app_iter(
+                    source_nodes[id(source)], source)
                 # See NOTE: swift_conn at top of file about this.
                 res.swift_conn = source.swift_conn
             res.status = source.status
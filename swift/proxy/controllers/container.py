@@ -135,9 +135,10 @@ class ContainerController(Controller):
             self.account_name, self.container_name)
         headers = self._backend_requests(req, len(containers),
                                          account_partition, accounts)
+        cache_key = get_container_memcache_key(self.account_name,
+                                               self.container_name)
+        self.app.info_cache.invalidate(cache_key)
         if self.app.memcache:
-            cache_key = get_container_memcache_key(self.account_name,
-                                                   self.container_name)
             self.app.memcache.delete(cache_key)
         resp = self.make_requests(
             req, self.app.container_ring,
@@ -163,9 +164,11 @@ class ContainerController(Controller):
                    'x-trans-id': self.trans_id,
                    'Connection': 'close'}
         self.transfer_headers(req.headers, headers)
+        cache_key = get_container_memcache_key(self.account_name,
+                                               self.container_name)
+        self.app.info_cache.invalidate(cache_key)
         if self.app.memcache:
-            self.app.memcache.delete(get_container_memcache_key(
-                self.account_name, self.container_name))
+            self.app.memcache.delete(cache_key)
         resp = self.make_requests(
             req, self.app.container_ring, container_partition, 'POST',
             req.path_info, [headers] * len(containers))
@@ -183,9 +186,10 @@ class ContainerController(Controller):
             self.account_name, self.container_name)
         headers = self._backend_requests(req, len(containers),
                                          account_partition, accounts)
+        cache_key = get_container_memcache_key(self.account_name,
+                                               self.container_name)
+        self.app.info_cache.invalidate(cache_key)
         if self.app.memcache:
-            cache_key = get_container_memcache_key(self.account_name,
-                                                   self.container_name)
             self.app.memcache.delete(cache_key)
         resp = self.make_requests(
             req, self.app.container_ring, container_partition, 'DELETE',
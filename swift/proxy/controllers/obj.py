@@ -1,3 +1,4 @@
+# --encoding: utf-8--
 # Copyright (c) 2010-2012 OpenStack, LLC.
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -24,19 +25,22 @@
 #   These shenanigans are to ensure all related objects can be garbage
 # collected. We've seen objects hang around forever otherwise.
 
+import functools
 import itertools
 import mimetypes
 import re
 import time
+from collections import deque
 from datetime import datetime
 from urllib import unquote, quote
 from hashlib import md5
 
-from eventlet import sleep, GreenPile
-from eventlet.queue import Queue
+from eventlet import sleep, spawn, GreenPile
+from eventlet.event import Event
+from eventlet.queue import Queue, Empty, Full
 from eventlet.timeout import Timeout
 
-from swift.common.utils import ContextPool, normalize_timestamp, \
+from swift.common.utils import normalize_timestamp, \
     config_true_value, public, json, csv_append
 from swift.common.bufferedhttp import http_connect
 from swift.common.constraints import check_metadata, check_object_creation, \
@@ -86,6 +90,101 @@ def check_content_type(req):
     return None
 
 
+class SegmentPrefetch(object):
+    """
+    Fetches one object segment in its own greenthread, reading ahead up to
+    max_chunks chunks of its body while earlier segments are still being
+    served.
+
+    :param fetch: callable that makes the segment GET and returns the
+                  validated swob.Response
+    :param start_time: time.time() before which the GET must not be made
+    :param max_chunks: number of body chunks to buffer before waiting for
+                       the reader
+    :param timeout: seconds to wait, once the reader has got to this
+                    segment, for it to make room in the buffer before giving
+                    up on the segment; also how long the reader waits for a
+                    chunk
+    """
+
+    def __init__(self, fetch, start_time, max_chunks, timeout):
+        self.loaded = Event()
+        self.chunks = Queue(max(1, max_chunks))
+        self.timeout = timeout
+        self.reading = False
+        self.gave_up = False
+        self.swift_conn = None
+        self.thread = spawn(self._run, fetch, start_time)
+
+    def _run(self, fetch, start_time):
+        sleep(max(start_time - time.time(), 0))
+        try:
+            resp = fetch()
+        except (Exception, Timeout), err:
+            self.loaded.send(exc=err)
+            return
+        # See NOTE: swift_conn at top of file about this.
+        self.swift_conn = getattr(resp, 'swift_conn', None)
+        self.loaded.send(resp)
+        try:
+            for chunk in resp.app_iter:
+                if not self._put(chunk):
+                    return
+            self._put(None)
+        except (Exception, Timeout), err:
+            self._put(err)
+
+    def _put(self, item):
+        try:
+            # Until the reader gets to this segment, it is busy with the
+            # ones before it and the wait is bounded by the prefetch window.
+            self.chunks.put(item,
+                            timeout=self.timeout if self.reading else None)
+            return True
+        except Full:
+            # Nobody is reading this segment any more
+            self.gave_up = True
+            self._close_conn()
+            return False
+
+    def wait(self):
+        """
+        Waits for the segment GET to finish.
+
+        :returns: the segment's swob.Response
+        :raises: whatever fetching the segment raised
+        """
+        return self.loaded.wait()
+
+    def __iter__(self):
+        self.reading = True
+        while True:
+            if self.gave_up and self.chunks.empty():
+                raise ChunkReadTimeout()
+            try:
+                chunk = self.chunks.get(timeout=self.timeout)
+            except Empty:
+                raise ChunkReadTimeout()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        """Stops reading the segment and drops its backend connection."""
+        self.thread.kill()
+        self._close_conn()
+
+    def _close_conn(self):
+        if self.swift_conn:
+            try:
+                self.swift_conn.close()
+            except Exception:
+                pass
+            self.swift_conn = None
+
+
 class SegmentedIterable(object):
     """
     Iterable that returns the object contents for a segmented object in Swift.
@@ -94,6 +193,11 @@ class SegmentedIterable(object):
     `status_int` will be updated (again, just for logging since the original
     status would have already been sent to the client).
 
+    If the proxy is configured with segment_prefetch, the GETs for that many
+    segments after the one being served are made concurrently and their
+    bodies buffered (up to segment_prefetch_bytes in all), still in listing
+    order and still subject to the segment rate limiting.
+
     :param controller: The ObjectController instance to work with.
     :param container: The container the object segments are within. If
                       container is None will derive container from elements
@@ -123,6 +227,103 @@ class SegmentedIterable(object):
         if not self.response:
             self.response = Response()
         self.next_get_time = 0
+        app = self.controller.app
+        self.prefetch = getattr(app, 'segment_prefetch', 0)
+        self.prefetch_chunks = 0
+        if self.prefetch:
+            self.prefetch_chunks = getattr(app, 'segment_prefetch_bytes', 0) \
+                // (app.object_chunk_size * (self.prefetch + 1))
+        self.prefetch_window = deque()
+        self.prefetch_current = None
+        self.listing_done = False
+
+    def _next_segment_request(self):
+        """
+        Takes the next object segment from the listing and works out how to
+        GET it.
+
+        :returns: a tuple of (segment_dict, container, obj, req)
+        :raises: StopIteration when there are no more object segments.
+        """
+        self.segment += 1
+        segment_dict = self.segment_peek or self.listing.next()
+        self.segment_peek = None
+        if self.container is None:
+            container, obj = segment_dict['name'].lstrip('/').split('/', 1)
+        else:
+            container, obj = self.container, segment_dict['name']
+        req = Request.blank(
+            '/%s/%s/%s' % (self.controller.account_name, container, obj))
+        if self.seek:
+            req.range = 'bytes=%s-' % self.seek
+            self.seek = 0
+        return segment_dict, container, obj, req
+
+    def _rate_limited(self):
+        return not self.is_slo and \
+            self.segment > self.controller.app.rate_limit_after_segment
+
+    def _get_segment(self, segment_dict, container, obj, req):
+        """
+        Makes the GET for one object segment and checks the response.
+
+        :returns: the segment's swob.Response
+        :raises: SloSegmentError if the segment no longer matches the SLO
+                 manifest, Exception if it could not be fetched.
+        """
+        path = '/%s/%s/%s' % (self.controller.account_name, container, obj)
+        partition, nodes = self.controller.app.object_ring.get_nodes(
+            self.controller.account_name, container, obj)
+        nodes = self.controller.app.sort_nodes(nodes)
+        resp = self.controller.GETorHEAD_base(
+            req, _('Object'), partition,
+            self.controller.iter_nodes(partition, nodes,
+                                       self.controller.app.object_ring),
+            path, len(nodes))
+        if self.is_slo and resp.status_int == HTTP_NOT_FOUND:
+            raise SloSegmentError(_(
+                'Could not load object segment %(path)s:'
+                ' %(status)s') % {'path': path, 'status': resp.status_int})
+        if not is_success(resp.status_int):
+            raise Exception(_(
+                'Could not load object segment %(path)s:'
+                ' %(status)s') % {'path': path, 'status': resp.status_int})
+        if self.is_slo:
+            if resp.etag != segment_dict['hash']:
+                raise SloSegmentError(_(
+                    'Object segment no longer valid: '
+                    '%(path)s etag: %(r_etag)s != %(s_etag)s.' %
+                    {'path': path, 'r_etag': resp.etag,
+                     's_etag': segment_dict['hash']}))
+        return resp
+
+    def _fill_prefetch_window(self, size):
+        """Starts GETs for segments until size of them are under way."""
+        while not self.listing_done and len(self.prefetch_window) < size:
+            try:
+                segment_dict, container, obj, req = \
+                    self._next_segment_request()
+            except StopIteration:
+                self.listing_done = True
+                break
+            start_time = time.time()
+            if self._rate_limited():
+                start_time = max(self.next_get_time, start_time)
+            self.next_get_time = start_time + \
+                1.0 / self.controller.app.rate_limit_segments_per_sec
+            fetch = functools.partial(
+                self._get_segment, segment_dict, container, obj, req)
+            self.prefetch_window.append((segment_dict, SegmentPrefetch(
+                fetch, start_time, self.prefetch_chunks,
+                self.controller.app.client_timeout)))
+
+    def _stop_prefetch(self):
+        """Abandons the segments being read ahead, if any."""
+        if self.prefetch_current:
+            self.prefetch_current.close()
+            self.prefetch_current = None
+        while self.prefetch_window:
+            self.prefetch_window.popleft()[1].close()
 
     def _load_next_segment(self):
         """
@@ -132,53 +333,33 @@ class SegmentedIterable(object):
                  segment no longer matches SLO manifest specifications.
         """
         try:
-            self.segment += 1
-            self.segment_dict = self.segment_peek or self.listing.next()
-            self.segment_peek = None
-            if self.container is None:
-                container, obj = \
-                    self.segment_dict['name'].lstrip('/').split('/', 1)
-            else:
-                container, obj = self.container, self.segment_dict['name']
-            partition, nodes = self.controller.app.object_ring.get_nodes(
-                self.controller.account_name, container, obj)
-            path = '/%s/%s/%s' % (self.controller.account_name, container, obj)
-            req = Request.blank(path)
-            if self.seek:
-                req.range = 'bytes=%s-' % self.seek
-                self.seek = 0
-            if not self.is_slo and self.segment > \
-                    self.controller.app.rate_limit_after_segment:
+            if self.prefetch:
+                self.prefetch_current = None
+                # The next segment is about to be taken out of the window,
+                # so fill it one past its size.
+                self._fill_prefetch_window(self.prefetch + 1)
+                if not self.prefetch_window:
+                    raise StopIteration
+                self.segment_dict, self.prefetch_current = \
+                    self.prefetch_window.popleft()
+                self.prefetch_current.wait()
+                self.segment_iter = iter(self.prefetch_current)
+                return
+            self.segment_dict, container, obj, req = \
+                self._next_segment_request()
+            if self._rate_limited():
                 sleep(max(self.next_get_time - time.time(), 0))
             self.next_get_time = time.time() + \
                 1.0 / self.controller.app.rate_limit_segments_per_sec
-            nodes = self.controller.app.sort_nodes(nodes)
-            resp = self.controller.GETorHEAD_base(
-                req, _('Object'), partition,
-                self.controller.iter_nodes(partition, nodes,
-                                           self.controller.app.object_ring),
-                path, len(nodes))
-            if self.is_slo and resp.status_int == HTTP_NOT_FOUND:
-                raise SloSegmentError(_(
-                    'Could not load object segment %(path)s:'
-                    ' %(status)s') % {'path': path, 'status': resp.status_int})
-            if not is_success(resp.status_int):
-                raise Exception(_(
-                    'Could not load object segment %(path)s:'
-                    ' %(status)s') % {'path': path, 'status': resp.status_int})
-            if self.is_slo:
-                if resp.etag != self.segment_dict['hash']:
-                    raise SloSegmentError(_(
-                        'Object segment no longer valid: '
-                        '%(path)s etag: %(r_etag)s != %(s_etag)s.' %
-                        {'path': path, 'r_etag': resp.etag,
-                         's_etag': self.segment_dict['hash']}))
+            resp = self._get_segment(self.segment_dict, container, obj, req)
             self.segment_iter = resp.app_iter
             # See NOTE: swift_conn at top of file about this.
             self.segment_iter_swift_conn = getattr(resp, 'swift_conn', None)
         except StopIteration:
+            self._stop_prefetch()
             raise
         except SloSegmentError, err:
+            self._stop_prefetch()
             if not getattr(err, 'swift_logged', False):
                 self.controller.app.logger.error(_(
                     'ERROR: While processing manifest '
@@ -190,6 +371,7 @@ class SegmentedIterable(object):
                 self.response.status_int = HTTP_CONFLICT
             raise StopIteration('Invalid manifiest segment')
         except (Exception, Timeout), err:
+            self._stop_prefetch()
             if not getattr(err, 'swift_logged', False):
                 self.controller.app.logger.exception(_(
                     'ERROR: While processing manifest '
@@ -204,6 +386,9 @@ class SegmentedIterable(object):
     def next(self):
         return iter(self).next()
 
+    def close(self):
+        self._stop_prefetch()
+
     def __iter__(self):
         """ Standard iterator function that returns the object's contents. """
         try:
@@ -222,6 +407,7 @@ class SegmentedIterable(object):
         except StopIteration:
             raise
         except (Exception, Timeout), err:
+            self._stop_prefetch()
             if not getattr(err, 'swift_logged', False):
                 self.controller.app.logger.exception(_(
                     'ERROR: While processing manifest '
@@ -264,6 +450,9 @@ class SegmentedIterable(object):
                         yield chunk[:length]
                         break
                 yield chunk
+            if self.prefetch:
+                self._stop_prefetch()
+                self.segment_iter = None
             # See NOTE: swift_conn at top of file about this.
             if self.segment_iter_swift_conn:
                 try:
@@ -280,6 +469,9 @@ class SegmentedIterable(object):
                 self.segment_iter = None
         except StopIteration:
             raise
+        except GeneratorExit:
+            self._stop_prefetch()
+            raise
         except (Exception, Timeout), err:
             if not getattr(err, 'swift_logged', False):
                 self.controller.app.logger.exception(_(
@@ -293,6 +485,126 @@ class SegmentedIterable(object):
             raise
 
 
+class PutFanOut(object):
+    """
+    Feeds the chunks of an object PUT to every backend connection.
+
+    Each chunk is framed once (for chunked transfers) and that one string is
+    shared by all the connections; each connection's sender works through
+    the shared buffer at its own pace, and chunks are dropped once every
+    live connection has sent them. add() applies back-pressure: it returns
+    once a quorum of the live connections is fewer than queue_depth chunks
+    behind and none is straggler_depth or more behind. So a slow node may
+    fall behind the rest by a bounded amount without slowing the client
+    down.
+
+    :param conns: backend connections
+    :param quorum: number of connections that must keep up
+    :param queue_depth: chunks a quorum may be behind before add() waits
+    :param straggler_depth: chunks any connection may be behind before
+                            add() waits
+    :param chunked: whether to frame chunks for transfer-encoding: chunked
+    """
+
+    def __init__(self, conns, quorum, queue_depth, straggler_depth, chunked):
+        self.conns = conns
+        self.quorum = quorum
+        self.queue_depth = max(1, queue_depth)
+        self.straggler_depth = max(self.queue_depth, straggler_depth)
+        self.chunked = chunked
+        self.chunks = deque()
+        # index of self.chunks[0] and one past the last chunk added
+        self.base = self.end = 0
+        self.finished = False
+        self.new_data = Event()
+        self.progress = Event()
+        for conn in conns:
+            conn.failed = False
+            conn.position = 0
+            conn.bytes_sent = 0
+            conn.send_time = 0.0
+
+    def live_conns(self):
+        return [conn for conn in self.conns if not conn.failed]
+
+    def add(self, chunk):
+        """
+        Queues a chunk for every connection, waiting for room first.
+        """
+        if self.chunked:
+            chunk = '%x\r\n%s\r\n' % (len(chunk), chunk)
+        self._append(chunk)
+        while not self._has_room():
+            self._wait_for_progress()
+
+    def finish(self):
+        """
+        Queues the end of the body; senders stop once they have sent it.
+        """
+        if self.chunked:
+            self._append('0\r\n\r\n')
+        self.finished = True
+        self._notify('new_data')
+
+    def next_chunk(self, conn):
+        """
+        :returns: the next chunk for conn to send, waiting for one to be
+                  added if need be, or None once there are no more
+        """
+        while conn.position == self.end:
+            if self.finished:
+                return None
+            self.new_data.wait()
+        return self.chunks[conn.position - self.base]
+
+    def sent(self, conn, nbytes, elapsed):
+        """
+        Records that conn has sent its next chunk.
+        """
+        conn.position += 1
+        conn.bytes_sent += nbytes
+        conn.send_time += elapsed
+        self._trim()
+        self._notify('progress')
+
+    def failed(self, conn):
+        """
+        Records that conn can no longer be written to.
+        """
+        conn.failed = True
+        self._trim()
+        self._notify('progress')
+
+    def _append(self, chunk):
+        self.chunks.append(chunk)
+        self.end += 1
+        self._notify('new_data')
+
+    def _notify(self, attr):
+        event = getattr(self, attr)
+        setattr(self, attr, Event())
+        event.send()
+
+    def _wait_for_progress(self):
+        self.progress.wait()
+
+    def _has_room(self):
+        live = self.live_conns()
+        if len(live) < self.quorum:
+            # let the caller notice and give up
+            return True
+        lags = [self.end - conn.position for conn in live]
+        return len([lag for lag in lags if lag < self.queue_depth]) >= \
+            self.quorum and max(lags) < self.straggler_depth
+
+    def _trim(self):
+        live = self.live_conns()
+        oldest = min(conn.position for conn in live) if live else self.end
+        while self.base < oldest:
+            self.chunks.popleft()
+            self.base += 1
+
+
 class ObjectController(Controller):
     """WSGI controller for object requests."""
     server_type = 'Object'
@@ -644,19 +956,89 @@ class ObjectController(Controller):
 
         return headers
 
-    def _send_file(self, conn, path):
+    def _put_to_node(self, fan_out, conn, path, results,
+                     logger_thread_locals):
+        """
+        Method for a file PUT coro: sends the body to one node and then
+        puts (status, reason, body, etag) for its response, or None if it
+        failed, on results.
+        """
+        self.app.logger.thread_locals = logger_thread_locals
+        self._send_file(fan_out, conn, path)
+        if conn.failed:
+            results.put(None)
+            return
+        try:
+            with Timeout(self.app.node_timeout):
+                if conn.resp:
+                    response = conn.resp
+                else:
+                    response = conn.getresponse()
+                body = response.read()
+        except (Exception, Timeout):
+            self.exception_occurred(
+                conn.node, _('Object'),
+                _('Trying to get final status of PUT to %s') % path)
+            results.put(None)
+            return
+        etag = None
+        if response.status >= HTTP_INTERNAL_SERVER_ERROR:
+            self.error_occurred(
+                conn.node,
+                _('ERROR %(status)d %(body)s From Object Server '
+                  're: %(path)s') %
+                {'status': response.status, 'body': body[:1024],
+                 'path': path})
+        elif is_success(response.status):
+            etag = response.getheader('etag').strip('"')
+        results.put((response.status, response.reason, body, etag))
+
+    def _collect_put_stragglers(self, results, remaining, etags, path,
+                                start_time, logger_thread_locals):
+        """
+        Collects the responses of the nodes still busy with a PUT that has
+        already been answered, once a quorum of them succeeded.  A straggler
+        that fails leaves its replica to be fixed by the object replicator.
+        """
+        self.app.logger.thread_locals = logger_thread_locals
+        failures = 0
+        for _junk in xrange(remaining):
+            result = results.get()
+            if result is None or not is_success(result[0]):
+                failures += 1
+            elif result[3] not in etags:
+                failures += 1
+                self.app.logger.error(
+                    _('Object server returned mismatched etag %(etag)s for '
+                      'PUT to %(path)s'), {'etag': result[3], 'path': path})
+        self.app.logger.timing_since('PUT.complete.timing', start_time)
+        if failures:
+            self.app.logger.increment('PUT.straggler_failures')
+            self.app.logger.warning(
+                _('%(failures)d of %(remaining)d object servers still busy '
+                  'after the response to PUT %(path)s failed; leaving it to '
+                  'the replicator'),
+                {'failures': failures, 'remaining': remaining, 'path': path})
+
+    def _send_file(self, fan_out, conn, path):
         """Method for a file PUT coro"""
         while True:
-            chunk = conn.queue.get()
-            if not conn.failed:
-                try:
-                    with ChunkWriteTimeout(self.app.node_timeout):
-                        conn.send(chunk)
-                except (Exception, ChunkWriteTimeout):
-                    conn.failed = True
-                    self.exception_occurred(conn.node, _('Object'),
-                                            _('Trying to write to %s') % path)
-            conn.queue.task_done()
+            chunk = fan_out.next_chunk(conn)
+            if chunk is None:
+                break
+            start = time.time()
+            try:
+                with ChunkWriteTimeout(self.app.node_timeout):
+                    conn.send(chunk)
+            except (Exception, ChunkWriteTimeout):
+                fan_out.failed(conn)
+                self.exception_occurred(conn.node, _('Object'),
+                                        _('Trying to write to %s') % path)
+                break
+            fan_out.sent(conn, len(chunk), time.time() - start)
+        if conn.bytes_sent:
+            self.app.logger.transfer_rate('PUT.backend.timing',
+                                          conn.send_time, conn.bytes_sent)
 
     def _connect_put_node(self, nodes, part, path, headers,
                           logger_thread_locals):
@@ -867,6 +1249,7 @@ class ObjectController(Controller):
                     source_resp.headers['X-Static-Large-Object']
 
             req = new_req
+        start_time = time.time()
         node_iter = self.iter_nodes(partition, nodes, self.app.object_ring)
         pile = GreenPile(len(nodes))
         chunked = req.headers.get('transfer-encoding')
@@ -889,41 +1272,41 @@ class ObjectController(Controller):
                   'required connections'),
                 {'conns': len(conns), 'nodes': len(nodes) // 2 + 1})
             return HTTPServiceUnavailable(request=req)
+        quorum = len(nodes) / 2 + 1
         bytes_transferred = 0
+        fan_out = PutFanOut(conns, quorum, self.app.put_queue_depth,
+                            self.app.put_straggler_depth, chunked)
+        results = Queue()
+        workers = [spawn(self._put_to_node, fan_out, conn, req.path, results,
+                         self.app.logger.thread_locals)
+                   for conn in conns]
+        body_sent = False
         try:
-            with ContextPool(len(nodes)) as pool:
-                for conn in conns:
-                    conn.failed = False
-                    conn.queue = Queue(self.app.put_queue_depth)
-                    pool.spawn(self._send_file, conn, req.path)
-                while True:
-                    with ChunkReadTimeout(self.app.client_timeout):
-                        try:
-                            chunk = next(data_source)
-                        except StopIteration:
-                            if chunked:
-                                [conn.queue.put('0\r\n\r\n') for conn in conns]
-                            break
-                    bytes_transferred += len(chunk)
-                    if bytes_transferred > MAX_FILE_SIZE:
-                        return HTTPRequestEntityTooLarge(request=req)
-                    for conn in list(conns):
-                        if not conn.failed:
-                            conn.queue.put(
-                                '%x\r\n%s\r\n' % (len(chunk), chunk)
-                                if chunked else chunk)
-                        else:
-                            conns.remove(conn)
-                    if len(conns) <= len(nodes) / 2:
-                        self.app.logger.error(_(
-                            'Object PUT exceptions during'
-                            ' send, %(conns)s/%(nodes)s required connections'),
-                            {'conns': len(conns), 'nodes': len(nodes) / 2 + 1})
-                        return HTTPServiceUnavailable(request=req)
-                for conn in conns:
-                    if conn.queue.unfinished_tasks:
-                        conn.queue.join()
-            conns = [conn for conn in conns if not conn.failed]
+            while True:
+                with ChunkReadTimeout(self.app.client_timeout):
+                    try:
+                        chunk = next(data_source)
+                    except StopIteration:
+                        break
+                bytes_transferred += len(chunk)
+                if bytes_transferred > MAX_FILE_SIZE:
+                    return HTTPRequestEntityTooLarge(request=req)
+                fan_out.add(chunk)
+                live = len(fan_out.live_conns())
+                if live < quorum:
+                    self.app.logger.error(_(
+                        'Object PUT exceptions during'
+                        ' send, %(conns)s/%(nodes)s required connections'),
+                        {'conns': live, 'nodes': quorum})
+                    return HTTPServiceUnavailable(request=req)
+            if req.content_length and bytes_transferred < req.content_length:
+                req.client_disconnect = True
+                self.app.logger.warn(
+                    _('Client disconnected without sending enough data'))
+                self.app.logger.increment('client_disconnects')
+                return HTTPClientDisconnect(request=req)
+            fan_out.finish()
+            body_sent = True
         except ChunkReadTimeout, err:
             self.app.logger.warn(
                 _('ERROR Client read timeout (%ss)'), err.seconds)
@@ -933,39 +1316,39 @@ class ObjectController(Controller):
             self.app.logger.exception(
                 _('ERROR Exception causing client disconnect'))
             return HTTPClientDisconnect(request=req)
-        if req.content_length and bytes_transferred < req.content_length:
-            req.client_disconnect = True
-            self.app.logger.warn(
-                _('Client disconnected without sending enough data'))
-            self.app.logger.increment('client_disconnects')
-            return HTTPClientDisconnect(request=req)
+        finally:
+            if not body_sent:
+                for worker in workers:
+                    worker.kill()
         statuses = []
         reasons = []
         bodies = []
         etags = set()
-        for conn in conns:
-            try:
-                with Timeout(self.app.node_timeout):
-                    if conn.resp:
-                        response = conn.resp
-                    else:
-                        response = conn.getresponse()
-                    statuses.append(response.status)
-                    reasons.append(response.reason)
-                    bodies.append(response.read())
-                    if response.status >= HTTP_INTERNAL_SERVER_ERROR:
-                        self.error_occurred(
-                            conn.node,
-                            _('ERROR %(status)d %(body)s From Object Server '
-                              're: %(path)s') %
-                            {'status': response.status,
-                             'body': bodies[-1][:1024], 'path': req.path})
-                    elif is_success(response.status):
-                        etags.add(response.getheader('etag').strip('"'))
-            except (Exception, Timeout):
-                self.exception_occurred(
-                    conn.node, _('Object'),
-                    _('Trying to get final status of PUT to %s') % req.path)
+        successes = 0
+        remaining = len(workers)
+        while remaining:
+            if successes >= quorum and self.app.put_quorum_response:
+                break
+            result = results.get()
+            remaining -= 1
+            if result is None:
+                continue
+            status, reason, body, result_etag = result
+            statuses.append(status)
+            reasons.append(reason)
+            bodies.append(body)
+            if is_success(status):
+                etags.add(result_etag)
+                successes += 1
+                if successes == quorum:
+                    self.app.logger.timing_since('PUT.quorum.timing',
+                                                 start_time)
+        if remaining:
+            spawn(self._collect_put_stragglers, results, remaining,
+                  set(etags), req.path, start_time,
+                  self.app.logger.thread_locals)
+        else:
+            self.app.logger.timing_since('PUT.complete.timing', start_time)
         if len(etags) > 1:
             self.app.logger.error(
                 _('Object servers returned %s mismatched etags'), len(etags))
@@ -1,3 +1,4 @@
+# --encoding: utf-8--
 # Copyright (c) 2010-2012 OpenStack, LLC.
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -33,12 +34,14 @@ from time import time
 
 from eventlet import Timeout
 
+from swift.common.bufferedhttp import ConnectionPool
 from swift.common.ring import Ring
 from swift.common.utils import cache_from_env, get_logger, \
     get_remote_client, split_path, config_true_value
 from swift.common.constraints import check_utf8
 from swift.proxy.controllers import AccountController, ObjectController, \
     ContainerController
+from swift.proxy.controllers.base import InfoCache, NodeLatency
 from swift.common.swob import HTTPBadRequest, HTTPForbidden, \
     HTTPMethodNotAllowed, HTTPNotFound, HTTPPreconditionFailed, \
     HTTPServerError, Request
@@ -61,6 +64,10 @@ class Application(object):
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
         self.client_timeout = int(conf.get('client_timeout', 60))
         self.put_queue_depth = int(conf.get('put_queue_depth', 10))
+        self.put_straggler_depth = int(
+            conf.get('put_straggler_depth', self.put_queue_depth * 4))
+        self.put_quorum_response = config_true_value(
+            conf.get('put_quorum_response', 'false'))
         self.object_chunk_size = int(conf.get('object_chunk_size', 65536))
         self.client_chunk_size = int(conf.get('client_chunk_size', 65536))
         self.error_suppression_interval = \
@@ -108,6 +115,9 @@ class Application(object):
             int(conf.get('rate_limit_after_segment', 10))
         self.rate_limit_segments_per_sec = \
             int(conf.get('rate_limit_segments_per_sec', 1))
+        self.segment_prefetch = int(conf.get('segment_prefetch', 0))
+        self.segment_prefetch_bytes = \
+            int(conf.get('segment_prefetch_bytes', 8388608))
         self.log_handoffs = config_true_value(conf.get('log_handoffs', 'true'))
         self.cors_allow_origin = [
             a.strip()
@@ -116,8 +126,20 @@ class Application(object):
         self.node_timings = {}
         self.timing_expiry = int(conf.get('timing_expiry', 300))
         self.sorting_method = conf.get('sorting_method', 'shuffle').lower()
+        self.node_latency = NodeLatency(self.timing_expiry)
+        self.hedged_get_percentile = \
+            float(conf.get('hedged_get_percentile', 0))
         self.allow_static_large_object = config_true_value(
             conf.get('allow_static_large_object', 'true'))
+        self.info_cache = InfoCache(
+            int(conf.get('info_cache_size', 10000)),
+            float(conf.get('info_cache_ttl', 0)), self.logger)
+        conn_pool_size = int(conf.get('conn_pool_size', 0))
+        self.conn_pool = None
+        if conn_pool_size > 0:
+            self.conn_pool = ConnectionPool(
+                conn_pool_size,
+                float(conf.get('conn_pool_idle_timeout', 30)))
 
     def get_controller(self, path):
         """
@@ -284,7 +306,8 @@ class Application(object):
         Sorts nodes in-place (and returns the sorted list) according to
         the configured strategy. The default "sorting" is to randomly
         shuffle the nodes. If the "timing" strategy is chosen, the nodes
-        are sorted according to the stored timing data.
+        are sorted according to the stored timing data. The "latency"
+        strategy sorts devices by their decaying moving average latency.
         '''
         # In the case of timing sorting, shuffling ensures that close timings
         # (ie within the rounding resolution) won't prefer one over another.
@@ -297,6 +320,9 @@ class Application(object):
                 timing, expires = self.node_timings.get(node['ip'], (-1.0, 0))
                 return timing if expires > now else -1.0
             nodes.sort(key=key_func)
+        elif self.sorting_method == 'latency':
+            now = time()
+            nodes.sort(key=lambda node: self.node_latency.estimate(node, now))
         return nodes
 
     def set_node_timing(self, node, timing):
@@ -306,6 +332,19 @@ class Application(object):
         timing = round(timing, 3)  # sort timings to the millisecond
         self.node_timings[node['ip']] = (timing, now + self.timing_expiry)
 
+    def record_node_latency(self, node, elapsed, server_type=None):
+        """
+        Feeds how long a backend request took to get response headers into
+        the per-device latency model used by the "latency" sorting method
+        and by hedged GETs.
+
+        :param node: dictionary of node the request went to
+        :param elapsed: seconds taken, or node_timeout if the request failed
+        :param server_type: server type to also record the sample under for
+                            hedging deadlines
+        """
+        self.node_latency.record(node, elapsed, server_type)
+
 
 def app_factory(global_conf, **local_conf):
     """paste.deploy app factory for creating WSGI proxy apps."""
@@ -138,6 +138,7 @@ class FakeLogger(object):
     timing = _store_in('timing')
     timing_since = _store_in('timing_since')
     update_stats = _store_in('update_stats')
+    transfer_rate = _store_in('transfer_rate')
     set_statsd_prefix = _store_in('set_statsd_prefix')
 
     def get_increments(self):
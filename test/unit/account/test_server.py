@@ -22,6 +22,8 @@ from StringIO import StringIO
 import simplejson
 import xml.dom.minidom
 
+import swift.account.server
+import swift.common.db
 from swift.common.swob import Request
 from swift.account.server import AccountController, ACCOUNT_LISTING_LIMIT
 from swift.common.utils import normalize_timestamp
@@ -488,6 +490,38 @@ class TestAccountController(unittest.TestCase):
         self.assertEquals(resp.content_type, 'text/plain')
         self.assertEquals(resp.charset, 'utf-8')
 
+    def test_GET_paged(self):
+        req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
+                            'HTTP_X_TIMESTAMP': '0'})
+        self.controller.PUT(req)
+        for name in ('c1', 'c2', 'd-1', 'd-2', 'e'):
+            req = Request.blank('/sda1/p/a/%s' % name,
+                                environ={'REQUEST_METHOD': 'PUT'},
+                                headers={'X-Put-Timestamp': '1',
+                                         'X-Delete-Timestamp': '0',
+                                         'X-Object-Count': '1',
+                                         'X-Bytes-Used': '2',
+                                         'X-Timestamp': normalize_timestamp(0)})
+            self.controller.PUT(req)
+        queries = ('', '?format=json', '?format=xml', '?delimiter=-',
+                   '?format=json&delimiter=-', '?format=xml&delimiter=-',
+                   '?marker=c1&limit=3')
+        bodies = {}
+        for query in queries:
+            resp = self.controller.GET(Request.blank('/sda1/p/a' + query))
+            bodies[query] = resp.body
+        orig_page_size = swift.common.db.LISTING_PAGE_SIZE
+        try:
+            swift.common.db.LISTING_PAGE_SIZE = \
+                swift.account.server.LISTING_PAGE_SIZE = 2
+            for query in queries:
+                resp = self.controller.GET(Request.blank('/sda1/p/a' + query))
+                self.assertEquals(resp.status_int, 200)
+                self.assertEquals(resp.body, bodies[query])
+        finally:
+            swift.common.db.LISTING_PAGE_SIZE = \
+                swift.account.server.LISTING_PAGE_SIZE = orig_page_size
+
     def test_GET_with_containers_json(self):
         req = Request.blank('/sda1/p/a', environ={'REQUEST_METHOD': 'PUT',
             'HTTP_X_TIMESTAMP': '0'})
@@ -21,8 +21,10 @@ from shutil import rmtree
 from tempfile import mkdtemp
 from StringIO import StringIO
 from mock import patch
+from eventlet import sleep
 from swift.common.middleware import bulk
-from swift.common.swob import Request, Response, HTTPException
+from swift.common.swob import Request, Response, HTTPException, \
+    HTTPUnauthorized
 from swift.common.utils import json
 
 
@@ -30,9 +32,17 @@ class FakeApp(object):
     def __init__(self):
         self.calls = 0
         self.delete_paths = []
+        self.in_flight = self.max_in_flight = 0
 
     def __call__(self, env, start_response):
         self.calls += 1
+        if env['PATH_INFO'].startswith('/delete_slow/'):
+            self.delete_paths.append(env['PATH_INFO'])
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            sleep(0.01)
+            self.in_flight -= 1
+            return Response(status='204 No Content')(env, start_response)
         if env['PATH_INFO'].startswith('/unauth/'):
             return Response(status=401)(env, start_response)
         if env['PATH_INFO'].startswith('/create_cont/'):
@@ -99,6 +109,61 @@ def build_tar_tree(tar, start_path, tree_obj, base_path=''):
         tar.addfile(tar_info)
 
 
+class TestBulkExecutor(unittest.TestCase):
+
+    def test_results_in_submission_order(self):
+        executor = bulk.BulkExecutor(3)
+
+        def slow(value, delay):
+            sleep(delay)
+            return value
+
+        executor.spawn(slow, 'a', 0.02)
+        executor.add_result('b')
+        executor.spawn(slow, 'c', 0)
+        self.assertEquals(list(executor.results()), [])
+        self.assertEquals(list(executor.results(wait=True)), ['a', 'b', 'c'])
+        self.assertEquals(list(executor.results(wait=True)), [])
+
+    def test_concurrency_bounded(self):
+        executor = bulk.BulkExecutor(2)
+        running = []
+        most = [0]
+
+        def work(value):
+            running.append(value)
+            most[0] = max(most[0], len(running))
+            sleep(0.001)
+            running.remove(value)
+            return value
+
+        for i in xrange(6):
+            executor.spawn(work, i)
+        self.assertEquals(list(executor.results(wait=True)), range(6))
+        self.assertEquals(most[0], 2)
+
+    def test_concurrency_one_runs_inline(self):
+        executor = bulk.BulkExecutor(0)
+        calls = []
+        executor.spawn(calls.append, 'x')
+        self.assertEquals(calls, ['x'])
+        self.assertEquals(list(executor.results()), [None])
+
+    def test_drain(self):
+        executor = bulk.BulkExecutor(2)
+        done = []
+
+        def work(value):
+            sleep(0.001)
+            done.append(value)
+
+        executor.spawn(work, 1)
+        executor.spawn(work, 2)
+        executor.drain()
+        self.assertEquals(done, [1, 2])
+        self.assertEquals(list(executor.results()), [])
+
+
 class TestUntar(unittest.TestCase):
 
     def setUp(self):
@@ -369,8 +434,54 @@ class TestUntar(unittest.TestCase):
         req.headers['transfer-encoding'] = 'chunked'
         resp = self.bulk.handle_extract(req, '')
         resp_data = json.loads(resp.body)
-        self.assertEquals(self.app.calls, 4)
+        # the failed container create isn't retried for every file in it
+        self.assertEquals(self.app.calls, 1)
+        self.assertEquals(len(resp_data['Errors']), 5)
+
+    def test_extract_tar_create_cont_server_error_retried(self):
+        self.build_tar()
+        req = Request.blank('/broke/acc/cont/',
+                            headers={'Accept': 'application/json'})
+        req.environ['wsgi.input'] = open(os.path.join(self.testdir,
+                                                      'tar_fails.tar'))
+        req.headers['transfer-encoding'] = 'chunked'
+        resp = self.bulk.handle_extract(req, '')
+        resp_data = json.loads(resp.body)
+        self.assertEquals(self.app.calls, 5)
         self.assertEquals(len(resp_data['Errors']), 5)
+        self.assertEquals(resp_data['Errors'][0][1], '500 Internal Error')
+
+    def test_extract_tar_concurrent_uploads(self):
+        self.build_tar()
+        uploads = []
+        in_flight = []
+        most = [0]
+
+        def fake_app(env, start_response):
+            if env['PATH_INFO'].count('/') > 3:
+                uploads.append(env['wsgi.input'].read())
+                in_flight.append(env['PATH_INFO'])
+                most[0] = max(most[0], len(in_flight))
+                sleep(0.01)
+                in_flight.remove(env['PATH_INFO'])
+            return Response(status='201 Created')(env, start_response)
+
+        for concurrency in (1, 4):
+            del uploads[:]
+            most[0] = 0
+            app = bulk.filter_factory(
+                {'max_concurrent_ops': str(concurrency)})(fake_app)
+            req = Request.blank('/tar_works/acc/cont/',
+                                headers={'Accept': 'application/json'})
+            req.environ['wsgi.input'] = open(os.path.join(self.testdir,
+                                                          'tar_fails.tar'))
+            req.headers['transfer-encoding'] = 'chunked'
+            resp = app.handle_extract(req, '')
+            self.assertEquals(resp.status_int, 201)
+            self.assertEquals(
+                json.loads(resp.body)['Number Files Created'], 5)
+            self.assertEquals(uploads, [''] * 5)
+            self.assertEquals(most[0], concurrency)
 
     def test_extract_tar_fail_create_cont_value_err(self):
         self.build_tar()
@@ -449,6 +560,83 @@ class TestDelete(unittest.TestCase):
             self.app.delete_paths, ['/delete_works/AUTH_Acc/c/f'])
         self.assertEquals(self.app.calls, 1)
 
+    def test_bulk_delete_concurrency(self):
+        objs = ['/c/o%d' % i for i in xrange(10)]
+        for concurrency in (1, 3):
+            app = FakeApp()
+            bulk_app = bulk.filter_factory(
+                {'max_concurrent_ops': str(concurrency)})(app)
+            req = Request.blank('/delete_slow/AUTH_Acc',
+                                body='\n'.join(objs),
+                                headers={'Accept': 'application/json'})
+            req.method = 'DELETE'
+            resp = bulk_app.handle_delete(req)
+            self.assertEquals(json.loads(resp.body)['Number Deleted'], 10)
+            self.assertEquals(app.max_in_flight, concurrency)
+            self.assertEquals(
+                app.delete_paths,
+                ['/delete_slow/AUTH_Acc' + obj for obj in objs])
+
+    def test_bulk_delete_keep_alive(self):
+        bulk_app = bulk.filter_factory({'yield_frequency': '0.005'})(self.app)
+        status = []
+
+        def fake_start_response(resp_status, headers):
+            status.append(resp_status)
+
+        req = Request.blank('/delete_slow/AUTH_Acc?bulk-delete',
+                            body='/c/f1\n/c/f2\n/c/f3\n/c/f4',
+                            headers={'Accept': 'application/json'})
+        req.method = 'DELETE'
+        body = ''.join(bulk_app(req.environ, fake_start_response))
+        self.assertEquals(status, ['200 OK'])
+        self.assert_(body.startswith(' '))
+        resp_data = json.loads(body)
+        self.assertEquals(resp_data['Response Status'], '200 OK')
+        self.assertEquals(resp_data['Number Deleted'], 4)
+
+        # a failure that takes a while is only reported in the body
+        del status[:]
+        req = Request.blank('/delete_slow/AUTH_Acc?bulk-delete',
+                            body='/c/f1\n/c/f2\n/c/f3\n/c/f4',
+                            headers={'Accept': 'application/json'})
+        req.method = 'DELETE'
+        with patch.object(bulk_app, 'handle_delete',
+                          lambda req: sleep(0.02) or HTTPUnauthorized()):
+            body = ''.join(bulk_app(req.environ, fake_start_response))
+        self.assertEquals(status, ['200 OK'])
+        resp_data = json.loads(body)
+        self.assertEquals(resp_data['Response Status'], '401 Unauthorized')
+        self.assert_('Response Body' in resp_data)
+
+        # so is one that raises
+        del status[:]
+        req = Request.blank('/delete_slow/AUTH_Acc?bulk-delete',
+                            body='/c/f1\n/c/f2\n/c/f3\n/c/f4',
+                            headers={'Accept': 'application/json'})
+        req.method = 'DELETE'
+
+        def handle_delete(req):
+            sleep(0.02)
+            raise ValueError('boom')
+
+        with patch.object(bulk_app, 'handle_delete', handle_delete):
+            with patch.object(bulk_app, 'logger') as logger:
+                body = ''.join(bulk_app(req.environ, fake_start_response))
+        self.assertEquals(status, ['200 OK'])
+        resp_data = json.loads(body)
+        self.assertEquals(resp_data['Response Status'],
+                          '500 Internal Error')
+        self.assertEquals(logger.exception.call_count, 1)
+
+        # quick ones are answered as usual
+        del status[:]
+        req = Request.blank('/broke/AUTH_acc?bulk-delete', body='/c/f\n')
+        req.method = 'DELETE'
+        body = ''.join(bulk_app(req.environ, fake_start_response))
+        self.assertEquals(status, ['502 Bad Gateway'])
+        self.assert_('Response Status' not in body)
+
     def test_bulk_delete_get_objs(self):
         req = Request.blank('/delete_works/AUTH_Acc', body='1\r\n2\r\n')
         req.method = 'DELETE'
@@ -16,6 +16,9 @@
 import unittest
 from ConfigParser import NoSectionError, NoOptionError
 
+from mock import patch
+
+from swift.common import memcached
 from swift.common.middleware import memcache
 from swift.common.memcached import MemcacheRing
 from swift.common.swob import Request
@@ -49,6 +52,8 @@ class SetConfigParser(object):
                 return '1.2.3.4:5'
             elif option == 'memcache_serialization_support':
                 return '1'
+            elif option == 'memcache_max_connections':
+                return '4'
             else:
                 raise NoOptionError(option)
         else:
@@ -89,7 +94,8 @@ class TestCacheMiddleware(unittest.TestCase):
         try:
             memcache.MemcacheMiddleware(
                     FakeApp(), {'memcache_servers': '1.2.3.4:5',
-                                'memcache_serialization_support': '2'})
+                                'memcache_serialization_support': '2',
+                                'memcache_max_connections': '3'})
         except Exception, err:
             exc = err
         finally:
@@ -106,6 +112,9 @@ class TestCacheMiddleware(unittest.TestCase):
         self.assertEquals(app.memcache_servers, '127.0.0.1:11211')
         self.assertEquals(app.memcache._allow_pickle, False)
         self.assertEquals(app.memcache._allow_unpickle, False)
+        self.assertEquals(app.memcache._allow_msgpack, False)
+        self.assertEquals(
+            app.memcache._client_cache['127.0.0.1:11211'].max_size, 2)
 
     def test_conf_from_extra_conf(self):
         orig_parser = memcache.ConfigParser
@@ -117,6 +126,8 @@ class TestCacheMiddleware(unittest.TestCase):
         self.assertEquals(app.memcache_servers, '1.2.3.4:5')
         self.assertEquals(app.memcache._allow_pickle, False)
         self.assertEquals(app.memcache._allow_unpickle, True)
+        self.assertEquals(
+            app.memcache._client_cache['1.2.3.4:5'].max_size, 4)
 
     def test_conf_from_inline_conf(self):
         orig_parser = memcache.ConfigParser
@@ -132,6 +143,23 @@ class TestCacheMiddleware(unittest.TestCase):
         self.assertEquals(app.memcache._allow_pickle, False)
         self.assertEquals(app.memcache._allow_unpickle, True)
 
+    def test_conf_msgpack(self):
+        orig_parser = memcache.ConfigParser
+        memcache.ConfigParser = EmptyConfigParser
+        try:
+            with patch.object(memcached, 'msgpack', object()):
+                app = memcache.MemcacheMiddleware(
+                    FakeApp(),
+                    {'memcache_serialization_support': '3',
+                     'memcache_max_connections': '0'})
+        finally:
+            memcache.ConfigParser = orig_parser
+        self.assertEquals(app.memcache._allow_pickle, False)
+        self.assertEquals(app.memcache._allow_unpickle, False)
+        self.assertEquals(app.memcache._allow_msgpack, True)
+        self.assertEquals(
+            app.memcache._client_cache['127.0.0.1:11211'].max_size, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -18,6 +18,7 @@ import time
 import eventlet
 from contextlib import contextmanager
 from threading import Thread
+from mock import patch
 
 from test.unit import FakeLogger
 from swift.common.middleware import ratelimit
@@ -434,5 +435,105 @@ class TestRateLimit(unittest.TestCase):
         time_took = time.time() - begin
         self.assertEquals(round(time_took, 1), 0) # no memcache, no limiting
 
+    def _local_app(self, fake_memcache, **conf):
+        conf.setdefault('account_ratelimit', 5)
+        conf.setdefault('sync_interval', 1)
+        the_app = ratelimit.RateLimitMiddleware(None, conf,
+                                                logger=FakeLogger())
+        the_app.memcache_client = fake_memcache
+        return the_app
+
+    def test_sync_interval(self):
+        fake_memcache = CountingMemcache()
+        the_app = self._local_app(fake_memcache)
+        with patch.object(eventlet, 'spawn_n', lambda f, *a: f(*a)):
+            begin = time.time()
+            for i in xrange(50):
+                mock_sleep(the_app._get_sleep_time('ratelimit/a', 5))
+            self.assertEquals(round(time.time() - begin, 1), 9.8)
+            mock_sleep(1)
+            the_app._sync_buckets()
+        # one incr to start with, then about one per second
+        self.assert_(fake_memcache.incrs < 15, fake_memcache.incrs)
+        self.assertEquals(
+            int(fake_memcache.store['ratelimit/a/requests']), 50)
+        self.assert_('ratelimit/a' not in fake_memcache.store)
+
+    def test_sync_interval_max_sleep(self):
+        the_app = self._local_app(FakeMemcache(), account_ratelimit=2,
+                                  max_sleep_time_seconds=1)
+        with patch.object(eventlet, 'spawn_n', lambda f, *a: f(*a)):
+            self.assertEquals(
+                the_app._get_sleep_time('ratelimit/a', 2), 0)
+            self.assertEquals(
+                the_app._get_sleep_time('ratelimit/a', 2), 0.5)
+            self.assertRaises(ratelimit.MaxSleepTimeHitError,
+                              the_app._get_sleep_time, 'ratelimit/a', 2)
+            mock_sleep(0.5)
+            self.assertEquals(
+                the_app._get_sleep_time('ratelimit/a', 2), 0.5)
+
+    def test_sync_interval_shares(self):
+        fake_memcache = FakeMemcache()
+        busy = self._local_app(fake_memcache)
+        quiet = self._local_app(fake_memcache)
+        admitted = []
+        with patch.object(eventlet, 'spawn_n', lambda f, *a: f(*a)):
+            # 40 requests a second, three in four of them to the busy proxy
+            for i in xrange(40 * 30):
+                mock_sleep(0.025)
+                the_app = quiet if i % 4 == 3 else busy
+                try:
+                    admitted.append(time.time() + the_app._get_sleep_time(
+                        'ratelimit/a', 5))
+                except ratelimit.MaxSleepTimeHitError:
+                    pass
+        self.assertAlmostEquals(
+            busy.buckets['ratelimit/a'].share, 0.75, delta=0.05)
+        self.assertAlmostEquals(
+            quiet.buckets['ratelimit/a'].share, 0.25, delta=0.05)
+        admitted = [t for t in admitted if 10 <= t < 30]
+        self.assertAlmostEquals(len(admitted) / 20.0, 5, delta=0.5)
+
+    def test_sync_interval_memcache_errors(self):
+        fake_memcache = FakeMemcache()
+        fake_memcache.error_on_incr = True
+        the_app = self._local_app(fake_memcache)
+        with patch.object(eventlet, 'spawn_n', lambda f, *a: f(*a)):
+            self.assertEquals(the_app._get_sleep_time('ratelimit/a', 5), 0)
+            self.assertEquals(the_app._get_sleep_time('ratelimit/a', 5), 0.2)
+            mock_sleep(1)
+            the_app._get_sleep_time('ratelimit/a', 5)
+            # nothing is lost while memcache is away
+            self.assertEquals(the_app.buckets['ratelimit/a'].requests, 3)
+            fake_memcache.error_on_incr = False
+            mock_sleep(1)
+            the_app._get_sleep_time('ratelimit/a', 5)
+        self.assertEquals(
+            int(fake_memcache.store['ratelimit/a/requests']), 4)
+
+    def test_sync_interval_forgets_idle_keys(self):
+        the_app = self._local_app(FakeMemcache())
+        with patch.object(eventlet, 'spawn_n', lambda f, *a: f(*a)):
+            the_app._get_sleep_time('ratelimit/a', 5)
+            mock_sleep(1)
+            the_app._get_sleep_time('ratelimit/b', 5)
+            mock_sleep(1)
+            the_app._get_sleep_time('ratelimit/b', 5)
+        self.assertEquals(the_app.buckets.keys(), ['ratelimit/b'])
+        self.assertFalse(the_app.syncing)
+
+
+class CountingMemcache(FakeMemcache):
+
+    def __init__(self):
+        FakeMemcache.__init__(self)
+        self.incrs = 0
+
+    def incr(self, key, delta=1, time=0):
+        self.incrs += 1
+        return FakeMemcache.incr(self, key, delta=delta, time=time)
+
+
 if __name__ == '__main__':
     unittest.main()
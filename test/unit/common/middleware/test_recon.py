@@ -444,7 +444,8 @@ class TestReconSuccess(TestCase):
         rv = self.app.get_replication_info('object')
         self.assertEquals(self.fakecache.fakeout_calls,
                             [((['object_replication_time',
-                                'object_replication_last'],
+                                'object_replication_last',
+                                'object_replication_progress'],
                                 '/var/cache/swift/object.recon'), {})])
         self.assertEquals(rv, {'object_replication_time': 200.0,
                                'object_replication_last': 1357962809.15})
@@ -459,6 +460,32 @@ class TestReconSuccess(TestCase):
                             '/var/cache/swift/container.recon'), {})])
         self.assertEquals(rv, {"container_updater_sweep": 18.476239919662476})
 
+    def test_get_merge_info(self):
+        from_cache_response = {"container_merge": {
+            "sda1:100": {"device": "sda1", "queue_depth": 3, "merged": 5,
+                         "merge_time": 0.5, "max_staleness": 1.5,
+                         "updated": 1000.0},
+            "sda1:101": {"device": "sda1", "queue_depth": 1, "merged": 2,
+                         "merge_time": 0.25, "max_staleness": 2.5,
+                         "updated": 1001.0},
+            "sdb1:100": {"device": "sdb1", "queue_depth": 0, "merged": 1,
+                         "merge_time": 0.1, "max_staleness": 1.0,
+                         "updated": 1002.0},
+            "queue_depth": 7}}
+        self.fakecache.fakeout_calls = []
+        self.fakecache.fakeout = from_cache_response
+        rv = self.app.get_merge_info()
+        self.assertEquals(self.fakecache.fakeout_calls,
+                          [((['container_merge'],
+                             '/var/cache/swift/container.recon'), {})])
+        self.assertEquals(rv, {"container_merge": {
+            "sda1": {"queue_depth": 4, "merged": 7, "merge_time": 0.5,
+                     "max_staleness": 2.5},
+            "sdb1": {"queue_depth": 0, "merged": 1, "merge_time": 0.1,
+                     "max_staleness": 1.0}}})
+        self.fakecache.fakeout = {"container_merge": None}
+        self.assertEquals(self.app.get_merge_info(), {"container_merge": {}})
+
     def test_get_updater_info_object(self):
         from_cache_response = {"object_updater_sweep": 0.79848217964172363}
         self.fakecache.fakeout_calls = []
@@ -14,6 +14,8 @@
 # limitations under the License.
 
 import unittest
+from hashlib import md5
+from StringIO import StringIO
 from mock import patch
 from swift.common.middleware import slo
 from swift.common.utils import json
@@ -117,6 +119,43 @@ class FakeApp(object):
                             headers={'X-Static-Large-Object': 'True'},
                             body=good_data)(env, start_response)
 
+
+class FakeAutoSegmentApp(object):
+    def __init__(self):
+        self.calls = []
+        self.objects = {}
+        self.containers = set()
+        self.fail_path = None
+
+    def __call__(self, env, start_response):
+        method, path = env['REQUEST_METHOD'], env['PATH_INFO']
+        self.calls.append((method, path))
+        body = ''
+        if method == 'PUT':
+            # Read the way the proxy does, a chunk at a time
+            body = ''.join(iter(lambda: env['wsgi.input'].read(4), ''))
+        if path.count('/') == 3:
+            if method == 'HEAD':
+                status = 204 if path in self.containers else 404
+            else:
+                self.containers.add(path)
+                status = 201
+            return Response(status=status)(env, start_response)
+        if method == 'DELETE':
+            del self.objects[path]
+            return Response(status=204)(env, start_response)
+        if path == self.fail_path:
+            return Response(status=503)(env, start_response)
+        if len(body) != int(env['CONTENT_LENGTH']):
+            return Response(status=499)(env, start_response)
+        self.objects[path] = (body, env)
+        return Response(
+            status=201, headers={'etag': md5(body).hexdigest(),
+                                 'Last-Modified':
+                                 'Fri, 01 Feb 2012 20:38:36 GMT'},
+        )(env, start_response)
+
+
 test_xml_data = '''<?xml version="1.0" encoding="UTF-8"?>
 <static_large_object>
 <object_segment>
@@ -384,5 +423,134 @@ class TestStaticLargeObject(unittest.TestCase):
                           [('GET', '/test_delete_bad/A/c/man'),
                            ('DELETE', '/test_delete_bad/A/c/a_1')])
 
+
+class TestAutoSegment(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeAutoSegmentApp()
+        self.slo = slo.filter_factory(
+            {'auto_segment_size': '10', 'min_segment_size': '1',
+             'auto_segment_concurrency': '2'})(self.app)
+        self.body = ''.join(chr(ord('a') + i) for i in xrange(25))
+
+    def put(self, body, headers=None):
+        req = Request.blank('/v/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                            headers=headers or {}, body=body)
+        return req.get_response(self.slo)
+
+    def test_small_put_passes_through(self):
+        resp = self.put('x' * 10, {'Content-Type': 'text/plain'})
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(self.app.calls, [('PUT', '/v/a/c/o')])
+
+    def test_auto_segment_put(self):
+        resp = self.put(self.body, {'Content-Type': 'text/plain',
+                                    'X-Object-Meta-Foo': 'bar'})
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(self.app.calls[:2],
+                          [('HEAD', '/v/a/c_segments'),
+                           ('PUT', '/v/a/c_segments')])
+        self.assertEquals(self.app.calls[-1], ('PUT', '/v/a/c/o'))
+        manifest_body, manifest_env = self.app.objects.pop('/v/a/c/o')
+        self.assertEquals(manifest_env['CONTENT_TYPE'],
+                          'text/plain;swift_bytes=25')
+        self.assertEquals(manifest_env['HTTP_X_STATIC_LARGE_OBJECT'], 'True')
+        self.assertEquals(manifest_env['HTTP_X_OBJECT_META_FOO'], 'bar')
+        manifest = json.loads(manifest_body)
+        self.assertEquals([seg['bytes'] for seg in manifest], [10, 10, 5])
+        segments = []
+        for index, seg in enumerate(manifest):
+            self.assert_(seg['name'].startswith('/c_segments/o/'))
+            self.assert_(seg['name'].endswith('/25/10/%08d' % index))
+            seg_body, seg_env = self.app.objects['/v/a' + seg['name']]
+            self.assertEquals(seg['hash'], md5(seg_body).hexdigest())
+            self.assert_('HTTP_X_OBJECT_META_FOO' not in seg_env)
+            segments.append(seg_body)
+        self.assertEquals(''.join(segments), self.body)
+        self.assertEquals(len(self.app.objects), 3)
+        # the Etag a GET of the large object will have
+        self.assertEquals(resp.etag, md5(''.join(
+            md5(seg_body).hexdigest() for seg_body in segments)).hexdigest())
+
+    def test_auto_segment_put_cannot_create_container(self):
+        def forbid_container_put(env, start_response):
+            if env['REQUEST_METHOD'] == 'PUT' and \
+                    env['PATH_INFO'] == '/v/a/c_segments':
+                self.app.calls.append(('PUT', env['PATH_INFO']))
+                return Response(status=403)(env, start_response)
+            return self.app(env, start_response)
+        self.slo.app = forbid_container_put
+        resp = self.put(self.body)
+        self.assertEquals(resp.status_int, 403)
+        self.assert_('c_segments' in resp.body)
+        self.assertEquals(self.app.calls, [('HEAD', '/v/a/c_segments'),
+                                           ('PUT', '/v/a/c_segments')])
+
+    def test_auto_segment_put_existing_container(self):
+        self.app.containers.add('/v/a/c_segments')
+        resp = self.put(self.body)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(self.app.calls[0], ('HEAD', '/v/a/c_segments'))
+        self.assertEquals(self.app.calls[1][0], 'PUT')
+        self.assertNotEquals(self.app.calls[1][1], '/v/a/c_segments')
+
+    def test_auto_segment_put_max_segments(self):
+        self.slo.max_manifest_segments = 2
+        resp = self.put(self.body)
+        self.assertEquals(resp.status_int, 201)
+        manifest = json.loads(self.app.objects['/v/a/c/o'][0])
+        self.assertEquals([seg['bytes'] for seg in manifest], [13, 12])
+
+    def test_auto_segment_put_etag(self):
+        resp = self.put(self.body, {'Etag': md5(self.body).hexdigest()})
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(len(self.app.objects), 4)
+        resp = self.put(self.body, {'Etag': md5('other').hexdigest()})
+        self.assertEquals(resp.status_int, 422)
+        self.assertEquals(len(self.app.objects), 4)
+
+    def test_auto_segment_put_segment_fails(self):
+        def fail_second(env, start_response):
+            if env['PATH_INFO'].endswith('/00000001'):
+                self.app.fail_path = env['PATH_INFO']
+            return self.app(env, start_response)
+        self.slo.app = fail_second
+        resp = self.put(self.body)
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(self.app.objects, {})
+        self.assert_(('PUT', '/v/a/c/o') not in self.app.calls)
+
+    def test_auto_segment_put_segment_fails_stops_reading(self):
+        def fail_first(env, start_response):
+            if env['PATH_INFO'].endswith('/00000000'):
+                # refused before any of the body is read
+                self.app.calls.append((env['REQUEST_METHOD'],
+                                       env['PATH_INFO']))
+                return Response(status=401)(env, start_response)
+            return self.app(env, start_response)
+        self.slo.app = fail_first
+        body = StringIO('x' * 1000)
+        req = Request.blank('/v/a/c/o', environ={'REQUEST_METHOD': 'PUT',
+                                                 'wsgi.input': body})
+        req.content_length = 1000
+        resp = req.get_response(self.slo)
+        self.assertEquals(resp.status_int, 401)
+        self.assert_(body.tell() < 100)
+        segment_puts = [path for method, path in self.app.calls
+                        if method == 'PUT' and path.count('/') > 3]
+        self.assert_(len(segment_puts) < 10)
+        self.assertEquals(self.app.objects, {})
+        self.assert_(('PUT', '/v/a/c/o') not in self.app.calls)
+
+    def test_auto_segment_put_client_disconnect(self):
+        req = Request.blank('/v/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                            body=self.body[:15])
+        req.content_length = 25
+        resp = req.get_response(self.slo)
+        self.assertEquals(resp.status_int, 499)
+        self.assertEquals(self.app.objects, {})
+        self.assert_(('PUT', '/v/a/c/o') not in self.app.calls)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -69,6 +69,63 @@ class TestRingData(unittest.TestCase):
         rd2 = ring.RingData.load(ring_fname)
         self.assert_ring_data_equal(rd, rd2)
 
+    def test_roundtrip_serialization_v2(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        rd = ring.RingData(
+            [array.array('H', [0, 1, 0, 1]), array.array('H', [0, 1, 0, 1]),
+             array.array('H', [1, 0])],
+            [{'id': 0, 'zone': 0}, {'id': 1, 'zone': 1}], 30)
+        rd.save(ring_fname, format_version=2)
+        self.assertEquals(os.listdir(self.testdir), ['foo.ring.gz'])
+        with open(ring_fname, 'rb') as fp:
+            self.assertEquals(fp.read(6), 'R1NG\x00\x02')
+        rd2 = ring.RingData.load(ring_fname)
+        self.assertEquals([list(r) for r in rd2._replica2part2dev_id],
+                          [[0, 1, 0, 1], [0, 1, 0, 1], [1, 0]])
+        self.assertEquals(rd.devs, rd2.devs)
+        self.assertEquals(rd._part_shift, rd2._part_shift)
+        # A ring loaded from version 2 can be written back out as version 1
+        rd2.save(ring_fname)
+        self.assert_ring_data_equal(rd, ring.RingData.load(ring_fname))
+
+    def test_file_format_version(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        self.assertEquals(ring.RingData.file_format_version(ring_fname), 1)
+        rd = ring.RingData([array.array('H', [0, 1, 0, 1])],
+                           [{'id': 0, 'zone': 0}, {'id': 1, 'zone': 1}], 30)
+        rd.save(ring_fname)
+        self.assertEquals(ring.RingData.file_format_version(ring_fname), 1)
+        rd.save(ring_fname, format_version=2)
+        self.assertEquals(ring.RingData.file_format_version(ring_fname), 2)
+
+    def test_load_v2_other_byteorder(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        rd = ring.RingData(
+            [array.array('H', [0, 1, 0, 1]), array.array('H', [1, 0, 1, 0])],
+            [{'id': 0, 'zone': 0}, {'id': 1, 'zone': 1}], 30)
+        swapped = []
+        for part2dev_id in rd._replica2part2dev_id:
+            part2dev_id = array.array('H', part2dev_id)
+            part2dev_id.byteswap()
+            swapped.append(part2dev_id)
+        other = {'little': 'big', 'big': 'little'}[sys.byteorder]
+        # What a host with the other byte order would have written
+        orig_byteorder = sys.byteorder
+        try:
+            sys.byteorder = other
+            ring.RingData(swapped, rd.devs, rd._part_shift).save(
+                ring_fname, format_version=2)
+        finally:
+            sys.byteorder = orig_byteorder
+        self.assert_ring_data_equal(rd, ring.RingData.load(ring_fname))
+
+    def test_save_bad_format_version(self):
+        ring_fname = os.path.join(self.testdir, 'foo.ring.gz')
+        rd = ring.RingData([array.array('H', [0, 1, 0, 1])],
+                           [{'id': 0, 'zone': 0}, {'id': 1, 'zone': 1}], 30)
+        self.assertRaises(ValueError, rd.save, ring_fname, format_version=3)
+        self.assertFalse(os.path.exists(ring_fname))
+
     def test_deterministic_serialization(self):
         """
         Two identical rings should produce identical .gz files on disk.
@@ -143,6 +200,21 @@ class TestRing(unittest.TestCase):
             utils.HASH_PATH_SUFFIX = _orig_hash_path_suffix
             utils.HASH_PATH_PREFIX = _orig_hash_path_prefix
 
+    def test_load_v2(self):
+        ring.RingData(self.intended_replica2part2dev_id,
+            self.intended_devs, self.intended_part_shift).save(
+                os.path.join(self.testdir, 'v2.ring.gz'), format_version=2)
+        v2_ring = ring.Ring(self.testdir, ring_name='v2')
+        self.assertEquals(v2_ring.replica_count, self.ring.replica_count)
+        self.assertEquals(v2_ring.partition_count, self.ring.partition_count)
+        for part in xrange(self.ring.partition_count):
+            self.assertEquals(v2_ring.get_part_nodes(part),
+                              self.ring.get_part_nodes(part))
+        self.assertEquals(v2_ring.get_nodes('a', 'c', 'o'),
+                          self.ring.get_nodes('a', 'c', 'o'))
+        self.assertEquals(list(v2_ring.get_more_nodes(1)),
+                          list(self.ring.get_more_nodes(1)))
+
     def test_has_changed(self):
         self.assertEquals(self.ring.has_changed(), False)
         os.utime(self.testgz, (time() + 60, time() + 60))
@@ -205,6 +277,24 @@ class TestRing(unittest.TestCase):
         part, nodes = self.ring.get_nodes('a')
         self.assertEquals(nodes, self.ring.get_part_nodes(part))
 
+    def test_get_part_nodes_cached(self):
+        nodes = self.ring.get_part_nodes(1)
+        self.assertEquals(nodes, [self.intended_devs[1],
+                                  self.intended_devs[4]])
+        nodes.reverse()
+        self.assertEquals(self.ring.get_part_nodes(1),
+                          [self.intended_devs[1], self.intended_devs[4]])
+        self.assertEquals(self.ring._part_nodes.keys(), [1])
+        orig_size = ring.ring.PART_NODES_CACHE_SIZE
+        try:
+            ring.ring.PART_NODES_CACHE_SIZE = 1
+            self.ring.get_part_nodes(0)
+            self.assertEquals(self.ring._part_nodes.keys(), [0])
+        finally:
+            ring.ring.PART_NODES_CACHE_SIZE = orig_size
+        self.ring._reload(force=True)
+        self.assertEquals(self.ring._part_nodes, {})
+
     def test_get_nodes(self):
         # Yes, these tests are deliberately very fragile. We want to make sure
         # that if someones changes the results the ring produces, they know it.
@@ -13,9 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import socket
 import unittest
 
 from eventlet import spawn, Timeout, listen
+from eventlet.green.httplib import BadStatusLine
 
 from swift.common import bufferedhttp
 
@@ -98,5 +100,167 @@ class TestBufferedHTTP(unittest.TestCase):
             bufferedhttp.HTTPSConnection = origHTTPSConnection
 
 
+class TestConnectionPool(unittest.TestCase):
+
+    def _serve(self, bindsock, responses):
+        """
+        Accepts connections and answers one canned response per request,
+        recording (connection number, request line, headers) for each.  A
+        response of None closes the connection without answering.
+        """
+        requests = []
+
+        def serve():
+            conn_number = 0
+            while responses:
+                sock, addr = bindsock.accept()
+                conn_number += 1
+                fp = sock.makefile()
+                while responses:
+                    line = fp.readline()
+                    if not line:
+                        break
+                    headers = {}
+                    header = fp.readline()
+                    while header and header != '\r\n':
+                        headers[header.split(':')[0].lower()] = \
+                            header.split(':', 1)[1].strip()
+                        header = fp.readline()
+                    requests.append((conn_number, line.split()[1], headers))
+                    response = responses.pop(0)
+                    if response is None:
+                        break
+                    fp.write(response)
+                    fp.flush()
+                fp.close()
+                sock.close()
+        return spawn(serve), requests
+
+    def test_reuses_fully_read_connection(self):
+        bindsock = listen(('127.0.0.1', 0))
+        port = bindsock.getsockname()[1]
+        ok = 'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbody'
+        server, requests = self._serve(bindsock, [ok, ok, ok])
+        pool = bufferedhttp.ConnectionPool()
+        with Timeout(3):
+            for path in ('/a', '/b'):
+                conn = bufferedhttp.http_connect(
+                    '127.0.0.1', port, 'dev', 1, 'GET', path,
+                    {'Connection': 'close'}, pool=pool)
+                resp = conn.getresponse()
+                self.assertEquals(resp.read(), 'body')
+                self.assertEquals(len(pool.idle[('127.0.0.1', port)]), 1)
+                # the old holder closing its connection must not matter
+                conn.close()
+            conn = bufferedhttp.http_connect(
+                '127.0.0.1', port, 'dev', 1, 'HEAD', '/c', pool=pool)
+            resp = conn.getresponse()
+            self.assertEquals(resp.read(), '')
+            server.kill()
+        self.assertEquals([(1, '/dev/1/a'), (1, '/dev/1/b'), (1, '/dev/1/c')],
+                          [r[:2] for r in requests])
+        self.assert_('connection' not in requests[0][2])
+
+    def test_retries_closed_reused_connection(self):
+        bindsock = listen(('127.0.0.1', 0))
+        port = bindsock.getsockname()[1]
+        ok = 'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbody'
+        server, requests = self._serve(bindsock, [ok, None, ok])
+        pool = bufferedhttp.ConnectionPool()
+        with Timeout(3):
+            for path in ('/a', '/b'):
+                conn = bufferedhttp.http_connect(
+                    '127.0.0.1', port, 'dev', 1, 'GET', path, pool=pool)
+                resp = conn.getresponse()
+                self.assertEquals(resp.read(), 'body')
+            server.kill()
+        # the server closed the reused connection on reading the request;
+        # it went again over a new one
+        self.assertEquals([(1, '/dev/1/a'), (1, '/dev/1/b'), (2, '/dev/1/b')],
+                          [r[:2] for r in requests])
+
+    def test_no_retry_once_body_sent(self):
+        bindsock = listen(('127.0.0.1', 0))
+        port = bindsock.getsockname()[1]
+        ok = 'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbody'
+        server, requests = self._serve(bindsock, [ok, None, ok])
+        pool = bufferedhttp.ConnectionPool()
+        with Timeout(3):
+            conn = bufferedhttp.http_connect(
+                '127.0.0.1', port, 'dev', 1, 'GET', '/a', pool=pool)
+            self.assertEquals(conn.getresponse().read(), 'body')
+            conn = bufferedhttp.http_connect(
+                '127.0.0.1', port, 'dev', 1, 'PUT', '/b',
+                {'Content-Length': '4'}, pool=pool)
+            conn.send('data')
+            self.assertRaises((socket.error, BadStatusLine), conn.getresponse)
+            server.kill()
+        self.assertEquals([(1, '/dev/1/a'), (1, '/dev/1/b')],
+                          [r[:2] for r in requests])
+
+    def test_partial_read_not_reused(self):
+        bindsock = listen(('127.0.0.1', 0))
+        port = bindsock.getsockname()[1]
+        server, requests = self._serve(bindsock, [
+            'HTTP/1.1 200 OK\r\nContent-Length: 8\r\n\r\nresponse'])
+        pool = bufferedhttp.ConnectionPool()
+        with Timeout(3):
+            conn = bufferedhttp.http_connect(
+                '127.0.0.1', port, 'dev', 1, 'GET', '/a', pool=pool)
+            resp = conn.getresponse()
+            self.assertEquals(resp.read(4), 'resp')
+            resp.close()
+            self.assertEquals(resp.read(), '')
+            server.wait()
+        self.assertFalse(pool.idle.get(('127.0.0.1', port)))
+
+    def test_connection_close_not_reused(self):
+        bindsock = listen(('127.0.0.1', 0))
+        port = bindsock.getsockname()[1]
+        server, requests = self._serve(bindsock, [
+            'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n'
+            'Connection: close\r\n\r\nbody'])
+        pool = bufferedhttp.ConnectionPool()
+        with Timeout(3):
+            conn = bufferedhttp.http_connect(
+                '127.0.0.1', port, 'dev', 1, 'GET', '/a', pool=pool)
+            resp = conn.getresponse()
+            self.assertEquals(resp.read(), 'body')
+            server.wait()
+        self.assertFalse(pool.idle.get(('127.0.0.1', port)))
+
+    def test_get_put_drop(self):
+        pool = bufferedhttp.ConnectionPool(max_idle=2, idle_timeout=30)
+        key = ('1.2.3.4', 6000)
+        pairs = [socket.socketpair() for _junk in range(4)]
+        self.assertEquals(pool.get(key), None)
+        for a, b in pairs[:3]:
+            pool.put(key, a)
+        # over max_idle, the third is closed rather than kept
+        self.assertEquals([s for s, _t in pool.idle[key]],
+                          [pairs[0][0], pairs[1][0]])
+        self.assertRaises(socket.error, pairs[2][0].getpeername)
+        # most recently used first
+        self.assert_(pool.get(key) is pairs[1][0])
+        pool.put(key, pairs[1][0])
+        # a socket the far end has written to or closed is thrown away
+        pairs[1][1].close()
+        self.assert_(pool.get(key) is pairs[0][0])
+        self.assertEquals(pool.idle[key], [])
+        pool.put(key, pairs[3][0])
+        pool.drop(key)
+        self.assert_(key not in pool.idle)
+        self.assertEquals(pool.get(key), None)
+
+    def test_idle_timeout(self):
+        pool = bufferedhttp.ConnectionPool(idle_timeout=30)
+        key = ('1.2.3.4', 6000)
+        a, b = socket.socketpair()
+        pool.put(key, a)
+        pool.idle[key][0] = (a, pool.idle[key][0][1] - 31)
+        self.assertEquals(pool.get(key), None)
+        self.assertEquals(pool.idle[key], [])
+
+
 if __name__ == '__main__':
     unittest.main()
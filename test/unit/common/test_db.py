@@ -22,15 +22,20 @@ import unittest
 from shutil import rmtree, copy
 from time import sleep, time
 from uuid import uuid4
+from StringIO import StringIO
+from tempfile import mkdtemp
+import cPickle as pickle
 
 import simplejson
 import sqlite3
 
 import swift.common.db
 from swift.common.db import AccountBroker, chexor, ContainerBroker, \
-    DatabaseBroker, DatabaseConnectionError, dict_factory, get_db_connection
+    DatabaseBroker, DatabaseConnectionError, dict_factory, \
+    get_db_connection, iter_pending, pending_entry
 from swift.common.utils import normalize_timestamp
 from swift.common.exceptions import LockTimeout
+from test.unit import FakeLogger
 
 
 class TestDatabaseConnectionError(unittest.TestCase):
@@ -78,6 +83,27 @@ class TestChexor(unittest.TestCase):
             'd41d8cd98f00b204e9800998ecf8427e', None, normalize_timestamp(1))
 
 
+class TestIterPending(unittest.TestCase):
+
+    def test_read_sizes(self):
+        rows = [('o%d' % i, normalize_timestamp(i), i, 'text/plain', 'x', 0)
+                for i in xrange(20)]
+        data = ''
+        for i, row in enumerate(rows):
+            if i % 3:
+                data += pending_entry(row)
+            else:
+                data += ':' + pickle.dumps(row, protocol=2).encode('base64')
+        data += ':not base64' + pending_entry(rows[0])[:-1]
+        expected = [row for row, entry in iter_pending(StringIO(data))]
+        self.assertEquals(expected, rows + [None, None])
+        for read_size in (1, 2, 5, 7, 64):
+            self.assertEquals(
+                [row for row, entry in
+                 iter_pending(StringIO(data), read_size=read_size)],
+                expected)
+
+
 class TestGetDBConnection(unittest.TestCase):
 
     def test_normal_case(self):
@@ -1160,6 +1186,60 @@ class TestContainerBroker(unittest.TestCase):
         self.assertEquals(len(listing), 2)
         self.assertEquals([row[0] for row in listing], ['3/0000', '3/0001'])
 
+    def test_list_objects_iter_rollup_scan(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        names = ['a', 'b/', 'c/c', 'e']
+        for size in (1, 2, 3, 4, 9):
+            names.extend('d%d/%d' % (size, i) for i in xrange(size))
+            names.extend('d%d/x/%d' % (size, i) for i in xrange(size))
+        for name in names:
+            broker.put_object(name, normalize_timestamp(time()), 0,
+                              'text/plain', 'd41d8cd98f00b204e9800998ecf8427e')
+        names.sort()
+
+        def expected(limit, marker, prefix, path=None):
+            results = []
+            if path is not None:
+                prefix = path = path and path + '/'
+            for name in names:
+                if name <= marker or not name.startswith(prefix) or \
+                        name == path:
+                    continue
+                end = name.find('/', len(prefix))
+                if path is None and end > 0:
+                    name = name[:end + 1]
+                    if name == marker or name in results:
+                        continue
+                elif path is not None and 0 <= end < len(name) - 1:
+                    continue
+                results.append(name)
+            return results[:limit]
+
+        orig_rollup_scan = swift.common.db.ROLLUP_SCAN
+        try:
+            for rollup_scan in (1, 3, 100):
+                swift.common.db.ROLLUP_SCAN = rollup_scan
+                for limit in (1, 2, 5, 100):
+                    for marker in ('', 'c', 'd3/', 'd3/1', 'd4/x/'):
+                        listing = broker.list_objects_iter(
+                            limit, marker, None, '', '/')
+                        self.assertEquals(
+                            [row[0] for row in listing],
+                            expected(limit, marker, ''))
+                        listing = broker.list_objects_iter(
+                            limit, marker, None, 'd9/', '/')
+                        self.assertEquals(
+                            [row[0] for row in listing],
+                            expected(limit, marker, 'd9/'))
+                        listing = broker.list_objects_iter(
+                            limit, marker, None, None, None, 'd4')
+                        self.assertEquals(
+                            [row[0] for row in listing],
+                            expected(limit, marker, None, 'd4'))
+        finally:
+            swift.common.db.ROLLUP_SCAN = orig_rollup_scan
+
     def test_list_objects_iter_prefix_delim(self):
         """ Test swift.common.db.ContainerBroker.list_objects_iter """
         broker = ContainerBroker(':memory:', account='a', container='c')
@@ -1306,6 +1386,52 @@ class TestContainerBroker(unittest.TestCase):
         self.assertEquals(['a', 'b', 'c'],
                           sorted([rec['name'] for rec in items]))
 
+    def test_merge_items_same_name(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        broker.merge_items([
+            {'name': 'a', 'created_at': normalize_timestamp(3), 'size': 3,
+             'content_type': 'text/plain', 'etag': 'x', 'deleted': 0},
+            {'name': 'a', 'created_at': normalize_timestamp(4), 'size': 4,
+             'content_type': 'text/plain', 'etag': 'x', 'deleted': 0},
+            {'name': 'a', 'created_at': normalize_timestamp(2), 'size': 2,
+             'content_type': 'text/plain', 'etag': 'x', 'deleted': 0},
+            {'name': 'a', 'created_at': normalize_timestamp(4), 'size': 5,
+             'content_type': 'text/plain', 'etag': 'x', 'deleted': 0}])
+        items = broker.get_items_since(-1, 1000)
+        self.assertEquals([(rec['name'], rec['size']) for rec in items],
+                          [('a', 4)])
+        self.assertEquals(broker.get_info()['bytes_used'], 4)
+
+    def test_pending_file(self):
+        testdir = mkdtemp()
+        try:
+            broker = ContainerBroker(os.path.join(testdir, '1.db'),
+                                     account='a', container='c')
+            broker.initialize(normalize_timestamp('1'))
+            broker.logger = FakeLogger()
+            # entries written by older versions
+            with open(broker.pending_file, 'wb') as fp:
+                for name in ('a', 'b'):
+                    fp.write(':')
+                    fp.write(pickle.dumps(
+                        (name, normalize_timestamp(2), 1, 'text/plain',
+                         'x', 0), protocol=2).encode('base64'))
+            broker.put_object('c', normalize_timestamp(3), 1, 'text/plain',
+                              'x')
+            with open(broker.pending_file, 'ab') as fp:
+                fp.write(':not base64')
+            broker.put_object('b', normalize_timestamp(4), 0, 'text/plain',
+                              'x', deleted=1)
+            items = broker.get_items_since(-1, 1000)
+            self.assertEquals(
+                sorted((rec['name'], rec['deleted']) for rec in items),
+                [('a', 0), ('b', 1), ('c', 0)])
+            self.assertEquals(os.path.getsize(broker.pending_file), 0)
+            self.assertEquals(len(broker.logger.log_dict['exception']), 1)
+        finally:
+            rmtree(testdir, ignore_errors=1)
+
     def test_merge_items_overwrite(self):
         """test DatabaseBroker.merge_items"""
         broker1 = ContainerBroker(':memory:', account='a', container='c')
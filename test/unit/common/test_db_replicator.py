@@ -18,14 +18,21 @@ from contextlib import contextmanager
 import os
 import logging
 import errno
+import struct
+import zlib
 from shutil import rmtree
+from StringIO import StringIO
 from tempfile import mkdtemp, NamedTemporaryFile
 
+import simplejson
+
 from swift.common import db_replicator
-from swift.common.utils import normalize_timestamp
+from swift.common.db import ContainerBroker
+from swift.common.swob import Request
+from swift.common.utils import normalize_timestamp, hash_path
 from swift.container import server as container_server
 
-from test.unit import FakeLogger
+from test.unit import FakeLogger, mock
 
 
 def teardown_module():
@@ -211,6 +218,44 @@ class TestDBReplicator(unittest.TestCase):
         conn.request = other_req
         self.assertEquals(conn.replicate(1, 2, 3), None)
 
+    def test_repl_connection_stream(self):
+        node = {'ip': '127.0.0.1', 'port': 80, 'device': 'sdb1'}
+        conn = db_replicator.ReplConnection(node, '1234567890', 'abcdefg',
+                                            logging.getLogger())
+        requests = []
+        headers = {}
+        sent = []
+
+        class Sock:
+            def setsockopt(self, *args):
+                sent.append(args)
+
+        class Resp:
+            def read(self):
+                return 'data'
+        resp = Resp()
+        conn.putrequest = lambda *args: requests.append(args)
+        conn.putheader = lambda key, value: headers.__setitem__(key, value)
+        conn.endheaders = lambda: None
+        conn.sock = Sock()
+        conn.send = sent.append
+        conn.getresponse = lambda *args: resp
+        self.assertEquals(conn.replicate_stream([1, 2], ['abc', 'de'], 10),
+                          resp)
+        self.assertEquals(resp.data, 'data')
+        self.assertEquals(requests,
+                          [('REPLICATE', '/sdb1/1234567890/abcdefg')])
+        self.assertEquals(headers['Content-Type'],
+                          db_replicator.ROW_STREAM_CONTENT_TYPE)
+        self.assertEquals(headers['Transfer-Encoding'], 'chunked')
+        self.assertEquals(sent[1:], ['7\r\n[1, 2]\n\r\n', '3\r\nabc\r\n',
+                                     '2\r\nde\r\n', '0\r\n\r\n'])
+
+        def fail(data):
+            raise Exception('blah')
+        conn.send = fail
+        self.assertEquals(conn.replicate_stream([1, 2], ['abc'], 10), None)
+
     def test_rsync_file(self):
         replicator = TestReplicator({})
         with _mock_process(-1):
@@ -245,11 +290,237 @@ class TestDBReplicator(unittest.TestCase):
         replicator = TestReplicator({})
         replicator.run_once()
 
+    def test_run_once_workers(self):
+
+        class FakeRingWithLocalDevs:
+            class Ring(FakeRing.Ring):
+                devs = [{'id': 0, 'ip': '127.0.0.1', 'port': 1000,
+                         'device': 'sda'},
+                        {'id': 1, 'ip': '127.0.0.1', 'port': 1000,
+                         'device': 'sdb'},
+                        {'id': 2, 'ip': '127.0.0.2', 'port': 1000,
+                         'device': 'sdc'}]
+
+        root = mkdtemp()
+        try:
+            for device in ('sda', 'sdb', 'sdc'):
+                for hsh in ('a83', 'b83'):
+                    hash_dir = os.path.join(root, device,
+                                            container_server.DATADIR,
+                                            '0', hsh[-3:], hsh)
+                    os.makedirs(hash_dir)
+                    open(os.path.join(hash_dir, hsh + '.db'), 'w').close()
+            db_replicator.ring = FakeRingWithLocalDevs()
+            replicator = TestReplicator({
+                'devices': root, 'mount_check': 'false',
+                'replicator_workers': '8', 'recon_cache_path': root})
+            replicated = os.path.join(root, 'replicated')
+
+            def fake_replicate_object(partition, object_file, node_id):
+                replicator.stats['attempted'] += 1
+                replicator.stats['success'] += 1
+                with open(replicated, 'a') as fp:
+                    fp.write('%s %d\n' % (object_file[len(root):],
+                                          os.getpid()))
+            replicator._replicate_object = fake_replicate_object
+            with mock({'swift.common.db_replicator.whataremyips':
+                       lambda: ['127.0.0.1']}):
+                replicator.run_once()
+            with open(replicated) as fp:
+                dbs = [line.split() for line in fp]
+            self.assertEquals(
+                sorted(db for db, pid in dbs),
+                ['/%s/containers/0/%s/%s/%s.db' % (device, hsh, hsh, hsh)
+                 for device in ('sda', 'sdb') for hsh in ('a83', 'b83')])
+            pids = set(pid for db, pid in dbs)
+            self.assertEquals(len(pids), 2)
+            self.assertFalse(str(os.getpid()) in pids)
+            self.assertEquals(replicator.stats['attempted'], 4)
+            self.assertEquals(replicator.stats['success'], 4)
+        finally:
+            rmtree(root)
+
     def test_usync(self):
         fake_http = ReplHttp()
         replicator = TestReplicator({})
         replicator._usync_db(0, FakeBroker(), fake_http, '12345', '67890')
 
+    def test_usync_stream(self):
+        root = mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'sda1'))
+            controller = container_server.ContainerController(
+                {'devices': root, 'mount_check': 'false'})
+            req = Request.blank(
+                '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': normalize_timestamp(1)})
+            self.assertEquals(controller.PUT(req).status_int, 201)
+            remote = ContainerBroker(os.path.join(
+                root, 'sda1', 'containers', 'p', hash_path('a', 'c')[-3:],
+                hash_path('a', 'c'), hash_path('a', 'c') + '.db'))
+            broker = ContainerBroker(os.path.join(root, 'local.db'),
+                                     account='a', container='c')
+            broker.initialize(normalize_timestamp(1))
+            broker.merge_items([
+                {'name': u'o\u2603%d' % i, 'size': i,
+                 'created_at': normalize_timestamp(2),
+                 'content_type': 'text/plain',
+                 'etag': 'etag%d' % i, 'deleted': 0} for i in xrange(5)])
+            local_id = broker.get_info()['id']
+            requests = []
+
+            class Resp:
+                def __init__(self, status):
+                    self.status = status
+                    self.data = ''
+
+            class StreamHttp:
+                host = 'localhost'
+
+                def replicate_stream(innerself, args, chunks, timeout):
+                    body = simplejson.dumps(args) + '\n' + ''.join(chunks)
+                    requests.append(args[0])
+                    req = Request.blank(
+                        '/sda1/p/%s' % hash_path('a', 'c'),
+                        environ={'REQUEST_METHOD': 'REPLICATE'},
+                        headers={'Content-Type':
+                                 db_replicator.ROW_STREAM_CONTENT_TYPE},
+                        body=body)
+                    return Resp(controller.REPLICATE(req).status_int)
+
+                def replicate(innerself, *args):
+                    requests.append(args[0])
+                    return Resp(202)
+
+            # capped after two batches of two rows
+            replicator = TestReplicator({'per_diff': 2, 'max_diffs': 2})
+            self.assertFalse(replicator._usync_db(
+                -1, broker, StreamHttp(), 'remote', local_id, True))
+            self.assertEquals(replicator.stats['diff_capped'], 1)
+            self.assertEquals(requests, ['merge_items_stream'])
+            self.assertEquals(
+                sorted(row['name'] for row in remote.get_items_since(-1, 10)),
+                ['o\xe2\x98\x830', 'o\xe2\x98\x831', 'o\xe2\x98\x832',
+                 'o\xe2\x98\x833'])
+            self.assertEquals(remote.get_sync(local_id), 4)
+            self.assertEquals(broker.get_sync('remote', incoming=False), -1)
+
+            del requests[:]
+            replicator = TestReplicator({'per_diff': 2})
+            self.assert_(replicator._usync_db(
+                -1, broker, StreamHttp(), 'remote', local_id, True))
+            self.assertEquals(requests, ['merge_items_stream', 'merge_syncs'])
+            self.assertEquals(
+                sorted((row['name'], row['size'], row['etag'])
+                       for row in remote.get_items_since(-1, 10)),
+                [('o\xe2\x98\x83%d' % i, i, 'etag%d' % i) for i in xrange(5)])
+            self.assertEquals(remote.get_sync(local_id), 5)
+            self.assertEquals(broker.get_sync('remote', incoming=False), 5)
+        finally:
+            rmtree(root)
+
+    def test_usync_stream_error(self):
+        class StreamHttp(ReplHttp):
+            def replicate_stream(self, args, chunks, timeout):
+                list(chunks)
+
+                class Response:
+                    status = 500
+                    data = ''
+                return Response()
+        fake_http = StreamHttp()
+        replicator = TestReplicator({})
+        self.assertFalse(replicator._usync_db(0, FakeBroker(), fake_http,
+                                              '12345', '67890', True))
+        self.assertFalse(fake_http.replicated)
+        fake_http.replicate_stream = lambda *args: None
+        self.assertFalse(replicator._usync_db(0, FakeBroker(), fake_http,
+                                              '12345', '67890', True))
+
+    def test_full_copy_cheaper(self):
+        replicator = TestReplicator({})
+        broker = FakeBroker()
+        with NamedTemporaryFile() as db_file:
+            db_file.write('x' * db_replicator.ROW_MERGE_BYTES * 10)
+            db_file.flush()
+            broker.db_file = db_file.name
+            info = {'max_row': 100}
+            # 10 rows worth of copying plus merging the remote's 30 rows
+            # beats sending 50 rows
+            self.assert_(replicator._full_copy_cheaper(
+                broker, info, {'max_row': 30}, 50))
+            self.assertFalse(replicator._full_copy_cheaper(
+                broker, info, {'max_row': 30}, 70))
+            self.assertFalse(replicator._full_copy_cheaper(
+                broker, info, {'max_row': 45}, 50))
+            # nothing at all on the remote yet
+            self.assert_(replicator._full_copy_cheaper(
+                broker, info, {'max_row': -1}, -1))
+        broker.db_file = '/no/such/file.db'
+        self.assertFalse(replicator._full_copy_cheaper(
+            broker, info, {'max_row': -1}, -1))
+
+    def test_full_copy_cheaper_threshold(self):
+        replicator = TestReplicator({})
+        broker = FakeBroker()
+
+        def cheaper(db_size, max_row, remote_max_row, point):
+            with NamedTemporaryFile() as db_file:
+                db_file.truncate(db_size)
+                broker.db_file = db_file.name
+                return replicator._full_copy_cheaper(
+                    broker, {'max_row': max_row},
+                    {'max_row': remote_max_row}, point)
+
+        self.assertEquals(db_replicator.ROW_MERGE_BYTES, 4096)
+        size = db_replicator.ROW_MERGE_BYTES * 10
+        # copying costs 10 rows plus the remote's 30: a diff of 40 rows is
+        # sent as a diff, 41 rows makes the copy cheaper
+        self.assertFalse(cheaper(size, 100, 30, 60))
+        self.assert_(cheaper(size, 100, 30, 59))
+        # a part of ROW_MERGE_BYTES doesn't count as a row
+        self.assertFalse(cheaper(size + db_replicator.ROW_MERGE_BYTES - 1,
+                                 100, 30, 60))
+        self.assertFalse(cheaper(size + db_replicator.ROW_MERGE_BYTES,
+                                 100, 30, 59))
+        # a container of a million rows of 140 bytes is worth 34179 rows of
+        # copying
+        size = 140 * 1000000
+        # a new replica gets a copy
+        self.assert_(cheaper(size, 1000000, -1, -1))
+        # one missing the last tenth gets a diff
+        self.assertFalse(cheaper(size, 1000000, 900000, 900000))
+        # one with few rows of its own gets a copy once it misses more than
+        # its rows and the copy together
+        self.assertFalse(cheaper(size, 1000000, 10000, 1000000 - 44179))
+        self.assert_(cheaper(size, 1000000, 10000, 1000000 - 44180))
+
+    def test_repl_to_node_copy_or_diff(self):
+        replicator = TestReplicator({})
+        fake_node = {'ip': '127.0.0.1', 'device': 'sda1', 'port': 1000}
+        fake_info = {'id': 'a', 'point': -1, 'max_row': 100, 'hash': 'b',
+                     'created_at': 100, 'put_timestamp': 0,
+                     'delete_timestamp': 0, 'count': 100,
+                     'metadata': {}}
+        calls = []
+        replicator._rsync_db = lambda *args, **kwargs: calls.append(
+            kwargs.get('replicate_method')) or True
+        replicator._usync_db = lambda *args: calls.append('usync') or True
+        broker = FakeBroker()
+        with NamedTemporaryFile() as db_file:
+            db_file.truncate(db_replicator.ROW_MERGE_BYTES * 10)
+            broker.db_file = db_file.name
+            # FakeBroker's sync point is 5, so the diff is 95 rows; copying
+            # costs 10 rows plus the remote's
+            for remote_max_row, method in ((84, 'rsync_then_merge'),
+                                           (85, 'usync')):
+                replicator._http_connect = lambda *args: ReplHttp(
+                    simplejson.dumps({'id': 3, 'point': -1, 'hash': 'c',
+                                      'max_row': remote_max_row}))
+                self.assert_(replicator._repl_to_node(
+                    fake_node, broker, '0', fake_info))
+                self.assertEquals(calls.pop(), method)
+
     def test_repl_to_node(self):
         replicator = TestReplicator({})
         fake_node = {'ip': '127.0.0.1', 'device': 'sda1', 'port': 1000}
@@ -410,6 +681,25 @@ class TestDBReplicator(unittest.TestCase):
         rpc.merge_items(fake_broker, args)
         self.assertEquals(fake_broker.args, args)
 
+    def test_merge_items_stream(self):
+        rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
+        fake_broker = FakeBroker()
+        columns = ['ROWID', 'name']
+        batch = zlib.compress(simplejson.dumps([[1, 'a'], [2, 'b']]))
+        frame = struct.pack('!I', len(batch)) + batch
+        resp = rpc.merge_items_stream(fake_broker, ['source', columns],
+                                      StringIO(frame + frame))
+        self.assertEquals(resp.status_int, 202)
+        self.assertEquals(fake_broker.args,
+                          ([{'ROWID': 1, 'name': 'a'},
+                            {'ROWID': 2, 'name': 'b'}], 'source'))
+        for body in (frame[:-1], frame[:3], struct.pack('!I', 3) + 'abc'):
+            resp = rpc.merge_items_stream(fake_broker, ['source', columns],
+                                          StringIO(body))
+            self.assertEquals(resp.status_int, 400)
+        resp = rpc.merge_items_stream(fake_broker, ['source', columns], None)
+        self.assertEquals(resp.status_int, 400)
+
     def test_merge_syncs(self):
         rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
         fake_broker = FakeBroker()
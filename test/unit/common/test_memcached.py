@@ -23,7 +23,12 @@ import time
 import unittest
 from uuid import uuid4
 
+from eventlet import GreenPool, sleep, Timeout
+from eventlet.pools import Pool
+from mock import patch
+
 from swift.common import memcached
+from swift.common.utils import json
 from test.unit import NullLoggingHandler
 
 
@@ -131,6 +136,15 @@ class MockMemcached(object):
             return response
 
 
+class MockedMemcachePool(memcached.MemcacheConnPool):
+    def __init__(self, mocks):
+        Pool.__init__(self, max_size=2)
+        self.mocks = mocks
+
+    def create(self):
+        return self.mocks.pop(0)
+
+
 class TestMemcached(unittest.TestCase):
     """ Tests for swift.common.memcached"""
 
@@ -159,13 +173,15 @@ class TestMemcached(unittest.TestCase):
                         one = False
                     if peeripport == sock2ipport:
                         two = False
+                    memcache_client._return_conn(*conn)
         finally:
             memcached.DEFAULT_MEMCACHED_PORT = orig_port
 
     def test_set_get(self):
         memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'])
         mock = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock, mock)] * 2
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)] * 2)
         memcache_client.set('some_key', [1, 2, 3])
         self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
         self.assertEquals(mock.cache.values()[0][1], '0')
@@ -192,7 +208,8 @@ class TestMemcached(unittest.TestCase):
     def test_incr(self):
         memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'])
         mock = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock, mock)] * 2
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)] * 2)
         memcache_client.incr('some_key', delta=5)
         self.assertEquals(memcache_client.get('some_key'), '5')
         memcache_client.incr('some_key', delta=5)
@@ -210,7 +227,8 @@ class TestMemcached(unittest.TestCase):
     def test_incr_w_timeout(self):
         memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'])
         mock = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock, mock)] * 2
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)] * 2)
         memcache_client.incr('some_key', delta=5, time=55)
         self.assertEquals(memcache_client.get('some_key'), '5')
         self.assertEquals(mock.cache.values()[0][1], '55')
@@ -233,7 +251,8 @@ class TestMemcached(unittest.TestCase):
     def test_decr(self):
         memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'])
         mock = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock, mock)] * 2
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)] * 2)
         memcache_client.decr('some_key', delta=5)
         self.assertEquals(memcache_client.get('some_key'), '0')
         memcache_client.incr('some_key', delta=15)
@@ -252,8 +271,10 @@ class TestMemcached(unittest.TestCase):
             ['1.2.3.4:11211', '1.2.3.5:11211'])
         mock1 = ExplodingMockMemcached()
         mock2 = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock2, mock2)]
-        memcache_client._client_cache['1.2.3.5:11211'] = [(mock1, mock1)]
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock2, mock2)])
+        memcache_client._client_cache['1.2.3.5:11211'] = MockedMemcachePool(
+            [(mock1, mock1)])
         memcache_client.set('some_key', [1, 2, 3])
         self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
         self.assertEquals(mock1.exploded, True)
@@ -261,7 +282,8 @@ class TestMemcached(unittest.TestCase):
     def test_delete(self):
         memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'])
         mock = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock, mock)] * 2
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)] * 2)
         memcache_client.set('some_key', [1, 2, 3])
         self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
         memcache_client.delete('some_key')
@@ -270,7 +292,8 @@ class TestMemcached(unittest.TestCase):
     def test_multi(self):
         memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'])
         mock = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock, mock)] * 2
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)] * 2)
         memcache_client.set_multi(
             {'some_key1': [1, 2, 3], 'some_key2': [4, 5, 6]}, 'multi_key')
         self.assertEquals(
@@ -304,7 +327,8 @@ class TestMemcached(unittest.TestCase):
         memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'],
                                                  allow_pickle=True)
         mock = MockMemcached()
-        memcache_client._client_cache['1.2.3.4:11211'] = [(mock, mock)] * 2
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)] * 2)
         memcache_client.set('some_key', [1, 2, 3])
         self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
         memcache_client._allow_pickle = False
@@ -319,6 +343,176 @@ class TestMemcached(unittest.TestCase):
         memcache_client._allow_pickle = True
         self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
 
+    def test_connection_pool_bounded(self):
+        memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'],
+                                                 max_conns=2)
+        created = []
+        in_use = []
+        most = [0]
+
+        class SlowMock(MockMemcached):
+            def readline(self):
+                in_use.append(self)
+                most[0] = max(most[0], len(in_use))
+                sleep(0.001)
+                in_use.remove(self)
+                return MockMemcached.readline(self)
+
+        def create():
+            mock = SlowMock()
+            mock.cache = shared_cache
+            created.append(mock)
+            return mock, mock
+
+        shared_cache = {}
+        pool = memcache_client._client_cache['1.2.3.4:11211']
+        with patch.object(pool, 'create', create):
+            memcache_client.set('some_key', [1, 2])
+            results = list(GreenPool().imap(
+                memcache_client.get, ['some_key'] * 10))
+        self.assertEquals(results, [[1, 2]] * 10)
+        self.assertEquals(len(created), 2)
+        self.assertEquals(most[0], 2)
+
+    def test_pool_timeout(self):
+        logging.getLogger().addHandler(NullLoggingHandler())
+        memcache_client = memcached.MemcacheRing(
+            ['1.2.3.4:11211'], max_conns=1, pool_timeout=0.01)
+        mock = MockMemcached()
+        memcache_client._client_cache['1.2.3.4:11211'] = MockedMemcachePool(
+            [(mock, mock)])
+        memcache_client._client_cache['1.2.3.4:11211'].max_size = 1
+        memcache_client.set('some_key', [1, 2, 3])
+        held = memcache_client._client_cache['1.2.3.4:11211'].get()
+        self.assertEquals(memcache_client.get('some_key'), None)
+        self.assertEquals(len(memcache_client._errors['1.2.3.4:11211']), 1)
+        memcache_client._return_conn('1.2.3.4:11211', *held)
+        self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
+
+    def test_failed_connection_replaced(self):
+        logging.getLogger().addHandler(NullLoggingHandler())
+        memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'])
+        mock1 = ExplodingMockMemcached()
+        mock2 = MockMemcached()
+        pool = MockedMemcachePool([(mock1, mock1), (mock2, mock2)])
+        memcache_client._client_cache['1.2.3.4:11211'] = pool
+        memcache_client.set('some_key', [1, 2, 3])
+        self.assertEquals(mock1.exploded, True)
+        self.assertEquals(list(pool.free_items), [(None, None)])
+        memcache_client.set('some_key', [1, 2, 3])
+        self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
+        self.assertEquals(list(pool.free_items), [(mock2, mock2)])
+
+    def test_timeouts_keep_pool_slots(self):
+        logging.getLogger().addHandler(NullLoggingHandler())
+        memcache_client = memcached.MemcacheRing(
+            ['1.2.3.4:11211'], pool_timeout=0.05)
+
+        class HangingMock(MockMemcached):
+            def readline(self):
+                sleep(1)
+
+        hanging = HangingMock()
+        mock = MockMemcached()
+        pool = MockedMemcachePool([(hanging, hanging), (mock, mock)])
+        pool.max_size = 1
+        memcache_client._client_cache['1.2.3.4:11211'] = pool
+        # the caller's own timeout gets back to the caller, with the slot
+        # returned and no error held against the server
+        timeout = Timeout(0.01)
+        try:
+            self.assertRaises(Timeout, memcache_client.get, 'some_key')
+        finally:
+            timeout.cancel()
+        self.assertEquals(pool.free(), 1)
+        self.assertEquals(memcache_client._errors['1.2.3.4:11211'], [])
+        memcache_client.set('some_key', [1, 2, 3])
+        self.assertEquals(memcache_client.get('some_key'), [1, 2, 3])
+
+        # the pool timeout going off while a failed slot reconnects
+        pool.get()
+        pool.put((None, None))
+
+        def slow_create():
+            sleep(1)
+        with patch.object(pool, 'create', slow_create):
+            self.assertEquals(memcache_client.get('some_key'), None)
+        self.assertEquals(pool.free(), 1)
+        self.assertEquals(list(pool.free_items), [(None, None)])
+
+    def test_multi_across_servers(self):
+        servers = ['1.2.3.4:11211', '1.2.3.5:11211', '1.2.3.6:11211']
+        memcache_client = memcached.MemcacheRing(servers, tries=1)
+        mocks = {}
+        commands = {}
+        for server in servers:
+            mock = MockMemcached()
+            mocks[server] = mock
+            commands[server] = []
+
+            def sendall(string, mock=mock, server=server):
+                commands[server].append(string.split(' ', 1)[0])
+                sleep(0)
+                return MockMemcached.sendall(mock, string)
+
+            mock.sendall = sendall
+            memcache_client._client_cache[server] = MockedMemcachePool(
+                [(mock, mock)] * 2)
+        keys = ['key%d' % i for i in xrange(30)]
+        memcache_client.set_multi(dict((key, key.upper()) for key in keys))
+        # each server got all its keys in one go
+        for server in servers:
+            self.assertEquals(commands[server], ['set'])
+        # and they are where single key calls look for them
+        for key in keys:
+            self.assertEquals(memcache_client.get(key), key.upper())
+        for server in servers:
+            del commands[server][:]
+        self.assertEquals(
+            memcache_client.get_multi(keys + ['missing']),
+            [key.upper() for key in keys] + [None])
+        for server in servers:
+            self.assert_(mocks[server].cache)
+            self.assert_(commands[server] in (['get'], []))
+        self.assertEquals(sum(len(c) for c in commands.values()), 3)
+
+    def test_msgpack_serialization(self):
+        class FakeMsgpack(object):
+            @staticmethod
+            def packb(value, use_bin_type=False):
+                return 'msgpack:' + json.dumps(value)
+
+            @staticmethod
+            def unpackb(value, encoding=None):
+                return json.loads(value[len('msgpack:'):])
+
+        mock = MockMemcached()
+        with patch.object(memcached, 'msgpack', FakeMsgpack):
+            memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'],
+                                                     allow_msgpack=True)
+            memcache_client._client_cache['1.2.3.4:11211'] = \
+                MockedMemcachePool([(mock, mock)] * 2)
+            memcache_client.set('some_key', {'a': [1, 2]})
+            self.assertEquals(mock.cache.values()[0][0],
+                              str(memcached.MSGPACK_FLAG))
+            self.assertEquals(memcache_client.get('some_key'),
+                              {'a': [1, 2]})
+            # any client can read it back
+            memcache_client._allow_msgpack = False
+            self.assertEquals(memcache_client.get('some_key'),
+                              {'a': [1, 2]})
+        # unless msgpack isn't installed, in which case it's a miss
+        with patch.object(memcached, 'msgpack', None):
+            self.assertEquals(memcache_client.get('some_key'), None)
+            memcache_client = memcached.MemcacheRing(['1.2.3.4:11211'],
+                                                     allow_msgpack=True)
+            memcache_client._client_cache['1.2.3.4:11211'] = \
+                MockedMemcachePool([(mock, mock)] * 2)
+            memcache_client.set('some_key', [1])
+            self.assertEquals(mock.cache.values()[0][0],
+                              str(memcached.JSON_FLAG))
+            self.assertEquals(memcache_client.get('some_key'), [1])
+
 
 if __name__ == '__main__':
     unittest.main()
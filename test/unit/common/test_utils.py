@@ -35,6 +35,7 @@ from StringIO import StringIO
 from functools import partial
 from tempfile import TemporaryFile, NamedTemporaryFile
 
+import eventlet
 from mock import patch
 
 from swift.common.exceptions import (Timeout, MessageTimeout,
@@ -1172,6 +1173,77 @@ log_name = %(yarr)s'''
         finally:
             utils._sys_fallocate = orig__sys_fallocate
 
+    def test_put_recon_cache_entry(self):
+        cache_entry = {'a': 1, 'b': {'x': 1, 'y': 2}, 'c': 'z'}
+        utils.put_recon_cache_entry(cache_entry, 'a', 2)
+        utils.put_recon_cache_entry(cache_entry, 'b', {'x': 3, 'y': {}})
+        utils.put_recon_cache_entry(cache_entry, 'c', {'w': 4})
+        utils.put_recon_cache_entry(cache_entry, 'd', {'v': 5})
+        self.assertEquals(cache_entry, {'a': 2, 'b': {'x': 3}, 'c': {'w': 4},
+                                        'd': {'v': 5}})
+
+    def test_fork_workers(self):
+        parent = os.getpid()
+
+        def work(shard):
+            if shard == 'fail':
+                raise Exception('fail')
+            return {shard: os.getpid() != parent}
+
+        self.assertEquals(utils.fork_workers(work, ['a', 'fail', 'b']),
+                          [{'a': True}, None, {'b': True}])
+        self.assertEquals(utils.fork_workers(work, []), [])
+
+    def test_fork_workers_logs_exceptions(self):
+        logger = logging.getLogger('test_fork_workers')
+        with TemporaryFile() as log:
+            handler = logging.StreamHandler(log)
+            logger.addHandler(handler)
+            try:
+                def work(shard):
+                    raise Exception('worker broke')
+
+                self.assertEquals(utils.fork_workers(work, ['a'], logger),
+                                  [None])
+            finally:
+                logger.removeHandler(handler)
+            log.seek(0)
+            logged = log.read()
+        self.assert_('Error in worker process' in logged)
+        self.assert_('Traceback' in logged)
+        self.assert_('worker broke' in logged)
+
+    def test_fork_workers_progress(self):
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(len(reports))
+                eventlet.sleep(0.01)
+
+        def work(shard, report):
+            for done in xrange(3):
+                report({shard: done})
+                time.sleep(0.1)
+            return {shard: 3}
+
+        reports = []
+        ticker = eventlet.spawn(tick)
+        try:
+            results = utils.fork_workers(
+                work, ['a', 'b'],
+                progress=lambda index, value: reports.append((index, value)))
+        finally:
+            ticker.kill()
+        self.assertEquals(results, [{'a': 3}, {'b': 3}])
+        self.assertEquals(sorted(reports),
+                          [(0, {'a': 0}), (0, {'a': 1}), (0, {'a': 2}),
+                           (1, {'b': 0}), (1, {'b': 1}), (1, {'b': 2})])
+        # the parent's greenthreads ran, and saw the reports come in, while
+        # the workers were still going
+        self.assert_(len(ticks) > 10)
+        self.assert_(0 < ticks[len(ticks) / 2] < 6)
+
 
 class TestStatsdLogging(unittest.TestCase):
     def test_get_logger_statsd_client_not_specified(self):
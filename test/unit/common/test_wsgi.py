@@ -24,6 +24,9 @@ from StringIO import StringIO
 from collections import defaultdict
 from urllib import quote
 
+from eventlet import listen, spawn, Timeout
+from eventlet.green import socket as green_socket
+
 from swift.common.swob import Request
 from swift.common import wsgi
 
@@ -112,6 +115,7 @@ class TestWSGI(unittest.TestCase):
                     socket.SO_KEEPALIVE: 1,
                 },
                 socket.IPPROTO_TCP: {
+                    socket.TCP_NODELAY: 1,
                     socket.TCP_KEEPIDLE: 600,
                 },
             }
@@ -266,5 +270,57 @@ class TestWSGIContext(unittest.TestCase):
         self.assertEquals(''.join(it), 'Ok\n')
 
 
+class TestSwiftHttpProtocol(unittest.TestCase):
+
+    def _run_server(self, keep_alive_timeout):
+        def app(env, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return ['ok']
+
+        orig_timeout = wsgi.SwiftHttpProtocol.keep_alive_timeout
+        wsgi.SwiftHttpProtocol.keep_alive_timeout = keep_alive_timeout
+        self.addCleanup(setattr, wsgi.SwiftHttpProtocol,
+                        'keep_alive_timeout', orig_timeout)
+        bindsock = listen(('127.0.0.1', 0))
+        server = spawn(wsgi.wsgi.server, bindsock, app, wsgi.NullLogger(),
+                       protocol=wsgi.SwiftHttpProtocol)
+        self.addCleanup(server.kill)
+        sock = green_socket.socket()
+        sock.connect(bindsock.getsockname())
+        return sock
+
+    def _request(self, fp):
+        fp.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        fp.flush()
+        self.assertEquals(fp.readline(), 'HTTP/1.1 200 OK\r\n')
+        while fp.readline() != '\r\n':
+            pass
+        self.assertEquals(fp.read(2), 'ok')
+
+    def test_keep_alive_timeout(self):
+        sock = self._run_server(0.2)
+        fp = sock.makefile()
+        with Timeout(3):
+            self._request(fp)
+            self._request(fp)
+            # idle connection gets closed by the server
+            self.assertEquals(fp.read(), '')
+
+    def test_no_keep_alive_timeout(self):
+        sock = self._run_server(0)
+        fp = sock.makefile()
+        with Timeout(3):
+            self._request(fp)
+        try:
+            with Timeout(0.1):
+                fp.read(1)
+        except Timeout:
+            pass
+        else:
+            self.fail('connection was closed')
+        with Timeout(3):
+            self._request(fp)
+
+
 if __name__ == '__main__':
     unittest.main()
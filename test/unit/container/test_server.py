@@ -15,20 +15,22 @@
 
 import operator
 import os
+import time
 import unittest
 from contextlib import contextmanager
 from shutil import rmtree
 from StringIO import StringIO
 from tempfile import mkdtemp
 
-from eventlet import spawn, Timeout, listen
+from eventlet import spawn, Timeout, listen, sleep
 import simplejson
 
 from swift.common.swob import Request
+import swift.common.db
 import swift.container
 from swift.container import server as container_server
 from swift.common.utils import normalize_timestamp, mkdirs
-from test.unit import fake_http_connect
+from test.unit import fake_http_connect, FakeLogger
 
 
 @contextmanager
@@ -155,6 +157,80 @@ class TestContainerController(unittest.TestCase):
         resp = self.controller.PUT(req)
         self.assertEquals(resp.status_int, 202)
 
+    def test_PUT_obj_background_merge(self):
+        recon_dir = os.path.join(self.testdir, 'recon')
+        mkdirs(recon_dir)
+        controller = container_server.ContainerController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'background_merge': 'true', 'merge_interval': '0.01',
+             'merge_staleness': '60', 'recon_cache_path': recon_dir})
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        self.assertEquals(controller.PUT(req).status_int, 201)
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': '2', 'X-Size': '1',
+                     'X-Content-Type': 'text/plain', 'X-Etag': 'x'})
+        self.assertEquals(controller.PUT(req).status_int, 201)
+        broker = controller._get_container_broker('sda1', 'p', 'a', 'c')
+        self.assert_(controller.merger.queued_since('sda1', broker.db_file))
+        # reads leave the update to the merger
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = controller.HEAD(req)
+        self.assertEquals(resp.headers['X-Container-Object-Count'], '0')
+        sleep(0.5)
+        self.assertEquals(controller.merger.queues, {})
+        resp = controller.HEAD(req)
+        self.assertEquals(resp.headers['X-Container-Object-Count'], '1')
+        with open(os.path.join(recon_dir, 'container.recon')) as fp:
+            stats = simplejson.load(fp)['container_merge']
+        self.assertEquals(stats.keys(), ['sda1:%d' % os.getpid()])
+        stats = stats['sda1:%d' % os.getpid()]
+        self.assertEquals(stats['device'], 'sda1')
+        self.assertEquals(stats['merged'], 1)
+        self.assertEquals(stats['queue_depth'], 0)
+
+    def test_background_merge_stats_per_worker(self):
+        recon_cache = os.path.join(self.testdir, 'container.recon')
+        merger = container_server.PendingMerger(0, FakeLogger(), recon_cache)
+        now = time.time()
+        other = {'device': 'sda1', 'merged': 3, 'updated': now}
+        gone = {'device': 'sda1', 'merged': 4,
+                'updated': now - container_server.MERGE_STATS_TTL - 1}
+        with open(recon_cache, 'w') as fp:
+            simplejson.dump({'container_merge': {'sda1:1': other,
+                                                 'sda1:2': gone,
+                                                 'queue_depth': 5},
+                             'other_stat': 1}, fp)
+        merger._merge = lambda db_file: None
+        merger.schedule('sda1', 'db')
+        sleep(0.1)
+        with open(recon_cache) as fp:
+            cache = simplejson.load(fp)
+        # other workers' entries are kept, unless they are long stale
+        self.assertEquals(sorted(cache['container_merge']),
+                          sorted(['sda1:%d' % os.getpid(), 'sda1:1']))
+        self.assertEquals(cache['container_merge']['sda1:1'], other)
+        self.assertEquals(
+            cache['container_merge']['sda1:%d' % os.getpid()]['merged'], 1)
+        self.assertEquals(cache['other_stat'], 1)
+
+    def test_GET_merges_stale_pending(self):
+        controller = container_server.ContainerController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'background_merge': 'true', 'merge_staleness': '0'})
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': '1'})
+        controller.PUT(req)
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': '2', 'X-Size': '1',
+                     'X-Content-Type': 'text/plain', 'X-Etag': 'x'})
+        controller.PUT(req)
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'GET'})
+        resp = controller.GET(req)
+        self.assertEquals(resp.body, 'o\n')
+
     def test_PUT_obj_not_found(self):
         req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
             headers={'X-Timestamp': '1', 'X-Size': '0',
@@ -774,6 +850,44 @@ class TestContainerController(unittest.TestCase):
             self.assertEquals(resp.content_type, 'application/json',
                 'Invalid content_type for Accept: %s' % accept)
 
+    def test_GET_paged(self):
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT',
+                            'HTTP_X_TIMESTAMP': '0'})
+        self.controller.PUT(req)
+        for name in ('0', '1', 'd/0', 'd/1', 'd/2', 'e'):
+            req = Request.blank('/sda1/p/a/c/%s' % name, environ={
+                'REQUEST_METHOD': 'PUT', 'HTTP_X_TIMESTAMP': '1',
+                'HTTP_X_CONTENT_TYPE': 'text/plain', 'HTTP_X_ETAG': 'x',
+                'HTTP_X_SIZE': 0})
+            self.assertEquals(self.controller.PUT(req).status_int, 201)
+        queries = ('', '?format=json', '?format=xml', '?delimiter=/',
+                   '?format=json&delimiter=/', '?format=xml&delimiter=/',
+                   '?prefix=d/&limit=2', '?marker=0&limit=3')
+        bodies = {}
+        for query in queries:
+            req = Request.blank('/sda1/p/a/c' + query)
+            resp = self.controller.GET(req)
+            self.assertEquals(resp.content_length, len(resp.body))
+            bodies[query] = resp.body
+        orig_page_size = swift.common.db.LISTING_PAGE_SIZE
+        try:
+            swift.common.db.LISTING_PAGE_SIZE = \
+                container_server.LISTING_PAGE_SIZE = 2
+            for query in queries:
+                req = Request.blank('/sda1/p/a/c' + query)
+                resp = self.controller.GET(req)
+                self.assertEquals(resp.status_int, 200)
+                self.assertEquals(resp.body, bodies[query])
+            # a listing that needs several pages is streamed
+            req = Request.blank('/sda1/p/a/c?format=json')
+            resp = self.controller.GET(req)
+            self.assertEquals(resp.content_length, None)
+            self.assertEquals([o['name'] for o in simplejson.loads(
+                ''.join(resp.app_iter))], ['0', '1', 'd/0', 'd/1', 'd/2', 'e'])
+        finally:
+            swift.common.db.LISTING_PAGE_SIZE = \
+                container_server.LISTING_PAGE_SIZE = orig_page_size
+
     def test_GET_plain(self):
         # make a container
         req = Request.blank('/sda1/p/a/plainc', environ={'REQUEST_METHOD': 'PUT',
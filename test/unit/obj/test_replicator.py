@@ -16,6 +16,7 @@
 from __future__ import with_statement
 
 import unittest
+import json
 import os
 from gzip import GzipFile
 from shutil import rmtree
@@ -23,13 +24,17 @@ import cPickle as pickle
 import time
 import tempfile
 from contextlib import contextmanager
+from hashlib import md5
+from StringIO import StringIO
 from eventlet.green import subprocess
-from eventlet import Timeout, tpool
+from eventlet import GreenPool, Timeout, sleep, tpool
 from test.unit import FakeLogger, mock
 from swift.common import utils
 from swift.common.utils import hash_path, mkdirs, normalize_timestamp
 from swift.common import ring
+from swift.common.swob import HTTPBadRequest, Request
 from swift.obj import replicator as object_replicator
+from swift.obj import server as object_server
 from swift.obj.server import DiskFile
 
 
@@ -67,6 +72,67 @@ def mock_http_connect(status):
             return
     return lambda *args, **kwargs: FakeConn(status, *args, **kwargs)
 
+
+def controller_connect(controller, log):
+    """
+    Returns an http_connect and an http_connect_raw that hand the requests
+    made through them to an object controller, appending (method, path,
+    headers, body) to log.
+    """
+
+    class FakeSock(object):
+
+        def setsockopt(self, *args):
+            pass
+
+    class FakeConn(object):
+
+        def __init__(self, method, path, headers):
+            self.method = method
+            self.path = path
+            self.headers = dict((k, str(v))
+                                for k, v in (headers or {}).iteritems())
+            self.sent = []
+            self.sock = FakeSock()
+
+        def send(self, data):
+            self.sent.append(data)
+
+        def getresponse(self):
+            body = ''.join(self.sent)
+            log.append((self.method, self.path, dict(self.headers), body))
+            if self.headers.pop('Transfer-Encoding', None) == 'chunked':
+                chunks = []
+                while True:
+                    size, body = body.split('\r\n', 1)
+                    size = int(size, 16)
+                    if not size:
+                        break
+                    chunks.append(body[:size])
+                    body = body[size + 2:]
+                body = ''.join(chunks)
+            req = Request.blank(self.path, headers=self.headers, body=body,
+                                environ={'REQUEST_METHOD': self.method})
+            resp = req.get_response(controller)
+            self.status = resp.status_int
+            self.body = StringIO(resp.body)
+            return self
+
+        def read(self, amt=-1):
+            return self.body.read(amt)
+
+        def close(self):
+            pass
+
+    def connect(ip, port, device, partition, method, path, headers=None,
+                pool=None):
+        return FakeConn(method, '/%s/%s%s' % (device, partition, path),
+                        headers)
+
+    def connect_raw(ip, port, method, path, headers=None, pool=None):
+        return FakeConn(method, path, headers)
+    return connect, connect_raw
+
 process_errors = []
 
 
@@ -103,7 +169,7 @@ def _mock_process(ret):
     object_replicator.subprocess.Popen = orig_process
 
 
-def _create_test_ring(path):
+def _create_test_ring(path, extra_devs=()):
     testgz = os.path.join(path, 'object.ring.gz')
     intended_replica2part2dev_id = [
         [0, 1, 2, 3, 4, 5, 6],
@@ -120,7 +186,7 @@ def _create_test_ring(path):
          'ip': 'fe80::202:b3ff:fe1e:8329', 'port': 6000},
         {'id': 6, 'device': 'sda', 'zone': 7,
          'ip': '2001:0db8:85a3:0000:0000:8a2e:0370:7334', 'port': 6000},
-        ]
+        ] + list(extra_devs)
     intended_part_shift = 30
     intended_reload_time = 15
     pickle.dump(ring.RingData(intended_replica2part2dev_id,
@@ -150,7 +216,7 @@ class TestObjectReplicator(unittest.TestCase):
         self.ring = _create_test_ring(self.testdir)
         self.conf = dict(
             swift_dir=self.testdir, devices=self.devices, mount_check='false',
-            timeout='300', stats_interval='1')
+            timeout='300', stats_interval='1', recon_cache_path=self.testdir)
         self.replicator = object_replicator.ObjectReplicator(
             self.conf)
         self.replicator.logger = FakeLogger()
@@ -229,10 +295,11 @@ class TestObjectReplicator(unittest.TestCase):
         part = os.path.join(self.objects, '0')
         hashed, hashes = object_replicator.get_hashes(part)
         i = [0]
-        def getmtime(filename):
+
+        def version(filename):
             i[0] += 1
             return 1
-        with mock({'os.path.getmtime': getmtime}):
+        with mock({'swift.obj.replicator._hashes_file_version': version}):
             hashed, hashes = object_replicator.get_hashes(
                 part, recalculate=['a83'])
         self.assertEquals(i[0], 2)
@@ -244,18 +311,20 @@ class TestObjectReplicator(unittest.TestCase):
         open(os.path.join(part, object_replicator.HASH_FILE), 'w')
         # Now the hash file is zero bytes.
         i = [0]
-        def getmtime(filename):
+
+        def version(filename):
             i[0] += 1
             return 1
-        with mock({'os.path.getmtime': getmtime}):
+        with mock({'swift.obj.replicator._hashes_file_version': version}):
             hashed, hashes = object_replicator.get_hashes(
                 part, recalculate=[])
-        # getmtime will actually not get called.  Initially, the pickle.load
-        # will raise an exception first and later, force_rewrite will
-        # short-circuit the if clause to determine whether to write out a fresh
-        # hashes_file.
-        self.assertEquals(i[0], 0)
+        # The pickle.load raises, so every suffix is listed and hashed, and
+        # as nobody rewrote the file meanwhile a fresh hashes_file replaces
+        # it.
+        self.assertEquals(i[0], 2)
         self.assertTrue('a83' in hashes)
+        with open(os.path.join(part, object_replicator.HASH_FILE)) as fp:
+            self.assertEquals(pickle.load(fp), hashes)
 
     def test_get_hashes_modified(self):
         df = DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o', FakeLogger())
@@ -266,11 +335,12 @@ class TestObjectReplicator(unittest.TestCase):
         part = os.path.join(self.objects, '0')
         hashed, hashes = object_replicator.get_hashes(part)
         i = [0]
-        def getmtime(filename):
+
+        def version(filename):
             if i[0] < 3:
                 i[0] += 1
             return i[0]
-        with mock({'os.path.getmtime': getmtime}):
+        with mock({'swift.obj.replicator._hashes_file_version': version}):
             hashed, hashes = object_replicator.get_hashes(
                 part, recalculate=['a83'])
         self.assertEquals(i[0], 3)
@@ -308,7 +378,8 @@ class TestObjectReplicator(unittest.TestCase):
         data_dir = ohash[-3:]
         whole_path_from = os.path.join(self.objects, '0', data_dir)
         object_replicator.hash_suffix(whole_path_from, 101)
-        self.assertEquals(len(os.listdir(self.parts['0'])), 1)
+        self.assertEquals(sorted(os.listdir(self.parts['0'])),
+                          [data_dir, data_dir + object_replicator.LISTING_EXT])
 
         object_replicator.hash_suffix(whole_path_from, 99)
         self.assertEquals(len(os.listdir(self.parts['0'])), 0)
@@ -358,31 +429,444 @@ class TestObjectReplicator(unittest.TestCase):
         # only the meta and data should be left
         self.assertEquals(len(os.listdir(whole_hsh_path)), 2)
 
-    def test_invalidate_hash(self):
+    def test_current_files(self):
+        self.assertEquals(object_replicator.current_files([]), [])
+        self.assertEquals(
+            object_replicator.current_files(['1.data', '3.meta', '2.meta']),
+            ['3.meta', '1.data'])
+        self.assertEquals(
+            object_replicator.current_files(['1.data', '2.ts', '3.meta']),
+            ['2.ts'])
+        self.assertEquals(
+            object_replicator.current_files(['1.meta', '2.data', '1.ts']),
+            ['2.data'])
+
+    def test_missing_files(self):
+        part = self.parts['0']
+        for hsh, files in (('a' * 29 + 'abc', ['2.ts']),
+                           ('b' * 29 + 'abc', ['1.data'])):
+            mkdirs(os.path.join(part, 'abc', hsh))
+            for filename in files:
+                open(os.path.join(part, 'abc', hsh, filename), 'wb').close()
+        names = ['abc/%s/1.data' % ('a' * 29 + 'abc'),
+                 'abc/%s/3.meta' % ('a' * 29 + 'abc'),
+                 'abc/%s/1.data' % ('b' * 29 + 'abc'),
+                 'abc/%s/3.meta' % ('b' * 29 + 'abc'),
+                 'abc/%s/2.meta' % ('b' * 29 + 'abc'),
+                 'abc/%s/4.data' % ('c' * 29 + 'abc'),
+                 'def/%s/5.ts' % ('c' * 29 + 'def')]
+        self.assertEquals(
+            sorted(object_replicator.missing_files(part, names)),
+            ['abc/%s/3.meta' % ('b' * 29 + 'abc'),
+             'abc/%s/4.data' % ('c' * 29 + 'abc'),
+             'def/%s/5.ts' % ('c' * 29 + 'def')])
+
+    def test_sync_method(self):
+        self.assertEquals(self.replicator.sync_method, 'rsync')
+        conf = dict(self.conf, sync_method='HTTP')
+        replicator = object_replicator.ObjectReplicator(conf)
+        self.assertEquals(replicator.sync_method, 'http')
+        conf['sync_method'] = 'scp'
+        self.assertRaises(ValueError, object_replicator.ObjectReplicator,
+                          conf)
+
+    def _put_object(self, devices, partition, obj, timestamp, body):
+        df = DiskFile(devices, 'sda', partition, 'a', 'c', obj, FakeLogger())
+        mkdirs(df.datadir)
+        with df.mkstemp() as fd:
+            os.write(fd, body)
+            df.put(fd, {'X-Timestamp': normalize_timestamp(timestamp),
+                        'Content-Length': str(len(body)),
+                        'ETag': md5(body).hexdigest(),
+                        'Content-Type': 'text/plain'})
+        return df
+
+    def test_http_sync_handoff(self):
+        remote = os.path.join(self.testdir, 'remote')
+        mkdirs(os.path.join(remote, 'sda'))
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'false'})
+        # o1 is already there, o2 is superseded by a newer tombstone
+        now = time.time()
+        self._put_object(self.devices, '1', 'o1', now - 5, 'one')
+        self._put_object(remote, '1', 'o1', now - 5, 'one')
+        tomb = DiskFile(remote, 'sda', '1', 'a', 'c', 'o2', FakeLogger())
+        mkdirs(tomb.datadir)
+        tomb.put_metadata({'X-Timestamp': normalize_timestamp(now - 1)},
+                          tombstone=True)
+        self._put_object(self.devices, '1', 'o2', now - 4, 'two')
+        self._put_object(self.devices, '1', 'o3', now - 3, 'three' * 30000)
+        log = []
+        conf = dict(self.conf, sync_method='http')
+        replicator = object_replicator.ObjectReplicator(conf)
+        replicator.logger = FakeLogger()
+        with mock({'swift.obj.replicator.http_connect':
+                   controller_connect(controller, log)[0]}):
+            replicator.replicate(override_partitions=['1'])
+        self.assertFalse(os.path.exists(os.path.join(self.objects, '1')))
+        # no rsync and no REPLICATE calls, just a check and an update for
+        # each of the three nodes
+        self.assertEquals([entry[0] for entry in log],
+                          ['SYNC'] * 6)
+        self.assertEquals([entry[2].get('X-Sync-Phase') for entry in log],
+                          ['check', None] * 3)
+        remote_part = os.path.join(remote, 'sda', 'objects', '1')
+        self.assertEquals(
+            sorted(suffix for suffix in os.listdir(remote_part)
+                   if len(suffix) == 3),
+            sorted(hash_path('a', 'c', o)[-3:] for o in ('o1', 'o2', 'o3')))
+        df = DiskFile(remote, 'sda', '1', 'a', 'c', 'o3', FakeLogger(),
+                      keep_data_fp=True)
+        self.assertEquals(df.metadata['ETag'],
+                          md5('three' * 30000).hexdigest())
+        self.assertEquals(''.join(df), 'three' * 30000)
+        df = DiskFile(remote, 'sda', '1', 'a', 'c', 'o2', FakeLogger())
+        self.assertTrue(df.is_deleted())
+        self.assertEquals(os.listdir(df.datadir),
+                          [normalize_timestamp(now - 1) + '.ts'])
+        # the remote hashes are up to date
+        self.assertEquals(
+            object_replicator.get_hashes(remote_part)[0], 0)
+
+    def test_http_sync_failure(self):
+        remote = os.path.join(self.testdir, 'remote')
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'true'})
+        self._put_object(self.devices, '1', 'o1', 1, 'one')
+        log = []
+        conf = dict(self.conf, sync_method='http')
+        replicator = object_replicator.ObjectReplicator(conf)
+        replicator.logger = FakeLogger()
+        with mock({'swift.obj.replicator.http_connect':
+                   controller_connect(controller, log)[0]}):
+            replicator.replicate(override_partitions=['1'])
+        self.assertTrue(os.path.exists(os.path.join(self.objects, '1')))
+        self.assertEquals(len(log), 3)
+        self.assertEquals(len(replicator.logger.log_dict['error']), 3)
+
+    def _batch_replicate(self, app, **conf):
+        log = []
+        connect, connect_raw = controller_connect(app, log)
+        for partition in ('0', '2', '3'):
+            self._put_object(self.devices, partition, 'o' + partition,
+                             time.time(), 'x')
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, replicate_batch_size='8', **conf))
+        replicator.logger = FakeLogger()
+        with mock({'swift.obj.replicator.http_connect': connect,
+                   'swift.obj.replicator.http_connect_raw': connect_raw}):
+            replicator.replicate()
+        return replicator, log
+
+    def _remote_partitions(self):
+        remote_partitions = {}
+        for partition in ('0', '2', '3'):
+            for node in self.ring.get_part_nodes(int(partition)):
+                if node['id']:
+                    remote_partitions.setdefault(node['id'], []).append(
+                        partition)
+        return sorted(remote_partitions.values())
+
+    def test_replicate_batch(self):
+        remote = os.path.join(self.testdir, 'remote')
+        mkdirs(os.path.join(remote, 'sda'))
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'false'})
+        replicator, log = self._batch_replicate(controller,
+                                                sync_method='http')
+        replicates = [entry for entry in log if entry[0] == 'REPLICATE']
+        # one request per remote device, none per partition
+        self.assertEquals([entry[1] for entry in replicates],
+                          ['/sda'] * len(replicates))
+        self.assertEquals(
+            sorted(sorted(line.split()[0] for line in entry[3].splitlines())
+                   for entry in replicates),
+            self._remote_partitions())
+        for partition in ('0', '2', '3'):
+            df = DiskFile(remote, 'sda', partition, 'a', 'c', 'o' + partition,
+                          FakeLogger())
+            self.assertFalse(df.is_deleted())
+        self.assertFalse(replicator.logger.log_dict['exception'])
+
+    def test_replicate_batch_old_server(self):
+        remote = os.path.join(self.testdir, 'remote')
+        mkdirs(os.path.join(remote, 'sda'))
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'false'})
+
+        def old_server(env, start_response):
+            if env['REQUEST_METHOD'] == 'REPLICATE' and \
+                    env['PATH_INFO'].count('/') == 1:
+                return HTTPBadRequest()(env, start_response)
+            return controller(env, start_response)
+
+        replicator, log = self._batch_replicate(old_server,
+                                                sync_method='http')
+        # each partition falls back to its own REPLICATE
+        replicates = [entry[1] for entry in log if entry[0] == 'REPLICATE'
+                      and entry[1] != '/sda']
+        self.assertEquals(
+            sorted(replicates),
+            sorted('/sda/%s' % partition
+                   for partitions in self._remote_partitions()
+                   for partition in partitions))
+        for partition in ('0', '2', '3'):
+            df = DiskFile(remote, 'sda', partition, 'a', 'c', 'o' + partition,
+                          FakeLogger())
+            self.assertFalse(df.is_deleted())
+
+    def test_replicate_batch_recalculate(self):
+        remote = os.path.join(self.testdir, 'remote')
+        mkdirs(os.path.join(remote, 'sda'))
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'false'})
+        with mock({'swift.obj.replicator.ObjectReplicator.rsync':
+                   lambda *args: True}):
+            replicator, log = self._batch_replicate(controller)
+        replicates = [entry for entry in log if entry[0] == 'REPLICATE']
+        self.assertEquals([entry[1] for entry in replicates],
+                          ['/sda'] * len(replicates))
+        # rsynced suffixes are recalculated in batches too
+        recalculated = sorted(
+            sorted(line for line in entry[3].splitlines())
+            for entry in replicates if ' ' in entry[3])
+        self.assertEquals(
+            recalculated,
+            sorted(sorted('%s %s' % (partition,
+                                     hash_path('a', 'c', 'o' + partition)[-3:])
+                          for partition in partitions)
+                   for partitions in self._remote_partitions()))
 
-        def assertFileData(file_path, data):
-            with open(file_path, 'r') as fp:
-                fdata = fp.read()
-                self.assertEquals(pickle.loads(fdata), pickle.loads(data))
+    def _queue_recalculations(self, batch_size, partitions):
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, replicate_batch_size=batch_size,
+                 replicate_batch_interval='0.01'))
+        replicator.recalculations = {}
+        replicator.recalculate_pool = GreenPool()
+        sent = []
+        replicator._recalculate_batch = \
+            lambda node, batch: sent.append((node['id'], batch))
+        for partition in partitions:
+            replicator.recalculate_remote({'id': 1}, {'partition': partition},
+                                          ['abc'])
+        return replicator, sent
+
+    def test_recalculate_remote_sends_partial_batch(self):
+        replicator, sent = self._queue_recalculations('8', ['0', '2'])
+        sleep()
+        self.assertEquals(sent, [])
+        # a batch that does not fill up goes out after the interval anyway
+        sleep(0.1)
+        self.assertEquals(sent, [(1, [('0', ['abc']), ('2', ['abc'])])])
+        self.assertEquals(replicator.recalculations, {})
+
+    def test_recalculate_remote_sends_full_batch(self):
+        replicator, sent = self._queue_recalculations('2', ['0', '2', '3'])
+        sleep()
+        self.assertEquals(sent, [(1, [('0', ['abc']), ('2', ['abc'])])])
+        sleep(0.1)
+        self.assertEquals(sent, [(1, [('0', ['abc']), ('2', ['abc'])]),
+                                 (1, [('3', ['abc'])])])
+        replicator.flush_recalculations()
+        self.assertEquals(len(sent), 2)
+
+    def test_flush_recalculations(self):
+        replicator, sent = self._queue_recalculations('8', ['0'])
+        replicator.flush_recalculations()
+        self.assertEquals(sent, [(1, [('0', ['abc'])])])
+        sleep(0.1)
+        self.assertEquals(len(sent), 1)
+
+    def test_hash_suffix_rebuilds_index(self):
+        df = DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o', FakeLogger())
+        mkdirs(df.datadir)
+        ohash = hash_path('a', 'c', 'o')
+        suffix_dir = os.path.join(self.objects, '0', ohash[-3:])
+        past = int(time.time()) - 10
+        ts1 = normalize_timestamp(1) + '.data'
+        open(os.path.join(df.datadir, ts1), 'wb').close()
+        os.utime(df.datadir, (past, past))
+        # an unindexed suffix doesn't get an index
+        object_replicator.hash_suffix(suffix_dir, 101)
+        self.assertEquals(object_replicator.read_suffix_index(suffix_dir),
+                          None)
+        object_replicator.request_suffix_index(suffix_dir)
+        self.assertEquals(object_replicator.read_suffix_index(suffix_dir),
+                          {})
+        self.assertEquals(object_replicator.read_hash_journal(
+            os.path.join(self.objects, '0'))[0], {ohash[-3:]: None})
+        object_replicator.hash_suffix(suffix_dir, 101)
+        self.assertEquals(object_replicator.read_suffix_index(suffix_dir),
+                          {ohash: (past, [ts1])})
+        # a hash dir that changed within the grace period is left out until
+        # the next rehash
+        ts2 = normalize_timestamp(2) + '.data'
+        open(os.path.join(df.datadir, ts2), 'wb').close()
+        object_replicator.hash_suffix(suffix_dir, 101)
+        self.assertEquals(object_replicator.read_suffix_index(suffix_dir),
+                          {})
+        os.utime(df.datadir, (past, past))
+        object_replicator.hash_suffix(suffix_dir, 101)
+        self.assertEquals(object_replicator.read_suffix_index(suffix_dir),
+                          {ohash: (past, [ts2])})
+        # once the suffix is gone, so is its index
+        rmtree(df.datadir)
+        object_replicator.hash_suffix(suffix_dir, 101)
+        self.assertFalse(os.path.exists(
+            suffix_dir + object_replicator.INDEX_EXT))
+
+    def test_get_indexed_files_checks_mtime(self):
+        df = DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o', FakeLogger())
+        mkdirs(df.datadir)
+        suffix_dir = os.path.dirname(df.datadir)
+        ohash = os.path.basename(df.datadir)
+        # asking a suffix without an index requests one
+        self.assertEquals(object_replicator.get_indexed_files(df.datadir),
+                          None)
+        self.assertEquals(object_replicator.read_suffix_index(suffix_dir),
+                          {})
+        mtime = os.stat(df.datadir).st_mtime
+        object_replicator.write_suffix_index(
+            suffix_dir, {ohash: (mtime, ['1.data'])})
+        self.assertEquals(object_replicator.get_indexed_files(df.datadir),
+                          ['1.data'])
+        # anything that changes the hash dir, rsync included, makes the
+        # entry stale
+        os.utime(df.datadir, (mtime - 10, mtime - 10))
+        self.assertEquals(object_replicator.get_indexed_files(df.datadir),
+                          None)
+        rmtree(df.datadir)
+        self.assertEquals(object_replicator.get_indexed_files(df.datadir),
+                          None)
 
+    def test_invalidate_hash(self):
         df = DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o', FakeLogger())
         mkdirs(df.datadir)
         ohash = hash_path('a', 'c', 'o')
         data_dir = ohash[-3:]
-        whole_path_from = os.path.join(self.objects, '0', data_dir)
-        hashes_file = os.path.join(self.objects, '0',
-                                   object_replicator.HASH_FILE)
-        # test that non existent file except caught
-        self.assertEquals(object_replicator.invalidate_hash(whole_path_from),
-                          None)
-        # test that hashes get cleared
-        check_pickle_data = pickle.dumps({data_dir: None},
-                                         object_replicator.PICKLE_PROTOCOL)
-        for data_hash in [{data_dir: None}, {data_dir: 'abcdefg'}]:
-            with open(hashes_file, 'wb') as fp:
-                pickle.dump(data_hash, fp, object_replicator.PICKLE_PROTOCOL)
-            object_replicator.invalidate_hash(whole_path_from)
-            assertFileData(hashes_file, check_pickle_data)
+        part = os.path.join(self.objects, '0')
+        whole_path_from = os.path.join(part, data_dir)
+        hashes_file = os.path.join(part, object_replicator.HASH_FILE)
+        journal_file = os.path.join(part, object_replicator.HASH_JOURNAL)
+        with open(hashes_file, 'wb') as fp:
+            pickle.dump({data_dir: 'abcdefg'}, fp,
+                        object_replicator.PICKLE_PROTOCOL)
+        object_replicator.invalidate_hash(whole_path_from)
+        object_replicator.invalidate_hash(whole_path_from, ohash)
+        # the hashes file is left alone, invalidations are only journaled
+        with open(hashes_file, 'rb') as fp:
+            self.assertEquals(pickle.load(fp), {data_dir: 'abcdefg'})
+        with open(journal_file, 'rb') as fp:
+            self.assertEquals(fp.read(),
+                              '%s\n%s/%s\n' % (data_dir, data_dir, ohash))
+        self.assertEquals(object_replicator.read_hash_journal(part),
+                          ({data_dir: None}, 9 + len(ohash)))
+        hashed, hashes = object_replicator.get_hashes(part)
+        self.assertEquals(hashed, 1)
+        self.assertNotEquals(hashes[data_dir], 'abcdefg')
+        with open(journal_file, 'rb') as fp:
+            self.assertEquals(fp.read(), '')
+
+    def test_read_hash_journal(self):
+        part = os.path.join(self.objects, '0')
+        mkdirs(part)
+        self.assertEquals(object_replicator.read_hash_journal(part), ({}, 0))
+        with open(os.path.join(part, object_replicator.HASH_JOURNAL),
+                  'wb') as fp:
+            fp.write('abc/h1\nabc/h2\ndef\ndef/h3\nabc/h')
+        self.assertEquals(object_replicator.read_hash_journal(part),
+                          ({'abc': set(['h1', 'h2']), 'def': None}, 25))
+        object_replicator.compact_hash_journal(part, 14)
+        self.assertEquals(object_replicator.read_hash_journal(part),
+                          ({'def': None}, 11))
+
+    def test_invalidate_hash_syncs(self):
+        synced = []
+        part = os.path.join(self.objects, '0')
+        mkdirs(os.path.join(part, 'abc'))
+        with mock({'swift.obj.replicator.fdatasync': synced.append}):
+            object_replicator.invalidate_hash(os.path.join(part, 'abc'))
+        self.assertEquals(len(synced), 1)
+        self.assertEquals(object_replicator.read_hash_journal(part),
+                          ({'abc': None}, 4))
+
+    def test_compact_hash_journal_replaces_journal(self):
+        part = os.path.join(self.objects, '0')
+        mkdirs(part)
+        journal_file = os.path.join(part, object_replicator.HASH_JOURNAL)
+        with open(journal_file, 'wb') as fp:
+            fp.write('abc\ndef\n')
+        inode = os.stat(journal_file).st_ino
+        object_replicator.compact_hash_journal(part, 4)
+        self.assertNotEquals(os.stat(journal_file).st_ino, inode)
+        self.assertEquals(object_replicator.read_hash_journal(part),
+                          ({'def': None}, 4))
+        self.assertEquals(os.listdir(part), [object_replicator.HASH_JOURNAL])
+        object_replicator.compact_hash_journal(part, 4)
+        self.assertEquals(os.path.getsize(journal_file), 0)
+
+    def test_get_hashes_keeps_entries_journaled_by_others(self):
+        part = os.path.join(self.objects, '0')
+        for suffix in ('abc', 'def'):
+            mkdirs(os.path.join(part, suffix))
+        object_replicator.invalidate_hash(os.path.join(part, 'abc'))
+        lock_path = object_replicator.lock_path
+        calls = []
+
+        @contextmanager
+        def racing_lock_path(directory):
+            if not calls:
+                calls.append(directory)
+                # once this one has hashed everything with no hashes file to
+                # go by, another rewrites the hashes file and compacts the
+                # journal, and then a suffix is invalidated again
+                object_replicator.get_hashes(part)
+                hash_dir = os.path.join(part, 'def', 'a' * 29 + 'def')
+                mkdirs(hash_dir)
+                with open(os.path.join(hash_dir, normalize_timestamp(
+                        time.time()) + '.data'), 'wb'):
+                    pass
+                object_replicator.invalidate_hash(os.path.join(part, 'def'))
+            with lock_path(directory):
+                yield
+
+        with mock({'swift.obj.replicator.lock_path': racing_lock_path}):
+            object_replicator.get_hashes(part)
+        self.assertEquals(len(calls), 1)
+        hashed, hashes = object_replicator.get_hashes(part)
+        self.assertEquals(hashes['def'], object_replicator.hash_suffix(
+            os.path.join(part, 'def'), 604800))
+
+    def test_get_hashes_incremental(self):
+        part = os.path.join(self.objects, '0')
+        suffix_dir = os.path.join(part, 'abc')
+        ts = normalize_timestamp(time.time())
+        for hsh in ('a' * 29 + 'abc', 'b' * 29 + 'abc'):
+            mkdirs(os.path.join(suffix_dir, hsh))
+            with open(os.path.join(suffix_dir, hsh, ts + '.data'), 'wb'):
+                pass
+        hashed, hashes = object_replicator.get_hashes(part)
+        self.assertEquals(hashed, 1)
+        # an object changes; only its hash dir gets listed again
+        hash_dir = os.path.join(suffix_dir, 'b' * 29 + 'abc')
+        new_ts = normalize_timestamp(time.time() + 1)
+        with open(os.path.join(hash_dir, new_ts + '.ts'), 'wb'):
+            pass
+        object_replicator.invalidate_hash(suffix_dir, 'b' * 29 + 'abc')
+        listed = []
+        orig_listdir = os.listdir
+
+        def listdir(path):
+            listed.append(path)
+            return orig_listdir(path)
+
+        with mock({'os.listdir': listdir}):
+            hashed, hashes = object_replicator.get_hashes(part)
+        self.assertEquals(hashed, 1)
+        self.assertEquals(listed, [hash_dir])
+        self.assertEquals(os.listdir(hash_dir), [new_ts + '.ts'])
+        self.assertEquals(hashes['abc'], object_replicator.hash_suffix(
+            suffix_dir, object_replicator.ONE_WEEK))
 
     def test_check_ring(self):
         self.assertTrue(self.replicator.check_ring())
@@ -440,6 +924,27 @@ class TestObjectReplicator(unittest.TestCase):
             self.assertEquals(jobs_by_part[part]['path'],
                               os.path.join(self.objects, part))
 
+    def test_collect_jobs_priority(self):
+        for part in ['0', '2', '3']:
+            utils.write_pickle({}, os.path.join(
+                self.parts[part], object_replicator.HASH_FILE))
+        with open(os.path.join(self.parts['3'],
+                               object_replicator.HASH_JOURNAL), 'w') as fp:
+            fp.write('abc\n')
+        self.replicator.last_failed_nodes = set([2])
+        jobs = self.replicator.collect_jobs()
+        self.assertEquals([job['class'] for job in jobs],
+                          ['handoff', 'degraded', 'degraded', 'changed'])
+        self.assertEquals([job['partition'] for job in jobs][::3],
+                          ['1', '3'])
+        self.replicator.last_failed_nodes = set()
+        os.unlink(os.path.join(self.parts['2'], object_replicator.HASH_FILE))
+        jobs = self.replicator.collect_jobs()
+        self.assertEquals(
+            [job['class'] for job in jobs],
+            ['handoff', 'changed', 'changed', 'normal'])
+        self.assertEquals(jobs[-1]['partition'], '0')
+
     def test_collect_jobs_removes_zbf(self):
         """
         After running xfs_repair, a partition directory could become a
@@ -604,6 +1109,146 @@ class TestObjectReplicator(unittest.TestCase):
             object_replicator.get_hashes = was_get_hashes
             tpool.execute = was_execute
 
+    def _record_jobs(self, replicator):
+        self.running = []
+        self.ran = []
+        self.max_running = 0
+
+        def fake_update(job):
+            self.running.append(job['partition'])
+            self.max_running = max(self.max_running, len(self.running))
+            sleep(0.01)
+            self.running.remove(job['partition'])
+            self.ran.append(job['partition'])
+        replicator.update = replicator.update_deleted = fake_update
+
+    def test_replicate_handoffs_first(self):
+        self._record_jobs(self.replicator)
+        self.replicator.replicate()
+        self.assertEquals(self.ran[0], '1')
+        self.assertEquals(sorted(self.ran), ['0', '1', '2', '3'])
+        with open(os.path.join(self.testdir, 'object.recon')) as fp:
+            progress = json.load(fp)['object_replication_progress']
+        self.assertEquals(progress['handoff'], {'total': 1, 'done': 1})
+        self.assertEquals(sum(job_class['done']
+                              for job_class in progress.itervalues()), 4)
+
+    def test_replicate_device_concurrency(self):
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, concurrency='4'))
+        self._record_jobs(replicator)
+        replicator.replicate()
+        self.assertEquals(self.max_running, 4)
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, concurrency='4', device_concurrency='2'))
+        self._record_jobs(replicator)
+        replicator.replicate()
+        self.assertEquals(self.max_running, 2)
+        self.assertEquals(sorted(self.ran), ['0', '1', '2', '3'])
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, concurrency='4', device_concurrency='0'))
+        self._record_jobs(replicator)
+        with Timeout(5):
+            replicator.replicate()
+        self.assertEquals(self.max_running, 1)
+        self.assertEquals(sorted(self.ran), ['0', '1', '2', '3'])
+
+    def test_replicate_failed_nodes(self):
+        for part in ['0', '2', '3']:
+            self._put_object(self.devices, part, 'o' + part, time.time(),
+                             'x')
+        with mock({'swift.obj.replicator.http_connect':
+                   mock_http_connect(500)}):
+            self.replicator.replicate(override_partitions=['0'])
+        # partition 0 is on nodes 1 and 2
+        self.assertEquals(self.replicator.failed_nodes, set([1, 2]))
+        jobs = self.replicator.collect_jobs()
+        self.assertEquals([job['class'] for job in jobs],
+                          ['handoff', 'degraded', 'degraded', 'degraded'])
+        self.replicator.rsync = lambda *args: True
+        with mock({'swift.obj.replicator.http_connect':
+                   mock_http_connect(200)}):
+            self.replicator.replicate(override_partitions=['0'])
+        self.assertEquals(self.replicator.last_failed_nodes, set([1, 2]))
+        self.assertEquals(self.replicator.failed_nodes, set())
+
+    def test_replicate_workers(self):
+        # a second local device, with handoffs only
+        _create_test_ring(self.testdir, [
+            {'id': 7, 'device': 'sdb', 'zone': 8, 'ip': '127.0.0.0',
+             'port': 6000}])
+        for part in ['0', '1']:
+            os.makedirs(os.path.join(self.devices, 'sdb', 'objects', part))
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, replicator_workers='4'))
+        replicator.logger = FakeLogger()
+        log_path = os.path.join(self.testdir, 'jobs')
+
+        def fake_update(job):
+            replicator.replication_count += 1
+            replicator.partition_times.append(0.1)
+            if job['device'] == 'sdb':
+                replicator.failed_nodes.add(job['nodes'][0]['id'])
+            with open(log_path, 'a') as fp:
+                fp.write('%s %s %d\n' % (job['device'], job['partition'],
+                                         os.getpid()))
+        replicator.update = replicator.update_deleted = fake_update
+        replicator.replicate()
+        with open(log_path) as fp:
+            jobs = [line.split() for line in fp]
+        self.assertEquals(
+            sorted((device, part) for device, part, pid in jobs),
+            [('sda', '0'), ('sda', '1'), ('sda', '2'), ('sda', '3'),
+             ('sdb', '0'), ('sdb', '1')])
+        # one worker for each device
+        pids = {}
+        for device, part, pid in jobs:
+            pids.setdefault(device, set()).add(pid)
+        self.assertEquals([len(device_pids) for device_pids in
+                           pids.itervalues()], [1, 1])
+        self.assertNotEquals(pids['sda'], pids['sdb'])
+        self.assertFalse(str(os.getpid()) in pids['sda'] | pids['sdb'])
+        # with their stats added up in the parent
+        self.assertEquals(replicator.replication_count, 6)
+        self.assertEquals(replicator.job_count, 6)
+        self.assertEquals(replicator.partition_times, [0.1] * 6)
+        self.assertEquals(replicator.job_progress['handoff'],
+                          {'total': 3, 'done': 3})
+        self.assertEquals(replicator.failed_nodes, set([0, 1]))
+        with open(os.path.join(self.testdir, 'object.recon')) as fp:
+            progress = json.load(fp)['object_replication_progress']
+        self.assertEquals(progress['handoff'], {'total': 3, 'done': 3})
+
+    def test_replicate_workers_dump_progress_as_they_go(self):
+        _create_test_ring(self.testdir, [
+            {'id': 7, 'device': 'sdb', 'zone': 8, 'ip': '127.0.0.0',
+             'port': 6000}])
+        for part in ['0', '1']:
+            os.makedirs(os.path.join(self.devices, 'sdb', 'objects', part))
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, replicator_workers='4'))
+        replicator.logger = FakeLogger()
+
+        def fake_update(job):
+            # what the workers' heartbeats do every stats_interval
+            replicator.dump_progress()
+            sleep(0.05)
+        replicator.update = replicator.update_deleted = fake_update
+        dumps = []
+
+        def fake_dump_recon_cache(cache_dict, cache_file, logger):
+            progress = cache_dict['object_replication_progress']
+            dumps.append(sum(p['done'] for p in progress.itervalues()))
+        with mock({'swift.obj.replicator.dump_recon_cache':
+                   fake_dump_recon_cache}):
+            replicator.replicate()
+        # the parent wrote out what the workers had done so far while they
+        # were working, and what they all did at the end
+        self.assertEquals(len(dumps), 7)
+        self.assertEquals(dumps[0], 0)
+        self.assertEquals(dumps[-1], 6)
+        self.assertEquals(dumps, sorted(dumps))
+
     def test_run(self):
         with _mock_process([(0, '')] * 100):
             self.replicator.replicate()
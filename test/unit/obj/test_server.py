@@ -16,8 +16,10 @@
 """ Tests for swift.object_server """
 
 import cPickle as pickle
+import errno
 import operator
 import os
+import struct
 import unittest
 import email
 from shutil import rmtree
@@ -27,11 +29,12 @@ from tempfile import mkdtemp
 from hashlib import md5
 
 from eventlet import sleep, spawn, wsgi, listen, Timeout
-from test.unit import FakeLogger
+from test.unit import FakeLogger, mock
 from test.unit import _getxattr as getxattr
 from test.unit import _setxattr as setxattr
 from test.unit import connect_tcp, readuntil2crlfs
 from swift.obj import server as object_server
+from swift.obj import replicator
 from swift.common import utils
 from swift.common.utils import hash_path, mkdirs, normalize_timestamp, \
                                NullLogger, storage_directory
@@ -41,6 +44,106 @@ from eventlet import tpool
 from swift.common.swob import Request
 
 
+class TestMetadata(unittest.TestCase):
+    """Test swift.obj.server metadata helpers"""
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_encode_decode(self):
+        metadata = {'name': '/a/c/o', 'X-Timestamp': 1300000000.12345,
+                    'Content-Length': 10, 'deleted': True,
+                    'X-Object-Meta-Uni': u'\u2603', 'ETag': ''}
+        self.assertEquals(
+            object_server.decode_metadata(
+                object_server.encode_metadata(metadata)),
+            metadata)
+
+    def test_encode_unsupported(self):
+        self.assertRaises(TypeError, object_server.encode_metadata,
+                          {'a': ['list']})
+        self.assertRaises(TypeError, object_server.encode_metadata,
+                          {u'a': 'b'})
+
+    def test_decode_bad_version_and_truncated(self):
+        metastr = object_server.encode_metadata({'a': 'b'})
+        self.assertRaises(ValueError, object_server.decode_metadata,
+                          metastr[:-1])
+        self.assertRaises(ValueError, object_server.decode_metadata,
+                          metastr[:3] + chr(99) + metastr[4:])
+
+    def test_write_metadata_single_xattr(self):
+        calls = []
+        metadata = {'name': '/a/c/o', 'X-Object-Meta-Big': 'x' * 1000}
+        with open(os.path.join(self.testdir, 'o'), 'wb') as fp:
+            was_setxattr = object_server.setxattr
+
+            def counting_setxattr(*args):
+                calls.append(args[1])
+                return was_setxattr(*args)
+
+            object_server.setxattr = counting_setxattr
+            try:
+                object_server.write_metadata(fp, metadata, binary=True)
+            finally:
+                object_server.setxattr = was_setxattr
+            self.assertEquals(calls, [object_server.METADATA_KEY])
+            self.assertEquals(object_server.read_metadata(fp), metadata)
+
+    def test_write_metadata_too_big_for_one_xattr(self):
+        calls = []
+        metadata = {'name': '/a/c/o', 'X-Object-Meta-Big': 'x' * 1000}
+        with open(os.path.join(self.testdir, 'o'), 'wb') as fp:
+            was_setxattr = object_server.setxattr
+
+            def small_setxattr(fd, key, value):
+                calls.append(key)
+                if len(value) > 254:
+                    raise IOError(errno.ENOSPC, 'No space left on device')
+                return was_setxattr(fd, key, value)
+
+            object_server.setxattr = small_setxattr
+            try:
+                object_server.write_metadata(fp, metadata, binary=True)
+            finally:
+                object_server.setxattr = was_setxattr
+            self.assertEquals(calls[:3], [object_server.METADATA_KEY,
+                                          object_server.METADATA_KEY,
+                                          object_server.METADATA_KEY + '1'])
+            self.assertEquals(
+                getxattr(fp, object_server.METADATA_KEY)[:3],
+                object_server.METADATA_MAGIC)
+            self.assertEquals(object_server.read_metadata(fp), metadata)
+
+    def test_pickle_by_default(self):
+        metadata = {'name': '/a/c/o', 'X-Object-Meta-Big': 'x' * 1000}
+        with open(os.path.join(self.testdir, 'o'), 'wb') as fp:
+            object_server.write_metadata(fp, metadata)
+            self.assertEquals(
+                pickle.loads(''.join(
+                    getxattr(fp, object_server.METADATA_KEY + suffix)
+                    for suffix in ('', '1', '2', '3', '4'))),
+                metadata)
+            self.assertEquals(
+                getxattr(fp, object_server.METADATA_KEY + '1')[:1], 'x')
+            self.assertEquals(object_server.read_metadata(fp), metadata)
+            metastr = pickle.dumps(metadata, object_server.PICKLE_PROTOCOL)
+            setxattr(fp, object_server.METADATA_KEY, metastr)
+            self.assertEquals(object_server.read_metadata(fp), metadata)
+
+    def test_write_falls_back_to_pickle(self):
+        metadata = {'name': '/a/c/o', 'odd': ('a', 'tuple')}
+        with open(os.path.join(self.testdir, 'o'), 'wb') as fp:
+            object_server.write_metadata(fp, metadata, binary=True)
+            self.assertEquals(
+                pickle.loads(getxattr(fp, object_server.METADATA_KEY)),
+                metadata)
+            self.assertEquals(object_server.read_metadata(fp), metadata)
+
+
 class TestDiskFile(unittest.TestCase):
     """Test swift.obj.server.DiskFile"""
 
@@ -354,6 +457,84 @@ class TestDiskFile(unittest.TestCase):
         self.assertEquals(len(os.listdir(df1.datadir)), 1)
         self.assertEquals(os.listdir(df1.datadir)[0], "%s.data" % future_time)
 
+    def _put_indexed(self, ts, extension='.data', data='0' * 8):
+        df = object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                    FakeLogger(), use_index=True)
+        with df.mkstemp() as fd:
+            os.write(fd, data)
+            df.put(fd, {'X-Timestamp': ts, 'ETag': md5(data).hexdigest(),
+                        'Content-Length': str(len(data))},
+                   extension=extension)
+        df.unlinkold(ts)
+        return df
+
+    def _index(self, df, age=10):
+        suffix_dir = os.path.dirname(df.datadir)
+        replicator.request_suffix_index(suffix_dir)
+        past = int(time()) - age
+        os.utime(df.datadir, (past, past))
+        replicator.hash_suffix(suffix_dir, 604800)
+
+    def test_index_not_written_by_put_and_unlinkold(self):
+        ts1 = normalize_timestamp(time())
+        df = self._put_indexed(ts1)
+        suffix_dir = os.path.dirname(df.datadir)
+        self.assertEquals(replicator.read_suffix_index(suffix_dir), None)
+        # opening an object in an unindexed suffix asks for an index
+        object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger(), use_index=True)
+        self.assertEquals(replicator.read_suffix_index(suffix_dir), {})
+        self._index(df)
+        self.assertEquals(replicator.get_indexed_files(df.datadir),
+                          [ts1 + '.data'])
+        index = replicator.read_suffix_index(suffix_dir)
+        ts2 = normalize_timestamp(time() + 1)
+        df.put_metadata({'X-Timestamp': ts2}, tombstone=True)
+        df.unlinkold(ts2)
+        self.assertEquals(replicator.read_suffix_index(suffix_dir), index)
+        self.assertEquals(replicator.get_indexed_files(df.datadir), None)
+        df = object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                    FakeLogger(), use_index=True)
+        self.assert_(df.is_deleted())
+        self._index(df, age=20)
+        self.assertEquals(replicator.get_indexed_files(df.datadir),
+                          [ts2 + '.ts'])
+
+    def test_index_open_skips_listdir(self):
+        ts = normalize_timestamp(time())
+        self._index(self._put_indexed(ts))
+        with mock({'os.listdir': lambda *args: self.fail('listdir')}):
+            df = object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c',
+                                        'o', FakeLogger(), use_index=True)
+        self.assertEquals(os.path.basename(df.data_file), ts + '.data')
+        self.assertEquals(df.metadata['X-Timestamp'], ts)
+
+    def test_index_stale_falls_back_to_listdir(self):
+        ts1 = normalize_timestamp(time())
+        df = self._put_indexed(ts1)
+        self._index(df)
+        # a newer object arrives, the way rsync would push it
+        ts2 = normalize_timestamp(time() + 1)
+        df = object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                    FakeLogger())
+        with df.mkstemp() as fd:
+            df.put(fd, {'X-Timestamp': ts2})
+        os.unlink(os.path.join(df.datadir, ts1 + '.data'))
+        df = object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                    FakeLogger(), use_index=True)
+        self.assertEquals(os.path.basename(df.data_file), ts2 + '.data')
+
+    def test_index_quarantine_drops_object(self):
+        df = self._put_indexed(normalize_timestamp(time()))
+        self._index(df)
+        df = object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                    FakeLogger(), use_index=True)
+        df.quarantine()
+        self.assertEquals(replicator.get_indexed_files(df.datadir), None)
+        df = object_server.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                    FakeLogger(), use_index=True)
+        self.assert_(df.is_deleted())
+
     def test_close_error(self):
 
         def err():
@@ -678,7 +859,7 @@ class TestObjectController(unittest.TestCase):
             timestamp + '.data')
         self.assert_(os.path.isfile(objfile))
         self.assertEquals(open(objfile).read(), 'VERIFY')
-        self.assertEquals(pickle.loads(getxattr(objfile,
+        self.assertEquals(object_server.decode_metadata(getxattr(objfile,
                             object_server.METADATA_KEY)),
                           {'X-Timestamp': timestamp,
                            'Content-Length': '6',
@@ -709,7 +890,7 @@ class TestObjectController(unittest.TestCase):
             timestamp + '.data')
         self.assert_(os.path.isfile(objfile))
         self.assertEquals(open(objfile).read(), 'VERIFY TWO')
-        self.assertEquals(pickle.loads(getxattr(objfile,
+        self.assertEquals(object_server.decode_metadata(getxattr(objfile,
                             object_server.METADATA_KEY)),
                           {'X-Timestamp': timestamp,
                            'Content-Length': '10',
@@ -752,7 +933,7 @@ class TestObjectController(unittest.TestCase):
             timestamp + '.data')
         self.assert_(os.path.isfile(objfile))
         self.assertEquals(open(objfile).read(), 'VERIFY THREE')
-        self.assertEquals(pickle.loads(getxattr(objfile,
+        self.assertEquals(object_server.decode_metadata(getxattr(objfile,
         object_server.METADATA_KEY)),
                           {'X-Timestamp': timestamp,
                            'Content-Length': '12',
@@ -762,6 +943,30 @@ class TestObjectController(unittest.TestCase):
                            'X-Object-Meta-1': 'One',
                            'X-Object-Meta-Two': 'Two'})
 
+    def test_PUT_binary_metadata(self):
+        objdir = os.path.join(
+            self.testdir, 'sda1', storage_directory(
+                object_server.DATADIR, 'p', hash_path('a', 'c', 'o')))
+        for binary in ('false', 'true'):
+            self.object_controller = object_server.ObjectController(
+                {'devices': self.testdir, 'mount_check': 'false',
+                 'binary_metadata': binary})
+            timestamp = normalize_timestamp(time())
+            req = Request.blank('/sda1/p/a/c/o',
+                                environ={'REQUEST_METHOD': 'PUT'},
+                                headers={'X-Timestamp': timestamp,
+                                         'Content-Type': 'text/plain'},
+                                body='VERIFY')
+            self.assertEquals(self.object_controller.PUT(req).status_int,
+                              201)
+            metastr = getxattr(os.path.join(objdir, timestamp + '.data'),
+                               object_server.METADATA_KEY)
+            # pickled unless every node has been upgraded to read binary
+            self.assertEquals(
+                metastr.startswith(object_server.METADATA_MAGIC),
+                binary == 'true')
+            sleep(.00001)
+
     def test_PUT_container_connection(self):
 
         def mock_http_connect(response, with_exc=False):
@@ -1214,6 +1419,88 @@ class TestObjectController(unittest.TestCase):
         resp = self.object_controller.GET(req)
         self.assertEquals(resp.status_int, 404)
 
+    def _put_corrupt_object(self):
+        timestamp = normalize_timestamp(time())
+        req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': timestamp,
+                                     'Content-Type': 'application/x-test'})
+        req.body = 'VERIFY'
+        resp = self.object_controller.PUT(req)
+        self.assertEquals(resp.status_int, 201)
+        file = object_server.DiskFile(self.testdir, 'sda1', 'p', 'a', 'c', 'o',
+                                      FakeLogger(), keep_data_fp=True)
+        metadata = {'X-Timestamp': timestamp, 'Content-Length': 6,
+                    'ETag': md5('VERIF').hexdigest()}
+        object_server.write_metadata(file.fp, metadata)
+        file.close()
+        return os.path.join(self.testdir, 'sda1', 'quarantined', 'objects',
+                            os.path.basename(file.datadir))
+
+    def test_GET_no_etag_verify(self):
+        quar_dir = self._put_corrupt_object()
+        self.object_controller.etag_verify_rate = 0
+        resp = self.object_controller.GET(Request.blank('/sda1/p/a/c/o'))
+        self.assertEquals(resp.body, 'VERIFY')
+        self.assertFalse(os.path.exists(quar_dir))
+
+    def test_GET_zero_copy(self):
+        quar_dir = self._put_corrupt_object()
+        wrapped = []
+
+        class FileWrapper(object):
+
+            def __init__(self, filelike, block_size):
+                wrapped.append((filelike, block_size))
+                self.filelike = filelike
+
+            def __iter__(self):
+                os.lseek(self.filelike.fileno(), 0, os.SEEK_SET)
+                return iter([os.read(self.filelike.fileno(), 1024)])
+
+            def close(self):
+                self.filelike.close()
+
+        env = {'wsgi.file_wrapper': FileWrapper}
+        # ranged GETs go through the DiskFile iterator, checked or not
+        self.object_controller.etag_verify_rate = 0
+        resp = self.object_controller.GET(
+            Request.blank('/sda1/p/a/c/o', environ=env,
+                          headers={'Range': 'bytes=1-2'}))
+        self.assertEquals(resp.body, 'ER')
+        self.assertEquals(wrapped, [])
+        self.object_controller.etag_verify_rate = 1.0
+
+        dropped = []
+        with mock({'swift.obj.server.drop_buffer_cache':
+                   lambda *args: dropped.append(args)}):
+            # GETs whose ETag is to be checked use the DiskFile iterator
+            resp = self.object_controller.GET(
+                Request.blank('/sda1/p/a/c/o', environ=env))
+            self.assertEquals(wrapped, [])
+            resp.app_iter.close()
+
+            self.object_controller.etag_verify_rate = 0
+            resp = self.object_controller.GET(
+                Request.blank('/sda1/p/a/c/o', environ=env))
+            self.assertEquals(len(wrapped), 1)
+            self.assert_(isinstance(resp.app_iter, FileWrapper))
+            self.assertEquals(resp.content_length, 6)
+            self.assertEquals(''.join(resp.app_iter), 'VERIFY')
+            resp.app_iter.close()
+            # small public objects stay in the cache, as they would for
+            # the iterator
+            self.assertEquals(dropped, [])
+            self.assertFalse(os.path.exists(quar_dir))
+
+            resp = self.object_controller.GET(
+                Request.blank('/sda1/p/a/c/o', environ=env,
+                              headers={'X-Auth-Token': 'token'}))
+            self.assertEquals(len(wrapped), 2)
+            self.assertEquals(''.join(resp.app_iter), 'VERIFY')
+            resp.app_iter.close()
+            self.assertEquals(len(dropped), 1)
+            self.assertFalse(os.path.exists(quar_dir))
+
     def test_GET_quarantine_zbyte(self):
         """ Test swift.object_server.ObjectController.GET """
         timestamp = normalize_timestamp(time())
@@ -1589,7 +1876,7 @@ class TestObjectController(unittest.TestCase):
             storage_directory(object_server.DATADIR, 'p', hash_path('a', 'c',
             'o')), timestamp + '.data')
         self.assert_(os.path.isfile(objfile))
-        self.assertEquals(pickle.loads(getxattr(objfile,
+        self.assertEquals(object_server.decode_metadata(getxattr(objfile,
             object_server.METADATA_KEY)), {'X-Timestamp': timestamp,
             'Content-Length': '0', 'Content-Type': 'text/plain', 'name':
             '/a/c/o', 'X-Object-Manifest': 'c/o/', 'ETag':
@@ -2459,6 +2746,153 @@ class TestObjectController(unittest.TestCase):
             tpool.execute = was_tpool_exe
             object_server.get_hashes = was_get_hashes
 
+    def test_REPLICATE_batch(self):
+        timestamp = normalize_timestamp(time())
+        req = Request.blank('/sda1/p/a/c/o',
+                            environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': timestamp,
+                                     'Content-Type': 'text/plain'},
+                            body='VERIFY')
+        self.assertEquals(self._sync_response(req).status_int, 201)
+        suffix = hash_path('a', 'c', 'o')[-3:]
+        req = Request.blank('/sda1', environ={'REQUEST_METHOD': 'REPLICATE'},
+                            body='p %s\nq' % suffix)
+        with mock({'eventlet.tpool.execute':
+                   lambda func, *args, **kwargs: func(*args, **kwargs)}):
+            resp = req.get_response(self.object_controller)
+            body = resp.body
+        self.assertEquals(resp.status_int, 200)
+        records = []
+        while body:
+            length, = struct.unpack('!I', body[:4])
+            records.append(pickle.loads(body[4:4 + length]))
+            body = body[4 + length:]
+        self.assertEquals([partition for partition, hashes in records],
+                          ['p', 'q'])
+        self.assertEquals(records[0][1].keys(), [suffix])
+        self.assertEquals(records[1][1], {})
+        # partitions a batch asks about are created, as with single ones
+        self.assertTrue(os.path.isdir(
+            os.path.join(self.testdir, 'sda1', object_server.DATADIR, 'q')))
+
+    def test_REPLICATE_batch_errors(self):
+        req = Request.blank('/sda1', environ={'REQUEST_METHOD': 'REPLICATE'},
+                            body='')
+        resp = self._sync_response(req)
+        self.assertEquals(resp.status_int, 400)
+        self.assertEquals(resp.body, 'No partitions')
+        req = Request.blank('/sda1', environ={'REQUEST_METHOD': 'REPLICATE'},
+                            body='p\n..')
+        self.assertEquals(self._sync_response(req).status_int, 400)
+
+    def _sync_record(self, name, metadata, body, legacy=False):
+        if legacy:
+            metastr = pickle.dumps(metadata, object_server.PICKLE_PROTOCOL)
+        else:
+            metastr = object_server.encode_metadata(metadata)
+        return '%s %d %d\n%s%s' % (name, len(metastr), len(body), metastr,
+                                   body)
+
+    def _sync_response(self, req):
+        with mock({'eventlet.tpool.execute':
+                   lambda func, *args, **kwargs: func(*args, **kwargs)}):
+            return req.get_response(self.object_controller)
+
+    def test_SYNC_check(self):
+        timestamp = normalize_timestamp(time())
+        req = Request.blank('/sda1/p/a/c/o',
+                            environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': timestamp,
+                                     'Content-Type': 'text/plain'},
+                            body='VERIFY')
+        self.assertEquals(self._sync_response(req).status_int,
+                          201)
+        ohash = hash_path('a', 'c', 'o')
+        newer = normalize_timestamp(float(timestamp) + 1)
+        other = hash_path('a', 'c', 'o2')
+        names = ['%s/%s/%s.data' % (ohash[-3:], ohash, timestamp),
+                 '%s/%s/%s.meta' % (ohash[-3:], ohash, newer),
+                 '%s/%s/%s.data' % (other[-3:], other, timestamp)]
+        req = Request.blank('/sda1/p/%s' % ohash[-3:],
+                            environ={'REQUEST_METHOD': 'SYNC'},
+                            headers={'X-Sync-Phase': 'check'},
+                            body='\n'.join(names))
+        resp = self._sync_response(req)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(sorted(resp.body.splitlines()), sorted(names[1:]))
+        req = Request.blank('/sda1/p/%s' % ohash[-3:],
+                            environ={'REQUEST_METHOD': 'SYNC'},
+                            headers={'X-Sync-Phase': 'check'},
+                            body='%s/%s/../x.data' % (ohash[-3:], ohash))
+        resp = self._sync_response(req)
+        self.assertEquals(resp.status_int, 400)
+
+    def test_SYNC_update(self):
+        timestamp = normalize_timestamp(time())
+        ohash = hash_path('a', 'c', 'o')
+        tomb_hash = hash_path('a', 'c', 'o2')
+        data_meta = {'X-Timestamp': timestamp, 'name': '/a/c/o',
+                     'Content-Type': 'text/plain', 'Content-Length': '6',
+                     'ETag': md5('VERIFY').hexdigest()}
+        body = self._sync_record(
+            '%s/%s/%s.data' % (ohash[-3:], ohash, timestamp), data_meta,
+            'VERIFY', legacy=True)
+        body += self._sync_record(
+            '%s/%s/%s.ts' % (tomb_hash[-3:], tomb_hash, timestamp),
+            {'X-Timestamp': timestamp, 'name': '/a/c/o2'}, '')
+        req = Request.blank('/sda1/p/%s-%s' % (ohash[-3:], tomb_hash[-3:]),
+                            environ={'REQUEST_METHOD': 'SYNC'}, body=body)
+        self.object_controller.binary_metadata = True
+        resp = self._sync_response(req)
+        self.assertEquals(resp.status_int, 204)
+        df = object_server.DiskFile(self.testdir, 'sda1', 'p', 'a', 'c', 'o',
+                                    FakeLogger(), keep_data_fp=True)
+        self.assertEquals(df.metadata, data_meta)
+        self.assertEquals(''.join(df), 'VERIFY')
+        # stored in this node's metadata format
+        self.assertTrue(
+            getxattr(df.data_file, object_server.METADATA_KEY).startswith(
+                object_server.METADATA_MAGIC))
+        df = object_server.DiskFile(self.testdir, 'sda1', 'p', 'a', 'c', 'o2',
+                                    FakeLogger())
+        self.assertTrue(df.is_deleted())
+        self.assertEquals(
+            os.listdir(os.path.join(self.testdir, 'sda1', 'tmp')), [])
+        # and rehashed
+        part = os.path.join(self.testdir, 'sda1', 'objects', 'p')
+        self.assertEquals(replicator.read_hash_journal(part), ({}, 0))
+        hashed, hashes = replicator.get_hashes(part)
+        self.assertEquals(hashed, 0)
+        self.assertEquals(sorted(hashes), sorted([ohash[-3:],
+                                                  tomb_hash[-3:]]))
+
+    def test_SYNC_update_errors(self):
+        timestamp = normalize_timestamp(time())
+        ohash = hash_path('a', 'c', 'o')
+        name = '%s/%s/%s.data' % (ohash[-3:], ohash, timestamp)
+        metadata = {'X-Timestamp': timestamp, 'name': '/a/c/o',
+                    'Content-Type': 'text/plain', 'Content-Length': '6',
+                    'ETag': md5('VERIFY').hexdigest()}
+
+        def sync(body):
+            req = Request.blank('/sda1/p/%s' % ohash[-3:],
+                                environ={'REQUEST_METHOD': 'SYNC'},
+                                body=body)
+            return self._sync_response(req).status_int
+
+        self.assertEquals(sync(self._sync_record(name, metadata, 'VERIFX')),
+                          422)
+        self.assertEquals(sync(self._sync_record(name, metadata, 'VERIFY')[
+            :-1]), 499)
+        self.assertEquals(sync(self._sync_record(
+            '%s/%s/%s.data' % ('abc', ohash, timestamp), metadata, 'VERIFY')),
+            400)
+        self.assertEquals(sync('%s 3 0\nabc' % name), 400)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.testdir, 'sda1', 'objects', 'p', ohash[-3:], ohash)))
+        self.assertEquals(
+            os.listdir(os.path.join(self.testdir, 'sda1', 'tmp')), [])
+
     def test_PUT_with_full_drive(self):
 
         class IgnoredBody():
@@ -15,12 +15,16 @@
 
 import unittest
 
+import eventlet
+from mock import patch
+
 import swift.proxy.controllers.base
 from swift.proxy.controllers.base import headers_to_container_info, \
     headers_to_account_info, get_container_info, get_container_memcache_key, \
-    get_account_info, get_account_memcache_key
+    get_account_info, get_account_memcache_key, InfoCache, NodeLatency
 from swift.common.swob import Request
 from swift.common.utils import split_path
+from test.unit import FakeLogger
 
 
 class FakeResponse(object):
@@ -167,3 +171,167 @@ class TestFuncs(unittest.TestCase):
         self.assertEquals(
             resp,
             headers_to_account_info(headers.items(), 200))
+
+
+class TestInfoCache(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = FakeLogger()
+        self.cache = InfoCache(10, 5, self.logger)
+        self.lookups = []
+
+    def lookup(self, status=200, sleep=0):
+        def do_lookup():
+            self.lookups.append(status)
+            if sleep:
+                eventlet.sleep(sleep)
+            return {'status': status, 'bytes': len(self.lookups)}
+        return do_lookup
+
+    def test_hit_and_miss(self):
+        info = self.cache.get('k', self.lookup())
+        self.assertEquals(info, {'status': 200, 'bytes': 1})
+        info['bytes'] = 'changed by caller'
+        self.assertEquals(self.cache.get('k', self.lookup()),
+                          {'status': 200, 'bytes': 1})
+        self.assertEquals(len(self.lookups), 1)
+        self.assertEquals(self.logger.get_increment_counts(),
+                          {'info_cache.miss': 1, 'info_cache.hit': 1})
+
+    def test_expiry(self):
+        now = [1000.0]
+        with patch('time.time', lambda: now[0]):
+            self.cache.get('found', self.lookup())
+            self.cache.get('missing', self.lookup(404))
+            self.cache.get('error', self.lookup(-1))
+            now[0] += 0.4
+            self.cache.get('found', self.lookup())
+            self.cache.get('missing', self.lookup(404))
+            self.cache.get('error', self.lookup(-1))
+            self.assertEquals(self.lookups, [200, 404, -1, -1])
+            now[0] += 0.2
+            self.cache.get('missing', self.lookup(404))
+            now[0] += 5
+            self.cache.get('found', self.lookup())
+        self.assertEquals(self.lookups, [200, 404, -1, -1, 404, 200])
+
+    def test_disabled(self):
+        for cache in (InfoCache(0, 5, self.logger),
+                      InfoCache(10, 0, self.logger)):
+            cache.get('k', self.lookup())
+            cache.get('k', self.lookup())
+            self.assertEquals(cache.entries, {})
+        self.assertEquals(len(self.lookups), 4)
+
+    def test_coalescing(self):
+        pile = eventlet.GreenPile()
+        for _junk in xrange(5):
+            pile.spawn(self.cache.get, 'k', self.lookup(sleep=0.01))
+        self.assertEquals(list(pile), [{'status': 200, 'bytes': 1}] * 5)
+        self.assertEquals(len(self.lookups), 1)
+        self.assertEquals(self.logger.get_increment_counts(),
+                          {'info_cache.miss': 1, 'info_cache.coalesced': 4})
+
+    def test_coalescing_error(self):
+        def lookup():
+            eventlet.sleep(0.01)
+            raise ValueError('boom')
+
+        def get():
+            try:
+                self.cache.get('k', lookup)
+            except ValueError, err:
+                return err
+
+        pile = eventlet.GreenPile()
+        for _junk in xrange(3):
+            pile.spawn(get)
+        errors = list(pile)
+        self.assertEquals([str(err) for err in errors], ['boom'] * 3)
+        self.assertEquals(self.cache.pending, {})
+        # each waiter gets an error of its own
+        self.assertEquals(len(set(map(id, errors))), 3)
+        self.assertEquals(self.cache.get('k', self.lookup()),
+                          {'status': 200, 'bytes': 1})
+
+    def test_early_refresh(self):
+        now = [1000.0]
+        with patch('time.time', lambda: now[0]):
+            self.cache.get('k', self.lookup())
+            now[0] += 4
+            self.assertEquals(self.cache.get('k', self.lookup()),
+                              {'status': 200, 'bytes': 1})
+            eventlet.sleep(0)
+            self.assertEquals(len(self.lookups), 2)
+            # The refreshed entry is good for another ttl
+            now[0] += 3
+            self.assertEquals(self.cache.get('k', self.lookup()),
+                              {'status': 200, 'bytes': 2})
+        self.assertEquals(self.logger.get_increment_counts(),
+                          {'info_cache.miss': 1, 'info_cache.hit': 2,
+                           'info_cache.refresh': 1})
+
+    def test_lru_eviction(self):
+        now = [1000.0]
+        with patch('time.time', lambda: now[0]):
+            for i in xrange(10):
+                self.cache.get(i, self.lookup())
+                now[0] += 0.01
+            self.cache.get(0, self.lookup())
+            self.cache.get(10, self.lookup())
+        self.assertEquals(sorted(self.cache.entries),
+                          [0] + range(3, 11))
+
+    def test_invalidate(self):
+        self.cache.get('k', self.lookup())
+        self.cache.invalidate('k')
+        self.cache.invalidate('not there')
+        self.cache.get('k', self.lookup())
+        self.assertEquals(len(self.lookups), 2)
+
+
+class TestNodeLatency(unittest.TestCase):
+
+    def setUp(self):
+        self.latency = NodeLatency(half_life=10, alpha=0.5, window=5)
+        self.node = {'ip': '1.2.3.4', 'port': 6000, 'device': 'sda'}
+
+    def test_ewma(self):
+        now = [1000.0]
+        with patch('time.time', lambda: now[0]):
+            self.assertEquals(self.latency.estimate(self.node), 0.0)
+            self.latency.record(self.node, 0.4)
+            self.assertEquals(self.latency.estimate(self.node), 0.4)
+            self.latency.record(self.node, 0.2)
+            self.assertAlmostEquals(self.latency.estimate(self.node), 0.3)
+            # other devices on the same server are tracked separately
+            other = dict(self.node, device='sdb')
+            self.assertEquals(self.latency.estimate(other), 0.0)
+
+    def test_decay(self):
+        now = [1000.0]
+        with patch('time.time', lambda: now[0]):
+            self.latency.record(self.node, 0.8)
+            now[0] += 10
+            self.assertAlmostEquals(self.latency.estimate(self.node), 0.4)
+            now[0] += 10
+            self.assertAlmostEquals(self.latency.estimate(self.node), 0.2)
+            # new samples average against the decayed estimate
+            self.latency.record(self.node, 0.4)
+            self.assertAlmostEquals(self.latency.estimate(self.node), 0.3)
+
+    def test_percentile(self):
+        self.latency.record(self.node, 5.0)
+        self.assertEquals(self.latency.percentile('Object', 50, 1), None)
+        for elapsed in (0.5, 0.1, 0.4, 0.2):
+            self.latency.record(self.node, elapsed, 'Object')
+        self.assertEquals(self.latency.percentile('Object', 50), None)
+        self.assertEquals(self.latency.percentile('Object', 50, 4), 0.4)
+        self.assertEquals(self.latency.percentile('Object', 100, 4), 0.5)
+        self.assertEquals(self.latency.percentile('Object', 0, 4), 0.1)
+        # only the most recent window samples count
+        self.latency.record(self.node, 0.3, 'Object')
+        self.latency.record(self.node, 0.3, 'Object')
+        self.assertEquals(sorted(self.latency.samples['Object']),
+                          [0.1, 0.2, 0.3, 0.3, 0.4])
+        self.assertEquals(self.latency.percentile('Container', 50, 0), None)
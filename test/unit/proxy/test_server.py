@@ -30,7 +30,8 @@ from hashlib import md5
 from tempfile import mkdtemp
 import random
 
-from eventlet import sleep, spawn, wsgi, listen
+from eventlet import GreenPile, sleep, spawn, wsgi, listen, Timeout
+from eventlet.event import Event
 import simplejson
 
 from test.unit import connect_tcp, readuntil2crlfs, FakeLogger, fake_http_connect
@@ -46,7 +47,8 @@ from swift.common.constraints import MAX_META_NAME_LENGTH, \
 from swift.common import utils
 from swift.common.utils import mkdirs, normalize_timestamp, NullLogger
 from swift.common.wsgi import monkey_patch_mimetools
-from swift.proxy.controllers.obj import SegmentedIterable
+from swift.proxy.controllers.obj import SegmentedIterable, PutFanOut, \
+    SegmentPrefetch
 from swift.proxy.controllers.base import get_container_memcache_key, \
     get_account_memcache_key, cors_validation
 import swift.proxy.controllers
@@ -555,6 +557,33 @@ class TestController(unittest.TestCase):
             test(404, 507, 503)
             test(503, 503, 503)
 
+    def test_container_info_account_autocreate_coalesced(self):
+        autocreates = []
+
+        def account_info(self, account, autocreate=False):
+            autocreates.append(autocreate)
+            sleep(0.01)
+            if autocreate:
+                return True, True, 0
+            return None, None, None
+
+        with save_globals():
+            swift.proxy.controllers.Controller.account_info = account_info
+            set_http_connect(200, headers={
+                'x-container-read': self.read_acl,
+                'x-container-write': self.write_acl})
+            pile = GreenPile()
+            for account_autocreate in (False, True):
+                pile.spawn(self.controller.container_info, self.account,
+                           self.container,
+                           account_autocreate=account_autocreate)
+            without, with_autocreate = list(pile)
+            self.check_container_info_return(without, True)
+            # waiting on a lookup that did not create the account is no good
+            # to one that may
+            self.check_container_info_return(with_autocreate)
+            self.assertEquals(autocreates, [False, True])
+
 
 class TestProxyServer(unittest.TestCase):
 
@@ -694,6 +723,29 @@ class TestProxyServer(unittest.TestCase):
         finally:
             proxy_server.shuffle = random.shuffle
 
+    def test_latency_sorting(self):
+        baseapp = proxy_server.Application({'sorting_method': 'latency',
+                                            'timing_expiry': '10'},
+                                           FakeMemcache(),
+                                           container_ring=FakeRing(),
+                                           object_ring=FakeRing(),
+                                           account_ring=FakeRing())
+        self.assertEquals(baseapp.node_latency.half_life, 10)
+        nodes = [{'ip': '10.0.0.1', 'port': 6000, 'device': 'sda'},
+                 {'ip': '10.0.0.1', 'port': 6000, 'device': 'sdb'},
+                 {'ip': '10.0.0.2', 'port': 6000, 'device': 'sda'}]
+        baseapp.record_node_latency(nodes[0], 0.5)
+        baseapp.record_node_latency(nodes[2], 0.1)
+        proxy_server.shuffle = lambda l: l
+        try:
+            res = baseapp.sort_nodes(list(nodes))
+            self.assertEquals(res, [nodes[1], nodes[2], nodes[0]])
+            baseapp.record_node_latency(nodes[1], 1.0)
+            res = baseapp.sort_nodes(list(nodes))
+            self.assertEquals(res, [nodes[2], nodes[0], nodes[1]])
+        finally:
+            proxy_server.shuffle = random.shuffle
+
 
 class TestObjectController(unittest.TestCase):
 
@@ -775,7 +827,7 @@ class TestObjectController(unittest.TestCase):
         test_errors = []
 
         def test_connect(ipaddr, port, device, partition, method, path,
-                         headers=None, query_string=None):
+                         headers=None, query_string=None, pool=None):
             if path == '/a/c/o.jpg':
                 if 'expect' in headers or 'Expect' in headers:
                     test_errors.append('Expect was in headers for object '
@@ -802,7 +854,7 @@ class TestObjectController(unittest.TestCase):
         test_errors = []
 
         def test_connect(ipaddr, port, device, partition, method, path,
-                         headers=None, query_string=None):
+                         headers=None, query_string=None, pool=None):
             if path == '/a/c/o.jpg':
                 if 'Expect' not in headers:
                     test_errors.append('Expect was not in headers for '
@@ -825,7 +877,7 @@ class TestObjectController(unittest.TestCase):
         test_errors = []
 
         def test_connect(ipaddr, port, device, partition, method, path,
-                         headers=None, query_string=None):
+                         headers=None, query_string=None, pool=None):
             if method == 'DELETE':
                 if 'x-if-delete-at' in headers or 'X-If-Delete-At' in headers:
                     test_errors.append('X-If-Delete-At in headers')
@@ -932,7 +984,7 @@ class TestObjectController(unittest.TestCase):
 
                 def capture_requested_paths(ipaddr, port, device, partition,
                                             method, path, headers=None,
-                                            query_string=None):
+                                            query_string=None, pool=None):
                     qs_dict = dict(urlparse.parse_qsl(query_string or ''))
                     requested.append([method, path, qs_dict])
 
@@ -1011,7 +1063,7 @@ class TestObjectController(unittest.TestCase):
 
             def capture_requested_paths(ipaddr, port, device, partition,
                                         method, path, headers=None,
-                                        query_string=None):
+                                        query_string=None, pool=None):
                 qs_dict = dict(urlparse.parse_qsl(query_string or ''))
                 requested.append([method, path, qs_dict])
 
@@ -1067,7 +1119,7 @@ class TestObjectController(unittest.TestCase):
 
             def capture_requested_paths(ipaddr, port, device, partition,
                                         method, path, headers=None,
-                                        query_string=None):
+                                        query_string=None, pool=None):
                 qs_dict = dict(urlparse.parse_qsl(query_string or ''))
                 requested.append([method, path, qs_dict])
 
@@ -1127,7 +1179,7 @@ class TestObjectController(unittest.TestCase):
 
             def capture_requested_paths(ipaddr, port, device, partition,
                                         method, path, headers=None,
-                                        query_string=None):
+                                        query_string=None, pool=None):
                 qs_dict = dict(urlparse.parse_qsl(query_string or ''))
                 requested.append([method, path, qs_dict])
 
@@ -1183,7 +1235,7 @@ class TestObjectController(unittest.TestCase):
 
             def capture_requested_paths(ipaddr, port, device, partition,
                                         method, path, headers=None,
-                                        query_string=None):
+                                        query_string=None, pool=None):
                 qs_dict = dict(urlparse.parse_qsl(query_string or ''))
                 requested.append([method, path, qs_dict])
 
@@ -1957,6 +2009,241 @@ class TestObjectController(unittest.TestCase):
                               (200, 200, 200, 204, 204, 204), 503,
                               raise_exc=True)
 
+    def test_error_drops_pooled_connections(self):
+        with save_globals():
+            app = proxy_server.Application({'conn_pool_size': '4'},
+                                           FakeMemcache(),
+                                           account_ring=FakeRing(),
+                                           container_ring=FakeRing(),
+                                           object_ring=FakeRing())
+            self.assertEquals(app.conn_pool.max_idle, 4)
+            self.assertEquals(app.conn_pool.idle_timeout, 30)
+            controller = proxy_server.ObjectController(app, 'account',
+                                                       'container', 'object')
+            node = {'ip': '10.0.0.1', 'port': 6000, 'device': 'sda'}
+            dropped = []
+            app.conn_pool.drop = dropped.append
+            controller.error_occurred(node, 'oops')
+            controller.error_limit(node)
+            controller.exception_occurred(node, 'Object', 'oops')
+            self.assertEquals(dropped, [('10.0.0.1', 6000)] * 3)
+
+            pools = []
+
+            def capture_pool(*args, **kwargs):
+                pools.append(kwargs.get('pool'))
+                return fake_conn(*args, **kwargs)
+
+            fake_conn = fake_http_connect(200, 200, 200)
+            swift.proxy.controllers.base.http_connect = capture_pool
+            req = Request.blank('/a/c/o', environ={'REQUEST_METHOD': 'HEAD'})
+            resp = controller.HEAD(req)
+            self.assertEquals(resp.status_int, 200)
+            # account HEAD, container HEAD, object HEAD
+            self.assertEquals(pools, [app.conn_pool] * 3)
+        self.assertEquals(self.app.conn_pool, None)
+
+    def _hedged_get(self, delays, statuses=None):
+        class DelayedConn(object):
+            def __init__(self, ip, delay, status):
+                self.ip = ip
+                self.delay = delay
+                self.status = status
+                self.reason = 'Fake'
+                self.body = ip
+                self.closed = False
+
+            def getresponse(self):
+                sleep(self.delay)
+                return self
+
+            def getheaders(self):
+                return [('content-length', str(len(self.body))),
+                        ('x-timestamp', '1')]
+
+            def getheader(self, name, default=None):
+                return dict(self.getheaders()).get(name.lower(), default)
+
+            def read(self, amt=None):
+                body, self.body = self.body, ''
+                return body
+
+            def close(self):
+                self.closed = True
+
+        conns = []
+        statuses = statuses or [200] * len(delays)
+
+        def connect(ipaddr, port, device, partition, method, path,
+                    headers=None, query_string=None, pool=None):
+            index = int(ipaddr.rsplit('.', 1)[1])
+            conns.append(DelayedConn(ipaddr, delays[index],
+                                     statuses[index]))
+            return conns[-1]
+
+        logger = FakeLogger()
+        logger.thread_locals = None
+        app = proxy_server.Application({'hedged_get_percentile': '90'},
+                                       FakeMemcache(), logger=logger,
+                                       account_ring=FakeRing(),
+                                       container_ring=FakeRing(),
+                                       object_ring=FakeRing())
+        nodes = [{'ip': '10.0.0.%d' % i, 'port': 6000, 'device': 'sda'}
+                 for i in xrange(len(delays))]
+        for _junk in xrange(20):
+            app.record_node_latency(nodes[0], 0.01, 'Object')
+        controller = proxy_server.ObjectController(app, 'a', 'c', 'o')
+        req = Request.blank('/a/c/o')
+        with save_globals():
+            swift.proxy.controllers.base.http_connect = connect
+            start = time.time()
+            resp = controller.GETorHEAD_base(req, 'Object', 0, nodes,
+                                             '/a/c/o', len(nodes))
+            elapsed = time.time() - start
+            body = resp.body if resp.status_int == 200 else None
+        return app, conns, resp, body, elapsed
+
+    def test_GET_hedged(self):
+        app, conns, resp, body, elapsed = self._hedged_get([0.5, 0, 0])
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(body, '10.0.0.1')
+        self.assert_(elapsed < 0.4)
+        self.assertEquals([c.ip for c in conns], ['10.0.0.0', '10.0.0.1'])
+        self.assertEquals(
+            app.logger.get_increment_counts().get('hedged_get'), 1)
+        # the slow response is thrown away once it does arrive
+        self.assertFalse(conns[0].closed)
+        sleep(0.6)
+        self.assert_(conns[0].closed)
+
+    def test_GET_hedged_fast_node(self):
+        app, conns, resp, body, elapsed = self._hedged_get([0, 0, 0])
+        self.assertEquals(body, '10.0.0.0')
+        self.assertEquals(len(conns), 1)
+        self.assertEquals(
+            app.logger.get_increment_counts().get('hedged_get'), None)
+        self.assert_(('10.0.0.0', 6000, 'sda') in app.node_latency.devices)
+
+    def test_GET_hedged_falls_back(self):
+        # errors move on to the next node as usual, hedging at most once
+        app, conns, resp, body, elapsed = self._hedged_get(
+            [0, 0.2, 0.2], statuses=[404, 503, 200])
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(body, '10.0.0.2')
+        self.assertEquals([c.ip for c in conns],
+                          ['10.0.0.0', '10.0.0.1', '10.0.0.2'])
+        self.assertEquals(
+            app.logger.get_increment_counts().get('hedged_get'), 1)
+
+    def _put_with_delays(self, delays, statuses=(201, 201, 201), conf=None):
+        class DelayedPutConn(object):
+            def __init__(self, delay, status):
+                self.delay = delay
+                self.status = status
+                self.reason = 'Fake'
+                self.sent = ''
+
+            def getexpect(self):
+                return FakeConn100()
+
+            def send(self, chunk):
+                self.sent += chunk
+
+            def getresponse(self):
+                sleep(self.delay)
+                return self
+
+            def getheader(self, name, default=None):
+                if name.lower() == 'etag':
+                    return '"%s"' % md5(self.sent).hexdigest()
+                return default
+
+            def read(self, amt=None):
+                return ''
+
+        class FakeConn100(object):
+            status = 100
+
+        conns = []
+
+        def connect(ipaddr, port, device, partition, method, path,
+                    headers=None, query_string=None, pool=None):
+            index = int(ipaddr.rsplit('.', 1)[1])
+            conns.append(DelayedPutConn(delays[index], statuses[index]))
+            return conns[-1]
+
+        logger = FakeLogger()
+        logger.thread_locals = None
+        app = proxy_server.Application(conf or {}, FakeMemcache(),
+                                       logger=logger,
+                                       account_ring=FakeRing(),
+                                       container_ring=FakeRing(),
+                                       object_ring=FakeRing())
+        controller = proxy_server.ObjectController(app, 'a', 'c', 'o')
+        controller.container_info = lambda *args, **kwargs: {
+            'partition': 1, 'nodes': app.container_ring.get_nodes('a')[1],
+            'write_acl': None, 'sync_key': None, 'versions': None}
+        req = Request.blank('/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'Content-Length': '4',
+                                     'Content-Type': 'text/plain'},
+                            body='data')
+        with save_globals():
+            swift.proxy.controllers.obj.http_connect = connect
+            start = time.time()
+            resp = controller.PUT(req)
+            elapsed = time.time() - start
+        return app, conns, resp, elapsed
+
+    def test_PUT_waits_for_all_nodes(self):
+        app, conns, resp, elapsed = self._put_with_delays([0, 0, 0.3])
+        self.assertEquals(resp.status_int, 201)
+        self.assert_(elapsed >= 0.3)
+        self.assertEquals([c.sent for c in conns], ['data'] * 3)
+        timings = [args[0] for args, kwargs in
+                   app.logger.log_dict['timing_since']]
+        self.assertEquals(timings, ['PUT.quorum.timing',
+                                    'PUT.complete.timing'])
+
+    def test_PUT_quorum_response(self):
+        app, conns, resp, elapsed = self._put_with_delays(
+            [0, 0.3, 0], conf={'put_quorum_response': 'yes'})
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(resp.etag, md5('data').hexdigest())
+        self.assert_(elapsed < 0.3)
+        timings = [args[0] for args, kwargs in
+                   app.logger.log_dict['timing_since']]
+        self.assertEquals(timings, ['PUT.quorum.timing'])
+        # the straggler is still seen through in the background
+        sleep(0.5)
+        timings = [args[0] for args, kwargs in
+                   app.logger.log_dict['timing_since']]
+        self.assertEquals(timings, ['PUT.quorum.timing',
+                                    'PUT.complete.timing'])
+        self.assertEquals([c.sent for c in conns], ['data'] * 3)
+        self.assertEquals(
+            app.logger.get_increment_counts().get('PUT.straggler_failures'),
+            None)
+
+    def test_PUT_quorum_response_straggler_fails(self):
+        app, conns, resp, elapsed = self._put_with_delays(
+            [0.3, 0, 0], statuses=(503, 201, 201),
+            conf={'put_quorum_response': 'yes'})
+        self.assertEquals(resp.status_int, 201)
+        self.assert_(elapsed < 0.3)
+        sleep(0.5)
+        self.assertEquals(
+            app.logger.get_increment_counts().get('PUT.straggler_failures'),
+            1)
+        self.assertEquals(len(app.logger.log_dict['warning']), 1)
+
+    def test_PUT_quorum_response_needs_quorum(self):
+        # with one node failing fast, the slow one is needed for a quorum
+        app, conns, resp, elapsed = self._put_with_delays(
+            [0, 0.3, 0], statuses=(201, 201, 503),
+            conf={'put_quorum_response': 'yes'})
+        self.assertEquals(resp.status_int, 201)
+        self.assert_(elapsed >= 0.3)
+
     def test_acc_or_con_missing_returns_404(self):
         with save_globals():
             self.app.memcache = FakeMemcacheReturnsNone()
@@ -4046,7 +4333,7 @@ class TestObjectController(unittest.TestCase):
         seen_headers = []
 
         def capture_headers(ipaddr, port, device, partition, method,
-                            path, headers=None, query_string=None):
+                            path, headers=None, query_string=None, pool=None):
             captured = {}
             for header in header_list:
                 captured[header] = headers.get(header)
@@ -4494,7 +4781,7 @@ class TestContainerController(unittest.TestCase):
             test_errors = []
 
             def test_connect(ipaddr, port, device, partition, method, path,
-                             headers=None, query_string=None):
+                             headers=None, query_string=None, pool=None):
                 if path == '/a/c':
                     find_header = test_header
                     find_value = test_value
@@ -4874,7 +5161,7 @@ class TestContainerController(unittest.TestCase):
                       'X-Account-Device')
 
         def capture_headers(ipaddr, port, device, partition, method,
-                            path, headers=None, query_string=None):
+                            path, headers=None, query_string=None, pool=None):
             captured = {}
             for header in to_capture:
                 captured[header] = headers.get(header)
@@ -5207,7 +5494,7 @@ class TestAccountController(unittest.TestCase):
             test_errors = []
 
             def test_connect(ipaddr, port, device, partition, method, path,
-                             headers=None, query_string=None):
+                             headers=None, query_string=None, pool=None):
                 if path == '/a':
                     find_header = test_header
                     find_value = test_value
@@ -5393,6 +5680,125 @@ class Stub(object):
     pass
 
 
+class TestPutFanOut(unittest.TestCase):
+
+    class FakeConn(object):
+        def __init__(self, number):
+            self.node = {'ip': '10.0.0.%d' % number, 'port': 6000,
+                         'device': 'sda'}
+            self.sent = []
+            self.stall = None
+            self.fail = False
+
+        def send(self, chunk):
+            if self.stall:
+                self.stall.wait()
+            if self.fail:
+                raise Exception('boom')
+            self.sent.append(chunk)
+
+    def setUp(self):
+        self.logger = FakeLogger()
+        self.app = proxy_server.Application(
+            None, FakeMemcache(), logger=self.logger,
+            account_ring=FakeRing(), container_ring=FakeRing(),
+            object_ring=FakeRing())
+        self.controller = proxy_server.ObjectController(
+            self.app, 'a', 'c', 'o')
+        self.conns = [self.FakeConn(i) for i in xrange(3)]
+
+    def _start(self, fan_out):
+        return [spawn(self.controller._send_file, fan_out, conn, '/a/c/o')
+                for conn in self.conns]
+
+    def test_shared_framed_chunks(self):
+        fan_out = PutFanOut(self.conns, 2, 2, 4, True)
+        senders = self._start(fan_out)
+        with Timeout(3):
+            fan_out.add('abc')
+            fan_out.add('defghijklmnopq')
+            fan_out.finish()
+            [sender.wait() for sender in senders]
+        for conn in self.conns:
+            self.assertEquals(conn.sent, ['3\r\nabc\r\n',
+                                          'e\r\ndefghijklmnopq\r\n',
+                                          '0\r\n\r\n'])
+            # one framed string, shared by every connection
+            for chunk, first in zip(conn.sent, self.conns[0].sent):
+                self.assert_(chunk is first)
+        # everything sent has been dropped from the buffer
+        self.assertEquals(len(fan_out.chunks), 0)
+        self.assertEquals(fan_out.base, 3)
+        rates = self.logger.log_dict['transfer_rate']
+        self.assertEquals(len(rates), 3)
+        for args, kwargs in rates:
+            self.assertEquals(args[0], 'PUT.backend.timing')
+            self.assertEquals(args[2], 32)
+
+    def test_quorum_back_pressure(self):
+        fan_out = PutFanOut(self.conns, 2, 2, 4, False)
+        self.conns[2].stall = Event()
+        senders = self._start(fan_out)
+        added = []
+
+        def writer():
+            for i in xrange(10):
+                fan_out.add(str(i))
+                added.append(i)
+        writer_thread = spawn(writer)
+        sleep(0.01)
+        # the stalled connection may fall straggler_depth chunks behind
+        # before the writer waits for it
+        self.assertEquals(added, [0, 1, 2])
+        self.assertEquals(self.conns[0].sent, ['0', '1', '2', '3'])
+        self.assertEquals(len(fan_out.chunks), 4)
+        self.conns[2].stall.send()
+        self.conns[2].stall = None
+        with Timeout(3):
+            writer_thread.wait()
+            fan_out.finish()
+            [sender.wait() for sender in senders]
+        for conn in self.conns:
+            self.assertEquals(conn.sent, [str(i) for i in xrange(10)])
+
+    def test_slowest_quorum_member_sets_pace(self):
+        fan_out = PutFanOut(self.conns, 2, 2, 100, False)
+        self.conns[1].stall = Event()
+        self.conns[2].stall = Event()
+        self._start(fan_out)
+        added = []
+
+        def writer():
+            for i in xrange(10):
+                fan_out.add(str(i))
+                added.append(i)
+        spawn(writer)
+        sleep(0.01)
+        # only one connection keeping up is not a quorum
+        self.assertEquals(added, [0])
+        self.conns[1].stall.send()
+        self.conns[1].stall = None
+        sleep(0.01)
+        self.assertEquals(added, range(10))
+        self.assertEquals(self.conns[2].sent, [])
+
+    def test_failed_connection(self):
+        fan_out = PutFanOut(self.conns, 2, 2, 4, False)
+        self.conns[1].fail = True
+        senders = self._start(fan_out)
+        with Timeout(3):
+            fan_out.add('abc')
+            fan_out.add('def')
+            fan_out.finish()
+            [sender.wait() for sender in senders]
+        self.assertEquals(fan_out.live_conns(),
+                          [self.conns[0], self.conns[2]])
+        self.assertEquals(self.conns[0].sent, ['abc', 'def'])
+        self.assertEquals(self.conns[1].sent, [])
+        self.assertEquals(len(self.logger.log_dict['exception']), 1)
+        self.assertEquals(len(fan_out.chunks), 0)
+
+
 class TestSegmentedIterable(unittest.TestCase):
 
     def setUp(self):
@@ -5630,6 +6036,151 @@ class TestSegmentedIterable(unittest.TestCase):
         segit.response = Stub()
         self.assertEquals(''.join(segit.app_iter_range(5, 7)), '34')
 
+    def _prefetching(self, window):
+        self.controller.segment_prefetch = window
+        self.controller.segment_prefetch_bytes = 2 * (window + 1)
+        self.controller.object_chunk_size = 1
+        self.controller.client_timeout = 1
+        paths = []
+        orig_GETorHEAD_base = self.controller.GETorHEAD_base
+
+        def local_GETorHEAD_base(*args):
+            paths.append(args[4])
+            return orig_GETorHEAD_base(*args)
+
+        self.controller.GETorHEAD_base = local_GETorHEAD_base
+        return paths
+
+    def test_load_next_segment_prefetch(self):
+        paths = self._prefetching(2)
+        segit = SegmentedIterable(self.controller, 'lc', [
+            {'name': 'o1'}, {'name': 'o2'}, {'name': 'o3'}, {'name': 'o4'}])
+        segit._load_next_segment()
+        # The current segment plus the two after it are under way
+        self.assertEquals(paths, ['/a/lc/o1', '/a/lc/o2', '/a/lc/o3'])
+        self.assertEquals(''.join(segit.segment_iter), '1')
+        segit._load_next_segment()
+        self.assertEquals([d['name'] for d, _junk in segit.prefetch_window],
+                          ['o3', 'o4'])
+        self.assertEquals(''.join(segit.segment_iter), '22')
+        segit._load_next_segment()
+        self.assertEquals(''.join(segit.segment_iter), '333')
+        segit._load_next_segment()
+        self.assertEquals(''.join(segit.segment_iter), '4444')
+        self.assertRaises(StopIteration, segit._load_next_segment)
+        self.assertEquals(len(paths), 4)
+
+    def test_iter_prefetch(self):
+        listing = [{'name': 'o1', 'bytes': 1}, {'name': 'o2', 'bytes': 2},
+                   {'name': 'o3', 'bytes': 3}, {'name': 'o4', 'bytes': 4},
+                   {'name': 'o5', 'bytes': 5}]
+        for window in (1, 2, 10):
+            self._prefetching(window)
+            segit = SegmentedIterable(self.controller, 'lc', listing)
+            segit.response = Stub()
+            self.assertEquals(''.join(segit), '122333444455555')
+            segit = SegmentedIterable(self.controller, 'lc', listing)
+            segit.response = Stub()
+            self.assertEquals(''.join(segit.app_iter_range(5, 7)), '34')
+            self.assertFalse(segit.prefetch_window)
+            self.assertEquals(segit.prefetch_current, None)
+
+    def test_iter_prefetch_with_get_error(self):
+        paths = self._prefetching(3)
+        orig_GETorHEAD_base = self.controller.GETorHEAD_base
+
+        def local_GETorHEAD_base(*args):
+            if args[4] == '/a/lc/o2':
+                paths.append(args[4])
+                return HTTPNotFound()
+            return orig_GETorHEAD_base(*args)
+
+        self.controller.GETorHEAD_base = local_GETorHEAD_base
+        segit = SegmentedIterable(self.controller, 'lc', [
+            {'name': 'o1'}, {'name': 'o2'}, {'name': 'o3'}])
+        segit.response = Stub()
+        self.assertRaises(Exception, ''.join, segit)
+        self.assertEquals(str(self.controller.exception_info[1]),
+                          'Could not load object segment /a/lc/o2: 404')
+        self.assertEquals(segit.response.status_int, 503)
+        self.assertFalse(segit.prefetch_window)
+
+    def test_load_next_segment_prefetch_rate_limiting(self):
+        self._prefetching(10)
+        sleep_calls = []
+
+        def _stub_sleep(sleepy_time):
+            if sleepy_time:
+                sleep_calls.append(sleepy_time)
+        orig_sleep = swift.proxy.controllers.obj.sleep
+        try:
+            swift.proxy.controllers.obj.sleep = _stub_sleep
+            segit = SegmentedIterable(
+                self.controller, 'lc', [
+                    {'name': 'o1'}, {'name': 'o2'}, {'name': 'o3'},
+                    {'name': 'o4'}, {'name': 'o5'}])
+            segit.response = Stub()
+            self.assertEquals(''.join(segit), '122333444455555')
+            # The 4th and 5th GETs wait their turn, half a second apart
+            self.assertEquals(len(sleep_calls), 2)
+            self.assertAlmostEqual(0.5, sleep_calls[0], places=2)
+            self.assertAlmostEqual(1.0, sleep_calls[1], places=2)
+        finally:
+            swift.proxy.controllers.obj.sleep = orig_sleep
+
+    def test_prefetch_waits_for_reader(self):
+        class Resp(object):
+            app_iter = [str(i) for i in xrange(10)]
+
+        # a segment is read ahead for as long as the segments before it
+        # take to serve
+        prefetch = SegmentPrefetch(lambda: Resp(), 0, 2, 0.2)
+        prefetch.wait()
+        sleep(0.5)
+        self.assertEquals(''.join(prefetch), '0123456789')
+        self.assert_(prefetch.thread.dead)
+
+        # once it is being read, a reader that stalls is given up on, and
+        # gets an error instead of waiting for chunks that will not come
+        prefetch = SegmentPrefetch(lambda: Resp(), 0, 2, 0.2)
+        prefetch.wait()
+        chunks = iter(prefetch)
+        self.assertEquals(chunks.next(), '0')
+        sleep(0.5)
+        self.assertEquals(chunks.next(), '1')
+        self.assertEquals(chunks.next(), '2')
+        self.assertRaises(ChunkReadTimeout, chunks.next)
+        self.assert_(prefetch.thread.dead)
+
+        # and so does one whose segment stops arriving
+        class SlowResp(object):
+            @property
+            def app_iter(self):
+                yield '0'
+                sleep(0.5)
+                yield '1'
+
+        prefetch = SegmentPrefetch(lambda: SlowResp(), 0, 2, 0.2)
+        prefetch.wait()
+        chunks = iter(prefetch)
+        self.assertEquals(chunks.next(), '0')
+        self.assertRaises(ChunkReadTimeout, chunks.next)
+        prefetch.close()
+
+    def test_close_stops_prefetch(self):
+        self._prefetching(2)
+        segit = SegmentedIterable(self.controller, 'lc', [
+            {'name': 'o1'}, {'name': 'o2'}, {'name': 'o3'}])
+        segit.response = Stub()
+        self.assertEquals(segit.next(), '1')
+        prefetches = [segit.prefetch_current] + \
+            [p for _junk, p in segit.prefetch_window]
+        self.assertEquals(len(prefetches), 3)
+        segit.close()
+        self.assertFalse(segit.prefetch_window)
+        for prefetch in prefetches:
+            self.assert_(prefetch.thread.dead)
+
 
 if __name__ == '__main__':
     setup()